@@ -0,0 +1,182 @@
+'''
+Per-call latency benchmarks for the single point calculations (named so that
+py.test will *not* pick them up).
+
+Run with:
+
+    $ python benchmarks.py {revision}
+
+Each line reports the mean time of one call in microseconds. The matrix
+operations are timed using both numpy matrices and the pure float
+diffcalc.mat3 kernel that the engines now use. The You engine hklToAngles and
+anglesToHkl are timed for this tree and, from a git checkout, for the
+numpy.matrix implementation at revision (by default the one before
+diffcalc.mat3 was added), which is exported to a temporary directory and
+timed in a separate process.
+'''
+
+from math import pi
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from diffcalc import settings
+from diffcalc.hardware import DummyHardwareAdapter
+from diffcalc.settings import NUNAME
+from diffcalc.util import x_rotation, y_rotation, z_rotation, \
+    angle_between_vectors
+
+try:
+    from numpy import matrix
+    from numpy.linalg import norm
+except ImportError:
+    from numjy import matrix
+    from numjy.linalg import norm
+
+TORAD = pi / 180
+
+
+def _time(f, number=2000):
+    return timeit.timeit(f, number=number) / number * 1e6
+
+
+def _report(name, f, number=2000):
+    print '%-45s %9.1f us' % (name, _time(f, number))
+
+
+def benchmark_kernel():
+    from diffcalc import mat3
+    a, b = matrix('1; 2; 3'), matrix('-1; .5; 2')
+    u, v = mat3.from_matrix(a), mat3.from_matrix(b)
+    R = z_rotation(.3) * y_rotation(.2) * x_rotation(.1)
+    S = mat3.from_matrix(R)
+    print 'Kernel operations (numpy.matrix / mat3)'
+    _report('  rotation matrix: numpy.matrix', lambda: z_rotation(.3))
+    _report('  rotation matrix: mat3', lambda: mat3.z_rotation(.3))
+    _report('  3x3 product: numpy.matrix', lambda: R * R)
+    _report('  3x3 product: mat3', lambda: mat3.mul(S, S))
+    _report('  inverse rotation of vector: numpy.matrix', lambda: R.I * a)
+    _report('  inverse rotation of vector: mat3', lambda: mat3.tmul_vec(S, u))
+    _report('  cross product: numpy.matrix',
+            lambda: matrix([[a[1, 0] * b[2, 0] - a[2, 0] * b[1, 0]],
+                            [a[2, 0] * b[0, 0] - a[0, 0] * b[2, 0]],
+                            [a[0, 0] * b[1, 0] - a[1, 0] * b[0, 0]]]))
+    _report('  cross product: mat3', lambda: mat3.cross(u, v))
+    _report('  angle between vectors: numpy.matrix',
+            lambda: (a * (1 / norm(a))).T * (b * (1 / norm(b))))
+    _report('  angle between vectors: mat3',
+            lambda: angle_between_vectors(u, v))
+
+
+def _you_calculator():
+    from diffcalc.hkl.you.calc import YouHklCalculator, YouUbCalcStrategy
+    from diffcalc.hkl.you.constraints import YouConstraintManager
+    from diffcalc.hkl.you.geometry import SixCircle
+    from diffcalc.ub.calc import UBCalculation
+    from diffcalc.ub.persistence import UbCalculationNonPersister
+
+    settings.geometry = SixCircle()
+    settings.hardware = DummyHardwareAdapter(
+        ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+    ubcalc = UBCalculation(UbCalculationNonPersister(), YouUbCalcStrategy())
+    ubcalc.start_new('benchmark')
+    ubcalc.set_lattice('xtal', 3.8, 4.1, 5.7, 90, 95, 120)
+    ubcalc.set_U_manually(z_rotation(12 * TORAD) * y_rotation(5 * TORAD))
+    calc = YouHklCalculator(ubcalc, YouConstraintManager())
+    if hasattr(calc, 'solution_cache'):
+        calc.solution_cache.resize(0)  # time the calculation, not the cache
+    return calc
+
+
+YOU_CONSTRAINTS = ({'a_eq_b': None, 'mu': 0, NUNAME: 0},
+                   {'alpha': 2 * TORAD, NUNAME: 5 * TORAD, 'phi': 20 * TORAD},
+                   {'chi': 0, 'phi': 0, 'eta': 0})
+
+
+def _you_timings():
+    """Return (name, time in us) for hklToAngles and anglesToHkl in each
+    of YOU_CONSTRAINTS"""
+    calc = _you_calculator()
+    timings = []
+    for constraints in YOU_CONSTRAINTS:
+        calc.constraints._constrained = dict(constraints)
+        pos, _ = calc.hklToAngles(1, .5, 1.2, 1.2)
+        name = ', '.join(sorted(constraints))
+        timings.append(('hklToAngles (%s)' % name,
+                        _time(lambda: calc.hklToAngles(1, .5, 1.2, 1.2), 200)))
+        timings.append(('anglesToHkl (%s)' % name,
+                        _time(lambda: calc.anglesToHkl(pos, 1.2))))
+    return timings
+
+
+def _baseline_revision():
+    """Return the revision before diffcalc.mat3 was added"""
+    added = subprocess.check_output(
+        ['git', 'log', '--diff-filter=A', '--format=%h', '--',
+         'diffcalc/mat3.py']).split()
+    return added[-1] + '^'
+
+
+def _you_timings_at(revision):
+    """Return _you_timings() for the tree at a git revision"""
+    root = tempfile.mkdtemp()
+    try:
+        archive = subprocess.Popen(['git', 'archive', revision, 'diffcalc',
+                                    'simplejson'],
+                                   stdout=subprocess.PIPE)
+        subprocess.check_call(['tar', '-x', '-C', root], stdin=archive.stdout)
+        if archive.wait():
+            raise subprocess.CalledProcessError(archive.returncode,
+                                                'git archive')
+        shutil.copy(__file__, root)
+        output = subprocess.check_output(
+            [sys.executable, os.path.basename(__file__), '--you-timings'],
+            cwd=root)
+        return dict(json.loads(output.splitlines()[-1]))
+    finally:
+        shutil.rmtree(root)
+
+
+def benchmark_you(revision=None):
+    try:
+        revision = revision or _baseline_revision()
+        before = _you_timings_at(revision)
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        before = {}
+    print 'You engine (numpy.matrix at %s / now)' % (
+        revision if before else 'unavailable')
+    for name, after in _you_timings():
+        if name in before:
+            print '  %-43s %9.1f us %9.1f us' % (name, before[name], after)
+        else:
+            print '  %-43s %9s    %9.1f us' % (name, '-', after)
+
+
+def benchmark_ub_refinement():
+    """Beyond a fixed cost for the covariances, robust UB refinement should
+    scale linearly with the number of reflections"""
+    import numpy as np
+    from diffcalc.ub.refinement import refine_ub
+    rng = np.random.RandomState(0)
+    UB = np.asarray(z_rotation(12 * TORAD) * y_rotation(5 * TORAD)) * 1.6
+    print 'UB refinement (10% outliers)'
+    for count in (100, 1000, 10000):
+        hkl = rng.randint(-6, 7, (count, 3)).astype(float)
+        q = hkl.dot(UB.T) + rng.normal(0, 1e-3, (count, 3))
+        q[:count // 10] += rng.normal(0, .5, (count // 10, 3))
+        for method in ('lstsq', 'irls', 'ransac'):
+            _report('  %s, %d reflections' % (method, count),
+                    lambda: refine_ub(hkl, q, method), 5)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--you-timings']:
+        print json.dumps(_you_timings())
+        sys.exit()
+    benchmark_kernel()
+    benchmark_you(*sys.argv[1:])
+    benchmark_ub_refinement()
@@ -36,8 +36,13 @@ off = 'off'
 auto = 'auto'
 manual = 'manual'
     
-def hkl_to_angles(h, k, l, energy=None):
-    """Convert a given hkl vector to a set of diffractometer angles"""
+def hkl_to_angles(h, k, l, energy=None, reference_position=None):
+    """Convert a given hkl vector to a set of diffractometer angles
+
+    reference_position is accepted for compatibility with the You engine;
+    this engine does not choose between solutions by their distance from the
+    current position.
+    """
     if energy is None:
         energy = settings.hardware.get_energy()  # @UndefinedVariable
 
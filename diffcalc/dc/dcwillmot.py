@@ -19,8 +19,13 @@ from diffcalc.hardware import *  # @UnusedWildImport
 from diffcalc.hkl.willmot.hkl import *  # @UnusedWildImport
 from diffcalc.gdasupport.scannable.sim import sim
 
-def hkl_to_angles(h, k, l, energy=None):
-    """Convert a given hkl vector to a set of diffractometer angles"""
+def hkl_to_angles(h, k, l, energy=None, reference_position=None):
+    """Convert a given hkl vector to a set of diffractometer angles
+
+    reference_position is accepted for compatibility with the You engine;
+    this engine does not choose between solutions by their distance from the
+    current position.
+    """
     if energy is None:
         energy = settings.hardware.get_energy()  # @UndefinedVariable
 
@@ -3,6 +3,7 @@ from diffcalc.dc.common import energy_to_wavelength
 from diffcalc.dc.help import compile_extra_motion_commands_for_help
 
 import diffcalc.hkl.you.calc
+from diffcalc.hkl.you.geometry import YouPosition
 settings.ubcalc_strategy = diffcalc.hkl.you.calc.YouUbCalcStrategy()
 settings.angles_to_hkl_function = diffcalc.hkl.you.calc.youAnglesToHkl
 
@@ -27,38 +28,162 @@ class DiffractometerYouCalculator(object):
         self.geometry = diffcalcObject
 
 
-    def hkl_to_angles(self, h, k, l, energy=None):
+    def _internal_reference_position(self, reference_position):
+        if reference_position is None:
+            return None
+        return self.geometry.physical_angles_to_internal_position(
+            tuple(reference_position))  # @UndefinedVariable
+
+    def hkl_to_angles(self, h, k, l, energy=None, reference_position=None):
         """Convert a given hkl vector to a set of diffractometer angles
         
         return angle tuple and params dictionary
+
+        Where there is more than one solution the one closest to the angle
+        tuple reference_position (e.g. the previous target in a scan) is
+        chosen, or to the current position if it is not given.
         
         """
         if energy is None:
             energy = self.diffhw.get_energy()  # @UndefinedVariable
     
-        (pos, params) = hklcalc.hklToAngles(h, k, l, energy_to_wavelength(energy))
+        (pos, params) = hklcalc.hklToAngles(
+            h, k, l, energy_to_wavelength(energy),
+            reference_position=self._internal_reference_position(reference_position))
         angle_tuple = self.geometry.internal_position_to_physical_angles(pos)  # @UndefinedVariable
         angle_tuple = self.diffhw.cut_angles(angle_tuple)  # @UndefinedVariable
     
         return angle_tuple, params
     
     
-    def hkl_list_to_angles(self, hkl_list, energy=None):
+    def hkl_list_to_angles(self, hkl_list, energy=None, reference_position=None,
+                           processes=None):
         """Convert a given hkl vector to a set of diffractometer angles
         
         return angle tuple and params dictionary
+
+        Long lists are solved by processes worker processes (see
+        hklprocesses).
         
         """
         if energy is None:
             energy = self.diffhw.get_energy()  # @UndefinedVariable
     
-        (pos, params) = hklcalc.hklListToAngles(hkl_list, energy_to_wavelength(energy))
+        (pos, params) = hklcalc.hklListToAngles(
+            hkl_list, energy_to_wavelength(energy),
+            reference_position=self._internal_reference_position(reference_position),
+            processes=processes)
         angle_tuple = self.geometry.internal_position_to_physical_angles(pos)  # @UndefinedVariable
         angle_tuple = self.diffhw.cut_angles(angle_tuple)  # @UndefinedVariable
     
         return angle_tuple, params
     
     
+    def iter_hkl_list_to_angles(self, hkl_list, energy=None,
+                                return_all_solutions=False, chunk_size=None,
+                                processes=None):
+        """Generate the diffractometer angles for each hkl vector in turn
+
+        yields (hkl, solutions) as each hkl is solved, where solutions is a
+        list of (angle tuple, params dictionary) pairs, empty if the hkl
+        cannot be reached, or lists of up to chunk_size of these if given.
+        Only solutions within the limits are included unless
+        return_all_solutions is True. Stop iterating to stop solving.
+
+        Long lists are solved by processes worker processes (see
+        hklprocesses), in which case the whole list is read at the start.
+
+        """
+        if energy is None:
+            energy = self.diffhw.get_energy()  # @UndefinedVariable
+        solutions = hklcalc.iterHklListToAngles(
+            hkl_list, energy_to_wavelength(energy), return_all_solutions,
+            chunk_size, processes)
+        if chunk_size is None:
+            return (self._physical_solutions(item) for item in solutions)
+        return ([self._physical_solutions(item) for item in chunk]
+                for chunk in solutions)
+
+    def _physical_solutions(self, item):
+        hkl, pos_params_pairs = item
+        angle_tuples_and_params = []
+        for pos, params in pos_params_pairs:
+            angle_tuple = self.geometry.internal_position_to_physical_angles(pos)  # @UndefinedVariable
+            angle_tuple = self.diffhw.cut_angles(angle_tuple)  # @UndefinedVariable
+            angle_tuples_and_params.append((angle_tuple, params))
+        return hkl, angle_tuples_and_params
+
+
+    def hkl_path_to_angles(self, hkl_path, energy=None, max_step=10.):
+        """Convert an ordered path of hkl vectors to a continuous trajectory
+        starting from the current diffractometer position
+
+        return list of angle tuples, list of params dictionaries and list of
+        unavoidable branch flips
+
+        """
+        if energy is None:
+            energy = self.diffhw.get_energy()  # @UndefinedVariable
+        start = self.geometry.physical_angles_to_internal_position(
+            self.diffhw.get_position())  # @UndefinedVariable
+        (positions, params, flips) = hklcalc.hklPathToAngles(
+            hkl_path, energy_to_wavelength(energy), start, max_step)
+        angle_tuples = [self.geometry.internal_position_to_physical_angles(pos)  # @UndefinedVariable
+                        for pos in positions]
+        return angle_tuples, params, flips
+
+
+    def hkl_path_to_pvt(self, hkl_path, energy=None, total_time=None,
+                        hkl_speed=None, max_velocity=None,
+                        max_acceleration=None, max_step=10.):
+        """Plan a continuous scan through an ordered path of hkl vectors
+        starting from the current diffractometer position
+
+        return a PVTTrajectory with times, positions and velocities for every
+        axis
+
+        """
+        if energy is None:
+            energy = self.diffhw.get_energy()  # @UndefinedVariable
+        start = self.geometry.physical_angles_to_internal_position(
+            self.diffhw.get_position())  # @UndefinedVariable
+        return hklcalc.hklPathToPVT(
+            hkl_path, energy_to_wavelength(energy), total_time, hkl_speed,
+            max_velocity, max_acceleration, start, max_step)
+
+
+    def reachable_reflections(self, energy=None):
+        """List every integer hkl reachable within the limits with the
+        current constraints, ordered by two theta
+
+        return an (N, 3) array of hkl, a list of angle tuples closest to the
+        current position and an array of two theta values
+
+        """
+        if energy is None:
+            energy = self.diffhw.get_energy()  # @UndefinedVariable
+        current = self.geometry.physical_angles_to_internal_position(
+            self.diffhw.get_position())  # @UndefinedVariable
+        hkl, positions, ttheta = hklcalc.reachableReflections(
+            energy_to_wavelength(energy), current.totuple())
+        angle_tuples = [self.geometry.internal_position_to_physical_angles(  # @UndefinedVariable
+                            YouPosition(*pos, unit='DEG')) for pos in positions]
+        return hkl, angle_tuples, ttheta
+
+
+    def accessible_volume(self, energy=None, step=.1, samples=1000000):
+        """Map the hkl that can be reached anywhere within the limits
+
+        return an AccessibleVolume with a voxel occupancy array, projections
+        and constant time lookups of hkl and hkl boxes
+
+        """
+        if energy is None:
+            energy = self.diffhw.get_energy()  # @UndefinedVariable
+        return hklcalc.accessibleVolume(energy_to_wavelength(energy), step,
+                                        samples)
+
+
     def angles_to_hkl(self, angleTuple, energy=None):
         """Converts a set of diffractometer angles to an hkl position
         
@@ -71,18 +196,87 @@ class DiffractometerYouCalculator(object):
         return hklcalc.anglesToHkl(i_pos, energy_to_wavelength(energy))
 
 
-def hkl_to_angles(h, k, l, energy=None):
+    def angles_array_to_hkl(self, angles, energy=None):
+        """Converts an array of diffractometer angles to hkl positions
+
+        angles holds one row of physical angles per point and energy is a
+        single energy or an array with one energy per point.
+
+        Return an (N, 3) array of hkl values
+
+        """
+        from numpy import asarray
+        from diffcalc.hkl.you.batch import physical_angles_to_internal_positions
+        if energy is None:
+            energy = self.diffhw.get_energy()  # @UndefinedVariable
+        energy = asarray(energy, dtype=float)
+        positions = physical_angles_to_internal_positions(self.geometry, angles)
+        return hklcalc.anglesArrayToHkl(positions, energy_to_wavelength(energy))
+
+
+    def angles_array_to_virtual_angles(self, angles, energy=None):
+        """Converts an array of diffractometer angles to virtual angles
+
+        Return a structured array with one field per virtual angle
+
+        """
+        from numpy import asarray
+        from diffcalc.hkl.you.batch import physical_angles_to_internal_positions
+        if energy is None:
+            energy = self.diffhw.get_energy()  # @UndefinedVariable
+        energy = asarray(energy, dtype=float)
+        positions = physical_angles_to_internal_positions(self.geometry, angles)
+        return hklcalc.anglesArrayToVirtualAngles(positions,
+                                                  energy_to_wavelength(energy))
+
+
+def hkl_to_angles(h, k, l, energy=None, reference_position=None):
+    _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
+    return _dcyou.hkl_to_angles(h, k, l, energy, reference_position)
+
+def hkl_list_to_angles(hkl, energy=None, reference_position=None,
+                       processes=None):
+    _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
+    return _dcyou.hkl_list_to_angles(hkl, energy, reference_position,
+                                     processes)
+
+def iter_hkl_list_to_angles(hkl_list, energy=None, return_all_solutions=False,
+                            chunk_size=None, processes=None):
+    _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
+    return _dcyou.iter_hkl_list_to_angles(hkl_list, energy,
+                                          return_all_solutions, chunk_size,
+                                          processes)
+
+def hkl_path_to_angles(hkl_path, energy=None, max_step=10.):
     _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
-    return _dcyou.hkl_to_angles(h, k, l, energy)
+    return _dcyou.hkl_path_to_angles(hkl_path, energy, max_step)
 
-def hkl_list_to_angles(hkl, energy=None):
+def hkl_path_to_pvt(hkl_path, energy=None, total_time=None, hkl_speed=None,
+                    max_velocity=None, max_acceleration=None, max_step=10.):
     _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
-    return _dcyou.hkl_list_to_angles(hkl, energy)
+    return _dcyou.hkl_path_to_pvt(hkl_path, energy, total_time, hkl_speed,
+                                  max_velocity, max_acceleration, max_step)
+
+def reachable_reflections(energy=None):
+    _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
+    return _dcyou.reachable_reflections(energy)
+
+def accessible_volume(energy=None, step=.1, samples=1000000):
+    _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
+    return _dcyou.accessible_volume(energy, step, samples)
 
 def angles_to_hkl(angleTuple, energy=None):
     _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
     return _dcyou.angles_to_hkl(angleTuple, energy)
 
+def angles_array_to_hkl(angles, energy=None):
+    _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
+    return _dcyou.angles_array_to_hkl(angles, energy)
+
+def angles_array_to_virtual_angles(angles, energy=None):
+    _dcyou = DiffractometerYouCalculator(settings.hardware, settings.geometry)
+    return _dcyou.angles_array_to_virtual_angles(angles, energy)
+
 
 
 ub_commands_for_help = _ub.commands_for_help
@@ -56,6 +56,9 @@ class Hkl(ScannableMotionWithScannableFieldsBase):
         if type(virtualAnglesToReport) is str:
             virtualAnglesToReport = (virtualAnglesToReport,)
         self.vAngleNames = virtualAnglesToReport
+        # the previous target within a scan, used to choose between solutions
+        self._in_scan = False
+        self._last_target = None
 
         self.setName(name)
         self.setInputNames(['h', 'k', 'l'])
@@ -71,14 +74,35 @@ class Hkl(ScannableMotionWithScannableFieldsBase):
     def rawAsynchronousMoveTo(self, hkl):
         if len(hkl) != 3: raise ValueError('Hkl device expects three inputs')
         try:
-            (pos, _) = self._diffcalc.hkl_to_angles(hkl[0], hkl[1], hkl[2])
+            if self._last_target is None:
+                (pos, _) = self._diffcalc.hkl_to_angles(hkl[0], hkl[1], hkl[2])
+            else:
+                (pos, _) = self._diffcalc.hkl_to_angles(
+                    hkl[0], hkl[1], hkl[2], reference_position=self._last_target)
         except DiffcalcException, e:
             if DEBUG:
                 raise
             else:
                 raise DiffcalcException(e.message)
+        if self._in_scan:
+            self._last_target = pos
         self.diffhw.asynchronousMoveTo(pos)
 
+    def atScanStart(self):
+        ScannableMotionWithScannableFieldsBase.atScanStart(self)
+        self._in_scan = True
+        self._last_target = None
+
+    def atScanEnd(self):
+        ScannableMotionWithScannableFieldsBase.atScanEnd(self)
+        self._in_scan = False
+        self._last_target = None
+
+    def atCommandFailure(self):
+        ScannableMotionWithScannableFieldsBase.atCommandFailure(self)
+        self._in_scan = False
+        self._last_target = None
+
     def rawGetPosition(self):
         pos = self.diffhw.getPosition()  # a tuple
         (hkl , params) = self._diffcalc.angles_to_hkl(pos)
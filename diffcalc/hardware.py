@@ -18,7 +18,7 @@
 
 from __future__ import absolute_import
 
-from diffcalc.util import DiffcalcException
+from diffcalc.util import DiffcalcException, ChangeNotifier
 from diffcalc import settings
 
 SMALL = 1e-8
@@ -96,6 +96,7 @@ class HardwareAdapter(object):
                  energyScannableMultiplierToGetKeV=1):
 
         self._diffractometerAngleNames = diffractometerAngleNames
+        self.notifier = ChangeNotifier()  # bumped when limits or cuts change
         self._cut_angles = {}
         self._configure_cuts(defaultCuts)
         self.energyScannableMultiplierToGetKeV = \
@@ -162,6 +163,15 @@ class HardwareAdapter(object):
         """value may be None to remove limit"""
         raise NotImplementedError()
 
+    def limits_key(self):
+        """Return a value that changes with limits set outside diffcalc.
+
+        Limits and cuts set through this adapter bump notifier. Adapters whose
+        limits may also be changed elsewhere return a snapshot of them, and
+        others None.
+        """
+        return None
+
     def is_axis_value_within_limits(self, axis_name, value):
         raise NotImplementedError()
 
@@ -219,6 +229,7 @@ class HardwareAdapter(object):
     def set_cut(self, name, value):
         if name in self._cut_angles:
             self._cut_angles[name] = value
+            self.notifier.notify()
         else:
             raise KeyError("Diffractometer has no angle %s. Try: %s." %
                             (name, self._diffractometerAngleNames))
@@ -339,6 +350,7 @@ class DummyHardwareAdapter(HardwareAdapter):
                        "clear" % name)
         else:
             self._lowerLimitDict[name] = value
+        self.notifier.notify()
 
     def set_upper_limit(self, name, value):
         """value may be None to remove limit"""
@@ -354,6 +366,7 @@ class DummyHardwareAdapter(HardwareAdapter):
                        "clear" % name)
         else:
             self._upperLimitDict[name] = value
+        self.notifier.notify()
 
     def is_axis_value_within_limits(self, axis_name, value):
         if axis_name in self._upperLimitDict:
@@ -459,6 +472,7 @@ class ScannableHardwareAdapter(HardwareAdapter):
         except AttributeError:
             raise DiffcalcException('This command is only implemented in dummy mode.\n'
                                     'Please use GDA/EPICS interface to set hardware limits.')
+        self.notifier.notify()
 
     def set_upper_limit(self, name, value):
         scn = self.diffhw.getGroupMember(name)
@@ -467,6 +481,19 @@ class ScannableHardwareAdapter(HardwareAdapter):
         except AttributeError:
             raise DiffcalcException('This command is only implemented in dummy mode.\n'
                                     'Please use GDA/EPICS interface to set hardware limits.')
+        self.notifier.notify()
+
+    def limits_key(self):
+        """Return the lower and upper limits of every axis, as they may be
+        changed on the scannables outside diffcalc"""
+        limits = []
+        for name in self.get_axes_names():
+            try:
+                limits.append((self.get_lower_limit(name),
+                               self.get_upper_limit(name)))
+            except DiffcalcException:
+                limits.append(None)
+        return tuple(limits)
 
     def is_position_within_limits(self, positionArray):
         """
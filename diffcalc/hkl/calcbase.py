@@ -20,6 +20,7 @@ from math import pi
 
 from diffcalc.util import DiffcalcException, differ
 from diffcalc import settings
+from diffcalc.hkl.profiling import profiler
 
 TORAD = pi / 180
 TODEG = 180 / pi
@@ -70,12 +71,17 @@ class HklCalculatorBase(object):
         raiseExceptionsIfAnglesDoNotMapBackToHkl is True, otherwise displays a
         warning.
         """
+        with profiler.stage('hklToAngles'):
+            return self._verified_hkl_to_angles(h, k, l, wavelength)
+
+    def _verified_hkl_to_angles(self, h, k, l, wavelength):
 
         # Update tracked parameters. During this calculation parameter values
         # will be read directly from self._parameters instead of via
         # self.getParameter which would trigger another potentially time-costly
         # position update.
-        self.parameter_manager.update_tracked()
+        with profiler.stage('update tracked parameters'):
+            self.parameter_manager.update_tracked()
 
         pos, virtualAngles = self._hklToAngles(h, k, l, wavelength)  # in rad
 
@@ -88,12 +94,21 @@ class HklCalculatorBase(object):
 
         self._verify_pos_map_to_hkl(h, k, l, wavelength, pos)
 
-        virtualAnglesReadback = self._verify_virtual_angles(h, k, l, wavelength, pos, virtualAngles)
+        with profiler.stage('verify virtual angles'):
+            virtualAnglesReadback = self._verify_virtual_angles(h, k, l, wavelength, pos, virtualAngles)
 
         return pos, virtualAnglesReadback
 
     def _verify_pos_map_to_hkl(self, h, k, l, wavelength, pos):
-        hkl, _ = self.anglesToHkl(pos, wavelength)
+        with profiler.stage('verify hkl'):
+            hkl, _ = self.anglesToHkl(pos, wavelength)
+        self._check_hkl_matches(h, k, l, hkl, pos)
+
+    def _check_hkl_matches(self, h, k, l, hkl, pos):
+        """Raise or warn if hkl, calculated from pos, differs from h, k, l.
+
+        Return True if it matches.
+        """
         e = 0.001
         if ((abs(hkl[0] - h) > e) or (abs(hkl[1] - k) > e) or 
             (abs(hkl[2] - l) > e)):
@@ -104,6 +119,8 @@ class HklCalculatorBase(object):
                 raise DiffcalcException(s)
             else:
                 print s
+            return False
+        return True
 
     def _verify_virtual_angles(self, h, k, l, wavelength, pos, virtualAngles):
         # Check that the virtual angles calculated/fixed during the hklToAngles
@@ -134,6 +151,14 @@ class HklCalculatorBase(object):
     def _getUBMatrix(self):
         return self._ubcalc.UB
 
+    def _getUBMatrixInverse(self):
+        # UBCalculation keeps the inverse until UB changes; other ubcalc
+        # objects may only provide UB
+        UB_inv = getattr(self._ubcalc, 'UB_inv', None)
+        if UB_inv is None:
+            return self._getUBMatrix().I
+        return UB_inv
+
     def _getMode(self):
         return self.mode_selector.getMode()
 
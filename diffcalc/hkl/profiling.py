@@ -0,0 +1,154 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Opt-in timing of the stages of the hkl to angles calculations.
+
+The hkl calculators wrap each stage of a calculation in profiler.stage(name).
+While the profiler is disabled (the default) this returns a shared do-nothing
+context manager, so the instrumentation costs next to nothing. Stages that
+discard candidate solutions also report how many they rejected.
+"""
+
+from collections import OrderedDict
+from timeit import default_timer as _timer
+import json
+
+from diffcalc.util import command
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._start = _timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profiler.record(self._name, _timer() - self._start)
+        return False
+
+
+class StageProfiler(object):
+    """Accumulates call counts, times and rejected candidate counts for named
+    calculation stages.
+
+    Stages are reported in the order they were first recorded. Times are in
+    seconds.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._stages = OrderedDict()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def _totals(self, name):
+        try:
+            return self._stages[name]
+        except KeyError:
+            totals = self._stages[name] = [0, 0., 0]
+            return totals
+
+    def record(self, name, seconds):
+        totals = self._totals(name)
+        totals[0] += 1
+        totals[1] += seconds
+
+    def reject(self, name, count=1):
+        """Count candidate solutions discarded by the stage name"""
+        if self.enabled:
+            self._totals(name)[2] += count
+
+    def reset(self):
+        self._stages.clear()
+
+    def as_dict(self):
+        """Return {stage: {'calls': n, 'total': s, 'mean': s / n,
+                           'rejected': r}}"""
+        result = OrderedDict()
+        for name, (calls, total, rejected) in self._stages.items():
+            result[name] = OrderedDict((
+                ('calls', calls), ('total', total),
+                ('mean', total / calls if calls else 0.),
+                ('rejected', rejected)))
+        return result
+
+    def to_json(self, indent=2):
+        return json.dumps(self.as_dict(), indent=indent)
+
+    def __str__(self):
+        if not self._stages:
+            return ('No stages recorded (profiling is %s)' %
+                    ('on' if self.enabled else 'off'))
+        width = max(len(name) for name in self._stages)
+        lines = ['%s  %8s  %10s  %10s  %8s' % (
+            'stage'.ljust(width), 'calls', 'total/ms', 'mean/us', 'rejected')]
+        for name, (calls, total, rejected) in self._stages.items():
+            lines.append('%s  %8d  %10.3f  %10.1f  %8d' % (
+                name.ljust(width), calls, total * 1e3,
+                total / calls * 1e6 if calls else 0., rejected))
+        return '\n'.join(lines)
+
+
+profiler = StageProfiler()
+
+
+@command
+def dcprofile(action=None, filename=None):
+    """dcprofile {'on'|'off'|'reset'} -- show or control hkl calculation profiling
+    dcprofile 'dump' {filename} -- print or save the profile as JSON
+
+    While on, the time spent in each stage of the hkl to angles calculations
+    and the number of candidate solutions each stage rejected are recorded.
+    Profiling is off by default.
+    """
+    if action is None:
+        pass
+    elif action == 'on':
+        profiler.enabled = True
+    elif action == 'off':
+        profiler.enabled = False
+    elif action == 'reset':
+        profiler.reset()
+    elif action == 'dump':
+        if filename is None:
+            print profiler.to_json()
+        else:
+            with open(filename, 'w') as f:
+                f.write(profiler.to_json())
+        return
+    else:
+        raise TypeError("Expected 'on', 'off', 'reset' or 'dump'")
+    print 'hkl profiling is %s' % ('on' if profiler.enabled else 'off')
+    print profiler
@@ -27,11 +27,13 @@ except ImportError:
     from numjy.linalg import norm
 
 from diffcalc.hkl.calcbase import HklCalculatorBase
+from diffcalc.hkl.profiling import profiler
 from diffcalc.hkl.vlieg.transform import TransformCInRadians
 from diffcalc.util import dot3, cross3, bound, differ
 from diffcalc.hkl.vlieg.geometry import createVliegMatrices, \
     createVliegsPsiTransformationMatrix, \
-    createVliegsSurfaceTransformationMatrices, calcPHI
+    createVliegsSurfaceTransformationMatrices, calcPHI, createVliegRotations
+from diffcalc import mat3
 from diffcalc.hkl.vlieg.geometry import VliegPosition
 from diffcalc.hkl.vlieg.constraints import VliegParameterManager
 from diffcalc.hkl.vlieg.constraints import ModeSelector
@@ -75,24 +77,33 @@ def sign(x):
         return 1
 
 
-def vliegAnglesToHkl(pos, wavelength, UBMatrix):
+def vliegAnglesToHkl(pos, wavelength, UBMatrix, UBinv=None):
     """
-    Returns hkl indices from pos object in radians.
+    Returns hkl indices from pos object in radians. UBinv may be given to
+    avoid inverting UBMatrix on every call.
     """
+    if UBinv is None:
+        UBinv = UBMatrix.I
     wavevector = 2 * pi / wavelength
 
     # Create transformation matrices
-    [ALPHA, DELTA, GAMMA, OMEGA, CHI, PHI] = createVliegMatrices(
+    [ALPHA, DELTA, GAMMA, OMEGA, CHI, PHI] = createVliegRotations(
         pos.alpha, pos.delta, pos.gamma, pos.omega, pos.chi, pos.phi)
 
     # Create the plane normal vector in the alpha axis coordinate frame
-    qa = ((DELTA * GAMMA) - ALPHA.I) * matrix([[0], [wavevector], [0]])
+    k = (0, wavevector, 0)
+    kout = mat3.mul_vec(mat3.mul(DELTA, GAMMA), k)
+    kin = mat3.tmul_vec(ALPHA, k)
+    qa = (kout[0] - kin[0], kout[1] - kin[1], kout[2] - kin[2])
 
     # Transform the plane normal vector from the alpha frame to reciprical
-    # lattice frame.
-    hkl = UBMatrix.I * PHI.I * CHI.I * OMEGA.I * qa
+    # lattice frame. The rotations are orthogonal so are inverted by
+    # transposition.
+    q_phi = qa
+    for R in (OMEGA, CHI, PHI):
+        q_phi = mat3.tmul_vec(R, q_phi)
 
-    return hkl[0, 0], hkl[1, 0], hkl[2, 0]
+    return mat3.mul_vec(mat3.from_matrix(UBinv), q_phi)
 
 
 class VliegUbCalcStrategy(PaperSpecificUbCalcStrategy):
@@ -138,7 +149,8 @@ class VliegHklCalculator(HklCalculatorBase):
         Return hkl tuple from VliegPosition in radians and wavelength in
         Angstroms.
         """
-        return vliegAnglesToHkl(pos, wavelength, self._getUBMatrix())
+        return vliegAnglesToHkl(pos, wavelength, self._getUBMatrix(),
+                                self._getUBMatrixInverse())
 
     def _anglesToVirtualAngles(self, pos, wavelength):
         """
@@ -214,32 +226,36 @@ class VliegHklCalculator(HklCalculatorBase):
         hklPhiNorm = self._getUBMatrix() * hklNorm
 
         # Determine Bin and Bout
-        if self._getMode().name == '4cPhi':
-            Bin = Bout = None
-        else:
-            Bin, Bout = self._determineBinAndBoutInFourAndFiveCirclesModes(
-                                                                    hklNorm)
+        with profiler.stage('Bin and Bout'):
+            if self._getMode().name == '4cPhi':
+                Bin = Bout = None
+            else:
+                Bin, Bout = self._determineBinAndBoutInFourAndFiveCirclesModes(
+                                                                        hklNorm)
 
         # Determine alpha and gamma
-        if self._getMode().group == 'fourc':
-            pos.alpha, pos.gamma = \
-                self._determineAlphaAndGammaForFourCircleModes(hklPhiNorm)
-        else:
-            pos.alpha, pos.gamma = \
-                self._determineAlphaAndGammaForFiveCircleModes(Bin, hklPhiNorm)
+        with profiler.stage('alpha and gamma'):
+            if self._getMode().group == 'fourc':
+                pos.alpha, pos.gamma = \
+                    self._determineAlphaAndGammaForFourCircleModes(hklPhiNorm)
+            else:
+                pos.alpha, pos.gamma = \
+                    self._determineAlphaAndGammaForFiveCircleModes(Bin, hklPhiNorm)
         if pos.alpha < -pi:
             pos.alpha += 2 * pi
         if pos.alpha > pi:
             pos.alpha -= 2 * pi
 
         # Determine delta
-        (pos.delta, twotheta) = self._determineDelta(hklPhiNorm, pos.alpha,
-                                                     pos.gamma)
+        with profiler.stage('delta'):
+            (pos.delta, twotheta) = self._determineDelta(hklPhiNorm, pos.alpha,
+                                                         pos.gamma)
 
         # Determine omega, chi & phi
-        pos.omega, pos.chi, pos.phi, psi = \
-            self._determineSampleAnglesInFourAndFiveCircleModes(
-                hklPhiNorm, pos.alpha, pos.delta, pos.gamma, Bin)
+        with profiler.stage('sample angles'):
+            pos.omega, pos.chi, pos.phi, psi = \
+                self._determineSampleAnglesInFourAndFiveCircleModes(
+                    hklPhiNorm, pos.alpha, pos.delta, pos.gamma, Bin)
         # (psi will be None in fixed phi mode)
 
         # Ensure that by default omega is between -90 and 90, by possibly
@@ -291,16 +307,18 @@ class VliegHklCalculator(HklCalculatorBase):
         Hw = CHI * PHI * hklPhi
 
         # Determine Bin and Bout:
-        (Bin, Bout) = self._determineBinAndBoutInZaxisModes(
-            Hw[2, 0] / wavevector)
+        with profiler.stage('Bin and Bout'):
+            (Bin, Bout) = self._determineBinAndBoutInZaxisModes(
+                Hw[2, 0] / wavevector)
 
         # Determine Alpha and Gamma (Equation 32):
         pos.alpha = Bin
         pos.gamma = Bout
 
         # Determine Delta:
-        (pos.delta, twotheta) = self._determineDelta(hklPhiNorm, pos.alpha,
-                                                     pos.gamma)
+        with profiler.stage('delta'):
+            (pos.delta, twotheta) = self._determineDelta(hklPhiNorm, pos.alpha,
+                                                         pos.gamma)
 
         # Determine Omega:
         delta = pos.delta
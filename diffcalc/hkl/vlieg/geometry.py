@@ -24,6 +24,7 @@ except ImportError:
     from numjy import matrix
 
 from diffcalc.util import x_rotation, z_rotation, y_rotation
+from diffcalc import mat3
 from diffcalc.util import AbstractPosition
 from diffcalc.util import bound, nearlyEqual
 
@@ -68,6 +69,14 @@ def createVliegMatrices(alpha=None, delta=None, gamma=None, omega=None,
     return ALPHA, DELTA, GAMMA, OMEGA, CHI, PHI
 
 
+def createVliegRotations(alpha, delta, gamma, omega, chi, phi):
+    """Create the matrices of createVliegMatrices() as diffcalc.mat3 tuples
+    """
+    return (mat3.x_rotation(alpha), mat3.z_rotation(-delta),
+            mat3.x_rotation(gamma), mat3.z_rotation(-omega),
+            mat3.y_rotation(chi), mat3.z_rotation(-phi))
+
+
 def createVliegsSurfaceTransformationMatrices(sigma, tau):
     """[SIGMA, TAU] = createVliegsSurfaceTransformationMatrices(sigma, tau)
     angles in radians
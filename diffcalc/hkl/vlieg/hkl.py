@@ -17,6 +17,7 @@
 ###
 
 from diffcalc.hkl.common import getNameFromScannableOrString
+from diffcalc.hkl.profiling import dcprofile
 from diffcalc.util import command
 from diffcalc import settings
 
@@ -26,7 +27,7 @@ from diffcalc.hkl.vlieg.calc import VliegHklCalculator
 
 
 __all__ = ['hklmode', 'setpar', 'trackalpha', 'trackgamma', 'trackphi',
-           'parameter_manager', 'hklcalc']
+           'dcprofile', 'parameter_manager', 'hklcalc']
 
 
 hklcalc = VliegHklCalculator(ub.ubcalc)
@@ -136,4 +137,6 @@ commands_for_help = ['Mode',
                      setpar,
                      trackalpha,
                      trackgamma,
-                     trackphi]
+                     trackphi,
+                     'Profiling',
+                     dcprofile]
@@ -29,7 +29,9 @@ from diffcalc.util import bound, AbstractPosition, DiffcalcException,\
 from diffcalc.hkl.vlieg.geometry import VliegGeometry
 from diffcalc.ub.calc import PaperSpecificUbCalcStrategy
 from diffcalc.hkl.calcbase import HklCalculatorBase
+from diffcalc.hkl.profiling import profiler
 from diffcalc.hkl.common import DummyParameterManager
+from diffcalc import mat3
 
 logger = logging.getLogger("diffcalc.hkl.willmot.calcwill")
 
@@ -73,12 +75,20 @@ def angles_to_hkl_phi(delta, gamma, omegah, phi):
     return H_phi
 
 
-def angles_to_hkl(delta, gamma, omegah, phi, wavelength, UB):
+def angles_to_hkl(delta, gamma, omegah, phi, wavelength, UB, UBinv=None):
     """Calculate hkl matrix in reprical lattice space in units of 1/Angstrom
     """
-    H_phi = angles_to_hkl_phi(delta, gamma, omegah, phi) * 2 * pi / wavelength
-    hkl = UB.I * H_phi                                                    # (5)
-    return hkl
+    if UBinv is None:
+        UBinv = UB.I
+    y = (0, 1, 0)
+    H_lab = mat3.mul_vec(mat3.mul(mat3.z_rotation(gamma),
+                                  mat3.x_rotation(delta)), y)           # (43)
+    H_lab = (H_lab[0], H_lab[1] - 1, H_lab[2])
+    H_phi = mat3.tmul_vec(mat3.z_rotation(phi),
+                          mat3.tmul_vec(mat3.x_rotation(omegah), H_lab))  # (44)
+    H_phi = mat3.scale(H_phi, 2 * pi / wavelength)
+    hkl = mat3.mul_vec(mat3.from_matrix(UBinv), H_phi)                  # (5)
+    return mat3.to_column(hkl)
 
 
 class WillmottHorizontalPosition(AbstractPosition):
@@ -196,7 +206,7 @@ class WillmottHorizontalCalculator(HklCalculatorBase):
         Calculate miller indices from position in radians.
         """
         hkl_matrix = angles_to_hkl(pos.delta, pos.gamma, pos.omegah, pos.phi,
-                             wavelength, self._UB)
+                             wavelength, self._UB, self._getUBMatrixInverse())
         return hkl_matrix[0, 0], hkl_matrix[1, 0], hkl_matrix[2, 0],
 
     def _anglesToVirtualAngles(self, pos, wavelength):
@@ -209,7 +219,7 @@ class WillmottHorizontalCalculator(HklCalculatorBase):
         betain = pos.omegah                                              # (52)
 
         hkl = angles_to_hkl(pos.delta, pos.gamma, pos.omegah, pos.phi,
-                              wavelength, self._UB)
+                              wavelength, self._UB, self._getUBMatrixInverse())
         H_phi = self._UB * hkl
         H_phi = H_phi / (2 * pi / wavelength)
         l_phi = H_phi[2, 0]
@@ -233,59 +243,59 @@ class WillmottHorizontalCalculator(HklCalculatorBase):
         l_phi = H_phi[2, 0]                                               # (5)
 
         ### determine betain (omegah) and betaout ###
-
-        if not self.constraints.reference:
-            raise ValueError("No reference constraint has been constrained.")
-
-        ref_name, ref_value = self.constraints.reference.items()[0]
-        if ref_value is not None:
-            ref_value *= TORAD
-        if ref_name == 'betain':
-            betain = ref_value
-            betaout = asin(bound(l_phi - sin(betain)))                   # (53)
-        elif ref_name == 'betaout':
-            betaout = ref_value
-            betain = asin(bound(l_phi - sin(betaout)))                   # (54)
-        elif ref_name == 'bin_eq_bout':
-            betain = betaout = asin(bound(l_phi / 2))                    # (55)
-        else:
-            raise ValueError("Unexpected constraint name'%s'." % ref_name)
-
-        if abs(betain) < SMALL:
-            raise DiffcalcException('required betain was 0 degrees (requested '
-                                    'q is perpendicular to surface normal)')
-        if betain < -SMALL:
-            raise DiffcalcException("betain was -ve (%.4f)" % betain)
+        with profiler.stage('betain and betaout'):
+            if not self.constraints.reference:
+                raise ValueError("No reference constraint has been constrained.")
+
+            ref_name, ref_value = self.constraints.reference.items()[0]
+            if ref_value is not None:
+                ref_value *= TORAD
+            if ref_name == 'betain':
+                betain = ref_value
+                betaout = asin(bound(l_phi - sin(betain)))                   # (53)
+            elif ref_name == 'betaout':
+                betaout = ref_value
+                betain = asin(bound(l_phi - sin(betaout)))                   # (54)
+            elif ref_name == 'bin_eq_bout':
+                betain = betaout = asin(bound(l_phi / 2))                    # (55)
+            else:
+                raise ValueError("Unexpected constraint name'%s'." % ref_name)
+
+            if abs(betain) < SMALL:
+                raise DiffcalcException('required betain was 0 degrees (requested '
+                                        'q is perpendicular to surface normal)')
+            if betain < -SMALL:
+                raise DiffcalcException("betain was -ve (%.4f)" % betain)
 #        logger.info('betain = %.4f, betaout = %.4f',
 #                    betain * TODEG, betaout * TODEG)
-        omegah = betain                                                  # (52)
+            omegah = betain                                                  # (52)
 
         ### determine H_lab (X, Y and Z) ###
-
-        Y = -(h_phi ** 2 + k_phi ** 2 + l_phi ** 2) / 2                  # (45)
-
-        Z = (sin(betaout) + sin(betain) * (Y + 1)) / cos(omegah)         # (47)
-
-        X_squared = (h_phi ** 2 + k_phi ** 2 -
-                    ((cos(betain) * Y + sin(betain) * Z) ** 2))          # (48)
-        if (X_squared < 0) and (abs(X_squared) < SMALL):
-            X_squared = 0
-        Xpositive = sqrt(X_squared)
-        if CHOOSE_POSITIVE_GAMMA:
-            X = -Xpositive
-        else:
-            X = Xpositive
+        with profiler.stage('detector and sample angles'):
+            Y = -(h_phi ** 2 + k_phi ** 2 + l_phi ** 2) / 2                  # (45)
+
+            Z = (sin(betaout) + sin(betain) * (Y + 1)) / cos(omegah)         # (47)
+
+            X_squared = (h_phi ** 2 + k_phi ** 2 -
+                        ((cos(betain) * Y + sin(betain) * Z) ** 2))          # (48)
+            if (X_squared < 0) and (abs(X_squared) < SMALL):
+                X_squared = 0
+            Xpositive = sqrt(X_squared)
+            if CHOOSE_POSITIVE_GAMMA:
+                X = -Xpositive
+            else:
+                X = Xpositive
 #        logger.info('H_lab (X,Y,Z) = [%.4f, %.4f, %.4f]', X, Y, Z)
-        ### determine diffractometer angles ###
-
-        gamma = atan2(-X, Y + 1)                                         # (49)
-        if (abs(gamma) < SMALL):
-            # degenerate case, only occurs when q || z
-            delta = 2 * omegah
-        else:
-            delta = atan2(Z * sin(gamma), -X)                            # (50)
-        M = cos(betain) * Y + sin(betain) * Z
-        phi = atan2(h_phi * M - k_phi * X, h_phi * X + k_phi * M)        # (51)
+            ### determine diffractometer angles ###
+
+            gamma = atan2(-X, Y + 1)                                         # (49)
+            if (abs(gamma) < SMALL):
+                # degenerate case, only occurs when q || z
+                delta = 2 * omegah
+            else:
+                delta = atan2(Z * sin(gamma), -X)                            # (50)
+            M = cos(betain) * Y + sin(betain) * Z
+            phi = atan2(h_phi * M - k_phi * X, h_phi * X + k_phi * M)        # (51)
 
         pos = WillmottHorizontalPosition(delta, gamma, omegah, phi)
         virtual_angles = {'betain': betain, 'betaout': betaout}
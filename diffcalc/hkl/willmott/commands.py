@@ -17,8 +17,11 @@
 ###
 
 from diffcalc.hkl.common import getNameFromScannableOrString
+from diffcalc.hkl.profiling import dcprofile
 from diffcalc.util import command
 
+__all__ = ['WillmottHklCommands', 'dcprofile']
+
 
 class WillmottHklCommands(object):
 
@@ -26,7 +29,8 @@ class WillmottHklCommands(object):
         self._hklcalc = hklcalc
         self.commands = [self.con,
                          self.uncon,
-                         self.cons]
+                         self.cons,
+                         dcprofile]
 
     def __str__(self):
         return self._hklcalc.__str__()
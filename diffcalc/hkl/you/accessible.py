@@ -0,0 +1,190 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Map the volume of reciprocal space accessible within the hardware limits.
+
+Physical angles are sampled at random within the limits of each axis,
+converted to hkl in bulk with YouHklCalculator.anglesArrayToHkl and binned
+into a voxel grid covering the limiting sphere. The constraint mode plays no
+part: the map shows everything the diffractometer can reach. A summed volume
+table over the occupied voxels answers whether any part of an hkl box can be
+reached with eight lookups, whatever its size.
+
+This module requires numpy and is therefore not available under Jython.
+"""
+
+import numpy as np
+
+from diffcalc import settings
+from diffcalc.hkl.you.batch import _is_position_within_limits, \
+    physical_angles_to_internal_positions
+from diffcalc.hkl.you.reachable import hkl_extent
+from diffcalc.util import DiffcalcException
+
+SAMPLES = 1000000
+CHUNK_SIZE = 100000
+STEP = .1  # voxel size in reciprocal lattice units
+MAX_VOXELS = 20000000
+
+AXES = 'hkl'
+
+
+class AccessibleVolume(object):
+    """A voxel map of the accessible hkl.
+
+      occupancy -- (nh, nk, nl) array counting the samples in each voxel
+      lower     -- the hkl of the lower corner of voxel (0, 0, 0)
+      step      -- the voxel size in reciprocal lattice units
+      samples   -- the number of positions sampled within the limits
+
+    Voxel centres lie on multiples of step so, if 1 / step is an integer,
+    integer hkl lie at voxel centres.
+    """
+
+    def __init__(self, occupancy, lower, step, samples):
+        self.occupancy = occupancy
+        self.lower = np.asarray(lower, dtype=float)
+        self.step = step
+        self.samples = samples
+        occupied = (occupancy > 0).astype(np.int32)
+        table = np.zeros(np.array(occupancy.shape) + 1, dtype=np.int32)
+        table[1:, 1:, 1:] = occupied.cumsum(0).cumsum(1).cumsum(2)
+        self._table = table
+
+    @property
+    def shape(self):
+        return self.occupancy.shape
+
+    def centres(self, axis):
+        """Return the h, k or l of the voxel centres along one axis"""
+        i = AXES.index(axis)
+        return self.lower[i] + self.step * (np.arange(self.shape[i]) + .5)
+
+    def index(self, hkl):
+        """Return the voxel index of hkl, or None if it is off the grid"""
+        index = np.floor((np.asarray(hkl, dtype=float) - self.lower) /
+                         self.step).astype(int)
+        if (index < 0).any() or (index >= self.shape).any():
+            return None
+        return tuple(index)
+
+    def is_reachable(self, hkl):
+        """Return True if hkl lies in a voxel reached by a sample"""
+        index = self.index(hkl)
+        return index is not None and bool(self.occupancy[index])
+
+    def count_reachable(self, lower, upper):
+        """Return the number of occupied voxels touching the hkl box from
+        lower to upper"""
+        start = np.floor((np.asarray(lower, dtype=float) - self.lower) /
+                         self.step).astype(int)
+        stop = np.floor((np.asarray(upper, dtype=float) - self.lower) /
+                        self.step).astype(int) + 1
+        (i0, j0, k0) = np.clip(start, 0, self.shape)
+        (i1, j1, k1) = np.clip(stop, 0, self.shape)
+        if i0 >= i1 or j0 >= j1 or k0 >= k1:
+            return 0
+        t = self._table
+        return int(t[i1, j1, k1] - t[i0, j1, k1] - t[i1, j0, k1] -
+                   t[i1, j1, k0] + t[i0, j0, k1] + t[i0, j1, k0] +
+                   t[i1, j0, k0] - t[i0, j0, k0])
+
+    def is_region_reachable(self, lower, upper):
+        """Return True if any part of the hkl box from lower to upper is
+        reachable"""
+        return self.count_reachable(lower, upper) > 0
+
+    def projection(self, axis):
+        """Return the number of occupied voxels along h, k or l through each
+        voxel of the plane of the other two"""
+        return (self.occupancy > 0).sum(AXES.index(axis))
+
+    @property
+    def fraction(self):
+        """The fraction of the voxels in the grid that are occupied"""
+        return (self.occupancy > 0).mean()
+
+    def __str__(self):
+        upper = self.lower + self.step * np.array(self.shape)
+        lines = ['%d samples in %d x %d x %d voxels of %g' %
+                 ((self.samples,) + self.shape + (self.step,))]
+        for axis, low, high in zip(AXES, self.lower, upper):
+            lines.append('   %s: %9.4f to %9.4f' % (axis, low, high))
+        lines.append('   %.1f%% of voxels reachable' % (100 * self.fraction))
+        return '\n'.join(lines)
+
+
+def _axis_ranges(hardware, names):
+    """Return the lower and upper limit of each axis, a full turn about the
+    cut, or about zero, where no limit is set or they cannot be read"""
+    cuts = hardware.get_cuts()
+    ranges = []
+    for name in names:
+        try:
+            low = hardware.get_lower_limit(name)
+            high = hardware.get_upper_limit(name)
+        except (DiffcalcException, NotImplementedError, AttributeError):
+            low = high = None
+        start = -180. if cuts.get(name) is None else cuts[name]
+        if low is None and high is None:
+            low, high = start, start + 360.
+        elif low is None:
+            low = high - 360.
+        elif high is None:
+            high = low + 360.
+        ranges.append((low, high))
+    return np.array(ranges, dtype=float)
+
+
+def sample_physical_angles(count, seed=0):
+    """Return a (count, n) array of physical angles drawn uniformly within the
+    hardware limits"""
+    hardware = settings.hardware
+    names = hardware.get_axes_names()
+    ranges = _axis_ranges(hardware, names)
+    physical = np.random.RandomState(seed).uniform(
+        ranges[:, 0], ranges[:, 1], (count, len(names)))
+    return physical[_is_position_within_limits(hardware, names, physical)]
+
+
+def accessible_volume(hklcalc, wavelength, step=STEP, samples=SAMPLES,
+                      seed=0, chunk_size=CHUNK_SIZE):
+    """Return an AccessibleVolume built from samples positions drawn within
+    the hardware limits"""
+    extent = hkl_extent(hklcalc._get_ubmatrix(), wavelength)
+    half = np.ceil(extent / step - 1e-9).astype(int)
+    shape = tuple(2 * half + 1)
+    if np.prod(shape, dtype=float) > MAX_VOXELS:
+        raise DiffcalcException(
+            'A %d x %d x %d voxel map is too large; use a larger step' % shape)
+    lower = -(half + .5) * step
+    occupancy = np.zeros(shape, dtype=np.int32)
+    random = np.random.RandomState(seed)
+    used = 0
+    for start in range(0, samples, chunk_size):
+        physical = sample_physical_angles(min(chunk_size, samples - start),
+                                          random.randint(2 ** 31))
+        used += len(physical)
+        positions = physical_angles_to_internal_positions(
+            settings.geometry, physical)
+        hkl = hklcalc.anglesArrayToHkl(positions, wavelength)
+        index = np.floor((hkl - lower) / step).astype(int)
+        on_grid = ((index >= 0) & (index < shape)).all(1)
+        flat, counts = np.unique(np.ravel_multi_index(index[on_grid].T, shape),
+                                 return_counts=True)
+        occupancy.flat[flat] += counts.astype(np.int32)
+    return AccessibleVolume(occupancy, lower, step, used)
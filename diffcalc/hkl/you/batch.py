@@ -0,0 +1,825 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Vectorised hkl to angles calculation for the You engine.
+
+The functions here follow the scalar code in diffcalc.hkl.you.calc branch for
+branch, but operate on whole arrays of reflections at once. Each solution
+branch of the scalar generators becomes a column of candidate values together
+with a mask marking the candidates the scalar code would have yielded. Rows
+for which the scalar code raises an exception are flagged as failed and
+produce no solutions.
+
+This module requires numpy and is therefore not available under Jython.
+"""
+
+from itertools import product
+from math import pi
+
+import numpy as np
+
+from diffcalc import settings
+from diffcalc.hkl.you.calc import SMALL, TODEG, TORAD, _calc_N
+from diffcalc.hkl.you.geometry import SixCircle, FourCircle, FiveCircle, \
+    YouPosition, calcMU, calcPHI
+from diffcalc.util import DiffcalcException
+
+BOUND_SMALL = 1e-10  # as used by diffcalc.util.bound
+CUT_SMALL = 1e-8  # as used by diffcalc.hardware.cut_angle_at
+
+ONE_SAMPLE_CONSTRAINTS = ('mu', 'eta', 'chi', 'phi')
+
+VIRTUAL_ANGLE_NAMES = ('theta', 'ttheta', 'qaz', 'alpha', 'naz', 'tau', 'psi',
+                       'beta', 'betain', 'betaout')
+REFERENCE_ANGLE_NAMES = ('alpha', 'naz', 'tau', 'psi', 'beta')
+
+# Columns of the internal (mu, delta, nu, eta, chi, phi) position holding the
+# physical angles of the standard geometry plugins
+_PHYSICAL_COLUMNS = {
+    SixCircle: [0, 1, 2, 3, 4, 5],
+    FiveCircle: [1, 2, 3, 4, 5],
+    FourCircle: [1, 3, 4, 5]}
+
+
+def _is_small(x):
+    return np.abs(x) < SMALL
+
+
+def _sign(x):
+    return np.where(_is_small(x), 0., np.sign(x))
+
+
+def _bound(x):
+    """Return x moved between -1 and 1 and a mask of the values which
+    diffcalc.util.bound would accept.
+    """
+    return np.clip(x, -1., 1.), ~(np.abs(x) > 1 + BOUND_SMALL)
+
+
+def _normalised(v):
+    return v / np.sqrt(np.sum(v * v, axis=-1))[..., np.newaxis]
+
+
+def _angle_between_vectors(a, b):
+    """Return angles between rows of a and b and a mask of valid angles."""
+    cos_angle, ok = _bound(np.sum(_normalised(a) * _normalised(b), axis=-1))
+    return np.arccos(cos_angle), ok
+
+
+def _combine(branches, size):
+    """Flatten solution branches into arrays of candidates.
+
+    Each branch is a tuple (mask, value1, value2, ...) of arrays (or scalars)
+    indexed by parent candidate. Return the parent index of each valid
+    candidate and a list with the candidate values, ordered by parent first
+    and then by branch, as the scalar generators would yield them.
+    """
+    valid = np.column_stack([b[0] * np.ones(size, dtype=bool)
+                             for b in branches])
+    parent, branch = np.nonzero(valid)
+    values = []
+    for column in zip(*[b[1:] for b in branches]):
+        stacked = np.column_stack([v * np.ones(size) for v in column])
+        values.append(stacked[parent, branch])
+    return parent, values
+
+
+def create_you_matrix_stacks(positions):
+    """Create the transformation matrices of H. You's paper for many positions.
+
+    positions is an (N, 6) array of mu, delta, nu, eta, chi and phi in
+    radians. Return MU, DELTA, NU, ETA, CHI and PHI as (N, 3, 3) stacks. The
+    sines and cosines of all angles are evaluated in a single pass.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 6)
+    # DELTA, ETA and PHI rotate about z by minus the angle
+    angles = positions * np.array([1., -1., 1., -1., 1., -1.])
+    c = np.cos(angles)
+    s = np.sin(angles)
+    stacks = np.zeros((6, len(positions), 3, 3))
+    for i in (0, 2):  # MU and NU: x rotations
+        stacks[i, :, 0, 0] = 1.
+        stacks[i, :, 1, 1], stacks[i, :, 1, 2] = c[:, i], -s[:, i]
+        stacks[i, :, 2, 1], stacks[i, :, 2, 2] = s[:, i], c[:, i]
+    for i in (1, 3, 5):  # DELTA, ETA and PHI: z rotations
+        stacks[i, :, 0, 0], stacks[i, :, 0, 1] = c[:, i], -s[:, i]
+        stacks[i, :, 1, 0], stacks[i, :, 1, 1] = s[:, i], c[:, i]
+        stacks[i, :, 2, 2] = 1.
+    # CHI: y rotation
+    stacks[4, :, 0, 0], stacks[4, :, 0, 2] = c[:, 4], s[:, 4]
+    stacks[4, :, 1, 1] = 1.
+    stacks[4, :, 2, 0], stacks[4, :, 2, 2] = -s[:, 4], c[:, 4]
+    return tuple(stacks)
+
+
+def _calc_N_stack(Q, n):
+    """Return an (N, 3, 3) stack of the matrices of Equation 31 and a mask of
+    the rows for which they could be calculated.
+    """
+    Q = _normalised(Q)
+    n = _normalised(n) * np.ones(Q.shape)
+    angle, ok = _angle_between_vectors(Q, n)
+    Qxn = np.cross(Q, n)
+    QxnxQ = _normalised(np.cross(Qxn, Q))
+    Qxn = _normalised(Qxn)
+    N = np.stack([Q, QxnxQ, Qxn], axis=2)
+    # The reference vector is replaced where it is parallel to Q. This is
+    # rare, so the scalar code is used.
+    for i in np.nonzero(ok & _is_small(angle))[0]:
+        N[i] = _calc_N(np.matrix(Q[i]).T, np.matrix(n[i]).T)
+    return N, ok
+
+
+def _calc_theta(h_phi, wavelength):
+    """Return theta and a mask of reachable reflections."""
+    q_length = np.sqrt(np.sum(h_phi * h_phi, axis=1))
+    wavevector = 2 * pi / wavelength
+    sin_theta, ok = _bound(q_length / (2 * wavevector))
+    theta = np.arcsin(sin_theta)
+    ok &= ~_is_small(q_length) & ~_is_small(np.cos(theta))
+    return theta, ok
+
+
+def _calc_remaining_reference_angles(name, value, theta, tau):
+    """Return alpha and a mask of rows the scalar code would not reject."""
+    if name == 'psi':
+        sin_alpha = (np.cos(tau) * np.sin(theta) -
+                     np.cos(theta) * np.sin(tau) * np.cos(value))
+        sin_beta = (np.cos(tau) * np.sin(theta) +
+                    np.cos(theta) * np.sin(tau) * np.cos(value))
+        ok = (~(np.abs(sin_alpha) > 1 + BOUND_SMALL) &
+              ~(np.abs(sin_beta) > 1 + BOUND_SMALL))
+        alpha = np.arcsin(np.clip(sin_alpha, -1., 1.))
+    elif name in ('a_eq_b', 'bin_eq_bout'):
+        alpha = np.arcsin(np.cos(tau) * np.sin(theta))
+        ok = np.ones(theta.shape, dtype=bool)
+    elif name in ('alpha', 'betain'):
+        alpha = value * np.ones(theta.shape)
+        sin_beta = 2 * np.sin(theta) * np.cos(tau) - np.sin(alpha)
+        ok = ~(np.abs(sin_beta) > 1)
+    else:  # beta or betaout
+        sin_alpha = 2 * np.sin(theta) * np.cos(tau) - np.sin(value)
+        ok = ~(np.abs(sin_alpha) > 1)
+        alpha = np.arcsin(np.clip(sin_alpha, -1., 1.))
+    return alpha, ok
+
+
+def _calc_angle_between_naz_and_qaz(theta, alpha, tau):
+    """Return the angle of Equation 30, a mask of rows for which it exists and
+    a mask of rows for which the scalar code raises.
+    """
+    top = np.cos(tau) - np.sin(alpha) * np.sin(theta)
+    bottom = np.cos(alpha) * np.cos(theta)
+    failed = _is_small(bottom) & (_is_small(np.cos(alpha)) |
+                                  _is_small(np.cos(theta)))
+    parallel = _is_small(np.sin(tau))
+    cos_angle, ok = _bound(top / bottom)
+    angle = np.where(parallel, 0., np.arccos(cos_angle))
+    return angle, ok | parallel, failed
+
+
+def _calc_remaining_detector_angles(name, value, theta):
+    """Return delta, nu and qaz given one detector angle.
+
+    Return the parent index of each candidate, the candidate delta, nu and qaz
+    values and a mask of the parents for which the scalar code raises.
+    """
+    size = len(theta)
+    ones = np.ones(size, dtype=bool)
+    value = value * np.ones(size)
+    sin_2theta = np.sin(2 * theta)
+    cos_2theta = np.cos(2 * theta)
+    failed = _is_small(sin_2theta)
+
+    branches = []
+    if name == 'delta':
+        delta = value
+        sin_qaz, ok = _bound(np.sin(delta) / sin_2theta)
+        asin_qaz = np.arcsin(sin_qaz)
+        cos_delta = np.cos(delta)
+        degenerate = _is_small(cos_delta)
+        cos_nu, ok_nu = _bound(cos_2theta / cos_delta)
+        ok &= degenerate | ok_nu
+        acos_nu = np.where(degenerate, 1., np.arccos(cos_nu))
+        single_qaz = _is_small(np.cos(asin_qaz))
+        single_nu = _is_small(acos_nu)
+        qaz_branches = [
+            (ones, np.where(single_qaz, _sign(asin_qaz) * pi / 2., asin_qaz)),
+            (~single_qaz, pi - asin_qaz)]
+        nu_branches = [(ones, np.where(single_nu, 0., acos_nu)),
+                       (~single_nu, -acos_nu)]
+        for (qaz_ok, qaz), (nu_ok, nu) in product(qaz_branches, nu_branches):
+            sgn_ref = _sign(sin_2theta) * _sign(np.cos(qaz))
+            sgn_ratio = _sign(np.sin(nu)) * _sign(cos_delta)
+            mask = ok & qaz_ok & nu_ok & (sgn_ref == sgn_ratio)
+            branches.append((mask, delta, nu, qaz))
+
+    elif name == settings.NUNAME:
+        nu = value
+        cos_nu = np.cos(nu)
+        failed |= _is_small(cos_nu)
+        cos_delta = cos_2theta / cos_nu
+        cos_delta_bound, ok_delta = _bound(cos_delta)
+        cos_qaz, ok_qaz = _bound(cos_delta * np.sin(nu) / sin_2theta)
+        ok = ok_delta & ok_qaz
+        acos_delta = np.arccos(cos_delta_bound)
+        acos_qaz = np.arccos(cos_qaz)
+        single_qaz = _is_small(acos_qaz)
+        single_delta = _is_small(acos_delta)
+        qaz_branches = [(ones, np.where(single_qaz, 0., acos_qaz)),
+                        (~single_qaz, -acos_qaz)]
+        delta_branches = [(ones, np.where(single_delta, 0., acos_delta)),
+                          (~single_delta, -acos_delta)]
+        for (qaz_ok, qaz), (delta_ok, delta) in product(qaz_branches,
+                                                        delta_branches):
+            sgn_ref = _sign(np.sin(delta))
+            sgn_ratio = _sign(np.sin(qaz)) * _sign(sin_2theta)
+            mask = ok & qaz_ok & delta_ok & (sgn_ref == sgn_ratio)
+            branches.append((mask, delta, nu, qaz))
+
+    elif name == 'qaz':
+        qaz = value
+        asin_delta = np.arcsin(np.sin(qaz) * sin_2theta)
+        single_delta = _is_small(np.cos(asin_delta))
+        delta_branches = [
+            (ones, np.where(single_delta, _sign(asin_delta) * pi / 2.,
+                            asin_delta)),
+            (~single_delta, pi - asin_delta)]
+        for delta_ok, delta in delta_branches:
+            cos_delta = np.cos(delta)
+            sgn_delta = _sign(cos_delta)
+            nu = np.where(_is_small(cos_delta), 0.,
+                          np.arctan2(sgn_delta * sin_2theta * np.cos(qaz),
+                                     sgn_delta * cos_2theta))
+            branches.append((delta_ok, delta, nu, qaz))
+
+    else:
+        raise DiffcalcException(
+            name + ' is not an explicit detector angle '
+            '(naz cannot be handled here)')
+
+    branches = [(b[0] & ~failed,) + b[1:] for b in branches]
+    parent, (delta, nu, qaz) = _combine(branches, size)
+    return parent, delta, nu, qaz, failed
+
+
+def _calc_det_angles_given_det_or_naz_constraint(
+        det_constraint, naz_constraint, theta, tau, alpha):
+    """Return parent index, qaz, naz, delta and nu of each candidate and a mask
+    of the parents for which the scalar code raises.
+    """
+    size = len(theta)
+    naz_qaz_angle, ok, failed = _calc_angle_between_naz_and_qaz(
+        theta, alpha, tau)
+    single = _is_small(naz_qaz_angle)
+    if det_constraint:
+        name, value = det_constraint.items()[0]
+        parent, delta, nu, qaz, det_failed = _calc_remaining_detector_angles(
+            name, value, theta)
+        failed |= det_failed & ok
+        angle = naz_qaz_angle[parent]
+        keep = ok[parent]
+        branches = [(keep, qaz, np.where(single[parent], qaz, qaz - angle),
+                     delta, nu),
+                    (keep & ~single[parent], qaz, qaz + angle, delta, nu)]
+        index, (qaz, naz, delta, nu) = _combine(branches, len(parent))
+        parent = parent[index]
+    else:
+        naz = naz_constraint.items()[0][1]
+        branches = [(ok, np.where(single, naz, naz - naz_qaz_angle)),
+                    (ok & ~single, naz + naz_qaz_angle)]
+        qaz_parent, (qaz,) = _combine(branches, size)
+        index, delta, nu, qaz, det_failed = _calc_remaining_detector_angles(
+            'qaz', qaz, theta[qaz_parent])
+        failed[qaz_parent[det_failed]] = True
+        parent = qaz_parent[index]
+        naz = naz * np.ones(len(parent))
+    return parent, qaz, naz, delta, nu, failed
+
+
+def _calc_remaining_sample_angles(name, value, N_lab, N_phi):
+    """Return phi, chi, eta and mu, given one of these.
+
+    Return the parent index of each candidate, the candidate mu, eta, chi and
+    phi values and a mask of the parents for which the scalar code raises.
+    """
+    size = len(N_lab)
+    ones = np.ones(size, dtype=bool)
+    Z = np.matmul(N_lab, np.transpose(N_phi, (0, 2, 1)))
+    failed = np.zeros(size, dtype=bool)
+
+    if name == 'mu':
+        mu = value
+        V = np.matmul(np.asarray(calcMU(mu).I), Z)
+        cos_chi, ok = _bound(V[:, 2, 2])
+        acos_chi = np.arccos(cos_chi)
+        single = _is_small(np.sin(acos_chi))
+        branches = []
+        for branch_ok, chi in ((ones, acos_chi), (~single, -acos_chi)):
+            sgn = _sign(np.sin(chi))
+            phi = np.arctan2(-sgn * V[:, 2, 1], -sgn * V[:, 2, 0])
+            eta = np.arctan2(-sgn * V[:, 1, 2], sgn * V[:, 0, 2])
+            # chi ~= 0 or 180 and therefore phi || eta: choose eta=0
+            phi = np.where(single, np.arctan2(-V[:, 1, 0], V[:, 1, 1]), phi)
+            eta = np.where(single, 0., eta)
+            branches.append((ok & branch_ok, mu, eta, chi, phi))
+
+    elif name == 'phi':
+        phi = value
+        V = np.matmul(np.matmul(N_lab, np.linalg.inv(N_phi)),
+                      np.asarray(calcPHI(phi).T))
+        sin_eta, ok = _bound(V[:, 0, 1])
+        asin_eta = np.arcsin(sin_eta)
+        failed |= ok & _is_small(np.cos(asin_eta))
+        branches = []
+        for eta in (asin_eta, pi - asin_eta):
+            sgn = _sign(np.cos(eta))
+            mu = np.arctan2(sgn * V[:, 2, 1], sgn * V[:, 1, 1])
+            chi = np.arctan2(sgn * V[:, 0, 2], sgn * V[:, 0, 0])
+            branches.append((ok, mu, eta, chi, phi))
+
+    elif name in ('eta', 'chi'):
+        if name == 'eta':
+            eta = value
+            cos_eta = np.cos(eta)
+            if _is_small(cos_eta):
+                failed |= True
+            sin_chi, ok = _bound(Z[:, 0, 2] / cos_eta)
+            asin_chi = np.arcsin(sin_chi)
+            all_chi = [asin_chi, pi - asin_chi]
+            all_eta = [eta]
+        else:
+            chi = value
+            sin_chi = np.sin(chi)
+            if _is_small(sin_chi):
+                failed |= True
+            cos_eta, ok = _bound(Z[:, 0, 2] / sin_chi)
+            acos_eta = np.arccos(cos_eta)
+            all_chi = [chi]
+            all_eta = [acos_eta, -acos_eta]
+
+        branches = []
+        for chi, eta in product(all_chi, all_eta):
+            top_for_mu = (Z[:, 2, 2] * np.sin(eta) * np.sin(chi) +
+                          Z[:, 1, 2] * np.cos(chi))
+            bot_for_mu = (-Z[:, 2, 2] * np.cos(chi) +
+                          Z[:, 1, 2] * np.sin(eta) * np.sin(chi))
+            # mu || phi: see YouHklCalculator._calc_remaining_sample_angles
+            failed |= ok & _is_small(top_for_mu) & _is_small(bot_for_mu)
+            mu = np.arctan2(-top_for_mu, -bot_for_mu)                   # (41)
+            top_for_phi = (Z[:, 0, 1] * np.cos(eta) * np.cos(chi) -
+                           Z[:, 0, 0] * np.sin(eta))
+            bot_for_phi = (Z[:, 0, 1] * np.sin(eta) +
+                           Z[:, 0, 0] * np.cos(eta) * np.cos(chi))
+            phi = np.arctan2(top_for_phi, bot_for_phi)                  # (42)
+            branches.append((ok, mu, eta, chi, phi))
+
+    else:
+        raise DiffcalcException('Given angle must be one of phi, chi, eta or mu')
+
+    branches = [(b[0] & ~failed,) + b[1:] for b in branches]
+    parent, (mu, eta, chi, phi) = _combine(branches, size)
+    return parent, mu, eta, chi, phi, failed
+
+
+def _tidy_degenerate_solutions(positions, constraints):
+    """Vectorised diffcalc.hkl.you.calc._tidy_degenerate_solutions."""
+    mu, delta, nu, eta, chi, phi = positions.T.copy()
+    detector_like_constraint = bool(constraints.detector or constraints.naz)
+    nu_constrained_to_0 = _is_small(nu) & detector_like_constraint
+    mu_constrained_to_0 = _is_small(mu) & ('mu' in constraints.sample)
+    delta_constrained_to_0 = _is_small(delta) & detector_like_constraint
+    eta_constrained_to_0 = _is_small(eta) & ('eta' in constraints.sample)
+    phi_not_constrained = not 'phi' in constraints.sample
+
+    vertical = (nu_constrained_to_0 & mu_constrained_to_0 &
+                phi_not_constrained)
+    horizontal = (~vertical & delta_constrained_to_0 & eta_constrained_to_0 &
+                  phi_not_constrained)
+
+    # constrained to vertical 4-circle like mode with phi || eta
+    tidy = vertical & _is_small(chi)
+    desired_eta = delta / 2.
+    eta_diff = desired_eta - eta
+    eta = np.where(tidy, desired_eta, eta)
+    phi = np.where(tidy, phi - eta_diff, phi)
+
+    # constrained to horizontal 4-circle like mode with phi || mu
+    tidy = horizontal & _is_small(chi - pi / 2)
+    desired_mu = nu / 2.
+    mu_diff = desired_mu - mu
+    mu = np.where(tidy, desired_mu, mu)
+    phi = np.where(tidy, phi + mu_diff, phi)
+
+    return np.column_stack((mu, delta, nu, eta, chi, phi))
+
+
+def _cut_angle_at(cut_angle, values):
+    """Vectorised diffcalc.hardware.cut_angle_at."""
+    zero = ((cut_angle == 0 and np.abs(values - 360) < CUT_SMALL) |
+            (np.abs(values + 360) < CUT_SMALL) |
+            (np.abs(values) < CUT_SMALL))
+    values = np.where(zero, 0., values)
+    return np.where(values < cut_angle - CUT_SMALL, values + 360.,
+                    np.where(values >= cut_angle + 360. + CUT_SMALL,
+                             values - 360., values))
+
+
+def internal_positions_to_physical_angles(geometry, positions):
+    """Map an (N, 6) array of internal positions in degrees to physical angles.
+    """
+    columns = _PHYSICAL_COLUMNS.get(type(geometry))
+    if columns is not None:
+        return positions[:, columns]
+    physical = [geometry.internal_position_to_physical_angles(
+                    YouPosition(*pos, unit='DEG')) for pos in positions]
+    return np.array(physical, dtype=float).reshape(len(positions), -1)
+
+
+def physical_angles_to_internal_positions(geometry, physical):
+    """Map an (N, M) array of physical angles to internal positions in degrees.
+    """
+    physical = np.atleast_2d(np.asarray(physical, dtype=float))
+    columns = _PHYSICAL_COLUMNS.get(type(geometry))
+    if columns is not None:
+        positions = np.zeros((len(physical), 6))
+        positions[:, columns] = physical
+        return positions
+    positions = [geometry.physical_angles_to_internal_position(
+                     tuple(angles)).totuple() for angles in physical]
+    return np.array(positions, dtype=float).reshape(len(physical), 6)
+
+
+def _is_position_within_limits(hardware, names, physical):
+    """Return a mask of the rows of physical inside the hardware limits.
+
+    The limits are read once. If they cannot be read the hardware is asked
+    about each position in turn.
+    """
+    try:
+        lower = [hardware.get_lower_limit(name) for name in names]
+        upper = [hardware.get_upper_limit(name) for name in names]
+    except (DiffcalcException, NotImplementedError, AttributeError):
+        return np.array([hardware.is_position_within_limits(list(angles))
+                         for angles in physical], dtype=bool)
+    ok = np.ones(len(physical), dtype=bool)
+    for i, (low, high) in enumerate(zip(lower, upper)[:physical.shape[1]]):
+        if high is not None:
+            ok &= ~(physical[:, i] > high)
+        if low is not None:
+            ok &= ~(physical[:, i] < low)
+    return ok
+
+
+def _filter_angle_limits(positions, filter_out_of_limits=True):
+    """Cut positions in radians and remove those outside hardware limits.
+
+    Return the cut positions in radians and a mask of the positions kept.
+    """
+    hardware = settings.hardware
+    geometry = settings.geometry
+    names = hardware.get_axes_names()
+    physical = internal_positions_to_physical_angles(geometry, positions * TODEG)
+    physical = physical.copy()
+    cuts = hardware.get_cuts()
+    for i, name in enumerate(names[:physical.shape[1]]):
+        if cuts[name] is not None:
+            physical[:, i] = _cut_angle_at(cuts[name], physical[:, i])
+    if filter_out_of_limits:
+        keep = _is_position_within_limits(hardware, names, physical)
+    else:
+        keep = np.ones(len(physical), dtype=bool)
+    positions = physical_angles_to_internal_positions(geometry, physical) * TORAD
+    return positions, keep
+
+
+def _unique_solutions(row, positions):
+    """Return a mask selecting one of each identical solution for a row."""
+    if not len(row):
+        return np.ones(0, dtype=bool)
+    # adding 0. converts -0. to 0. so that these compare equal as in a set
+    keys = np.ascontiguousarray(np.column_stack((row, positions + 0.)))
+    _, index = np.unique(keys.view([('', keys.dtype)] * keys.shape[1]),
+                         return_index=True)
+    keep = np.zeros(len(row), dtype=bool)
+    keep[index] = True
+    return keep
+
+
+def _virtual_angles(positions, n_phi, surf_nphi):
+    """Calculate virtual angles in radians from positions in radians.
+
+    Return a dictionary of arrays and a mask of positions for which the scalar
+    code would raise.
+    """
+    MU, DELTA, NU, ETA, CHI, PHI = create_you_matrix_stacks(positions)
+    _, delta, nu, _, _, _ = positions.T
+    Z = np.matmul(np.matmul(np.matmul(MU, ETA), CHI), PHI)
+    D = np.matmul(NU, DELTA)
+
+    # Equation 19:
+    theta = np.arccos(np.cos(delta) * np.cos(nu)) / 2.
+    sgn = _sign(np.sin(2. * theta))
+    qaz = np.arctan2(sgn * np.sin(delta), sgn * np.cos(delta) * np.sin(nu))
+
+    surf_nlab = np.dot(Z, surf_nphi)
+    kin = np.array([0., 1., 0.])
+    kout = D[:, :, 1]
+    angle_in, ok_in = _angle_between_vectors(kin, surf_nlab)
+    angle_out, ok_out = _angle_between_vectors(kout, surf_nlab)
+    failed = ~ok_in | ~ok_out
+    virtual_angles = {'theta': theta, 'ttheta': 2 * theta, 'qaz': qaz,
+                      'betain': angle_in - pi / 2.,
+                      'betaout': pi / 2. - angle_out}
+
+    if settings.include_reference:
+        n_lab = np.dot(Z, n_phi)
+        sin_alpha, ok_alpha = _bound(-n_lab[:, 1])
+        alpha = np.arcsin(sin_alpha)
+        naz = np.arctan2(n_lab[:, 0], n_lab[:, 2])                     # (20)
+        cos_tau, ok_tau = _bound(np.cos(alpha) * np.cos(theta) *
+                                 np.cos(naz - qaz) +
+                                 np.sin(alpha) * np.sin(theta))
+        tau = np.arccos(cos_tau)                                       # (23)
+        sin_beta, ok_beta = _bound(2 * np.sin(theta) * np.cos(tau) -
+                                   np.sin(alpha))
+        beta = np.arcsin(sin_beta)                                     # (24)
+        failed |= ~ok_alpha | ~ok_tau | ~ok_beta
+
+        # psi from Eq. (18), (25) and (28) as in YouHklCalculator._calc_psi
+        sin_tau = np.sin(tau)
+        cos_theta = np.cos(theta)
+        cos_psi = (np.cos(tau) * np.sin(theta) - np.sin(alpha)) / cos_theta
+        sin_psi = np.cos(alpha) * np.sin(qaz - naz)
+        sgn = _sign(sin_tau)
+        sigma_ = (sin_psi ** 2 + cos_psi ** 2) / sin_tau ** 2 - 1
+        undefined = (_is_small(sin_tau) | _is_small(cos_theta) |
+                     _is_small(np.sin(theta)) | ~_is_small(sigma_))
+        psi = np.where(undefined, np.nan,
+                       np.arctan2(sgn * sin_psi, sgn * cos_psi))
+
+        virtual_angles.update({'alpha': alpha, 'naz': naz, 'tau': tau,
+                               'psi': psi, 'beta': beta})
+    return virtual_angles, failed
+
+
+def virtual_angles_dtype():
+    """Return the dtype of the structured arrays holding virtual angles.
+
+    The angles depending on the reference vector are only included if
+    settings.include_reference is set.
+    """
+    names = [name for name in VIRTUAL_ANGLE_NAMES
+             if settings.include_reference or
+             name not in REFERENCE_ANGLE_NAMES]
+    return np.dtype([(name, float) for name in names])
+
+
+def _to_structured(virtual_angles, size):
+    result = np.empty(size, dtype=virtual_angles_dtype())
+    for name in result.dtype.names:
+        result[name] = virtual_angles.get(name, np.nan)
+    return result
+
+
+def youAnglesToVirtualAnglesArray(positions, n_phi, surf_nphi):
+    """Calculate virtual angles from many positions in radians.
+
+    positions is an (N, 6) array of mu, delta, nu, eta, chi and phi and n_phi
+    and surf_nphi the reference and surface normal vectors in the phi frame.
+    Return a structured array with one field in radians for each virtual
+    angle calculated by YouHklCalculator._anglesToVirtualAngles. All angles
+    are nan for positions where the scalar calculation would fail.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 6)
+    n_phi = np.asarray(n_phi, dtype=float).ravel()
+    surf_nphi = np.asarray(surf_nphi, dtype=float).ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        virtual_angles, failed = _virtual_angles(positions, n_phi, surf_nphi)
+    result = _to_structured(virtual_angles, len(positions))
+    result[failed] = np.nan
+    return result
+
+
+def _matches_constraints(virtual_angles, constraints):
+    """Return a mask of the positions whose virtual angles satisfy the
+    reference, detector and naz constraints.
+    """
+    size = len(virtual_angles['theta'])
+    ok = np.ones(size, dtype=bool)
+    for constraint in (constraints.reference, constraints.detector,
+                       constraints.naz):
+        if not constraint:
+            continue
+        name, value = constraint.items()[0]
+        if name == 'a_eq_b':
+            if 'alpha' not in virtual_angles:
+                continue
+            diff = virtual_angles['alpha'] - virtual_angles['beta']
+        elif name == 'bin_eq_bout':
+            diff = virtual_angles['betain'] - virtual_angles['betaout']
+        elif name in virtual_angles:
+            diff = value - virtual_angles[name]
+        else:
+            continue
+        ok &= _is_small(np.abs(np.sin(diff / 2.)))
+    return ok
+
+
+def youAnglesToHklArray(positions, wavelength, UBmatrix, UBinv=None):
+    """Calculate miller indices from many positions in radians.
+
+    positions is an (N, 6) array of mu, delta, nu, eta, chi and phi and
+    wavelength a single wavelength or an array of N. Return an (N, 3) array of
+    h, k and l. The rotation matrices are orthogonal so are inverted by
+    transposition; only UB is inverted, once per call, unless UBinv is
+    given.
+    """
+    if UBinv is None:
+        UBinv = np.linalg.inv(np.asarray(UBmatrix, dtype=float))
+    positions = np.asarray(positions, dtype=float).reshape(-1, 6)
+    MU, DELTA, NU, ETA, CHI, PHI = create_you_matrix_stacks(positions)
+    wavevector = 2 * pi / (np.asarray(wavelength, dtype=float) *
+                           np.ones(len(positions)))
+    # Equation 12 with k_i along y: q_lab = (NU * DELTA - I) * [0, k, 0]
+    q = np.einsum('nij,nj->ni', NU, DELTA[:, :, 1])
+    q[:, 1] -= 1.
+    q *= wavevector[:, np.newaxis]
+    # PHI.T * CHI.T * ETA.T * MU.T * q_lab
+    for R in (MU, ETA, CHI, PHI):
+        q = np.einsum('nji,nj->ni', R, q)
+    return np.dot(q, np.asarray(UBinv, dtype=float).T)
+
+
+def _empty_solutions():
+    return (np.zeros(0, dtype=int), np.zeros((0, 6)), _to_structured({}, 0))
+
+
+def _rows_to_arrays(solutions):
+    """Pack (row, position, virtual angles) tuples into arrays."""
+    if not solutions:
+        return _empty_solutions()
+    names = set()
+    for _, _, virtual_angles in solutions:
+        names.update(virtual_angles.keys())
+    index = np.array([row for row, _, _ in solutions], dtype=int)
+    positions = np.array([pos for _, pos, _ in solutions], dtype=float)
+    virtual_angles = {}
+    for name in names:
+        values = [va.get(name) for _, _, va in solutions]
+        virtual_angles[name] = np.array(
+            [np.nan if v is None else v for v in values], dtype=float)
+    return index, positions, _to_structured(virtual_angles, len(index))
+
+
+def _hkl_array_to_angles_by_row(hklcalc, hkl, wavelength,
+                                filter_out_of_limits):
+    """Solve each reflection in turn with the scalar code."""
+    solutions = []
+    for row, ((h, k, l), wl) in enumerate(zip(hkl, wavelength)):
+        try:
+            pairs = hklcalc._hklToAngles(h, k, l, wl, not filter_out_of_limits)
+            for pos, virtual_angles in pairs:
+                pos.changeToDegrees()
+                solutions.append(
+                    (row, pos.totuple(),
+                     dict((name, None if val is None else val * TODEG)
+                          for name, val in virtual_angles.items())))
+        except DiffcalcException:
+            continue
+    return _rows_to_arrays(solutions)
+
+
+def is_mode_vectorised(constraints):
+    """Return True if the current constraint mode is solved with arrays.
+
+    Other modes are solved by calling the scalar code for each
+    reflection.
+    """
+    return bool(constraints.reference and
+                (constraints.detector or constraints.naz) and
+                len(constraints.sample) == 1 and
+                constraints.sample.keys()[0] in ONE_SAMPLE_CONSTRAINTS)
+
+
+def hkl_array_to_angles(hklcalc, hkl, wavelength, filter_out_of_limits=True):
+    """Calculate all solutions for an array of reflections.
+
+    See YouHklCalculator.hklArrayToAngles.
+    """
+    constraints = hklcalc.constraints
+    if not constraints.is_fully_constrained():
+        raise DiffcalcException(
+            "Diffcalc is not fully constrained.\n"
+            "Type 'help con' for instructions")
+    hkl = np.array(hkl, dtype=float).reshape(-1, 3)
+    size = len(hkl)
+    wavelength = np.array(wavelength, dtype=float) * np.ones(size)
+    if not size:
+        return _empty_solutions()
+
+    if not is_mode_vectorised(constraints):
+        return _hkl_array_to_angles_by_row(hklcalc, hkl, wavelength,
+                                           filter_out_of_limits)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return _hkl_array_to_angles(hklcalc, hkl, wavelength,
+                                    filter_out_of_limits)
+
+
+def _hkl_array_to_angles(hklcalc, hkl, wavelength, filter_out_of_limits):
+
+    constraints = hklcalc.constraints
+    ref_name, ref_value = constraints.reference.items()[0]
+    samp_name, samp_value = constraints.sample.items()[0]
+    ref_nphi = np.asarray(hklcalc._get_n_phi(), dtype=float).ravel()
+    surf_nphi = np.asarray(hklcalc._get_surf_nphi(), dtype=float).ravel()
+    UB = np.asarray(hklcalc._get_ubmatrix(), dtype=float)
+
+    h_phi = np.dot(hkl, UB.T)
+    theta, ok = _calc_theta(h_phi, wavelength)
+    tau, ok_tau = _angle_between_vectors(h_phi, ref_nphi)
+    surf_tau, ok_surf_tau = _angle_between_vectors(h_phi, surf_nphi)
+    ok &= ok_tau & ok_surf_tau
+    if ref_name in ('psi', 'a_eq_b'):
+        ok &= ~_is_small(np.sin(tau))
+    elif ref_name == 'bin_eq_bout':
+        ok &= ~_is_small(np.sin(surf_tau))
+
+    ### Reference constraint column ###
+
+    if ref_name in ('bin_eq_bout', 'betain', 'betaout'):
+        tau = surf_tau
+        n_phi = surf_nphi
+    else:
+        n_phi = ref_nphi
+    alpha, ok_ref = _calc_remaining_reference_angles(ref_name, ref_value,
+                                                     theta, tau)
+    ok &= ok_ref
+
+    ### Detector and sample constraint columns ###
+
+    parent, qaz, naz, delta, nu, failed = \
+        _calc_det_angles_given_det_or_naz_constraint(
+            constraints.detector, constraints.naz, theta, tau, alpha)
+    ok &= ~failed
+    row = parent[ok[parent]]
+    qaz, naz, delta, nu = [v[ok[parent]] for v in (qaz, naz, delta, nu)]
+
+    cos_theta, sin_theta = np.cos(theta[row]), np.sin(theta[row])
+    cos_alpha, sin_alpha = np.cos(alpha[row]), np.sin(alpha[row])
+    q_lab = np.column_stack((cos_theta * np.sin(qaz), -sin_theta,
+                             cos_theta * np.cos(qaz)))                 # (18)
+    n_lab = np.column_stack((cos_alpha * np.sin(naz), -sin_alpha,
+                             cos_alpha * np.cos(naz)))                 # (20)
+    N_lab, ok_N_lab = _calc_N_stack(q_lab, n_lab)
+    N_phi, ok_N_phi = _calc_N_stack(h_phi, n_phi)
+    failed = np.zeros(len(hkl), dtype=bool)
+    failed[row[~ok_N_lab]] = True
+    failed |= ~ok_N_phi
+
+    parent, mu, eta, chi, phi, samp_failed = _calc_remaining_sample_angles(
+        samp_name, samp_value, N_lab, N_phi[row])
+    failed[row[samp_failed]] = True
+    row = row[parent]
+    positions = np.column_stack((mu, delta[parent], nu[parent], eta, chi, phi))
+
+    ### Select solutions ###
+
+    positions = _tidy_degenerate_solutions(positions, constraints)
+    positions, keep = _filter_angle_limits(positions, filter_out_of_limits)
+    row, positions = row[keep], positions[keep]
+    keep = _unique_solutions(row, positions)
+    row, positions = row[keep], positions[keep]
+
+    virtual_angles, va_failed = _virtual_angles(positions, ref_nphi, surf_nphi)
+    failed[row[va_failed]] = True
+    keep = _matches_constraints(virtual_angles, constraints)
+
+    hkl_readback = youAnglesToHklArray(positions, wavelength[row], UB)
+    mapped = np.all(np.abs(hkl_readback - hkl[row]) <= 0.001, axis=1)
+    if hklcalc.raiseExceptionsIfAnglesDoNotMapBackToHkl:
+        failed[row[keep & ~mapped]] = True
+
+    keep &= ~failed[row]
+    order = np.argsort(row[keep], kind='mergesort')
+    positions = positions[keep][order] * TODEG
+    virtual_angles = _to_structured(virtual_angles, len(row))[keep][order]
+    for name in virtual_angles.dtype.names:
+        virtual_angles[name] *= TODEG
+    return row[keep][order], positions, virtual_angles
+
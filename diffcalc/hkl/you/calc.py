@@ -18,6 +18,7 @@
 
 from math import pi, sin, cos, tan, acos, asin, atan, atan2, sqrt
 from itertools import product
+from copy import deepcopy
 from diffcalc import settings
 
 try:
@@ -29,12 +30,15 @@ except ImportError:
 
 from diffcalc.log import logging
 from diffcalc.hkl.calcbase import HklCalculatorBase
+from diffcalc.hkl.profiling import profiler
 from diffcalc.hkl.you.geometry import create_you_matrices, calcMU, calcPHI, \
     calcCHI, calcETA
-from diffcalc.hkl.you.geometry import YouPosition
+from diffcalc.hkl.you.geometry import YouPosition, create_you_rotations
+from diffcalc import mat3
 from diffcalc.util import DiffcalcException, bound, angle_between_vectors,\
     y_rotation
-from diffcalc.util import cross3, z_rotation, x_rotation
+from diffcalc.util import cross3, z_rotation, x_rotation, LRUCache, \
+    version_key
 from diffcalc.ub.calc import PaperSpecificUbCalcStrategy
 
 from diffcalc.settings import NUNAME
@@ -47,6 +51,9 @@ TODEG = 180 / pi
 
 PRINT_DEGENERATE = False
 
+SOLUTION_CACHE_SIZE = 1000
+READBACK_CACHE_SIZE = 100
+
 
 def is_small(x):
     return abs(x) < SMALL
@@ -75,27 +82,27 @@ def cut_at_minus_pi(value):
 
 def _calc_N(Q, n):
     """Return N as described by Equation 31"""
-    Q = normalised(Q)
-    n = normalised(n)
+    Q = mat3.normalised(mat3.from_matrix(Q))
+    n = list(mat3.normalised(mat3.from_matrix(n)))
     if is_small(angle_between_vectors(Q, n)):
         # Replace the reference vector with an alternative vector from Eq.(78) 
-        idx_min, _ = min(enumerate([abs(Q[0, 0]), abs(Q[1, 0]), abs(Q[2, 0])]), key=lambda v: v[1])
+        idx_min, _ = min(enumerate([abs(Q[0]), abs(Q[1]), abs(Q[2])]), key=lambda v: v[1])
         idx_1, idx_2 = [idx for idx in range(3) if idx != idx_min]
-        qval = sqrt(Q[idx_1, 0] * Q[idx_1, 0] + Q[idx_2, 0] * Q[idx_2, 0])
-        n[idx_min, 0] = qval
-        n[idx_1, 0] = -Q[idx_min, 0] * Q[idx_1, 0] / qval
-        n[idx_2, 0] = -Q[idx_min, 0] * Q[idx_2, 0] / qval
-        if is_small(norm(n)):
-            n[idx_min, 0] = 0
-            n[idx_1, 0] =  Q[idx_2, 0] / qval
-            n[idx_2, 0] = -Q[idx_1, 0] / qval
-    Qxn = cross3(Q, n)
-    QxnxQ = cross3(Qxn, Q)
-    QxnxQ = normalised(QxnxQ)
-    Qxn = normalised(Qxn)
-    return matrix([[Q[0, 0], QxnxQ[0, 0], Qxn[0, 0]],
-                   [Q[1, 0], QxnxQ[1, 0], Qxn[1, 0]],
-                   [Q[2, 0], QxnxQ[2, 0], Qxn[2, 0]]])
+        qval = sqrt(Q[idx_1] * Q[idx_1] + Q[idx_2] * Q[idx_2])
+        n[idx_min] = qval
+        n[idx_1] = -Q[idx_min] * Q[idx_1] / qval
+        n[idx_2] = -Q[idx_min] * Q[idx_2] / qval
+        if is_small(mat3.norm(n)):
+            n[idx_min] = 0
+            n[idx_1] =  Q[idx_2] / qval
+            n[idx_2] = -Q[idx_1] / qval
+    Qxn = mat3.cross(Q, n)
+    QxnxQ = mat3.cross(Qxn, Q)
+    QxnxQ = mat3.normalised(QxnxQ)
+    Qxn = mat3.normalised(Qxn)
+    return matrix([[Q[0], QxnxQ[0], Qxn[0]],
+                   [Q[1], QxnxQ[1], Qxn[1]],
+                   [Q[2], QxnxQ[2], Qxn[2]]])
 
 
 def _calc_angle_between_naz_and_qaz(theta, alpha, tau):
@@ -112,17 +119,51 @@ def _calc_angle_between_naz_and_qaz(theta, alpha, tau):
     return acos(bound(top / bottom))
 
 
-def youAnglesToHkl(pos, wavelength, UBmatrix):
+def youAnglesToHkl(pos, wavelength, UBmatrix, UBinv=None):
     """Calculate miller indices from position in radians.
+
+    UBinv may be given to avoid inverting UBmatrix on every call.
+    """
+    if UBinv is None:
+        UBinv = UBmatrix.I
+    return _hkl_from_you_rotations(create_you_rotations(*pos.totuple()),
+                                   wavelength, mat3.from_matrix(UBinv))
+
+
+def _hkl_from_you_rotations(rotations, wavelength, UBinv):
+    """Calculate miller indices from the rotation matrices of a position, as
+    returned by create_you_rotations, and the inverse of UB as a mat3 matrix.
     """
+    [MU, DELTA, NU, ETA, CHI, PHI] = rotations
+
+    wavevector = 2 * pi / wavelength
+    q_lab = mat3.mul_vec(mat3.mul(NU, DELTA), (0, wavevector, 0))     # 12
+    q_lab = (q_lab[0], q_lab[1] - wavevector, q_lab[2])
 
-    [MU, DELTA, NU, ETA, CHI, PHI] = create_you_matrices(*pos.totuple())
+    # The rotation matrices are orthogonal so their inverse is the transpose
+    q_phi = q_lab
+    for R in (MU, ETA, CHI, PHI):
+        q_phi = mat3.tmul_vec(R, q_phi)
 
-    q_lab = (NU * DELTA - I) * matrix([[0], [2 * pi / wavelength], [0]])   # 12
+    return mat3.mul_vec(UBinv, q_phi)
 
-    hkl = UBmatrix.I * PHI.I * CHI.I * ETA.I * MU.I * q_lab
 
-    return hkl[0, 0], hkl[1, 0], hkl[2, 0]
+def _matches_virtual_constraints(virtual_angles, virtual_constraints):
+    """Return False if virtual_angles break any of the (name, value) pairs
+    of reference, detector and naz constraints."""
+    for constraint_name, constraint_value in virtual_constraints:
+        try:
+            if constraint_name == 'a_eq_b':
+                diff = virtual_angles['alpha'] - virtual_angles['beta']
+            elif constraint_name == 'bin_eq_bout':
+                diff = virtual_angles['betain'] - virtual_angles['betaout']
+            else:
+                diff = constraint_value - virtual_angles[constraint_name]
+        except Exception:
+            continue
+        if not is_small(abs(sin(diff / 2.))):
+            return False
+    return True
 
 
 def _tidy_degenerate_solutions(pos, constraints):
@@ -185,6 +226,131 @@ class YouUbCalcStrategy(PaperSpecificUbCalcStrategy):
         return PHI.I * CHI.I * ETA.I * MU.I * q_lab
 
 
+REFERENCE_DETECTOR_SAMPLE = 'reference, detector and sample'
+DETECTOR_TWO_SAMPLE = 'detector and two sample'
+REFERENCE_TWO_SAMPLE = 'reference and two sample'
+THREE_SAMPLE = 'three sample'
+NUMERICAL = 'numerical'
+
+NOT_IMPLEMENTED_MSG = ("Sorry, the selected constraint combination is valid but "
+                       "is not implemented. Type 'help con' for implemented combinations")
+
+
+class ConstraintPlan(object):
+    """The active constraint combination compiled for repeated evaluation.
+
+    A plan is built from a YouConstraintManager once, when the constraints
+    change, and holds everything _hklToAngles needs that does not depend on
+    the reflection: the solver branch to take, the constraint values, their
+    sines and cosines and, for three sample constraints, the coefficients of
+    the equation for the remaining sample angle. The reference, detector,
+    naz and sample dictionaries mirror those of YouConstraintManager, and
+    all holds every constraint value.
+
+    Combinations without a closed form solution take the NUMERICAL branch.
+    Raises DiffcalcException if the constraints are incomplete.
+    """
+
+    def __init__(self, constraints):
+        if not constraints.is_fully_constrained():
+            raise DiffcalcException(
+                "Diffcalc is not fully constrained.\n"
+                "Type 'help con' for instructions")
+
+        self.all = constraints.all
+        self.reference = constraints.reference
+        self.detector = constraints.detector
+        self.naz = constraints.naz
+        self.sample = constraints.sample
+        assert not (self.detector and self.naz), (
+               "Two 'detector' constraints given")
+
+        self.trig = dict((name, (sin(value), cos(value)))
+                         for name, value in constraints.all.items()
+                         if value is not None)
+
+        if self.reference:
+            self.ref_name, self.ref_value = self.reference.items()[0]
+        else:
+            self.ref_name = self.ref_value = None
+        self.uses_surface_normal = self.ref_name in ('bin_eq_bout', 'betain',
+                                                     'betaout')
+        # constraints checked against the virtual angles of each solution
+        self.virtual_constraints = (self.reference.items() +
+                                    self.detector.items() + self.naz.items())
+
+        if not constraints.is_current_mode_implemented():
+            self.branch = NUMERICAL
+        elif self.detector or self.naz:
+            if len(self.sample) == 1:
+                self.branch = REFERENCE_DETECTOR_SAMPLE
+            elif not self.detector:
+                # no closed form for naz and two sample constraints
+                self.branch = NUMERICAL
+            else:
+                self.branch = DETECTOR_TWO_SAMPLE
+        elif len(self.sample) == 2:
+            self.branch = REFERENCE_TWO_SAMPLE
+        else:
+            self.branch = THREE_SAMPLE
+            self._compile_three_sample_coefficients()
+
+    def _compile_three_sample_coefficients(self):
+        """Coefficients of A sin(x) + B cos(x) = C for the free sample angle x.
+
+        A, B and C are linear in the normalised h_phi = (h0, h1, h2) with
+        coefficient vectors a, b and c, and sin(theta) is subtracted from C.
+        """
+        free = [name for name in ('mu', 'eta', 'chi', 'phi')
+                if name not in self.sample]
+        if len(free) != 1:
+            raise DiffcalcException(
+                'Internal error: Invalid set of sample constraints.')
+        self.free_sample_angle = free[0]
+        sm, cm = self.trig.get('mu', (None, None))
+        se, ce = self.trig.get('eta', (None, None))
+        sc, cc = self.trig.get('chi', (None, None))
+        sp, cp = self.trig.get('phi', (None, None))
+
+        if self.free_sample_angle == 'mu':
+            self.a = (cp * sc, sc * sp, -cc)
+            self.b = (-cc * se * cp - ce * sp, ce * cp - cc * se * sp, -sc * se)
+            self.c = (0., 0., 0.)
+        elif self.free_sample_angle == 'eta':
+            self.a = (-cc * cm * cp, -cc * cm * sp, -cm * sc)
+            self.b = (-cm * sp, cm * cp, 0.)
+            self.c = (-cp * sc * sm, -sc * sm * sp, cc * sm)
+        elif self.free_sample_angle == 'chi':
+            self.a = (cp * sm, sm * sp, -cm * se)
+            self.b = (-cm * cp * se, -cm * se * sp, -sm)
+            self.c = (ce * cm * sp, -ce * cm * cp, 0.)
+        else:  # phi
+            self.a = (-ce * cm, sc * sm - cc * se * cm, 0.)
+            self.b = (sc * sm - cc * se * cm, ce * cm, 0.)
+            self.c = (0., 0., cm * sc * se + cc * sm)
+
+    def sample_trig_with(self, value):
+        """Return sin and cos of mu, eta, chi and phi with the free sample
+        angle set to value (three sample constraint plans only)."""
+        trig = dict(self.trig)
+        trig[self.free_sample_angle] = (sin(value), cos(value))
+        return trig['mu'] + trig['eta'] + trig['chi'] + trig['phi']
+
+    def sample_angles_with(self, value):
+        """Return mu, eta, chi and phi with the free sample angle set to value
+        (three sample constraint plans only)."""
+        angles = dict(self.sample)
+        angles[self.free_sample_angle] = value
+        return angles['mu'], angles['eta'], angles['chi'], angles['phi']
+
+    def __str__(self):
+        return '%s plan for %s' % (
+            self.branch, ', '.join(sorted(self.reference.keys() +
+                                          self.detector.keys() +
+                                          self.naz.keys() +
+                                          self.sample.keys())))
+
+
 UNREACHABLE_MSG = (
     'The current combination of constraints with %s = %.4f\n'
     'prohibits a solution for the specified reflection.')
@@ -198,6 +364,12 @@ class YouHklCalculator(HklCalculatorBase):
                                    raiseExceptionsIfAnglesDoNotMapBackToHkl)
         self.constraints = constraints
         self.parameter_manager = constraints  # TODO: remove need for this attr
+        self.solution_cache = LRUCache(SOLUTION_CACHE_SIZE)
+        self.readback_cache = LRUCache(READBACK_CACHE_SIZE)
+        self.processes = 1  # worker processes used for hkl lists
+        self.numerical_solver = None  # created when first needed
+        self._plan = None
+        self._plan_version = None
 
     def __str__(self):
         return self.constraints.__str__()
@@ -214,39 +386,137 @@ class YouHklCalculator(HklCalculatorBase):
     def repr_mode(self):
         return repr(self.constraints.all)
 
+    def anglesToHkl(self, pos, wavelength):
+        """
+        Return hkl tuple and dictionary of all virtual angles in degrees from
+        Position in degrees and wavelength in Angstroms.
+
+        Results are kept in readback_cache, keyed on the position, wavelength
+        and the UB calculation version, so that a diffractometer read back
+        repeatedly while stationary is only calculated once.
+        """
+        version = version_key(self._ubcalc)
+        if version is None or self.readback_cache.maxsize <= 0:
+            return HklCalculatorBase.anglesToHkl(self, pos, wavelength)
+        key = (tuple(pos.inDegrees().totuple()), float(wavelength), version,
+               settings.include_reference)
+        result = self.readback_cache.get(key)
+        if result is None:
+            result = HklCalculatorBase.anglesToHkl(self, pos, wavelength)
+            self.readback_cache.put(key, result)
+        hkl, virtual_angles = result
+        return hkl, dict(virtual_angles)
+
     def _anglesToHkl(self, pos, wavelength):
         """Calculate miller indices from position in radians.
         """
-        return youAnglesToHkl(pos, wavelength, self._get_ubmatrix())
+        return youAnglesToHkl(pos, wavelength, self._get_ubmatrix(),
+                              self._getUBMatrixInverse())
+
+    def anglesArrayToHkl(self, positions, wavelength):
+        """
+        Return an (N, 3) array of hkl from an (N, 6) array of mu, delta, nu,
+        eta, chi and phi in degrees and a wavelength in Angstroms or an array
+        of N wavelengths.
+        """
+        from numpy import asarray
+        from diffcalc.hkl.you.batch import youAnglesToHklArray
+        positions = asarray(positions, dtype=float) * TORAD
+        return youAnglesToHklArray(positions, wavelength, self._get_ubmatrix(),
+                                   self._getUBMatrixInverse())
+
+    def anglesArrayToVirtualAngles(self, positions, _wavelength):
+        """
+        Return a structured array with a field in degrees for each virtual
+        angle from an (N, 6) array of mu, delta, nu, eta, chi and phi in
+        degrees. All angles are nan for positions where they cannot be
+        calculated.
+        """
+        from numpy import asarray
+        from diffcalc.hkl.you.batch import youAnglesToVirtualAnglesArray
+        positions = asarray(positions, dtype=float) * TORAD
+        virtual_angles = youAnglesToVirtualAnglesArray(
+            positions, self._get_n_phi(), self._get_surf_nphi())
+        for name in virtual_angles.dtype.names:
+            virtual_angles[name] *= TODEG
+        return virtual_angles
+
+    def anglesArrayToHklJacobians(self, positions, wavelength):
+        """
+        Return the (N, 3, 6) derivatives of h, k & l by each of mu, delta,
+        nu, eta, chi and phi (per degree) at an (N, 6) array of positions in
+        degrees, for a wavelength in Angstroms or an array of N wavelengths.
+
+        Multiplied by the encoder resolutions these give the resolution in
+        hkl.
+        """
+        from numpy import asarray
+        from diffcalc.hkl.you.numerical import hkl_jacobians
+        positions = asarray(positions, dtype=float) * TORAD
+        return hkl_jacobians(positions, wavelength,
+                             self._getUBMatrixInverse()) * TORAD
+
+    def hklToAnglesJacobians(self, positions, wavelength):
+        """
+        Return the (N, 6, 3) derivatives of mu, delta, nu, eta, chi and phi
+        (in degrees) by h, k & l at an (N, 6) array of solution positions in
+        degrees, moving so that the current constraints stay satisfied.
+
+        The angle velocities for a move through hkl space are these times
+        the hkl velocity. Derivatives are nan where the constraints do not
+        fix the angles to first order.
+        """
+        from numpy import asarray
+        from diffcalc.hkl.you.numerical import angle_jacobians
+        if not self.constraints.is_fully_constrained():
+            raise DiffcalcException(
+                "Diffcalc is not fully constrained.\n"
+                "Type 'help con' for instructions")
+        positions = asarray(positions, dtype=float) * TORAD
+        return angle_jacobians(
+            positions, wavelength, self._getUBMatrixInverse(),
+            self.constraints.all, self._get_n_phi(),
+            self._get_surf_nphi()) * TODEG
 
     def _anglesToVirtualAngles(self, pos, _wavelength):
         """Calculate pseudo-angles in radians from position in radians.
 
         Return theta, qaz, alpha, naz, tau, psi and beta in a dictionary.
 
+        """
+        angles = pos.totuple()
+        return self._virtual_angles_from_rotations(
+            angles, create_you_rotations(*angles),
+            mat3.from_matrix(self._get_n_phi()),
+            mat3.from_matrix(self._get_surf_nphi()))
+
+    def _virtual_angles_from_rotations(self, angles, rotations, n_phi,
+                                       surf_nphi):
+        """Calculate pseudo-angles in radians from the position angles in
+        radians, their rotation matrices and the reference and surface normals
+        as mat3 vectors.
         """
 
         # depends on surface normal n_lab.
-        mu, delta, nu, eta, chi, phi = pos.totuple()
+        mu, delta, nu, eta, chi, phi = angles
 
         theta, qaz = _theta_and_qaz_from_detector_angles(delta, nu)      # (19)
 
-        [MU, DELTA, NU, ETA, CHI, PHI] = create_you_matrices(mu,
-                                           delta, nu, eta, chi, phi)
-        Z = MU * ETA * CHI * PHI
-        D = NU * DELTA
+        [MU, DELTA, NU, ETA, CHI, PHI] = rotations
+        Z = mat3.mul(mat3.mul(mat3.mul(MU, ETA), CHI), PHI)
+        D = mat3.mul(NU, DELTA)
 
         # Compute incidence and outgoing angles bin and betaout
-        surf_nphi = Z * self._get_surf_nphi()
-        kin = matrix([[0],[1],[0]])
-        kout = D * matrix([[0],[1],[0]])
+        surf_nphi = mat3.mul_vec(Z, surf_nphi)
+        kin = (0, 1, 0)
+        kout = mat3.mul_vec(D, kin)
         betain = angle_between_vectors(kin, surf_nphi) - pi / 2.
         betaout = pi / 2. - angle_between_vectors(kout, surf_nphi)
 
         if settings.include_reference:
-            n_lab = Z * self._get_n_phi()
-            alpha = asin(bound((-n_lab[1, 0])))
-            naz = atan2(n_lab[0, 0], n_lab[2, 0])                            # (20)
+            n_lab = mat3.mul_vec(Z, n_phi)
+            alpha = asin(bound((-n_lab[1])))
+            naz = atan2(n_lab[0], n_lab[2])                                  # (20)
 
             cos_tau = cos(alpha) * cos(theta) * cos(naz - qaz) + \
                       sin(alpha) * sin(theta)
@@ -270,14 +540,27 @@ class YouHklCalculator(HklCalculatorBase):
                 'betain': betain, 'betaout': betaout}
 
 
-    def _choose_single_solution(self, pos_virtual_angles_pairs_in_degrees):
+    def _choose_single_solution(self, pos_virtual_angles_pairs_in_degrees,
+                                reference_position=None):
+        """Return the solution closest to reference_position.
+
+        reference_position may be a YouPosition or a snapshot of the physical
+        angles in degrees. If None the hardware position is read, but only
+        when there is more than one solution to choose from.
+        """
 
         if len(pos_virtual_angles_pairs_in_degrees) == 1:
             return pos_virtual_angles_pairs_in_degrees[0]
 
         absolute_distances = []
-        _hw_pos = settings.hardware.get_position()
-        _you_pos = settings.geometry.physical_angles_to_internal_position(_hw_pos).totuple()
+        if reference_position is None:
+            reference_position = settings.hardware.get_position()
+        if isinstance(reference_position, YouPosition):
+            _ref_pos = reference_position.clone()
+            _ref_pos.changeToDegrees()
+            _you_pos = _ref_pos.totuple()
+        else:
+            _you_pos = settings.geometry.physical_angles_to_internal_position(reference_position).totuple()
 
         metric = lambda (a, b): 2.* asin(abs(sin((a - b) * TORAD / 2.))) * TODEG
 
@@ -309,7 +592,37 @@ class YouHklCalculator(HklCalculatorBase):
 
         return pos, virtual_angles
 
-    def hklToAngles(self, h, k, l, wavelength, return_all_solutions=False):
+    def _state_version(self):
+        """Return a key identifying the state that solutions depend on.
+
+        The key changes whenever the UB calculation, the constraints or the
+        hardware limits and cuts change, including limits set outside
+        diffcalc (see HardwareAdapter.limits_key). None is returned if any of
+        these do not publish change notifications, in which case nothing is
+        cached.
+        """
+        versions = version_key(self._ubcalc, self.constraints,
+                               settings.hardware)
+        if versions is None:
+            return None
+        return versions + (settings.geometry, settings.include_reference,
+                           settings.hardware.limits_key())
+
+    def _get_constraint_plan(self):
+        """Return the ConstraintPlan for the current constraints.
+
+        The plan is compiled again only when the constraints change.
+        """
+        version = version_key(self.constraints)
+        if version is None:
+            return ConstraintPlan(self.constraints)
+        if self._plan is None or self._plan_version != version:
+            self._plan = ConstraintPlan(self.constraints)
+            self._plan_version = version
+        return self._plan
+
+    def hklToAngles(self, h, k, l, wavelength, return_all_solutions=False,
+                    reference_position=None):
         """
         Return verified Position and all virtual angles in degrees from
         h, k & l and wavelength in Angstroms.
@@ -324,9 +637,58 @@ class YouHklCalculator(HklCalculatorBase):
         Throws a DiffcalcException if either check fails and
         raiseExceptionsIfAnglesDoNotMapBackToHkl is True, otherwise displays a
         warning.
-        """
 
-        pos_virtual_angles_pairs = self._hklToAngles(h, k, l, wavelength, return_all_solutions)  # in rad
+        If there is more than one solution the one closest to
+        reference_position is returned. This may be a YouPosition or a
+        snapshot of the physical angles in degrees (as returned by the
+        hardware's get_position()) and defaults to the current hardware
+        position. Scans should pass the previous point's target to save
+        reading back the hardware.
+
+        Results are kept in solution_cache, keyed on hkl, wavelength and the
+        state version, and copies are returned for repeated requests.
+        Constraint combinations solved numerically are not cached, as their
+        solutions depend on the starting position (reference_position if
+        given).
+        """
+        with profiler.stage('hklToAngles'):
+            return self._cached_hkl_to_angles(h, k, l, wavelength,
+                                              return_all_solutions,
+                                              reference_position)
+
+    def _cached_hkl_to_angles(self, h, k, l, wavelength, return_all_solutions,
+                              reference_position):
+        pos_virtual_angles_pairs_in_degrees = self._cached_solutions(
+            h, k, l, wavelength, return_all_solutions, reference_position)
+        if return_all_solutions:
+            return pos_virtual_angles_pairs_in_degrees
+        else:
+            return self._choose_single_solution(
+                pos_virtual_angles_pairs_in_degrees, reference_position)
+
+    def _cached_solutions(self, h, k, l, wavelength, return_all_solutions,
+                          reference_position=None):
+        version = self._state_version()
+        if (version is None or self.solution_cache.maxsize <= 0 or
+                self._get_constraint_plan().branch == NUMERICAL):
+            pos_virtual_angles_pairs_in_degrees = self._verified_hkl_to_angles(
+                h, k, l, wavelength, return_all_solutions, reference_position)
+        else:
+            key = (float(h), float(k), float(l), float(wavelength),
+                   bool(return_all_solutions), version)
+            result = self.solution_cache.get(key)
+            if result is None:
+                result = self._verified_hkl_to_angles(h, k, l, wavelength,
+                                                      return_all_solutions)
+                self.solution_cache.put(key, result)
+            pos_virtual_angles_pairs_in_degrees = deepcopy(result)
+        return pos_virtual_angles_pairs_in_degrees
+
+    def _verified_hkl_to_angles(self, h, k, l, wavelength,
+                                return_all_solutions=False,
+                                reference_position=None):
+        pos_virtual_angles_pairs = self._hklToAngles(h, k, l, wavelength, return_all_solutions,
+                                                     reference_position)  # in rad
         assert pos_virtual_angles_pairs
         pos_virtual_angles_pairs_in_degrees = []
         for pos, virtual_angles in pos_virtual_angles_pairs:
@@ -337,17 +699,12 @@ class YouHklCalculator(HklCalculatorBase):
                 if val is not None:
                     virtual_angles[key] = val * TODEG
 
-            self._verify_pos_map_to_hkl(h, k, l, wavelength, pos)
-
             pos_virtual_angles_pairs_in_degrees.append((pos, virtual_angles))
 
-        if return_all_solutions:
-            return pos_virtual_angles_pairs_in_degrees
-        else:
-            pos, virtual_angles = self._choose_single_solution(pos_virtual_angles_pairs_in_degrees)
-            return pos, virtual_angles
+        return pos_virtual_angles_pairs_in_degrees
 
-    def hklListToAngles(self, hkl_list, wavelength, return_all_solutions=False):
+    def hklListToAngles(self, hkl_list, wavelength, return_all_solutions=False,
+                        reference_position=None, processes=None):
         """
         Return verified Position and all virtual angles in degrees from
         h, k & l and wavelength in Angstroms.
@@ -362,25 +719,23 @@ class YouHklCalculator(HklCalculatorBase):
         Throws a DiffcalcException if either check fails and
         raiseExceptionsIfAnglesDoNotMapBackToHkl is True, otherwise displays a
         warning.
-        """
 
-        pos_virtual_angles_pairs_in_degrees = []
-        for (h, k, l) in hkl_list:
-            try:
-                pos_virtual_angles_pairs = self._hklToAngles(h, k, l, wavelength, return_all_solutions)  # in rad
-                for pos, virtual_angles in pos_virtual_angles_pairs:
-                    
-                    # to degrees:
-                    pos.changeToDegrees()
-                    for key, val in virtual_angles.items():
-                        if val is not None:
-                            virtual_angles[key] = val * TODEG
-        
-                    self._verify_pos_map_to_hkl(h, k, l, wavelength, pos)
-        
-                    pos_virtual_angles_pairs_in_degrees.append((pos, virtual_angles))
-            except DiffcalcException:
-                continue
+        The solution closest to reference_position is returned, as for
+        hklToAngles.
+
+        Long lists are split across processes worker processes, defaulting to
+        self.processes; 0 uses one per cpu. See diffcalc.hkl.you.parallel.
+        """
+        if processes is None:
+            processes = self.processes
+        if processes == 1:
+            pos_virtual_angles_pairs_in_degrees = self._hkl_list_solutions(
+                hkl_list, wavelength, return_all_solutions, reference_position)
+        else:
+            from diffcalc.hkl.you.parallel import hkl_list_solutions
+            pos_virtual_angles_pairs_in_degrees = hkl_list_solutions(
+                self, hkl_list, wavelength, return_all_solutions, processes,
+                reference_position)
         if not pos_virtual_angles_pairs_in_degrees:
             raise DiffcalcException('No solutions were found matching existing hardware limits. '
                 'Please consider using an alternative set of constraints.')
@@ -388,55 +743,200 @@ class YouHklCalculator(HklCalculatorBase):
         if return_all_solutions:
             return pos_virtual_angles_pairs_in_degrees
         else:
-            pos, virtual_angles = self._choose_single_solution(pos_virtual_angles_pairs_in_degrees)
+            pos, virtual_angles = self._choose_single_solution(
+                pos_virtual_angles_pairs_in_degrees, reference_position)
             return pos, virtual_angles
 
+    def _hkl_list_solutions(self, hkl_list, wavelength, return_all_solutions,
+                            reference_position=None):
+        """Return the verified solutions in degrees for every hkl in hkl_list
+        in order, skipping those that cannot be reached."""
+        pos_virtual_angles_pairs_in_degrees = []
+        for _, pos_virtual_angles_pairs in self._iter_hkl_list_solutions(
+                hkl_list, wavelength, return_all_solutions, reference_position):
+            pos_virtual_angles_pairs_in_degrees.extend(pos_virtual_angles_pairs)
+        return pos_virtual_angles_pairs_in_degrees
+
+    def iterHklListToAngles(self, hkl_list, wavelength,
+                            return_all_solutions=False, chunk_size=None,
+                            processes=None):
+        """
+        Generate the verified solutions for each hkl in hkl_list in turn.
+
+        Yields (hkl, pos_virtual_angles_pairs) as soon as each hkl has been
+        solved, where pos_virtual_angles_pairs is the list of Position and
+        virtual angles pairs in degrees, as returned by hklToAngles with
+        return_all_solutions set, or an empty list if the hkl cannot be
+        reached. Unless return_all_solutions is True only solutions within the
+        hardware limits are included.
+
+        hkl_list may be any iterable, including a generator, and is only read
+        as far as the solutions are consumed. Stop iterating to stop solving,
+        e.g. to find the first reachable hkl:
+
+            for hkl, solutions in hklcalc.iterHklListToAngles(hkls, wl):
+                if solutions:
+                    break
+
+        If chunk_size is given, lists of up to chunk_size (hkl,
+        pos_virtual_angles_pairs) items are yielded instead.
+
+        Long lists are solved by processes worker processes as by
+        hklListToAngles. The whole of hkl_list is then read at the start
+        and the items are yielded as each chunk of the list is finished.
+        """
+        if chunk_size is not None:
+            if chunk_size < 1:
+                raise ValueError('chunk_size must be at least 1')
+            return self._iter_chunks(self.iterHklListToAngles(
+                hkl_list, wavelength, return_all_solutions,
+                processes=processes), chunk_size)
+        if processes is None:
+            processes = self.processes
+        if processes == 1:
+            return self._iter_hkl_list_solutions(hkl_list, wavelength,
+                                                 return_all_solutions)
+        from diffcalc.hkl.you.parallel import iter_hkl_list_solutions
+        return iter_hkl_list_solutions(self, hkl_list, wavelength,
+                                       return_all_solutions, processes)
+
+    def _iter_hkl_list_solutions(self, hkl_list, wavelength,
+                                 return_all_solutions, reference_position=None):
+        for hkl in hkl_list:
+            h, k, l = hkl
+            try:
+                pos_virtual_angles_pairs = self._cached_solutions(
+                    h, k, l, wavelength, return_all_solutions,
+                    reference_position)
+            except DiffcalcException:
+                pos_virtual_angles_pairs = []
+            yield hkl, pos_virtual_angles_pairs
+
+    @staticmethod
+    def _iter_chunks(items, chunk_size):
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def hklPathToAngles(self, hkl_path, wavelength, start_position=None,
+                        max_step=10.):
+        """
+        Return a continuous trajectory of positions in degrees through the
+        ordered reflections in hkl_path.
+
+        The solution branch is carried from each point to the next instead of
+        choosing each point's solution afresh, and angles are not cut so that
+        they do not jump by 360 degrees. Returns (positions, virtual_angles,
+        flips) where flips lists the points before which a jump larger than
+        max_step degrees could not be avoided. See
+        diffcalc.hkl.you.trajectory.
+        """
+        from diffcalc.hkl.you.trajectory import hkl_path_to_angles
+        return hkl_path_to_angles(self, hkl_path, wavelength, start_position,
+                                  max_step)
+
+    def hklPathToPVT(self, hkl_path, wavelength, total_time=None,
+                     hkl_speed=None, max_velocity=None, max_acceleration=None,
+                     start_position=None, max_step=10., ramp=True):
+        """
+        Return a position-velocity-time trajectory for a continuous scan
+        through the ordered reflections in hkl_path, taking either total_time
+        seconds or moving at hkl_speed through hkl, and slowed down as needed
+        to respect the axes' max_velocity and max_acceleration. See
+        diffcalc.hkl.you.flyscan.
+        """
+        from diffcalc.hkl.you.flyscan import hkl_path_to_pvt
+        return hkl_path_to_pvt(self, hkl_path, wavelength, total_time,
+                               hkl_speed, max_velocity, max_acceleration,
+                               start_position, max_step, ramp)
+
+    def reachableReflections(self, wavelength, reference_position=None):
+        """
+        Return every integer reflection that can be reached within the
+        hardware limits with the current constraints, ordered by two theta,
+        as (hkl, positions, ttheta) arrays with positions and ttheta in
+        degrees. The solution closest to the internal reference_position is
+        given, if one is. See diffcalc.hkl.you.reachable.
+        """
+        from diffcalc.hkl.you.reachable import reachable_reflections
+        return reachable_reflections(self, wavelength, reference_position)
+
+    def accessibleVolume(self, wavelength, step=.1, samples=1000000, seed=0):
+        """
+        Return an AccessibleVolume, a voxel map with the given step in
+        reciprocal lattice units of the hkl reached by samples random
+        positions within the hardware limits, whatever the constraints. See
+        diffcalc.hkl.you.accessible.
+        """
+        from diffcalc.hkl.you.accessible import accessible_volume
+        return accessible_volume(self, wavelength, step, samples, seed)
 
     def hkl_to_all_angles(self, h, k, l, wavelength):
         return self.hklToAngles(h, k, l, wavelength, True)
 
+    def hklArrayToAngles(self, hkl_array, wavelength, filter_out_of_limits=True):
+        """
+        Return all verified solutions for an array of reflections.
+
+        hkl_array is an (N, 3) array of h, k & l values and wavelength either a
+        single wavelength in Angstroms or an array of N wavelengths.
+
+        Returns (index, positions, virtual_angles) where index is an (M,)
+        array holding the row of hkl_array each solution belongs to, positions
+        an (M, 6) array of mu, delta, nu, eta, chi and phi in degrees and
+        virtual_angles a structured (M,) array with a field in degrees for
+        each virtual angle. Reflections
+        without a solution do not appear in index. Solutions outside the
+        hardware limits are removed if filter_out_of_limits is True.
+
+        The solutions are the same as those returned by hklToAngles with
+        return_all_solutions set, but for modes with one reference, one
+        detector and one sample constraint the calculation is carried out for
+        all reflections at once with numpy. For 10000 reflections this is
+        around 100 times faster than calling hklToAngles for each. Other
+        modes solve the reflections one by one.
+        """
+        from diffcalc.hkl.you.batch import hkl_array_to_angles
+        return hkl_array_to_angles(self, hkl_array, wavelength,
+                                   filter_out_of_limits)
+
 
-    def _hklToAngles(self, h, k, l, wavelength, return_all_solutions=False):
+    def _hklToAngles(self, h, k, l, wavelength, return_all_solutions=False,
+                     reference_position=None):
         """(pos, virtualAngles) = hklToAngles(h, k, l, wavelength) --- with
         Position object pos and the virtual angles returned in degrees. Some
         modes may not calculate all virtual angles.
-        """
-
-        if not self.constraints.is_fully_constrained():
-            raise DiffcalcException(
-                "Diffcalc is not fully constrained.\n"
-                "Type 'help con' for instructions")
-
-        if not self.constraints.is_current_mode_implemented():
-            raise DiffcalcException(
-                "Sorry, the selected constraint combination is valid but "
-                "is not implemented. Type 'help con' for implemented combinations")
-              
-        # constraints are dictionaries  
-        ref_constraint = self.constraints.reference
-        if ref_constraint:
-            ref_constraint_name, ref_constraint_value = ref_constraint.items()[0]
-        det_constraint = self.constraints.detector
-        naz_constraint = self.constraints.naz
-        samp_constraints = self.constraints.sample
-            
-        assert not (det_constraint and naz_constraint), (
-               "Two 'detector' constraints given")
 
+        reference_position, if given, seeds the numerical solver in place of
+        the hardware position.
+        """
 
-        h_phi = self._get_ubmatrix() * matrix([[h], [k], [l]])
-        theta = self._calc_theta(h_phi, wavelength)
-        tau = angle_between_vectors(h_phi, self._get_n_phi())
-        surf_tau = angle_between_vectors(h_phi, self._get_surf_nphi())
+        stage = profiler.stage
+        with stage('constraint plan'):
+            plan = self._get_constraint_plan()
+        ref_constraint_name = plan.ref_name
+        ref_constraint_value = plan.ref_value
+        samp_constraints = plan.sample
+
+        with stage('theta and tau'):
+            h_phi = self._get_ubmatrix() * matrix([[h], [k], [l]])
+            theta = self._calc_theta(h_phi, wavelength)
+            tau = angle_between_vectors(h_phi, self._get_n_phi())
+            surf_tau = angle_between_vectors(h_phi, self._get_surf_nphi())
         
-        if is_small(sin(tau)) and ref_constraint:
+        if is_small(sin(tau)) and ref_constraint_name:
             if ref_constraint_name == 'psi':
                 raise DiffcalcException("Azimuthal angle 'psi' is undefined as reference and scattering vectors parallel.\n"
                                         "Please constrain one of the sample angles or choose different reference vector orientation.")
             elif ref_constraint_name == 'a_eq_b':
                 raise DiffcalcException("Reference constraint 'a_eq_b' is redundant as reference and scattering vectors are parallel.\n"
                                         "Please constrain one of the sample angles or choose different reference vector orientation.")
-        if is_small(sin(surf_tau)) and ref_constraint and ref_constraint_name == 'bin_eq_bout':
+        if is_small(sin(surf_tau)) and ref_constraint_name == 'bin_eq_bout':
             raise DiffcalcException("Reference constraint 'bin_eq_bout' is redundant as scattering vectors is parallel to the surface normal.\n"
                                     "Please select another constrain to define sample azimuthal orientation.")
 
@@ -444,118 +944,170 @@ class YouHklCalculator(HklCalculatorBase):
         ### Reference constraint column ###
 
         n_phi = self._get_n_phi()
-        if ref_constraint:
-            if set(['psi', 'a_eq_b', 'alpha', 'beta']).issuperset(ref_constraint.keys()):
-                # An angle for the reference vector (n) is given      (Section 5.2)         
-                alpha, _ = self._calc_remaining_reference_angles(
-                    ref_constraint_name, ref_constraint_value, theta, tau)
-            elif set(['bin_eq_bout', 'betain', 'betaout']).issuperset(ref_constraint.keys()):
-                alpha, _ = self._calc_remaining_reference_angles(
-                    ref_constraint_name, ref_constraint_value, theta, surf_tau)
-                tau = surf_tau
-                n_phi = self._get_surf_nphi()
+        if ref_constraint_name:
+            with stage('reference angles'):
+                if plan.uses_surface_normal:
+                    alpha, _ = self._calc_remaining_reference_angles(
+                        ref_constraint_name, ref_constraint_value, theta, surf_tau)
+                    tau = surf_tau
+                    n_phi = self._get_surf_nphi()
+                else:
+                    # An angle for the reference vector (n) is given      (Section 5.2)         
+                    alpha, _ = self._calc_remaining_reference_angles(
+                        ref_constraint_name, ref_constraint_value, theta, tau)
 
+        # With two sample constraints and a reference, or three sample
+        # constraints, the detector angles are found along with the sample
+        # angles and are timed with them.
         solution_tuples = []
-        if det_constraint or naz_constraint:
-
-            if len(samp_constraints) == 1:
-                for qaz, naz, delta, nu in self._calc_det_angles_given_det_or_naz_constraint(
-                                                det_constraint, naz_constraint, theta, tau, alpha):
+        if plan.branch == REFERENCE_DETECTOR_SAMPLE:
+            with stage('detector angles'):
+                detector_solutions = list(self._calc_det_angles_given_det_or_naz_constraint(
+                                                plan.detector, plan.naz, theta, tau, alpha))
+            with stage('sample angles'):
+                for qaz, naz, delta, nu in detector_solutions:
                     for mu, eta, chi, phi in self._calc_sample_angles_from_one_sample_constraint(
                                                 samp_constraints, h_phi, theta, alpha, qaz, naz, n_phi):
                         solution_tuples.append((mu, delta, nu, eta, chi, phi))
 
-            elif len(samp_constraints) == 2:
-                if det_constraint:
-                    det_constraint_name, det_constraint_val = det_constraint.items()[0]
-                    for delta, nu, qaz in self._calc_remaining_detector_angles(det_constraint_name, det_constraint_val, theta):
-                        for mu, eta, chi, phi in self._calc_sample_angles_given_two_sample_and_detector(
-                            samp_constraints, qaz, theta, h_phi, n_phi):
-                            solution_tuples.append((mu, delta, nu, eta, chi, phi))
-                
-                else:
-                    raise DiffcalcException(
-                        'No code yet to handle this combination of detector and sample constraints!')
+        elif plan.branch == DETECTOR_TWO_SAMPLE:
+            det_constraint_name, det_constraint_val = plan.detector.items()[0]
+            with stage('detector angles'):
+                detector_solutions = list(self._calc_remaining_detector_angles(
+                    det_constraint_name, det_constraint_val, theta))
+            with stage('sample angles'):
+                for delta, nu, qaz in detector_solutions:
+                    for mu, eta, chi, phi in self._calc_sample_angles_given_two_sample_and_detector(
+                        samp_constraints, qaz, theta, h_phi, n_phi):
+                        solution_tuples.append((mu, delta, nu, eta, chi, phi))
 
-        elif len(samp_constraints) == 2:
-            if ref_constraint_name == 'psi':
-                psi_vals = [ref_constraint_value,]
-            else:
-                psi_vals = self._calc_psi(alpha, theta, tau)
-            for psi in psi_vals:
-                angles = list(self._calc_sample_given_two_sample_and_reference(
-                    samp_constraints, h_phi, theta, psi, n_phi))
-                solution_tuples.extend(angles)
-
-        elif len(samp_constraints) == 3:
-            for angles in self._calc_angles_given_three_sample_constraints(
-                h, k, l, wavelength, return_all_solutions, samp_constraints,
-                 h_phi, theta):
-                solution_tuples.append(angles)
+        elif plan.branch == REFERENCE_TWO_SAMPLE:
+            with stage('sample angles'):
+                if ref_constraint_name == 'psi':
+                    psi_vals = [ref_constraint_value,]
+                else:
+                    psi_vals = self._calc_psi(alpha, theta, tau)
+                for psi in psi_vals:
+                    angles = list(self._calc_sample_given_two_sample_and_reference(
+                        samp_constraints, h_phi, theta, psi, n_phi))
+                    solution_tuples.extend(angles)
+
+        elif plan.branch == THREE_SAMPLE:
+            with stage('sample angles'):
+                for angles in self._calc_angles_given_three_sample_constraints(
+                        plan, h_phi, theta):
+                    solution_tuples.append(angles)
+
+        else:  # NUMERICAL
+            with stage('numerical solution'):
+                solution_tuples = self._solve_numerically(plan, h_phi,
+                                                          wavelength,
+                                                          reference_position)
         
         if not solution_tuples:
             raise DiffcalcException('No solutions were found. '
                 'Please consider using an alternative set of constraints.')
 
-        tidy_solutions = [_tidy_degenerate_solutions(YouPosition(*pos, unit='RAD'),
-                                                     self.constraints).totuple() for pos in solution_tuples]
-        merged_solution_tuples = set(self._filter_angle_limits(tidy_solutions,
-                                                               not return_all_solutions))
-        if not merged_solution_tuples:
+        return self._prune_candidates(h, k, l, wavelength, solution_tuples,
+                                      plan, not return_all_solutions)
+
+    def _prune_candidates(self, h, k, l, wavelength, solution_tuples, plan,
+                          filter_out_of_limits):
+        """Return (position, virtual angles) pairs in radians for the
+        candidate solution_tuples that survive each check.
+
+        Each candidate passes once through the pipeline: it is tidied, cut
+        and checked against the hardware limits, dropped if it duplicates an
+        earlier one and then checked against the virtual angle constraints and
+        mapped back to hkl. The rotation matrices are calculated once per
+        candidate and shared by the last two checks. The number of candidates
+        rejected by each stage is counted by the profiler.
+        """
+        stage = profiler.stage
+        UBinv = mat3.from_matrix(self._getUBMatrixInverse())
+        n_phi = mat3.from_matrix(self._get_n_phi())
+        surf_nphi = mat3.from_matrix(self._get_surf_nphi())
+        angle_names = settings.hardware.get_axes_names()
+
+        seen = set()
+        out_of_limits = duplicates = mismatched = 0
+        position_pseudo_angles_pairs = []
+        for candidate in solution_tuples:
+            with stage('tidy degenerate solutions'):
+                pos = _tidy_degenerate_solutions(
+                    YouPosition(*candidate, unit='RAD'), plan)
+            with stage('filter angle limits'):
+                angles = self._cut_angles_within_limits(pos, angle_names,
+                                                        filter_out_of_limits)
+            if angles is None:
+                out_of_limits += 1
+                continue
+            if angles in seen:
+                duplicates += 1
+                continue
+            seen.add(angles)
+
+            with stage('virtual angle check'):
+                rotations = create_you_rotations(*angles)
+                pseudo_angles = self._virtual_angles_from_rotations(
+                    angles, rotations, n_phi, surf_nphi)
+                is_sol = _matches_virtual_constraints(pseudo_angles,
+                                                      plan.virtual_constraints)
+            if not is_sol:
+                mismatched += 1
+                continue
+
+            position = YouPosition(*angles, unit='RAD')
+            with stage('verify hkl'):
+                hkl = _hkl_from_you_rotations(rotations, wavelength, UBinv)
+                self._check_hkl_matches(h, k, l, hkl, position.inDegrees())
+            position_pseudo_angles_pairs.append((position, pseudo_angles))
+
+        profiler.reject('filter angle limits', out_of_limits + duplicates)
+        profiler.reject('virtual angle check', mismatched)
+        logger.debug('%d candidate solutions: %d outside limits, %d duplicates,'
+                     ' %d failing virtual angle constraints',
+                     len(solution_tuples), out_of_limits, duplicates,
+                     mismatched)
+
+        if out_of_limits == len(solution_tuples):
             raise DiffcalcException('No solutions were found matching existing hardware limits. '
                 'Please consider using an alternative set of constraints.')
-
-        #def _find_duplicate_angles(el):
-        #    idx, tpl = el
-        #    for tmp_tpl in filtered_solutions[idx:]:
-        #        if False not in [abs(x-y) < SMALL for x,y in zip(tmp_tpl, tpl)]:
-        #            return False
-        #    return True
-        #merged_solution_tuples = filter(_find_duplicate_angles, enumerate(filtered_solutions, 1))
-        position_pseudo_angles_pairs = self._create_position_pseudo_angles_pairs(wavelength, merged_solution_tuples)
         if not position_pseudo_angles_pairs:
             raise DiffcalcException('No solutions were found. Please check hardware limits and '
                 'consider using an alternative pseudo-angle constraints.')
-
         return position_pseudo_angles_pairs
 
+    def _solve_numerically(self, plan, h_phi, wavelength,
+                           reference_position=None):
+        """Solve constraint combinations without a closed form solution.
 
-    def _create_position_pseudo_angles_pairs(self, wavelength, merged_solution_tuples):
-
-        position_pseudo_angles_pairs = []
-        for pos in merged_solution_tuples:
-            # Create position
-            position = YouPosition(*pos, unit='RAD')
-            #position = _tidy_degenerate_solutions(position, self.constraints)
-            #if position.phi <= -pi + SMALL:
-            #    position.phi += 2 * pi
-            # pseudo angles calculated along the way were for the initial solution
-            # and may be invalid for the chosen solution TODO: anglesToHkl need no
-            # longer check the pseudo_angles as they will be generated with the
-            # same function and it will prove nothing
-            pseudo_angles = self._anglesToVirtualAngles(position, wavelength)
-            is_sol = True
-            for constraint in [self.constraints.reference,
-                               self.constraints.detector,
-                               self.constraints.naz]:
-                try:
-                    constraint_name, constraint_value = constraint.items()[0]
-                    if constraint_name == 'a_eq_b':
-                        diff = pseudo_angles['alpha'] - pseudo_angles['beta']
-                    elif constraint_name == 'bin_eq_bout':
-                        diff = pseudo_angles['betain'] - pseudo_angles['betaout']
-                    else:
-                        diff = constraint_value - pseudo_angles[constraint_name]
-                except Exception:
-                    continue
-                diff = abs(sin(diff/2.))
-                if not is_small(diff):
-                    is_sol = False
-                    break
-            if is_sol:
-                position_pseudo_angles_pairs.append((position, pseudo_angles))
-        return position_pseudo_angles_pairs
-
+        The least squares solver is seeded from, amongst others,
+        reference_position or, if None, the current hardware position if it
+        can be read. See diffcalc.hkl.you.numerical.
+        """
+        try:
+            from diffcalc.hkl.you.numerical import LeastSquaresSolver
+        except ImportError:  # numpy is not available
+            raise DiffcalcException(NOT_IMPLEMENTED_MSG)
+        if self.numerical_solver is None:
+            self.numerical_solver = LeastSquaresSolver()
+        try:
+            if reference_position is None:
+                reference_position = settings.hardware.get_position()
+            if isinstance(reference_position, YouPosition):
+                start = reference_position.clone()
+            else:
+                start = settings.geometry.physical_angles_to_internal_position(
+                    reference_position)
+            start.changeToRadians()
+            start = start.totuple()
+        except (DiffcalcException, NotImplementedError):
+            # the position cannot be read; seed from the other starts only
+            start = None
+        return self.numerical_solver.solve(plan.all, h_phi, wavelength,
+                                           self._get_n_phi(),
+                                           self._get_surf_nphi(), start)
 
     def _calc_theta(self, h_phi, wavelength):
         """Calculate theta using Equation1
@@ -830,15 +1382,15 @@ class YouHklCalculator(HklCalculatorBase):
         """Return phi, chi, eta and mu, given one of these"""
         #                                                         (section 5.3)
 
-        N_lab = _calc_N(q_lab, n_lab)
-        N_phi = _calc_N(q_phi, n_phi)
-        Z = N_lab * N_phi.T
+        N_lab = mat3.from_matrix(_calc_N(q_lab, n_lab))
+        N_phi = mat3.from_matrix(_calc_N(q_phi, n_phi))
+        Z = mat3.mul(N_lab, mat3.transpose(N_phi))
 
         if constraint_name == 'mu':                                      # (35)
             mu = constraint_value
-            V = calcMU(mu).I * N_lab * N_phi.T
+            V = mat3.mul(mat3.transpose(mat3.x_rotation(mu)), Z)
             try:
-                acos_chi = acos(bound(V[2, 2]))
+                acos_chi = acos(bound(V[2][2]))
             except AssertionError:
                 return
             if is_small(sin(acos_chi)):
@@ -849,7 +1401,7 @@ class YouHklCalculator(HklCalculatorBase):
                 # tan(phi+eta)=v12/v11 from docs/extensions_to_yous_paper.wxm
                 chi = acos_chi
                 eta = 0.
-                phi = atan2(-V[1, 0], V[1, 1])
+                phi = atan2(-V[1][0], V[1][1])
                 logger.debug(
                     'Eta and phi cannot be chosen uniquely with chi so close '
                     'to 0 or 180. Returning phi=%.3f and eta=%.3f', 
@@ -858,15 +1410,16 @@ class YouHklCalculator(HklCalculatorBase):
             else:
                 for chi in [acos_chi, -acos_chi]:
                     sgn = sign(sin(chi))
-                    phi = atan2(-sgn * V[2, 1], -sgn * V[2, 0])
-                    eta = atan2(-sgn * V[1, 2],  sgn * V[0, 2])
+                    phi = atan2(-sgn * V[2][1], -sgn * V[2][0])
+                    eta = atan2(-sgn * V[1][2],  sgn * V[0][2])
                     yield mu, eta, chi, phi
 
         elif constraint_name == 'phi':                                     # (37)
             phi = constraint_value
-            V = N_lab * N_phi.I * calcPHI(phi).T
+            # N_phi is orthonormal so its inverse is its transpose
+            V = mat3.mul(Z, mat3.transpose(mat3.z_rotation(-phi)))
             try:
-                asin_eta = asin(bound(V[0, 1]))
+                asin_eta = asin(bound(V[0][1]))
             except AssertionError:
                 return
             if is_small(cos(asin_eta)):
@@ -874,8 +1427,8 @@ class YouHklCalculator(HklCalculatorBase):
                                         'with eta so close to +/-90.')
             for eta in [asin_eta, pi - asin_eta]:
                 sgn = sign(cos(eta))
-                mu = atan2(sgn * V[2, 1], sgn * V[1, 1])
-                chi = atan2(sgn * V[0, 2], sgn * V[0, 0])
+                mu = atan2(sgn * V[2][1], sgn * V[1][1])
+                chi = atan2(sgn * V[0][2], sgn * V[0][0])
                 yield mu, eta, chi, phi
 
         elif constraint_name in ('eta', 'chi'):
@@ -888,7 +1441,7 @@ class YouHklCalculator(HklCalculatorBase):
                         'Chi and mu cannot be chosen uniquely with eta '
                         'constrained so close to +-90.')
                 try:
-                    asin_chi = asin(bound(Z[0, 2] / cos_eta))
+                    asin_chi = asin(bound(Z[0][2] / cos_eta))
                 except AssertionError:
                     return
                 all_eta = [eta,]
@@ -903,15 +1456,15 @@ class YouHklCalculator(HklCalculatorBase):
                         'constrained so close to 0. (Please contact developer '
                         'if this case is useful for you)')
                 try:
-                    acos_eta = acos(bound(Z[0, 2] / sin_chi))
+                    acos_eta = acos(bound(Z[0][2] / sin_chi))
                 except AssertionError:
                     return
                 all_eta = [acos_eta, -acos_eta]
                 all_chi = [chi,]
 
             for chi, eta in product(all_chi, all_eta):
-                top_for_mu = Z[2, 2] * sin(eta) * sin(chi) + Z[1, 2] * cos(chi)
-                bot_for_mu = -Z[2, 2] * cos(chi) + Z[1, 2] * sin(eta) * sin(chi)
+                top_for_mu = Z[2][2] * sin(eta) * sin(chi) + Z[1][2] * cos(chi)
+                bot_for_mu = -Z[2][2] * cos(chi) + Z[1][2] * sin(eta) * sin(chi)
                 if is_small(top_for_mu) and is_small(bot_for_mu):
                     # chi == +-90, eta == 0/180 and therefore phi || mu cos(chi) ==
                     # 0 and sin(eta) == 0 Experience shows that even though e.g.
@@ -926,15 +1479,15 @@ class YouHklCalculator(HklCalculatorBase):
                     # here if the one found was incorrect.
 
                     # tan(phi+eta)=v12/v11 from extensions_to_yous_paper.wxm
-                    #phi_minus_mu = -atan2(Z[2, 0], Z[1, 1])
+                    #phi_minus_mu = -atan2(Z[2][0], Z[1][1])
                     raise DiffcalcException(
                         'Mu cannot be chosen uniquely as mu || phi with chi so close '
                         'to +/-90 and eta so close 0 or 180.\nPlease choose '
                         'a different set of constraints.')
                 mu = atan2(-top_for_mu, -bot_for_mu)                         # (41)
 
-                top_for_phi = Z[0, 1] * cos(eta) * cos(chi) - Z[0, 0] * sin(eta)
-                bot_for_phi = Z[0, 1] * sin(eta) + Z[0, 0] * cos(eta) * cos(chi)
+                top_for_phi = Z[0][1] * cos(eta) * cos(chi) - Z[0][0] * sin(eta)
+                bot_for_phi = Z[0][1] * sin(eta) + Z[0][0] * cos(eta) * cos(chi)
                 if is_small(bot_for_phi) and is_small(top_for_phi):
                     DiffcalcException(
                         'Phi cannot be chosen uniquely as mu || phi with chi so close '
@@ -946,9 +1499,7 @@ class YouHklCalculator(HklCalculatorBase):
         else:
             raise DiffcalcException('Given angle must be one of phi, chi, eta or mu')
 
-    def _calc_angles_given_three_sample_constraints(
-            self, h, k, l, wavelength, return_all_solutions, samp_constraints,
-            h_phi, theta):
+    def _calc_angles_given_three_sample_constraints(self, plan, h_phi, theta):
 
         def __get_last_sample_angle(A, B, C):
             if is_small(A) and is_small(B):
@@ -962,95 +1513,32 @@ class YouHklCalculator(HklCalculatorBase):
                 alp_list = [acos_alp + ks, -acos_alp + ks]
             return alp_list
                 
-        def __get_qaz_value(mu, eta, chi, phi):
-            V0 = h2*cos(eta)*sin(chi) + (h0*cos(chi)*cos(eta) + h1*sin(eta))*cos(phi) + (h1*cos(chi)*cos(eta) - h0*sin(eta))*sin(phi)
-            V2 = -h2*sin(chi)*sin(eta)*sin(mu) + h2*cos(chi)*cos(mu) - (h0*cos(mu)*sin(chi) + (h0*cos(chi)*sin(eta) - h1*cos(eta))*sin(mu))*cos(phi) - \
-                    (h1*cos(mu)*sin(chi) + (h1*cos(chi)*sin(eta) + h0*cos(eta))*sin(mu))*sin(phi)
+        def __get_qaz_value(sm, cm, se, ce, sc, cc, sp, cp):
+            V0 = h2*ce*sc + (h0*cc*ce + h1*se)*cp + (h1*cc*ce - h0*se)*sp
+            V2 = -h2*sc*se*sm + h2*cc*cm - (h0*cm*sc + (h0*cc*se - h1*ce)*sm)*cp - \
+                    (h1*cm*sc + (h1*cc*se + h0*ce)*sm)*sp
             sgn_theta = sign(cos(theta))
             qaz = atan2(sgn_theta * V0, sgn_theta * V2)
             return qaz
             
-        h_phi_norm = normalised(h_phi)                                    # (68,69) 
-        h0, h1, h2 = h_phi_norm[0, 0], h_phi_norm[1, 0], h_phi_norm[2, 0]
-
-        if not 'mu' in samp_constraints:
-            eta = self.constraints.sample['eta']
-            chi = self.constraints.sample['chi']
-            phi = self.constraints.sample['phi']
+        h0, h1, h2 = mat3.normalised(mat3.from_matrix(h_phi))            # (68,69) 
 
-            A = h0*cos(phi)*sin(chi) + h1*sin(chi)*sin(phi) - h2*cos(chi)
-            B = -h2*sin(chi)*sin(eta) - (h0*cos(chi)*sin(eta) - h1*cos(eta))*cos(phi) - (h1*cos(chi)*sin(eta) + h0*cos(eta))*sin(phi)
-            C = -sin(theta)
-            try:
-                mu_vals = __get_last_sample_angle(A, B, C)
-            except AssertionError:
-                return
-            for mu in mu_vals:
-                qaz = __get_qaz_value(mu, eta, chi, phi)
-                logger.debug("--- Trying mu:%.f qaz_%.f", mu * TODEG, qaz * TODEG)
-                for delta, nu, _ in self._calc_remaining_detector_angles('qaz', qaz, theta):
-                    logger.debug("delta=%.3f, %s=%.3f", delta * TODEG, NUNAME, nu * TODEG)
-                    yield mu, delta, nu, eta, chi, phi
-
-        elif not 'eta' in samp_constraints:
-            mu = self.constraints.sample['mu']
-            chi = self.constraints.sample['chi']
-            phi = self.constraints.sample['phi']
-
-            A = -h0*cos(chi)*cos(mu)*cos(phi) - h1*cos(chi)*cos(mu)*sin(phi) - h2*cos(mu)*sin(chi)
-            B = h1*cos(mu)*cos(phi) - h0*cos(mu)*sin(phi)
-            C = -h0*cos(phi)*sin(chi)*sin(mu) - h1*sin(chi)*sin(mu)*sin(phi) + h2*cos(chi)*sin(mu) - sin(theta)
-            try:
-                eta_vals = __get_last_sample_angle(A, B, C)
-            except AssertionError:
-                return
-            for eta in eta_vals:
-                qaz = __get_qaz_value(mu, eta, chi, phi)
-                logger.debug("--- Trying eta:%.f qaz_%.f", eta * TODEG, qaz * TODEG)
-                for delta, nu, _ in self._calc_remaining_detector_angles('qaz', qaz, theta):
-                    logger.debug("delta=%.3f, %s=%.3f", delta * TODEG, NUNAME, nu * TODEG)
-                    yield mu, delta, nu, eta, chi, phi
-
-        elif not 'chi' in samp_constraints:
-            mu = self.constraints.sample['mu']
-            eta = self.constraints.sample['eta']
-            phi = self.constraints.sample['phi']
-
-            A = -h2*cos(mu)*sin(eta) + h0*cos(phi)*sin(mu) + h1*sin(mu)*sin(phi)
-            B = -h0*cos(mu)*cos(phi)*sin(eta) - h1*cos(mu)*sin(eta)*sin(phi) - h2*sin(mu)
-            C = -h1*cos(eta)*cos(mu)*cos(phi) + h0*cos(eta)*cos(mu)*sin(phi) - sin(theta)
-            try:
-                chi_vals = __get_last_sample_angle(A, B, C)
-            except AssertionError:
-                return
-            for chi in chi_vals:
-                qaz = __get_qaz_value(mu, eta, chi, phi)
-                logger.debug("--- Trying chi:%.f qaz_%.f", chi * TODEG, qaz * TODEG)
-                for delta, nu, _ in self._calc_remaining_detector_angles('qaz', qaz, theta):
-                    logger.debug("delta=%.3f, %s=%.3f", delta * TODEG, NUNAME, nu * TODEG)
-                    yield mu, delta, nu, eta, chi, phi
-
-        elif not 'phi' in samp_constraints:
-            mu = self.constraints.sample['mu']
-            eta = self.constraints.sample['eta']
-            chi = self.constraints.sample['chi']
-
-            A = h1*sin(chi)*sin(mu) - (h1*cos(chi)*sin(eta) + h0*cos(eta))*cos(mu)
-            B = h0*sin(chi)*sin(mu) - (h0*cos(chi)*sin(eta) - h1*cos(eta))*cos(mu)
-            C = h2*cos(mu)*sin(chi)*sin(eta) + h2*cos(chi)*sin(mu) - sin(theta)
-            try:
-                phi_vals = __get_last_sample_angle(A, B, C)
-            except AssertionError:
-                return
-            for phi in phi_vals:
-                qaz = __get_qaz_value(mu, eta, chi, phi)
-                logger.debug("--- Trying phi:%.f qaz_%.f", phi * TODEG, qaz * TODEG)
-                for delta, nu, _ in self._calc_remaining_detector_angles('qaz', qaz, theta):
-                    logger.debug("delta=%.3f, %s=%.3f", delta * TODEG, NUNAME, nu * TODEG)
-                    yield mu, delta, nu, eta, chi, phi
-        else:
-            raise DiffcalcException(
-                'Internal error: Invalid set of sample constraints.')
+        # The coefficients of the fixed angles are compiled into the plan
+        A = mat3.dot(plan.a, (h0, h1, h2))
+        B = mat3.dot(plan.b, (h0, h1, h2))
+        C = mat3.dot(plan.c, (h0, h1, h2)) - sin(theta)
+        try:
+            last_sample_angles = __get_last_sample_angle(A, B, C)
+        except AssertionError:
+            return
+        for value in last_sample_angles:
+            mu, eta, chi, phi = plan.sample_angles_with(value)
+            qaz = __get_qaz_value(*plan.sample_trig_with(value))
+            logger.debug("--- Trying %s:%.f qaz_%.f", plan.free_sample_angle,
+                         value * TODEG, qaz * TODEG)
+            for delta, nu, _ in self._calc_remaining_detector_angles('qaz', qaz, theta):
+                logger.debug("delta=%.3f, %s=%.3f", delta * TODEG, NUNAME, nu * TODEG)
+                yield mu, delta, nu, eta, chi, phi
 
     def _calc_sample_angles_given_two_sample_and_reference(
             self, samp_constraints, psi, theta, q_phi, n_phi):
@@ -1518,16 +2006,23 @@ class YouHklCalculator(HklCalculatorBase):
         res = []
         angle_names = settings.hardware.get_axes_names()
         for possible_solution in possible_solutions:
-            hw_sol = []
-            hw_possible_solution = settings.geometry.internal_position_to_physical_angles(YouPosition(*possible_solution, unit='RAD'))
-            for name, value in zip(angle_names, hw_possible_solution):
-                hw_sol.append(settings.hardware.cut_angle(name, value))
-            if filter_out_of_limits:
-                is_in_limits = settings.hardware.is_position_within_limits(hw_sol)
-            else:
-                is_in_limits = True
-            if is_in_limits:
-                sol = settings.geometry.physical_angles_to_internal_position(tuple(hw_sol))
-                sol.changeToRadians()
-                res.append(sol.totuple())
+            sol = self._cut_angles_within_limits(
+                YouPosition(*possible_solution, unit='RAD'), angle_names,
+                filter_out_of_limits)
+            if sol is not None:
+                res.append(sol)
         return res
+
+    def _cut_angles_within_limits(self, pos, angle_names,
+                                  filter_out_of_limits=True):
+        """Return the cut angles of YouPosition pos as a tuple in radians, or
+        None if filtering and they are outside the hardware limits."""
+        hw_sol = []
+        hw_possible_solution = settings.geometry.internal_position_to_physical_angles(pos)
+        for name, value in zip(angle_names, hw_possible_solution):
+            hw_sol.append(settings.hardware.cut_angle(name, value))
+        if filter_out_of_limits and not settings.hardware.is_position_within_limits(hw_sol):
+            return None
+        sol = settings.geometry.physical_angles_to_internal_position(tuple(hw_sol))
+        sol.changeToRadians()
+        return sol.totuple()
@@ -24,7 +24,7 @@ try:
 except ImportError:
     from numjy import matrix
 
-from diffcalc.util import DiffcalcException, bold
+from diffcalc.util import DiffcalcException, bold, ChangeNotifier
 from diffcalc.settings import NUNAME
 
 TODEG = 180 / pi
@@ -55,6 +55,7 @@ number_single_sample = (len(det_constraints) * len(ref_constraints) *
 class YouConstraintManager(object):
 
     def __init__(self, fixed_constraints = {}):
+        self.notifier = ChangeNotifier()
         self._constrained = {}
 #        self._tracking = []
         self.n_phi = matrix([[0], [0], [1]])
@@ -62,6 +63,15 @@ class YouConstraintManager(object):
         self._fixed_samp_constraints = ()
         self._fix_constraints(fixed_constraints)
 
+    def _get_constrained(self):
+        return self.__constrained
+
+    def _set_constrained(self, constrained):
+        self.__constrained = constrained
+        self.notifier.notify()
+
+    _constrained = property(_get_constrained, _set_constrained)
+
     def __str__(self):
         lines = []
 #        TODO: Put somewhere with access to UB matrix!
@@ -291,13 +301,15 @@ class YouConstraintManager(object):
         if name in self.all:
             return "%s is already constrained." % ext_name.capitalize()
         elif name in det_constraints:
-            return self._constrain_detector(name)
+            msg = self._constrain_detector(name)
         elif name in ref_constraints:
-            return self._constrain_reference(name)
+            msg = self._constrain_reference(name)
         elif name in samp_constraints:
-            return self._constrain_sample(name)
+            msg = self._constrain_sample(name)
         else:
             raise DiffcalcException("%s is not a valid constraint name. Type 'con' for a table of constraint name" % ext_name)
+        self.notifier.notify()
+        return msg
 
     def is_constraint_fixed(self, name):
         return ((name in det_constraints and self._hide_detector_constraint) or
@@ -376,6 +388,7 @@ class YouConstraintManager(object):
             raise DiffcalcException('%s constraint cannot be removed' % ext_name)
         if name in self._constrained:
             del self._constrained[name]
+            self.notifier.notify()
         else:
             return "%s was not already constrained." % ext_name.capitalize()
 
@@ -416,6 +429,7 @@ class YouConstraintManager(object):
             self._constrained[name] = float(value) * TORAD
         except Exception:
             raise DiffcalcException('Cannot set %s constraint. Invalid input value.' % ext_name)
+        self.notifier.notify()
         try:
             new_str = '---' if value is None else str(value)
         except Exception:
@@ -0,0 +1,313 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Position-velocity-time (PVT) trajectories for continuous hkl scans.
+
+The path is solved for all points at once and the solution branch carried
+from point to point as in diffcalc.hkl.you.trajectory. Time is spent along
+the path in proportion to its length in hkl, either to fill a total time or
+at a given hkl speed. The motor velocity at each point is the speed through
+hkl times the analytic derivative of the angles by hkl for the current
+constraints, so the axes move together along the path rather than from
+point to point.
+
+A motion controller interpolates each segment with the cubic fixed by the
+positions and velocities at its ends. The whole trajectory is slowed down
+until these cubics respect the velocity and acceleration limits of every
+axis, run-up and run-down moves from and to rest are added and the extreme
+positions of every segment are checked against the hardware limits.
+
+This module requires numpy and is therefore not available under Jython.
+"""
+
+import numpy as np
+
+from diffcalc import settings
+from diffcalc.hkl.you.geometry import YouPosition
+from diffcalc.hkl.you.trajectory import MAX_STEP, hkl_path_to_angles
+from diffcalc.util import DiffcalcException
+
+SMALL = 1e-9
+VELOCITY_STEP = 1e-3  # seconds, to map velocities to physical axes
+
+
+class PVTTrajectory(object):
+    """Positions in degrees, velocities in degrees per second and times in
+    seconds for every physical axis.
+
+      names      -- the axis names, in hardware order
+      times      -- (M,) absolute times, starting at zero
+      positions  -- (M, n) positions, not cut so that they change smoothly
+      velocities -- (M, n) velocities
+      path_rows  -- the rows of the hkl path points; the others are the
+                    run-up and run-down moves
+      flips      -- the unavoidable BranchFlips along the path
+      slowdown   -- the factor by which the requested timing was stretched to
+                    respect the velocity and acceleration limits
+    """
+
+    def __init__(self, names, times, positions, velocities, path_rows, flips,
+                 slowdown):
+        self.names = tuple(names)
+        self.times = times
+        self.positions = positions
+        self.velocities = velocities
+        self.path_rows = path_rows
+        self.flips = flips
+        self.slowdown = slowdown
+
+    def axis(self, name):
+        """Return the (positions, velocities, times) arrays of one axis"""
+        i = self.names.index(name)
+        return self.positions[:, i], self.velocities[:, i], self.times
+
+    def __len__(self):
+        return len(self.times)
+
+    def __str__(self):
+        lines = ['%8s  ' % 'time' + '  '.join(
+            '%17s' % ('%s (pos, vel)' % name) for name in self.names)]
+        for t, pos, vel in zip(self.times, self.positions, self.velocities):
+            lines.append('%8.3f  ' % t + '  '.join(
+                '%8.3f %8.3f' % pv for pv in zip(pos, vel)))
+        return '\n'.join(lines)
+
+
+def _per_axis(limit, names):
+    """Return an array of limits from a number or a {name: limit} dict"""
+    if limit is None:
+        return np.full(len(names), np.inf)
+    if isinstance(limit, dict):
+        return np.array([limit.get(name, np.inf) for name in names],
+                        dtype=float)
+    return np.full(len(names), float(limit))
+
+
+def _segment_times(hkl, total_time, hkl_speed):
+    lengths = np.sqrt(((hkl[1:] - hkl[:-1]) ** 2).sum(1))
+    if (lengths < SMALL).any():
+        raise DiffcalcException(
+            'Consecutive points of the path must differ, but point %d repeats '
+            'the one before' % (np.nonzero(lengths < SMALL)[0][0] + 1))
+    if (total_time is None) == (hkl_speed is None):
+        raise DiffcalcException('Give either a total time or an hkl speed')
+    if total_time is not None:
+        if total_time <= 0:
+            raise DiffcalcException('The total time must be positive')
+        return lengths * total_time / lengths.sum()
+    hkl_speed = np.asarray(hkl_speed, dtype=float) * np.ones(len(lengths))
+    if (hkl_speed <= 0).any():
+        raise DiffcalcException('The hkl speed must be positive')
+    return lengths / hkl_speed
+
+
+def _solve_path(hklcalc, hkl, wavelength, start_position, max_step):
+    """Solve all points at once and carry the branch along the path"""
+    index, positions, virtual_angles = hklcalc.hklArrayToAngles(
+        hkl, wavelength, filter_out_of_limits=False)
+    solutions = [[] for _ in hkl]
+    for row, pos, va in zip(index, positions, virtual_angles):
+        solutions[row].append((tuple(pos), dict(
+            (name, None if np.isnan(va[name]) else float(va[name]))
+            for name in virtual_angles.dtype.names)))
+    path, _, flips = hkl_path_to_angles(hklcalc, hkl, wavelength,
+                                        start_position, max_step, solutions)
+    return np.array([pos.totuple() for pos in path]), flips
+
+
+def _internal_velocities(hklcalc, positions, hkl, wavelength, dt):
+    """Angle velocities in degrees per second along the path"""
+    # the hkl velocity at each point averages the adjoining segments
+    segment_velocities = (hkl[1:] - hkl[:-1]) / dt[:, None]
+    hkl_velocities = np.empty_like(hkl)
+    hkl_velocities[0] = segment_velocities[0]
+    hkl_velocities[-1] = segment_velocities[-1]
+    hkl_velocities[1:-1] = (segment_velocities[1:] + segment_velocities[:-1]) / 2
+    jacobians = hklcalc.hklToAnglesJacobians(positions, wavelength)
+    velocities = np.einsum('sij,sj->si', jacobians, hkl_velocities)
+
+    # fall back to the mean of the neighbouring segments' angle changes where
+    # the constraints do not fix the angles to first order
+    singular = np.isnan(velocities).any(1)
+    if singular.any():
+        steps = (positions[1:] - positions[:-1]) / dt[:, None]
+        fallback = np.empty_like(positions)
+        fallback[0], fallback[-1] = steps[0], steps[-1]
+        fallback[1:-1] = (steps[1:] + steps[:-1]) / 2
+        velocities[singular] = fallback[singular]
+    return velocities
+
+
+def _physical(positions, velocities):
+    """Map internal positions and velocities to the physical axes"""
+    geometry = settings.geometry
+
+    def to_physical(pos):
+        return geometry.internal_position_to_physical_angles(
+            YouPosition(*pos, unit='DEG'))
+
+    physical = np.array([to_physical(pos) for pos in positions])
+    ahead = np.array([to_physical(pos + vel * VELOCITY_STEP)
+                      for pos, vel in zip(positions, velocities)])
+    behind = np.array([to_physical(pos - vel * VELOCITY_STEP)
+                       for pos, vel in zip(positions, velocities)])
+    return physical, (ahead - behind) / (2 * VELOCITY_STEP)
+
+
+def _cubic_coefficients(positions, velocities, dt):
+    """Return c2, c3 of p(t) = p0 + v0 t + c2 t^2 + c3 t^3 for each segment
+    and axis"""
+    T = dt[:, None]
+    dp = positions[1:] - positions[:-1]
+    v0, v1 = velocities[:-1], velocities[1:]
+    c2 = (3 * dp / T - 2 * v0 - v1) / T
+    c3 = (-2 * dp / T + v0 + v1) / T ** 2
+    return c2, c3
+
+
+def _peak_velocities_and_accelerations(positions, velocities, dt):
+    c2, c3 = _cubic_coefficients(positions, velocities, dt)
+    T = dt[:, None]
+    # the acceleration is linear, so largest at the ends of a segment
+    acceleration = np.maximum(abs(2 * c2), abs(2 * c2 + 6 * c3 * T))
+    speed = np.maximum(abs(velocities[:-1]), abs(velocities[1:]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_peak = np.nan_to_num(-c2 / (3 * c3))
+    inside = (t_peak > 0) & (t_peak < T)
+    t_peak = np.where(inside, t_peak, 0.)
+    peak = abs(velocities[:-1] + 2 * c2 * t_peak + 3 * c3 * t_peak ** 2)
+    speed = np.where(inside, np.maximum(speed, peak), speed)
+    return speed.max(0), acceleration.max(0)
+
+
+def _position_extremes(positions, velocities, dt):
+    """Return the lowest and highest position of each axis and the times
+    into the trajectory at which they are reached"""
+    c2, c3 = _cubic_coefficients(positions, velocities, dt)
+    v0 = velocities[:-1]
+    T = np.broadcast_to(dt[:, None], c2.shape)
+    starts = np.concatenate(([0.], np.cumsum(dt)[:-1]))[:, None]
+    # candidate times: segment ends and the roots of the velocity in between
+    a, b, c = 3 * c3, 2 * c2, v0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root = np.sqrt(np.maximum(b ** 2 - 4 * a * c, 0.))
+        roots = [(-b + root) / (2 * a), (-b - root) / (2 * a), -c / b]
+    candidates = [np.zeros_like(T), T]
+    for i, t in enumerate(roots):
+        if i < 2:
+            ok = ~np.isclose(a, 0.) & (b ** 2 >= 4 * a * c)
+        else:
+            ok = np.isclose(a, 0.) & ~np.isclose(b, 0.)
+        t = np.nan_to_num(t)
+        candidates.append(np.where(ok & (t > 0) & (t < T), t, 0.))
+    t = np.array(candidates)
+    p = positions[:-1] + v0 * t + c2 * t ** 2 + c3 * t ** 3
+    t = t + starts
+    p = p.reshape(-1, p.shape[-1])
+    t = t.reshape(-1, t.shape[-1])
+    columns = np.arange(p.shape[1])
+    low, high = p.argmin(0), p.argmax(0)
+    return (p[low, columns], t[low, columns], p[high, columns],
+            t[high, columns])
+
+
+def _check_limits(names, positions, velocities, dt):
+    hardware = settings.hardware
+    low, t_low, high, t_high = _position_extremes(positions, velocities, dt)
+    for i, name in enumerate(names):
+        lower = hardware.get_lower_limit(name)
+        upper = hardware.get_upper_limit(name)
+        if lower is not None and low[i] < lower - SMALL:
+            raise DiffcalcException(
+                'The trajectory takes %s to %.3f at %.3fs, below its lower '
+                'limit %.3f' % (name, low[i], t_low[i], lower))
+        if upper is not None and high[i] > upper + SMALL:
+            raise DiffcalcException(
+                'The trajectory takes %s to %.3f at %.3fs, above its upper '
+                'limit %.3f' % (name, high[i], t_high[i], upper))
+
+
+def _ramp_time(velocity, max_acceleration, default):
+    """Time to reach velocity from rest at constant acceleration"""
+    if np.isinf(max_acceleration).all():
+        return default if abs(velocity).max() > 0 else 0.
+    return (abs(velocity) / max_acceleration).max()
+
+
+def hkl_path_to_pvt(hklcalc, hkl_path, wavelength, total_time=None,
+                    hkl_speed=None, max_velocity=None, max_acceleration=None,
+                    start_position=None, max_step=MAX_STEP, ramp=True):
+    """Return a PVTTrajectory through the ordered reflections in hkl_path.
+
+    Give either total_time in seconds or hkl_speed, the speed through hkl in
+    reciprocal lattice units per second, as a number or one value per
+    segment. max_velocity (degrees/s) and max_acceleration (degrees/s^2) are
+    numbers for all axes or dictionaries by physical axis name. If the
+    requested timing would break them the whole trajectory is slowed down by
+    the trajectory's slowdown factor. With ramp set, run-up and run-down moves
+    at constant acceleration are added so that the axes start and end at
+    rest.
+
+    start_position and max_step are as for hklPathToAngles. Raises
+    DiffcalcException if a point has no solution or the trajectory, between
+    points included, leaves the hardware limits.
+    """
+    hkl = np.array(hkl_path, dtype=float).reshape(-1, 3)
+    if len(hkl) < 2:
+        raise DiffcalcException('A trajectory needs at least two points')
+    dt = _segment_times(hkl, total_time, hkl_speed)
+
+    positions, flips = _solve_path(hklcalc, hkl, wavelength, start_position,
+                                   max_step)
+    velocities = _internal_velocities(hklcalc, positions, hkl, wavelength, dt)
+    positions, velocities = _physical(positions, velocities)
+    names = settings.hardware.get_axes_names()
+    # start within the hardware cuts
+    if start_position is None:
+        cut = np.array(settings.hardware.cut_angles(tuple(positions[0])))
+        positions = positions + (cut - positions[0])
+
+    max_velocity = _per_axis(max_velocity, names)
+    max_acceleration = _per_axis(max_acceleration, names)
+    speed, acceleration = _peak_velocities_and_accelerations(
+        positions, velocities, dt)
+    slowdown = max(1., (speed / max_velocity).max(),
+                   np.sqrt((acceleration / max_acceleration).max()))
+    dt = dt * slowdown
+    velocities = velocities / slowdown
+
+    first, last = 0, len(positions) - 1
+    if ramp:
+        run_up = _ramp_time(velocities[0], max_acceleration, dt[0])
+        run_down = _ramp_time(velocities[-1], max_acceleration, dt[-1])
+        zero = np.zeros((1, len(names)))
+        if run_up > 0:
+            positions = np.vstack((positions[:1] - velocities[:1] * run_up / 2,
+                                   positions))
+            velocities = np.vstack((zero, velocities))
+            dt = np.concatenate(([run_up], dt))
+            first, last = 1, last + 1
+        if run_down > 0:
+            positions = np.vstack((positions,
+                                   positions[-1:] + velocities[-1:] * run_down / 2))
+            velocities = np.vstack((velocities, zero))
+            dt = np.concatenate((dt, [run_down]))
+
+    _check_limits(names, positions, velocities, dt)
+    times = np.concatenate(([0.], np.cumsum(dt)))
+    return PVTTrajectory(names, times, positions, velocities,
+                         slice(first, last + 1), flips, slowdown)
@@ -24,6 +24,7 @@ from diffcalc import settings
 TORAD = pi / 180
 TODEG = 180 / pi
 from diffcalc.util import x_rotation, z_rotation, y_rotation
+from diffcalc import mat3
 
 from diffcalc.settings import NUNAME
 
@@ -210,6 +211,16 @@ def create_you_matrices(mu=None, delta=None, nu=None, eta=None, chi=None,
     return MU, DELTA, NU, ETA, CHI, PHI
 
 
+def create_you_rotations(mu, delta, nu, eta, chi, phi):
+    """
+    Create the transformation matrices of create_you_matrices() as
+    diffcalc.mat3 tuples.
+    """
+    return (mat3.x_rotation(mu), mat3.z_rotation(-delta),
+            mat3.x_rotation(nu), mat3.z_rotation(-eta),
+            mat3.y_rotation(chi), mat3.z_rotation(-phi))
+
+
 def calcNU(nu):
     return x_rotation(nu)
 
@@ -19,8 +19,10 @@
 from __future__ import absolute_import
 
 from diffcalc.hkl.common import getNameFromScannableOrString
+from diffcalc.hkl.profiling import dcprofile
 from diffcalc.util import command
 from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.geometry import YouPosition
 from diffcalc import settings
 
 
@@ -28,7 +30,8 @@ from diffcalc import settings
 import diffcalc.ub.ub
 from diffcalc.hkl.you.constraints import YouConstraintManager
 
-__all__ = ['allhkl', 'con', 'uncon', 'hklcalc', 'constraint_manager']
+__all__ = ['allhkl', 'reachable', 'con', 'uncon', 'hklcache', 'hklprocesses',
+           'dcprofile', 'hklcalc', 'constraint_manager']
 
 
 _fixed_constraints = settings.geometry.fixed_constraints  # @UndefinedVariable
@@ -52,7 +55,8 @@ def con(*args):
     from each of the sample and detector columns and up to three from
     the sample column.
 
-    Not all constraint combinations are currently available:
+    These constraint combinations are solved analytically, others are
+    solved numerically, which is slower:
 
         1 x samp:              all
 
@@ -84,8 +88,9 @@ def con(*args):
     msg = _handle_con(args)
     if (hklcalc.constraints.is_fully_constrained() and 
         not hklcalc.constraints.is_current_mode_implemented()):
-        msg += ("\n\nWARNING: The selected constraint combination "
-            "is not implemented.\n\nType 'help con' to see implemented combinations")
+        msg += ("\n\nWARNING: The selected constraint combination has no "
+            "analytical solution and will be solved numerically, which is "
+            "slower.\n\nType 'help con' to see analytically solved combinations")
     if msg:
         print msg
 
@@ -210,9 +215,78 @@ def allhkl(hkl, wavelength=None):
     print '\n'.join(lines)
 
 
+@command
+def reachable(wavelength=None):
+    """reachable {wavelength} -- list all integer hkl reachable within the limits
+
+    """
+    _hardware = settings.hardware
+    _geometry = settings.geometry
+    if wavelength is None:
+        wavelength = _hardware.get_wavelength()
+    current = _geometry.physical_angles_to_internal_position(
+        _hardware.get_position()).totuple()
+    hkls, positions, ttheta = hklcalc.reachableReflections(wavelength, current)
+    names = list(_hardware.get_axes_names())
+    lines = ['%4s %4s %4s  %9s  ' % ('h', 'k', 'l', 'ttheta') +
+             ' '.join('%9s' % name for name in names)]
+    for hkl, pos, tth in zip(hkls, positions, ttheta):
+        angles = _geometry.internal_position_to_physical_angles(
+            YouPosition(*pos, unit='DEG'))
+        lines.append('%4d %4d %4d  %9.4f  ' % (tuple(hkl) + (tth,)) +
+                     ' '.join('%9.4f' % val for val in angles))
+    lines.append('')
+    lines.append('%d reachable reflections' % len(hkls))
+    print '\n'.join(lines)
+
+
+@command
+def hklcache(action=None):
+    """hklcache {'clear'|size} -- show, clear or resize the hkl solution cache
+
+    Solutions are reused until the UB matrix, constraints, limits or cuts
+    change. Clearing the cache also clears the hkl readbacks kept for
+    unchanged positions. A size of 0 disables caching.
+    """
+    cache = hklcalc.solution_cache
+    if action is None:
+        pass
+    elif action == 'clear':
+        cache.clear()
+        hklcalc.readback_cache.clear()
+    elif isinstance(action, (int, long)) and action >= 0:
+        cache.resize(action)
+    else:
+        raise TypeError("Expected 'clear' or a cache size")
+    print 'hkl solution cache: ' + str(cache)
+
+
+@command
+def hklprocesses(processes=None):
+    """hklprocesses {n} -- show or set the processes used to solve hkl lists
+
+    Long lists of hkl, from hkl_list_to_angles and iter_hkl_list_to_angles
+    (which gives the solutions of every hkl), are split across n worker
+    processes, each solving with a snapshot of the current UB matrix,
+    constraints, geometry and limits. Use 1 to solve in this process (the
+    default) and 0 for one process per cpu.
+    """
+    if processes is None:
+        pass
+    elif isinstance(processes, (int, long)) and processes >= 0:
+        hklcalc.processes = processes
+    else:
+        raise TypeError("Expected a number of processes")
+    print 'hkl list processes: %s' % (hklcalc.processes or 'one per cpu')
+
+
 commands_for_help = ['Constraints',
                      con,
                      uncon,
                      'Hkl',
-                     allhkl
+                     allhkl,
+                     reachable,
+                     hklcache,
+                     hklprocesses,
+                     dcprofile
                      ]
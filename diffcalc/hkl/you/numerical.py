@@ -0,0 +1,498 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Numerical hkl to angles calculation for the You engine.
+
+Constraint combinations without a closed form solution are solved here. The
+three constraints and the three components of the scattering vector give six
+equations in the six angles, which are solved by damped least squares
+(Levenberg-Marquardt) from a batch of starting positions at once. The
+Jacobians are calculated analytically from the derivatives of the rotation
+matrices of H. You's paper. Each solve is bounded in iterations, so that it
+may be used inside scans and returns the same solutions however loaded the
+machine is.
+
+The same Jacobians give the sensitivities of hkl to the angles and, for a
+given set of constraints, of the angles to hkl (see hkl_jacobians and
+angle_jacobians).
+
+This module requires numpy and is therefore not available under Jython.
+"""
+
+from itertools import product
+from math import asin, pi
+from timeit import default_timer as _timer
+
+import numpy as np
+
+from diffcalc.hkl.you.batch import create_you_matrix_stacks
+from diffcalc.settings import NUNAME
+from diffcalc.util import DiffcalcException
+
+MAX_ITERATIONS = 40
+TOLERANCE = 1e-10  # largest residual of a converged solution
+DUPLICATE_TOLERANCE = 1e-6  # radians
+
+ANGLE_NAMES = ('mu', 'delta', 'nu', 'eta', 'chi', 'phi')
+
+_KX = np.array([[0., 0, 0], [0, 0, -1], [0, 1, 0]])
+_KY = np.array([[0., 0, 1], [0, 0, 0], [-1, 0, 0]])
+_KZ = np.array([[0., -1, 0], [1, 0, 0], [0, 0, 0]])
+
+# The derivative of each rotation matrix R by its angle is R * sign * K.
+# DELTA, ETA and PHI rotate about z by minus the angle.
+_GENERATORS = ((1., _KX), (-1., _KZ), (1., _KX), (-1., _KZ), (1., _KY),
+               (-1., _KZ))
+
+
+def _wrap(angle):
+    return (angle + pi) % (2 * pi) - pi
+
+
+def create_you_derivative_stacks(stacks):
+    """Return the derivatives of the MU, DELTA, NU, ETA, CHI and PHI stacks
+    returned by create_you_matrix_stacks, each by its own angle."""
+    return tuple(sign * np.einsum('sij,jk->sik', R, K)
+                 for R, (sign, K) in zip(stacks, _GENERATORS))
+
+
+def _mul(*stacks):
+    result = stacks[0]
+    for stack in stacks[1:]:
+        result = np.einsum('sij,sjk->sik', result, stack)
+    return result
+
+
+class RotationChain(object):
+    """The vectors of the You rotation chain for many positions, and their
+    derivatives by each of the six angles.
+
+    positions is an (N, 6) array of mu, delta, nu, eta, chi and phi in
+    radians. Vectors are (N, 3) arrays and their derivatives (N, 6, 3) arrays
+    with one row per angle:
+
+      kout -- the unit outgoing wavevector in the lab frame
+      q    -- kout minus the unit incoming wavevector (0, 1, 0): the
+              scattering vector in units of the wavevector
+      q_phi -- q in the phi frame
+      w    -- MU * ETA * (0, 1, 0), used for the omega and bisect constraints
+    """
+
+    def __init__(self, positions):
+        positions = np.asarray(positions, dtype=float).reshape(-1, 6)
+        size = len(positions)
+        self.positions = positions
+        stacks = create_you_matrix_stacks(positions)
+        MU, DELTA, NU, ETA, CHI, PHI = stacks
+        dMU, dDELTA, dNU, dETA, dCHI, dPHI = create_you_derivative_stacks(
+            stacks)
+
+        # (0, 1, 0) picks the second column
+        D = _mul(NU, DELTA)
+        self.kout = D[:, :, 1]
+        self.dkout = np.zeros((size, 6, 3))
+        self.dkout[:, 1] = _mul(NU, dDELTA)[:, :, 1]
+        self.dkout[:, 2] = _mul(dNU, DELTA)[:, :, 1]
+        self.q = self.kout - np.array([0., 1, 0])
+        self.dq = self.dkout
+
+        self.Z = _mul(MU, ETA, CHI, PHI)
+        self.dZ = np.zeros((size, 6, 3, 3))
+        self.dZ[:, 0] = _mul(dMU, ETA, CHI, PHI)
+        self.dZ[:, 3] = _mul(MU, dETA, CHI, PHI)
+        self.dZ[:, 4] = _mul(MU, ETA, dCHI, PHI)
+        self.dZ[:, 5] = _mul(MU, ETA, CHI, dPHI)
+
+        self.q_phi = np.einsum('sji,sj->si', self.Z, self.q)
+        self.dq_phi = (np.einsum('sdji,sj->sdi', self.dZ, self.q) +
+                       np.einsum('sji,sdj->sdi', self.Z, self.dq))
+
+        self.w = _mul(MU, ETA)[:, :, 1]
+        self.dw = np.zeros((size, 6, 3))
+        self.dw[:, 0] = _mul(dMU, ETA)[:, :, 1]
+        self.dw[:, 3] = _mul(MU, dETA)[:, :, 1]
+
+    def lab_vector(self, v_phi):
+        """Return Z * v_phi and its derivatives for a phi frame vector"""
+        v_phi = np.asarray(v_phi, dtype=float).ravel()
+        return (np.einsum('sij,j->si', self.Z, v_phi),
+                np.einsum('sdij,j->sdi', self.dZ, v_phi))
+
+
+### Constraint residuals
+#
+# Each returns an (N,) array of residuals, zero where the constraint holds,
+# and its (N, 6) derivative. Angle constraints give wrapped angle
+# differences; constraints on alpha, beta, betain and betaout compare sines.
+
+def _atan2_residual(y, dy, x, dx, value):
+    r = _wrap(np.arctan2(y, x) - value)
+    J = ((x[:, None] * dy - y[:, None] * dx) /
+         (x * x + y * y)[:, None])
+    return r, J
+
+
+def _angle_residual(index):
+    def residual(chain, n_phi, surf_nphi, value):
+        r = _wrap(chain.positions[:, index] - value)
+        J = np.zeros((len(r), 6))
+        J[:, index] = 1.
+        return r, J
+    return residual
+
+
+def _mu_is_nu(chain, n_phi, surf_nphi, value):
+    r = _wrap(chain.positions[:, 0] - chain.positions[:, 2])
+    J = np.zeros((len(r), 6))
+    J[:, 0], J[:, 2] = 1., -1.
+    return r, J
+
+
+def _qaz(chain, n_phi, surf_nphi, value):
+    q, dq = chain.q, chain.dq
+    return _atan2_residual(q[:, 0], dq[:, :, 0], q[:, 2], dq[:, :, 2], value)
+
+
+def _naz(chain, n_phi, surf_nphi, value):
+    n, dn = chain.lab_vector(n_phi)
+    return _atan2_residual(n[:, 0], dn[:, :, 0], n[:, 2], dn[:, :, 2], value)
+
+
+def _sin_in(n_phi):
+    # sin(alpha) = -n_lab . kin
+    def residual(chain, ref_nphi, surf_nphi, value):
+        n, dn = chain.lab_vector(n_phi(ref_nphi, surf_nphi))
+        return -n[:, 1] - np.sin(value), -dn[:, :, 1]
+    return residual
+
+
+def _sin_out(n_phi):
+    # sin(beta) = n_lab . kout
+    def residual(chain, ref_nphi, surf_nphi, value):
+        n, dn = chain.lab_vector(n_phi(ref_nphi, surf_nphi))
+        r = np.einsum('si,si->s', n, chain.kout) - np.sin(value)
+        J = (np.einsum('sdi,si->sd', dn, chain.kout) +
+             np.einsum('si,sdi->sd', n, chain.dkout))
+        return r, J
+    return residual
+
+
+def _in_eq_out(n_phi):
+    sin_in, sin_out = _sin_in(n_phi), _sin_out(n_phi)
+
+    def residual(chain, ref_nphi, surf_nphi, value):
+        r_in, J_in = sin_in(chain, ref_nphi, surf_nphi, 0.)
+        r_out, J_out = sin_out(chain, ref_nphi, surf_nphi, 0.)
+        return r_in - r_out, J_in - J_out
+    return residual
+
+
+_reference = lambda ref_nphi, surf_nphi: ref_nphi
+_surface = lambda ref_nphi, surf_nphi: surf_nphi
+
+
+def _psi(chain, n_phi, surf_nphi, value):
+    # The azimuth of n_lab about q: psi = atan2(S, C) with, scaling both
+    # by |q|**2, S = |q| (q x n)_y and C = |q|**2 n_y - (q . n) q_y
+    n, dn = chain.lab_vector(n_phi)
+    q, dq = chain.q, chain.dq
+    q2 = np.einsum('si,si->s', q, q)
+    dq2 = 2 * np.einsum('si,sdi->sd', q, dq)
+    q_len = np.sqrt(q2)
+    dq_len = dq2 / (2 * q_len[:, None])
+    cross = q[:, 2] * n[:, 0] - q[:, 0] * n[:, 2]
+    dcross = (dq[:, :, 2] * n[:, 0, None] + q[:, 2, None] * dn[:, :, 0] -
+              dq[:, :, 0] * n[:, 2, None] - q[:, 0, None] * dn[:, :, 2])
+    q_dot_n = np.einsum('si,si->s', q, n)
+    dq_dot_n = (np.einsum('sdi,si->sd', dq, n) +
+                np.einsum('si,sdi->sd', q, dn))
+    S = -q_len * cross
+    dS = -(dq_len * cross[:, None] + q_len[:, None] * dcross)
+    C = q2 * n[:, 1] - q_dot_n * q[:, 1]
+    dC = (dq2 * n[:, 1, None] + q2[:, None] * dn[:, :, 1] -
+          dq_dot_n * q[:, 1, None] - q_dot_n[:, None] * dq[:, :, 1])
+    return _atan2_residual(S, dS, C, dC, value)
+
+
+def _bisect(chain, n_phi, surf_nphi, value):
+    # w lies in the scattering plane, whose normal is (q_z, 0, -q_x)
+    q, dq, w, dw = chain.q, chain.dq, chain.w, chain.dw
+    rho = np.sqrt(q[:, 0] ** 2 + q[:, 2] ** 2)
+    drho = (q[:, 0, None] * dq[:, :, 0] + q[:, 2, None] * dq[:, :, 2]) / \
+        rho[:, None]
+    g = w[:, 0] * q[:, 2] - w[:, 2] * q[:, 0]
+    dg = (dw[:, :, 0] * q[:, 2, None] + w[:, 0, None] * dq[:, :, 2] -
+          dw[:, :, 2] * q[:, 0, None] - w[:, 2, None] * dq[:, :, 0])
+    return g / rho, dg / rho[:, None] - (g / rho ** 2)[:, None] * drho
+
+
+def _omega(chain, n_phi, surf_nphi, value):
+    # omega is the angle of w in the scattering plane, from (0, 1, 0)
+    # towards the horizontal direction of q, less theta
+    q, dq, w, dw = chain.q, chain.dq, chain.w, chain.dw
+    rho = np.sqrt(q[:, 0] ** 2 + q[:, 2] ** 2)
+    drho = (q[:, 0, None] * dq[:, :, 0] + q[:, 2, None] * dq[:, :, 2]) / \
+        rho[:, None]
+    p = (w[:, 0] * q[:, 0] + w[:, 2] * q[:, 2]) / rho
+    dp = (dw[:, :, 0] * q[:, 0, None] + w[:, 0, None] * dq[:, :, 0] +
+          dw[:, :, 2] * q[:, 2, None] + w[:, 2, None] * dq[:, :, 2] -
+          p[:, None] * drho) / rho[:, None]
+    # |q| = 2 sin(theta)
+    q_len = np.sqrt(np.einsum('si,si->s', q, q))
+    theta = np.arcsin(np.clip(q_len / 2, -1, 1))
+    dtheta = np.einsum('si,sdi->sd', q, dq) / (
+        q_len * 2 * np.cos(theta))[:, None]
+    r, J = _atan2_residual(p, dp, w[:, 1], dw[:, :, 1], 0.)
+    return _wrap(r - theta - value), J - dtheta
+
+
+RESIDUALS = {
+    'mu': _angle_residual(0),
+    'delta': _angle_residual(1),
+    'nu': _angle_residual(2),
+    'eta': _angle_residual(3),
+    'chi': _angle_residual(4),
+    'phi': _angle_residual(5),
+    'mu_is_nu': _mu_is_nu,
+    'qaz': _qaz,
+    'naz': _naz,
+    'alpha': _sin_in(_reference),
+    'beta': _sin_out(_reference),
+    'a_eq_b': _in_eq_out(_reference),
+    'betain': _sin_in(_surface),
+    'betaout': _sin_out(_surface),
+    'bin_eq_bout': _in_eq_out(_surface),
+    'psi': _psi,
+    'bisect': _bisect,
+    'omega': _omega,
+    }
+
+
+def _canonical_name(name):
+    # the nu circle is named by NUNAME
+    if name == NUNAME:
+        return 'nu'
+    if name == 'mu_is_' + NUNAME:
+        return 'mu_is_nu'
+    return name
+
+
+def _residual_function(name):
+    try:
+        return RESIDUALS[_canonical_name(name)]
+    except KeyError:
+        raise DiffcalcException('The %s constraint cannot be solved '
+                                'numerically' % name)
+
+
+### Sensitivities
+
+def hkl_jacobians(positions, wavelength, UBinv):
+    """Return the (N, 3, 6) derivatives of hkl by mu, delta, nu, eta, chi and
+    phi at an (N, 6) array of positions in radians.
+
+    wavelength is a single wavelength or an array of N wavelengths and UBinv
+    the inverse of the UB matrix.
+    """
+    chain = RotationChain(positions)
+    scale = 2 * pi / (np.asarray(wavelength, dtype=float) *
+                      np.ones(len(chain.positions)))
+    UBinv = np.asarray(UBinv, dtype=float)
+    return np.einsum('ij,sdj->sid', UBinv, chain.dq_phi) * scale[:, None, None]
+
+
+def angle_jacobians(positions, wavelength, UBinv, constraints, n_phi,
+                    surf_nphi, rcond=1e-10):
+    """Return the (N, 6, 3) derivatives of the angles by h, k and l at an
+    (N, 6) array of positions in radians, for motion that keeps the
+    constraints satisfied.
+
+    constraints is a dictionary holding a full set of three constraints. The
+    derivatives are nan at positions where the constraints do not fix the
+    angles to first order, that is where the combined Jacobian of hkl and the
+    constraint residuals has a singular value smaller than rcond times the
+    largest.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 6)
+    chain = RotationChain(positions)
+    n_phi = np.asarray(n_phi, dtype=float).ravel()
+    surf_nphi = np.asarray(surf_nphi, dtype=float).ravel()
+    rows = [hkl_jacobians(positions, wavelength, UBinv)]
+    for name, value in sorted(constraints.items()):
+        _, J = _residual_function(name)(chain, n_phi, surf_nphi, value)
+        rows.append(J[:, None, :])
+    G = np.concatenate(rows, axis=1)
+    # hkl changes while the constraint residuals stay zero, so the angle
+    # derivatives are the first three columns of the inverse of G
+    U, singular_values, Vt = np.linalg.svd(G)
+    inverse = np.einsum('sji,sj,skj->sik', Vt, 1. / singular_values, U)
+    singular = singular_values[:, -1] < rcond * singular_values[:, 0]
+    inverse[singular] = np.nan
+    return inverse[:, :, :3]
+
+
+def equivalent_positions(positions):
+    """Return the positions together with those giving the same kout and
+    sample orientation.
+
+    (delta, nu) -> (pi - delta, nu + pi) leaves kout unchanged,
+    (eta, chi, phi) -> (eta + pi, -chi, phi + pi) leaves ETA * CHI * PHI
+    unchanged and (mu, eta, chi) -> (mu + pi, pi - eta, chi + pi) leaves
+    MU * ETA * CHI unchanged.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 6)
+    mu, delta, nu, eta, chi, phi = positions.T
+    detector = [(delta, nu), (pi - delta, nu + pi)]
+    sample = [(mu, eta, chi, phi), (mu, eta + pi, -chi, phi + pi),
+              (mu + pi, pi - eta, chi + pi, phi),
+              (mu + pi, -eta, pi - chi, phi + pi)]
+    return np.concatenate([np.column_stack((m, d, n, e, c, p))
+                           for (d, n), (m, e, c, p)
+                           in product(detector, sample)])
+
+
+class LeastSquaresSolver(object):
+    """Damped least squares solver for any full set of You constraints.
+
+    max_iterations bounds the work done for each reflection. After a solve,
+    iterations, elapsed and converged record the iterations taken, the time
+    taken (for reporting only) and the number of seeds that converged.
+    """
+
+    def __init__(self, max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE):
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.iterations = 0
+        self.elapsed = 0.
+        self.converged = 0
+
+    def seeds(self, constraints, theta, start_position=None):
+        """Return an (N, 6) array of starting positions in radians.
+
+        start_position, the current position as a tuple in radians, is tried
+        first. The others combine the four detector positions with the
+        scattering vector horizontal or vertical with a spread of sample
+        orientations. Constrained angles are set to their values. Positions
+        equivalent by symmetry are not needed, see equivalent_positions.
+        """
+        detector = [(2 * theta, 0.), (0., 2 * theta), (-2 * theta, 0.),
+                    (0., -2 * theta)]
+        seeds = [] if start_position is None else [tuple(start_position)]
+        for (delta, nu), eta, chi, phi in product(
+                detector, (theta, pi - theta), (0., pi / 2, -pi / 2),
+                (0., pi / 2, pi, -pi / 2)):
+            seeds.append((0., delta, nu, eta, chi, phi))
+        seeds = np.array(seeds, dtype=float)
+        for name, value in constraints.items():
+            name = _canonical_name(name)
+            if name in ANGLE_NAMES and value is not None:
+                seeds[:, ANGLE_NAMES.index(name)] = value
+        _, first = np.unique(seeds.round(12), axis=0, return_index=True)
+        return seeds[np.sort(first)]
+
+    def evaluate(self, positions, constraints, q_phi, n_phi, surf_nphi):
+        """Return the (N, 6) residuals and (N, 6, 6) Jacobians at positions.
+
+        q_phi is the required scattering vector in the phi frame in units of
+        the wavevector; its residuals are scaled by its length.
+        """
+        chain = RotationChain(positions)
+        scale = 1. / np.linalg.norm(q_phi)
+        residuals = [(chain.q_phi - q_phi) * scale]
+        jacobians = [chain.dq_phi.transpose(0, 2, 1) * scale]
+        for name, value in sorted(constraints.items()):
+            r, J = _residual_function(name)(chain, n_phi, surf_nphi, value)
+            residuals.append(r[:, None])
+            jacobians.append(J[:, None, :])
+        return np.concatenate(residuals, 1), np.concatenate(jacobians, 1)
+
+    def solve(self, constraints, h_phi, wavelength, n_phi, surf_nphi,
+              start_position=None):
+        """Return the distinct solutions as position tuples in radians.
+
+        constraints is a dictionary of the three constraint values in radians
+        (None for valueless constraints), h_phi the scattering vector UB * hkl
+        in the phi frame and n_phi and surf_nphi the reference and surface
+        normals.
+        """
+        start = _timer()
+        q_phi = np.asarray(h_phi, dtype=float).ravel() * wavelength / (2 * pi)
+        n_phi = np.asarray(n_phi, dtype=float).ravel()
+        surf_nphi = np.asarray(surf_nphi, dtype=float).ravel()
+        theta = asin(min(np.linalg.norm(q_phi) / 2, 1.))
+
+        def evaluate(x):
+            return self.evaluate(x, constraints, q_phi, n_phi, surf_nphi)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = self._refine(self.seeds(constraints, theta, start_position),
+                             evaluate)
+            if not len(x):
+                self.elapsed = _timer() - start
+                return []
+            # add the positions equivalent by symmetry that also satisfy
+            # the constraints
+            candidates = equivalent_positions(x)
+            r, _ = evaluate(candidates)
+            converged = np.abs(r).max(1) <= self.tolerance
+
+        solutions = []
+        for position in _wrap(candidates[converged]):
+            if not any(np.abs(_wrap(position - other)).max() <
+                       DUPLICATE_TOLERANCE for other in solutions):
+                solutions.append(position)
+        self.elapsed = _timer() - start
+        return [tuple(float(v) for v in position) for position in solutions]
+
+    def _refine(self, x, evaluate):
+        """Return the seeds x that converge"""
+        r, J = evaluate(x)
+        cost = np.einsum('si,si->s', r, r)
+        damping = np.full(len(x), 1e-3)
+        active = np.abs(r).max(1) > self.tolerance
+        self.iterations = 0
+        while active.any() and self.iterations < self.max_iterations:
+            self.iterations += 1
+            idx = np.nonzero(active)[0]
+            Ja, ra = J[idx], r[idx]
+            JT = Ja.transpose(0, 2, 1)
+            A = np.einsum('sij,sjk->sik', JT, Ja)
+            A += damping[idx, None, None] * np.eye(6)
+            g = np.einsum('sij,sj->si', JT, ra)
+            try:
+                step = np.linalg.solve(A, -g[:, :, None])[:, :, 0]
+            except np.linalg.LinAlgError:
+                break
+            x_new = x[idx] + step
+            r_new, J_new = evaluate(x_new)
+            cost_new = np.einsum('si,si->s', r_new, r_new)
+            better = cost_new < cost[idx]
+            # seeds stuck in a local minimum stop improving
+            stalled = idx[better & (cost[idx] - cost_new < 1e-9 * cost[idx])]
+            accepted = idx[better]
+            x[accepted], r[accepted], J[accepted] = (
+                x_new[better], r_new[better], J_new[better])
+            cost[accepted] = cost_new[better]
+            damping[accepted] *= .3
+            damping[idx[~better]] *= 10.
+            active = np.abs(r).max(1) > self.tolerance
+            active[stalled] = False
+            active[damping > 1e10] = False
+
+        converged = np.abs(r).max(1) <= self.tolerance
+        self.converged = int(converged.sum())
+        return x[converged]
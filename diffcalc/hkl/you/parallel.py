@@ -0,0 +1,167 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Solving long hkl lists with a pool of worker processes.
+
+Each worker is started with a snapshot of the state the solutions depend on:
+the UB matrix and reference vectors, the constraints, the geometry, the
+hardware limits and cuts and the verification setting. Later changes in the
+calling process therefore cannot leak into a running calculation. The list is
+split into contiguous chunks whose results are joined again in input order,
+so that choosing a single solution from them gives the same answer as solving
+the list serially. The reference position that seeds the numerical solver is
+resolved once here and passed to every chunk, as the workers have no motors
+to read.
+
+This module uses multiprocessing and is therefore not available under Jython.
+"""
+
+import multiprocessing
+
+from diffcalc import settings
+from diffcalc.hardware import DummyHardwareAdapter
+from diffcalc.hkl.you.constraints import YouConstraintManager
+from diffcalc.util import DiffcalcException
+
+MIN_HKL_PER_PROCESS = 32  # smaller lists are not worth starting a pool for
+CHUNKS_PER_PROCESS = 4
+
+
+class _UBSnapshot(object):
+    """The parts of a UBCalculation used by YouHklCalculator."""
+
+    def __init__(self, ubcalc):
+        self.UB = ubcalc.UB
+        self.n_phi = ubcalc.n_phi
+        self.surf_nphi = ubcalc.surf_nphi
+
+
+class _Snapshot(object):
+
+    def __init__(self, hklcalc):
+        self.ubcalc = _UBSnapshot(hklcalc._ubcalc)
+        self.constrained = dict(hklcalc.constraints._constrained)
+        self.raise_exceptions = hklcalc.raiseExceptionsIfAnglesDoNotMapBackToHkl
+        self.geometry = settings.geometry
+        self.include_reference = settings.include_reference
+        hardware = settings.hardware
+        self.axes_names = hardware.get_axes_names()
+        self.cuts = dict(hardware.get_cuts())
+        self.limits = [(name, hardware.get_lower_limit(name),
+                        hardware.get_upper_limit(name))
+                       for name in self.axes_names]
+
+    def create_hardware(self):
+        hardware = DummyHardwareAdapter(self.axes_names)
+        for name, value in self.cuts.items():
+            hardware.set_cut(name, value)
+        for name, lower, upper in self.limits:
+            if lower is not None:
+                hardware.set_lower_limit(name, lower)
+            if upper is not None:
+                hardware.set_upper_limit(name, upper)
+        return hardware
+
+    def create_calculator(self):
+        from diffcalc.hkl.you.calc import YouHklCalculator
+        constraints = YouConstraintManager()
+        constraints._constrained = dict(self.constrained)
+        hklcalc = YouHklCalculator(self.ubcalc, constraints,
+                                   self.raise_exceptions)
+        hklcalc.solution_cache.resize(0)
+        return hklcalc
+
+
+_worker_hklcalc = None
+
+
+def _init_worker(snapshot):
+    global _worker_hklcalc
+    settings.geometry = snapshot.geometry
+    settings.hardware = snapshot.create_hardware()
+    settings.include_reference = snapshot.include_reference
+    _worker_hklcalc = snapshot.create_calculator()
+
+
+def _solve_chunk(args):
+    hkl_list, wavelength, return_all_solutions, reference_position = args
+    return list(_worker_hklcalc._iter_hkl_list_solutions(
+        hkl_list, wavelength, return_all_solutions, reference_position))
+
+
+def _chunks(hkl_list, count):
+    size, remainder = divmod(len(hkl_list), count)
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < remainder else 0)
+        yield hkl_list[start:end]
+        start = end
+
+
+def iter_hkl_list_solutions(hklcalc, hkl_list, wavelength,
+                            return_all_solutions, processes=0,
+                            reference_position=None):
+    """Generate (hkl, solutions) for every hkl in hkl_list in turn.
+
+    The items are those of YouHklCalculator._iter_hkl_list_solutions, in the
+    order of hkl_list, but are calculated by up to processes workers (0 for
+    one per cpu) and yielded as each chunk is finished. Lists too short to
+    benefit are solved in this process. reference_position, or the current
+    hardware position if None, seeds the numerical solver. Stop iterating to
+    stop the workers.
+    """
+    hkl_list = list(hkl_list)
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(hkl_list) // MIN_HKL_PER_PROCESS)
+    if processes <= 1:
+        for item in hklcalc._iter_hkl_list_solutions(
+                hkl_list, wavelength, return_all_solutions,
+                reference_position):
+            yield item
+        return
+
+    if reference_position is None:
+        try:
+            reference_position = tuple(settings.hardware.get_position())
+        except (DiffcalcException, NotImplementedError):
+            pass
+    chunk_count = min(len(hkl_list), processes * CHUNKS_PER_PROCESS)
+    tasks = [(chunk, wavelength, return_all_solutions, reference_position)
+             for chunk in _chunks(hkl_list, chunk_count)]
+    pool = multiprocessing.Pool(processes, _init_worker, (_Snapshot(hklcalc),))
+    try:
+        for chunk_result in pool.imap(_solve_chunk, tasks):
+            for item in chunk_result:
+                yield item
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def hkl_list_solutions(hklcalc, hkl_list, wavelength, return_all_solutions,
+                       processes=0, reference_position=None):
+    """Return the verified solutions in degrees for every hkl in hkl_list.
+
+    The solutions are returned in the order of hkl_list, as by
+    YouHklCalculator._hkl_list_solutions, but are calculated in parallel as
+    by iter_hkl_list_solutions.
+    """
+    return [pair for _, pairs in iter_hkl_list_solutions(
+                hklcalc, hkl_list, wavelength, return_all_solutions,
+                processes, reference_position)
+            for pair in pairs]
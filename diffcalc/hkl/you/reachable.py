@@ -0,0 +1,111 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""List every integer reflection that can be reached at a wavelength.
+
+Only reflections with 1/d <= 2/wavelength can satisfy Bragg's law. They are
+generated from the reciprocal metric, a plane of constant h at a time so
+that the memory used stays bounded for large cells, and solved in batches
+with YouHklCalculator.hklArrayToAngles, which applies the constraints and
+the hardware limits.
+
+This module requires numpy and is therefore not available under Jython.
+"""
+
+from math import pi
+
+import numpy as np
+
+CHUNK_SIZE = 10000
+
+
+def _reciprocal_metric(UB):
+    """G with 1/d^2 = hkl G hkl"""
+    G = np.asarray(UB, dtype=float) / (2 * pi)
+    return G.T.dot(G)
+
+
+def hkl_extent(UB, wavelength):
+    """Return the largest |h|, |k| and |l| inside the limiting sphere"""
+    # the sphere extends to 2/wavelength times each real axis length
+    G = _reciprocal_metric(UB)
+    return np.sqrt(np.diag(np.linalg.inv(G)) * 4. / wavelength ** 2)
+
+
+def hkl_within_sphere(UB, wavelength, chunk_size=CHUNK_SIZE):
+    """Generate (N, 3) arrays of the integer hkl, except 0 0 0, whose
+    scattering vectors UB * hkl are no longer than 4 pi / wavelength, ordered
+    by h, k and l and in chunks of at least chunk_size reflections, bar the
+    last"""
+    G = _reciprocal_metric(UB)
+    limit = 4. / wavelength ** 2
+    h_max, k_max, l_max = np.floor(
+        hkl_extent(UB, wavelength) + 1e-9).astype(int)
+    k, l = np.mgrid[-k_max:k_max + 1, -l_max:l_max + 1].reshape(2, -1)
+    chunk = []
+    count = 0
+    for h in range(-h_max, h_max + 1):
+        hkl = np.column_stack((np.full(len(k), h), k, l)).astype(float)
+        keep = np.einsum('ij,jk,ik->i', hkl, G, hkl) <= limit * (1 + 1e-12)
+        keep &= np.abs(hkl).sum(1) > 0
+        if keep.any():
+            chunk.append(hkl[keep])
+            count += keep.sum()
+        if count >= chunk_size:
+            yield np.vstack(chunk)
+            chunk, count = [], 0
+    if chunk:
+        yield np.vstack(chunk)
+
+
+def _closest(index, positions, reference_position):
+    """Pick one solution for each reflection, the first or that closest to
+    the reference position"""
+    if reference_position is None:
+        _, first = np.unique(index, return_index=True)
+        return first
+    distance = np.abs((positions - np.asarray(reference_position, dtype=float)
+                       + 180) % 360 - 180).max(1)
+    order = np.lexsort((distance, index))
+    _, first = np.unique(index[order], return_index=True)
+    return order[first]
+
+
+def reachable_reflections(hklcalc, wavelength, reference_position=None,
+                          chunk_size=CHUNK_SIZE):
+    """Return the integer reflections reachable within the hardware limits.
+
+    Returns (hkl, positions, ttheta): an (N, 3) array of h, k & l, an (N, 6)
+    array of one solution for each in degrees, the one closest to the
+    internal reference_position if given, and their two theta in degrees.
+    The reflections are ordered by two theta.
+    """
+    UB = hklcalc._get_ubmatrix()
+    hkl, positions, ttheta = [np.zeros((0, 3))], [np.zeros((0, 6))], [[]]
+    for chunk in hkl_within_sphere(UB, wavelength, chunk_size):
+        index, chunk_positions, virtual_angles = hklcalc.hklArrayToAngles(
+            chunk, wavelength)
+        if not len(index):
+            continue
+        pick = _closest(index, chunk_positions, reference_position)
+        hkl.append(chunk[index[pick]])
+        positions.append(chunk_positions[pick])
+        ttheta.append(virtual_angles['ttheta'][pick])
+    hkl, positions = np.vstack(hkl), np.vstack(positions)
+    ttheta = np.concatenate(ttheta)
+    order = np.lexsort(hkl.T[::-1].tolist() + [np.round(ttheta, 8)])
+    return hkl[order], positions[order], ttheta[order]
@@ -0,0 +1,283 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Continuous motor trajectories along an ordered path in hkl.
+
+Solving each point of a path independently lets the chosen solution jump
+between branches (or by 360 degrees across an angle cut) from one point to
+the next. Here the branch found for one point is carried on to the next by a
+few Newton steps from the previous position, using the analytic Jacobians of
+the hkl and constraint residuals (see diffcalc.hkl.you.numerical), so the
+angles follow on from their previous values without being cut. All the
+solution branches of a point are only enumerated when these steps do not
+converge, or the continued branch jumps by more than max_step in any angle
+or leaves the hardware limits; the one closest to the previous position is
+then taken and each such unavoidable branch flip is reported. Without numpy
+(under Jython) every point is enumerated.
+"""
+
+from math import pi
+
+from diffcalc import settings
+from diffcalc.hkl.you.geometry import YouPosition
+from diffcalc.util import DiffcalcException
+
+TORAD = pi / 180
+TODEG = 180 / pi
+
+MAX_STEP = 10.  # degrees
+SMALL = 1e-6
+NEWTON_ITERATIONS = 5
+
+DISCONTINUITY = 'discontinuity'
+LIMITS = 'limits'
+
+
+class BranchFlip(object):
+    """An unavoidable jump in the trajectory before the point at index.
+
+    reason is DISCONTINUITY if the continued branch itself jumps by more than
+    max_step, or LIMITS if it leaves the hardware limits and another branch
+    had to be chosen. step is the largest angle change in degrees.
+    """
+
+    def __init__(self, index, reason, step):
+        self.index = index
+        self.reason = reason
+        self.step = step
+
+    def __repr__(self):
+        return 'BranchFlip(%r, %r, %.3f)' % (self.index, self.reason, self.step)
+
+    def __str__(self):
+        return ('point %d: %.3f degree move as the solution branch %s' %
+                (self.index, self.step,
+                 'is not continuous' if self.reason == DISCONTINUITY
+                 else 'leaves the hardware limits'))
+
+
+def _unwrapped(values, previous):
+    """Shift each angle by whole turns to lie within 180 degrees of previous
+    """
+    return tuple(v + 360. * round((p - v) / 360.)
+                 for v, p in zip(values, previous))
+
+
+def _step(values, previous):
+    return max(abs(v - p) for v, p in zip(values, previous))
+
+
+def _is_within_limits(values):
+    physical = settings.geometry.internal_position_to_physical_angles(
+        YouPosition(*values, unit='DEG'))
+    return settings.hardware.is_position_within_limits(physical)
+
+
+def _all_solutions(hklcalc, h, k, l, wavelength):
+    """Return verified (position tuple, virtual angles) pairs in degrees for
+    every solution branch, regardless of hardware limits."""
+    solutions = []
+    for pos, virtual_angles in hklcalc._hklToAngles(h, k, l, wavelength,
+                                                    True):
+        pos.changeToDegrees()
+        for key, val in virtual_angles.items():
+            if val is not None:
+                virtual_angles[key] = val * TODEG
+        solutions.append((pos.totuple(), virtual_angles))
+    return solutions
+
+
+class _Continuation(object):
+    """Follow the solution branch through a previous position to the next
+    point of a path by Newton's method. Requires numpy."""
+
+    def __init__(self, hklcalc, wavelength):
+        import numpy as np
+        from diffcalc.hkl.you.numerical import LeastSquaresSolver
+        self._np = np
+        self._hklcalc = hklcalc
+        self._solver = LeastSquaresSolver()
+        self._constraints = hklcalc._get_constraint_plan().all
+        self._UB = np.asarray(hklcalc._get_ubmatrix(), dtype=float)
+        self._n_phi = np.asarray(hklcalc._get_n_phi(), dtype=float).ravel()
+        self._surf_nphi = np.asarray(hklcalc._get_surf_nphi(),
+                                     dtype=float).ravel()
+        self._scale = wavelength / (2 * pi)
+        self._last = None
+
+    def position(self, previous, hkl):
+        """Return the position tuple in degrees solving hkl that Newton's
+        method reaches from previous, or None if it does not converge"""
+        np = self._np
+        q_phi = self._UB.dot(hkl) * self._scale
+        x = np.array(previous, dtype=float) * TORAD
+        residuals = self._residuals_at_last(previous, q_phi)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for _ in range(NEWTON_ITERATIONS + 1):
+                if residuals is None:
+                    r, J = self._solver.evaluate(
+                        x[None], self._constraints, q_phi, self._n_phi,
+                        self._surf_nphi)
+                    r, J = r[0], J[0]
+                else:
+                    r, J = residuals
+                    residuals = None
+                if not np.isfinite(r).all():
+                    return None
+                if np.abs(r).max() <= self._solver.tolerance:
+                    values = tuple(float(v) for v in x * TODEG)
+                    self._last = values, q_phi, r, J
+                    return values
+                try:
+                    x = x - np.linalg.solve(J, r)
+                except np.linalg.LinAlgError:
+                    return None
+        return None
+
+    def _residuals_at_last(self, previous, q_phi):
+        """Return the residuals and Jacobian for q_phi at the last position
+        found, if previous is that position, without evaluating the rotation
+        chain again. The hkl residuals are scaled by the length of q_phi."""
+        if self._last is None or self._last[0] != previous:
+            return None
+        _, q_last, r, J = self._last
+        norm = self._np.linalg.norm
+        r, J = r.copy(), J.copy()
+        # r[:3] is (q at previous - q_last) / |q_last|
+        r[:3] = (r[:3] * norm(q_last) + q_last - q_phi) / norm(q_phi)
+        J[:3] *= norm(q_last) / norm(q_phi)
+        return r, J
+
+    def virtual_angles(self, values):
+        """Return the virtual angles in degrees at a position in degrees"""
+        virtual_angles = self._hklcalc._anglesToVirtualAngles(
+            YouPosition(*values, unit='DEG').inRadians(), None)
+        for key, val in virtual_angles.items():
+            if val is not None:
+                virtual_angles[key] = val * TODEG
+        return virtual_angles
+
+
+def _continuation(hklcalc, wavelength):
+    """Return a _Continuation, or None if numpy is not available or the
+    constraints cannot be solved numerically"""
+    if not hklcalc.constraints.is_fully_constrained():
+        return None
+    try:
+        return _Continuation(hklcalc, wavelength)
+    except (ImportError, DiffcalcException):
+        return None
+
+
+def _closest_branch(hklcalc, index, hkl, wavelength, previous, max_step,
+                    point_solutions=None):
+    """Return the position tuple and virtual angles in degrees of the
+    solution for point index closest to previous, and a BranchFlip if it is
+    more than max_step away.
+
+    All the solution branches are enumerated, unless given as
+    point_solutions, and those within the hardware limits considered.
+    """
+    h, k, l = hkl
+    try:
+        if point_solutions is None:
+            point_solutions = _all_solutions(hklcalc, h, k, l, wavelength)
+        elif not point_solutions:
+            raise DiffcalcException('No solutions were found.')
+    except DiffcalcException, e:
+        raise DiffcalcException(
+            'No solution for point %d of the path, hkl=(%g, %g, %g):'
+            '\n%s' % (index, h, k, l, e))
+    candidates = [(_unwrapped(values, previous), virtual_angles)
+                  for values, virtual_angles in point_solutions]
+    values, virtual_angles = min(
+        candidates, key=lambda c: _step(c[0], previous))
+    step = _step(values, previous)
+    continued_in_limits = _is_within_limits(values)
+    if step <= max_step + SMALL and continued_in_limits:
+        return values, virtual_angles, None
+    # the alternative branches, including the cut solutions, that are
+    # within the limits
+    allowed = [c for c in candidates + point_solutions
+               if _is_within_limits(c[0])]
+    if not allowed:
+        raise DiffcalcException(
+            'No solution within the hardware limits for point %d '
+            'of the path, hkl=(%g, %g, %g)' % (index, h, k, l))
+    values, virtual_angles = min(allowed, key=lambda c: _step(c[0], previous))
+    step = _step(values, previous)
+    flip = None
+    if index > 0 and step > max_step + SMALL:
+        flip = BranchFlip(index, LIMITS if not continued_in_limits
+                          else DISCONTINUITY, step)
+    return values, virtual_angles, flip
+
+
+def hkl_path_to_angles(hklcalc, hkl_path, wavelength, start_position=None,
+                       max_step=MAX_STEP, solutions=None):
+    """Return a continuous trajectory through the reflections in hkl_path.
+
+    hklcalc is a YouHklCalculator and start_position an optional YouPosition
+    in degrees from which the trajectory should continue. Without it the first
+    point is solved with hklToAngles. The move from start_position to the
+    first point is not reported as a branch flip.
+
+    Returns (positions, virtual_angles, flips) where positions is a list of
+    YouPositions in degrees, one per point, whose angles are not cut so that
+    they change smoothly, virtual_angles a matching list of dictionaries and
+    flips a list of BranchFlips. Raises DiffcalcException if a point has no
+    solution within the hardware limits.
+
+    solutions may give the (position tuple, virtual angles) pairs in degrees
+    of every branch at each point, solved beforehand; the branch is then
+    chosen from these rather than continued by Newton's method.
+    """
+    positions = []
+    virtual_angles_list = []
+    flips = []
+    continuation = _continuation(hklcalc, wavelength) if solutions is None \
+        else None
+    previous = None
+    if start_position is not None:
+        previous = start_position.clone()
+        previous.changeToDegrees()
+        previous = previous.totuple()
+
+    for index, (h, k, l) in enumerate(hkl_path):
+        values = None
+        if previous is None:
+            pos, virtual_angles = hklcalc.hklToAngles(h, k, l, wavelength)
+            values = pos.totuple()
+        elif continuation is not None:
+            values = continuation.position(previous, (h, k, l))
+            if values is not None and (
+                    _step(values, previous) > max_step + SMALL or
+                    not _is_within_limits(values)):
+                values = None
+            if values is not None:
+                virtual_angles = continuation.virtual_angles(values)
+        if values is None:
+            values, virtual_angles, flip = _closest_branch(
+                hklcalc, index, (h, k, l), wavelength, previous, max_step,
+                None if solutions is None else solutions[index])
+            if flip is not None:
+                flips.append(flip)
+        positions.append(YouPosition(*values, unit='DEG'))
+        virtual_angles_list.append(virtual_angles)
+        previous = values
+
+    return positions, virtual_angles_list, flips
@@ -0,0 +1,150 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Pure float 3-vector and 3x3 matrix operations.
+
+The single point calculations work with 3x1 and 3x3 matrices only, and at
+this size the per-call cost of creating numpy (or numjy) matrix objects
+far outweighs the arithmetic. The functions here work on plain tuples
+instead: a vector is (x, y, z) and a matrix is a tuple of three row tuples.
+Use from_matrix() and to_column() at the boundaries with code that expects
+matrix objects.
+"""
+
+from math import cos, sin, sqrt
+
+try:
+    from numpy import matrix
+except ImportError:
+    from numjy import matrix
+
+
+def from_matrix(m):
+    """Return a 3x1 or 1x3 matrix as a vector or a 3x3 matrix as row tuples
+
+    Vectors and matrices that are already tuples or lists are returned as they
+    are, so callers may accept either form.
+    """
+    if isinstance(m, (tuple, list)):
+        return m
+    rows = m.tolist()
+    if len(rows) == 1:
+        return tuple(rows[0])
+    if len(rows[0]) == 1:
+        return (rows[0][0], rows[1][0], rows[2][0])
+    return tuple(tuple(row) for row in rows)
+
+
+def to_column(v):
+    return matrix([[v[0]], [v[1]], [v[2]]])
+
+
+### Rotations
+
+def x_rotation(th):
+    c, s = cos(th), sin(th)
+    return ((1, 0, 0), (0, c, -s), (0, s, c))
+
+
+def y_rotation(th):
+    c, s = cos(th), sin(th)
+    return ((c, 0, s), (0, 1, 0), (-s, 0, c))
+
+
+def z_rotation(th):
+    c, s = cos(th), sin(th)
+    return ((c, -s, 0), (s, c, 0), (0, 0, 1))
+
+
+### Matrices
+
+def transpose(m):
+    (a, b, c), (d, e, f), (g, h, i) = m
+    return ((a, d, g), (b, e, h), (c, f, i))
+
+
+def mul(m, n):
+    """Return the matrix product m * n"""
+    (m11, m12, m13), (m21, m22, m23), (m31, m32, m33) = m
+    (n11, n12, n13), (n21, n22, n23), (n31, n32, n33) = n
+    return ((m11 * n11 + m12 * n21 + m13 * n31,
+             m11 * n12 + m12 * n22 + m13 * n32,
+             m11 * n13 + m12 * n23 + m13 * n33),
+            (m21 * n11 + m22 * n21 + m23 * n31,
+             m21 * n12 + m22 * n22 + m23 * n32,
+             m21 * n13 + m22 * n23 + m23 * n33),
+            (m31 * n11 + m32 * n21 + m33 * n31,
+             m31 * n12 + m32 * n22 + m33 * n32,
+             m31 * n13 + m32 * n23 + m33 * n33))
+
+
+def mul_vec(m, v):
+    """Return the matrix-vector product m * v"""
+    x, y, z = v
+    (a, b, c), (d, e, f), (g, h, i) = m
+    return (a * x + b * y + c * z,
+            d * x + e * y + f * z,
+            g * x + h * y + i * z)
+
+
+def tmul_vec(m, v):
+    """Return transpose(m) * v, the inverse rotation if m is a rotation"""
+    x, y, z = v
+    (a, b, c), (d, e, f), (g, h, i) = m
+    return (a * x + d * y + g * z,
+            b * x + e * y + h * z,
+            c * x + f * y + i * z)
+
+
+def det(m):
+    (a, b, c), (d, e, f), (g, h, i) = m
+    return a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
+
+
+def inverse(m):
+    """Return the inverse of m by its adjugate"""
+    (a, b, c), (d, e, f), (g, h, i) = m
+    r = 1. / det(m)
+    return (((e * i - f * h) * r, (c * h - b * i) * r, (b * f - c * e) * r),
+            ((f * g - d * i) * r, (a * i - c * g) * r, (c * d - a * f) * r),
+            ((d * h - e * g) * r, (b * g - a * h) * r, (a * e - b * d) * r))
+
+
+### Vectors
+
+def dot(u, v):
+    return u[0] * v[0] + u[1] * v[1] + u[2] * v[2]
+
+
+def cross(u, v):
+    u1, u2, u3 = u
+    v1, v2, v3 = v
+    return (u2 * v3 - u3 * v2,
+            u3 * v1 - u1 * v3,
+            u1 * v2 - u2 * v1)
+
+
+def norm(v):
+    return sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2])
+
+
+def scale(v, factor):
+    return (v[0] * factor, v[1] * factor, v[2] * factor)
+
+
+def normalised(v):
+    return scale(v, 1 / norm(v))
@@ -1,6 +1,8 @@
 
 from math import pi
 
+import pytest
+
 try:
     from numpy import matrix
 except ImportError:
@@ -8,6 +10,7 @@ except ImportError:
 from diffcalc.tests.tools import mneq_, aneq_, dneq_
 
 import diffcalc.util  # @UnusedImport
+from diffcalc.util import DiffcalcException
 from diffcalc.hardware import DummyHardwareAdapter
 from diffcalc.hkl.you.geometry import SixCircle
 from diffcalc.ub.persistence import UbCalculationNonPersister
@@ -70,6 +73,19 @@ def test_angles_to_hkl():
     aneq_(hkl_calc, [1, 0, 0])
     dneq_(param_calc, param)
     
+def test_angles_array_to_hkl():
+    hkl_calc = dc.angles_array_to_hkl([angles, [0, 60, 0, 30, 0, 90]],
+                                      [en, en])
+    aneq_(hkl_calc[0], [1, 0, 0])
+    aneq_(hkl_calc[1], [0, 1, 0])
+    hkl_calc = dc.angles_array_to_hkl([angles])
+    aneq_(hkl_calc[0], [1, 0, 0])
+
+def test_angles_array_to_virtual_angles():
+    param_calc = dc.angles_array_to_virtual_angles([angles], en)
+    for name, value in param.items():
+        aneq_([param_calc[name][0]], [value])
+
 def test_hkl_to_angles():
     dc.con('a_eq_b')
     dc.con('mu', 0)
@@ -80,6 +96,127 @@ def test_hkl_to_angles():
     aneq_(angles_calc, angles)
     dneq_(param_calc, param)
     
+def test_hkl_to_angles_cache():
+    dc.con('a_eq_b', 'mu', 0, NUNAME, 0)
+    cache = dc.hklcalc.solution_cache
+    cache.clear()
+    _, param_calc = dc.hkl_to_angles(1, 0, 0)
+    param_calc['theta'] = 0
+    angles_calc, param_calc = dc.hkl_to_angles(1, 0, 0)
+    aneq_(angles_calc, angles)
+    dneq_(param_calc, param)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    dc.con('mu', 10)
+    angles_calc, _ = dc.hkl_to_angles(1, 0, 0)
+    assert abs(angles_calc[0] - 10) < 1e-8
+    dc.con('mu', 0)
+    dc.setmin('delta', 70)
+    try:
+        with pytest.raises(DiffcalcException):
+            dc.hkl_to_angles(1, 0, 0)
+    finally:
+        settings.hardware.set_lower_limit('delta', None)
+    dc.hkl_to_angles(1, 0, 0)
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    dc.hklcache('clear')
+    assert len(cache) == 0
+
+def test_hkl_to_angles_cache_follows_motors():
+    dc.con('delta', 60, 'mu', 0, 'eta', 0)
+    cache = dc.hklcalc.solution_cache
+    cache.clear()
+    solutions = dc.hklcalc.hklToAngles(1, 0, 0, wl, True)
+    assert len(solutions) == 2
+    position = settings.hardware.position
+    try:
+        for _ in range(2):
+            for pos, _ in solutions:
+                settings.hardware.position = list(pos.totuple())
+                angles_calc, _ = dc.hkl_to_angles(1, 0, 0)
+                aneq_(angles_calc, pos.totuple())
+    finally:
+        settings.hardware.position = position
+    # one miss listing all solutions and one for the first single solution
+    assert (cache.hits, cache.misses) == (3, 2)
+
+def test_angles_to_hkl_readback_cache():
+    cache = dc.hklcalc.readback_cache
+    cache.clear()
+    hkl_calc, param_calc = dc.angles_to_hkl(angles, en)
+    param_calc['theta'] = 0
+    hkl_calc, param_calc = dc.angles_to_hkl(angles, en)
+    aneq_(hkl_calc, [1, 0, 0])
+    dneq_(param_calc, param)
+    assert (cache.hits, cache.misses) == (1, 1)
+    # the wavelength is part of the key, so energy changes are never stale
+    hkl_calc, _ = dc.angles_to_hkl(angles, 2 * en)
+    aneq_(hkl_calc, [2, 0, 0])
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    reference = dc._ub.ubcalc._state.reference
+    n_hkl = reference.n_hkl_configured
+    reference.n_hkl_configured = matrix('0; 1; 1')
+    try:
+        _, param_calc = dc.angles_to_hkl(angles, en)
+        assert abs(param_calc['psi'] - param['psi']) > 1
+    finally:
+        reference.n_hkl_configured = n_hkl
+    dneq_(dc.angles_to_hkl(angles, en)[1], param)
+    assert (cache.hits, cache.misses) == (1, 4)
+
+def test_hkl_path_to_angles():
+    dc.con('a_eq_b', 'mu', 0, NUNAME, 0)
+    angles_list, params, flips = dc.hkl_path_to_angles(
+        [(1, 0, 0), (1, .05, 0), (1, .1, 0)])
+    assert len(angles_list) == len(params) == 3
+    assert flips == []
+    aneq_(angles_list[0], angles)
+    for (h, k, l), angles_calc in zip([(1, .05, 0), (1, .1, 0)],
+                                      angles_list[1:]):
+        hkl, _ = dc.angles_to_hkl(angles_calc)
+        aneq_(hkl, (h, k, l))
+
+def test_hkl_path_to_pvt():
+    dc.con('a_eq_b', 'mu', 0, NUNAME, 0)
+    trajectory = dc.hkl_path_to_pvt([(1, 0, 0), (1, .05, 0), (1, .1, 0)],
+                                    total_time=2., max_acceleration=10.)
+    assert len(trajectory) == 5
+    aneq_(trajectory.positions[1], angles)
+    aneq_(trajectory.velocities[0], [0] * 6)
+    for i, (h, k, l) in zip(range(1, 4), [(1, 0, 0), (1, .05, 0), (1, .1, 0)]):
+        hkl, _ = dc.angles_to_hkl(trajectory.positions[i])
+        aneq_(hkl, (h, k, l))
+
+def test_iter_hkl_list_to_angles():
+    dc.con('a_eq_b', 'mu', 0, NUNAME, 0)
+    hkl_list = [(1, 0, 0), (10, 0, 0), (1, .1, 0)]
+    items = list(dc.iter_hkl_list_to_angles(hkl_list))
+    assert [hkl for hkl, _ in items] == hkl_list
+    assert items[1][1] == []
+    for hkl, solutions in (items[0], items[2]):
+        for angles_calc, _ in solutions:
+            aneq_(dc.angles_to_hkl(angles_calc)[0], hkl)
+    chunks = list(dc.iter_hkl_list_to_angles(hkl_list, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+
+def test_reachable_reflections():
+    dc.con('a_eq_b', 'mu', 0, NUNAME, 0)
+    hkl, angles_list, ttheta = dc.reachable_reflections()
+    assert len(hkl) == len(angles_list) == len(ttheta)
+    assert (1, 0, 0) in map(tuple, hkl)
+    assert all(b - a > -1e-8 for a, b in zip(ttheta, ttheta[1:]))
+    for hkl_expected, angles_calc in zip(hkl, angles_list):
+        aneq_(dc.angles_to_hkl(angles_calc)[0], hkl_expected)
+    dc.reachable()
+
+def test_accessible_volume():
+    volume = dc.accessible_volume(step=.5, samples=10000)
+    assert volume.samples == 10000
+    assert volume.is_reachable((1, 0, 0))
+    assert not volume.is_region_reachable((5, 5, 5), (6, 6, 6))
+
 def test_allhkl():
     diffcalc.util.DEBUG = True
     dc.con('eta', 0, 'chi', 0, 'phi', 0)
@@ -146,6 +146,23 @@ class TestHkl(object):
         self.mockSixc.asynchronousMoveTo.assert_called_with(
             [12.1, 5.1, 4.1, 3.1, 2.1, 1.1])
 
+    def testAsynchronousMoveToInScanPassesPreviousTarget(self):
+        self.mockSixc.getPosition.return_value = [6, 5, 4, 3, 2, 1]
+        self.mock_dc_module.angles_to_hkl.return_value = ([1, 0, 1], PARAM_DICT)
+        self.mock_dc_module.hkl_to_angles.return_value = ([12, 5, 4, 3, 2, 1],
+                                                          PARAM_DICT)
+        self.hkl.atScanStart()
+        self.hkl.asynchronousMoveTo([2, 0, 1])
+        self.mock_dc_module.hkl_to_angles.assert_called_with(2, 0, 1)
+
+        self.hkl.asynchronousMoveTo([2, 0, 2])
+        self.mock_dc_module.hkl_to_angles.assert_called_with(
+            2, 0, 2, reference_position=[12, 5, 4, 3, 2, 1])
+
+        self.hkl.atScanEnd()
+        self.hkl.asynchronousMoveTo([2, 0, 3])
+        self.mock_dc_module.hkl_to_angles.assert_called_with(2, 0, 3)
+
     def testIsBusy(self):
         self.mockSixc.isBusy.return_value = False
         assert not self.hkl.isBusy()
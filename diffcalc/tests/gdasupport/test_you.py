@@ -17,6 +17,7 @@
 ###
 
 from math import pi
+import pytest
 from nose.tools import eq_, raises  # @UnresolvedImport
 from nose.plugins.skip import Skip, SkipTest  # @UnresolvedImport
 from diffcalc.hardware import ScannableHardwareAdapter
@@ -26,6 +27,7 @@ from diffcalc.hkl.you.geometry import SixCircle
 from diffcalc.ub.persistence import UbCalculationNonPersister
 
 import diffcalc.util  # @UnusedImport
+from diffcalc.util import DiffcalcException
 
 try:
     from numpy import matrix
@@ -171,6 +173,22 @@ def test_hkl_move_okay():
     pos(you.hkl, [1, 1, 0])  # TODO: prints DEGENERATE. necessary?
     call_scannable(you.sixc)  # @UndefinedVariable
 
+def test_cached_solutions_follow_limits_set_on_scannables():
+    _orient()
+    you.con('a_eq_b', mu, 0, gam, 0)
+    cache = you.hklcalc.solution_cache
+    cache.clear()
+    you.hkl_to_angles(1, 1, 0)
+    you.hkl_to_angles(1, 1, 0)
+    assert (cache.hits, cache.misses) == (1, 1)
+    delta.setLowerDummyLimit(100)
+    try:
+        with pytest.raises(DiffcalcException):
+            you.hkl_to_angles(1, 1, 0)
+    finally:
+        delta.setLowerDummyLimit(None)
+    assert (cache.hits, cache.misses) == (1, 2)
+
 @raises(TypeError)
 def test_usage_error_signature():
     you.c2th('wrong arg', 'wrong arg')
@@ -0,0 +1,159 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import json
+
+import pytest
+
+from diffcalc import settings
+from diffcalc.hardware import DummyHardwareAdapter
+from diffcalc.hkl import profiling
+from diffcalc.hkl.profiling import StageProfiler, dcprofile
+from diffcalc.hkl.willmott import commands as willmott_commands
+from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.constraints import YouConstraintManager
+from diffcalc.hkl.you.geometry import SixCircle
+from diffcalc.settings import NUNAME
+from diffcalc.tests.hkl.you.test_calc import createMockUbcalc
+from diffcalc.ub.crystal import CrystalUnderTest
+
+
+class TestStageProfiler(object):
+
+    def setup_method(self):
+        self.profiler = StageProfiler()
+
+    def test_disabled_by_default(self):
+        with self.profiler.stage('a'):
+            pass
+        assert self.profiler.as_dict() == {}
+        assert 'off' in str(self.profiler)
+
+    def test_records_calls_and_time(self):
+        self.profiler.enabled = True
+        for _ in range(3):
+            with self.profiler.stage('a'):
+                pass
+        self.profiler.record('b', 2.)
+        self.profiler.record('b', 4.)
+        stages = self.profiler.as_dict()
+        assert stages.keys() == ['a', 'b']
+        assert stages['a']['calls'] == 3
+        assert stages['b'] == {'calls': 2, 'total': 6., 'mean': 3.,
+                               'rejected': 0}
+        assert json.loads(self.profiler.to_json())['b']['total'] == 6.
+        assert str(self.profiler).splitlines()[2].split() == \
+            ['b', '2', '6000.000', '3000000.0', '0']
+
+    def test_counts_rejections_only_while_enabled(self):
+        self.profiler.reject('a', 2)
+        assert self.profiler.as_dict() == {}
+        self.profiler.enabled = True
+        self.profiler.reject('a', 2)
+        self.profiler.reject('a')
+        assert self.profiler.as_dict()['a'] == {
+            'calls': 0, 'total': 0., 'mean': 0., 'rejected': 3}
+
+    def test_records_stage_that_raises(self):
+        self.profiler.enabled = True
+        with pytest.raises(ValueError):
+            with self.profiler.stage('a'):
+                raise ValueError()
+        assert self.profiler.as_dict()['a']['calls'] == 1
+
+    def test_reset(self):
+        self.profiler.record('a', 1.)
+        self.profiler.reset()
+        assert self.profiler.as_dict() == {}
+
+
+class TestDcprofile(object):
+
+    def setup_method(self):
+        self.profiler = profiling.profiler
+        self.profiler.reset()
+
+    def teardown_method(self):
+        self.profiler.enabled = False
+        self.profiler.reset()
+
+    def test_on_off_and_reset(self):
+        dcprofile('on')
+        assert self.profiler.enabled
+        self.profiler.record('a', 1.)
+        dcprofile()
+        dcprofile('reset')
+        assert self.profiler.as_dict() == {}
+        dcprofile('off')
+        assert not self.profiler.enabled
+        with pytest.raises(TypeError):
+            dcprofile('not a command')
+
+    def test_dump(self, tmpdir):
+        self.profiler.record('a', 1.)
+        dcprofile('dump')
+        filename = str(tmpdir.join('profile.json'))
+        dcprofile('dump', filename)
+        with open(filename) as f:
+            assert json.load(f) == {'a': {'calls': 1, 'total': 1.,
+                                          'mean': 1., 'rejected': 0}}
+
+    def test_willmott_commands(self):
+        assert 'dcprofile' in willmott_commands.__all__
+        commands = willmott_commands.WillmottHklCommands(None).commands
+        assert dcprofile in commands
+
+    def test_you_calculator_stages(self):
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        B = CrystalUnderTest('xtal', 4, 4, 4, 90, 90, 90).B
+        constraints = YouConstraintManager()
+        constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        calc = YouHklCalculator(createMockUbcalc(B), constraints)
+        dcprofile('on')
+        calc.hklToAngles(1, 0, 1, 1.)
+        stages = self.profiler.as_dict()
+        for name in ('hklToAngles', 'constraint plan', 'theta and tau',
+                     'reference angles', 'detector angles', 'sample angles',
+                     'tidy degenerate solutions', 'filter angle limits',
+                     'virtual angle check', 'verify hkl'):
+            assert stages[name]['calls'] >= 1, name
+        assert stages['hklToAngles']['calls'] == 1
+
+    def test_you_calculator_rejections(self):
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        settings.hardware.set_lower_limit('delta', 0)
+        B = CrystalUnderTest('xtal', 4, 4, 4, 90, 90, 90).B
+        constraints = YouConstraintManager()
+        constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        calc = YouHklCalculator(createMockUbcalc(B), constraints)
+        dcprofile('on')
+        try:
+            calc.hklToAngles(1, 0, 1, 1.)
+        finally:
+            settings.hardware.set_lower_limit('delta', None)
+        stages = self.profiler.as_dict()
+        assert stages['filter angle limits']['rejected'] >= 1
+        assert (stages['filter angle limits']['calls'] ==
+                stages['tidy degenerate solutions']['calls'])
+        assert (stages['virtual angle check']['calls'] ==
+                stages['filter angle limits']['calls'] -
+                stages['filter angle limits']['rejected'])
@@ -46,6 +46,7 @@ def createMockUbcalc(UB):
     ubcalc.tau = 0
     ubcalc.sigma = 0
     ubcalc.UB = UB
+    ubcalc.UB_inv = None  # the calculators invert UB
     ubcalc.n_phi = matrix([[0], [0], [1]])
     return ubcalc
 
@@ -0,0 +1,120 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import asin, pi
+
+import pytest
+
+try:
+    import numpy as np
+except ImportError:
+    pytest.skip('numpy not available', allow_module_level=True)
+
+from diffcalc import settings
+from diffcalc.hardware import DummyHardwareAdapter
+from diffcalc.hkl.you import accessible
+from diffcalc.hkl.you.calc import YouHklCalculator, youAnglesToHkl
+from diffcalc.hkl.you.constraints import YouConstraintManager
+from diffcalc.hkl.you.geometry import SixCircle, YouPosition
+from diffcalc.settings import NUNAME
+from diffcalc.tests.hkl.you.test_calc import createMockUbcalc
+from diffcalc.ub.crystal import CrystalUnderTest
+from diffcalc.util import DiffcalcException
+
+TODEG = 180 / pi
+WAVELENGTH = 1.5
+
+
+class TestAccessibleVolume(object):
+
+    def setup_method(self):
+        self.crystal = CrystalUnderTest('xtal', 3, 3, 3, 90, 90, 90)
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        self.calc = YouHklCalculator(createMockUbcalc(self.crystal.B),
+                                     YouConstraintManager())
+
+    def test_occupancy_matches_single_positions(self):
+        settings.hardware.set_lower_limit('delta', 0)
+        settings.hardware.set_upper_limit('delta', 60)
+        volume = accessible.accessible_volume(self.calc, WAVELENGTH, .5, 200,
+                                              seed=1, chunk_size=50)
+        assert volume.samples == 200
+        expected = np.zeros(volume.shape, dtype=int)
+        seeds = np.random.RandomState(1)
+        for _ in range(4):
+            for angles in accessible.sample_physical_angles(
+                    50, seeds.randint(2 ** 31)):
+                assert 0 <= angles[1] <= 60
+                position = YouPosition(*angles, unit='DEG').inRadians()
+                hkl = youAnglesToHkl(position, WAVELENGTH, self.crystal.B)
+                expected[volume.index(hkl)] += 1
+        assert (volume.occupancy == expected).all()
+
+    def test_limits_restrict_the_volume(self):
+        settings.hardware.set_lower_limit('delta', 0)
+        settings.hardware.set_upper_limit('delta', 60)
+        settings.hardware.set_lower_limit(NUNAME, 0)
+        settings.hardware.set_upper_limit(NUNAME, 0)
+        volume = self.calc.accessibleVolume(WAVELENGTH, .25, 200000)
+        assert volume.shape == (33, 33, 33)
+        # two theta is 29 degrees at 1 0 0 and 90 degrees at 2 2 0
+        assert 2 * asin(WAVELENGTH / 6) * TODEG < 30
+        assert volume.is_reachable((1, 0, 0))
+        assert volume.is_reachable((0, -1, 0))
+        assert not volume.is_reachable((2, 2, 0))
+        assert not volume.is_reachable((10, 0, 0))
+        assert not volume.is_region_reachable((1.9, 1.9, -.1), (2.1, 2.1, .1))
+        assert volume.is_region_reachable((.5, .5, -.5), (2.5, 2.5, .5))
+        lines = str(volume).splitlines()
+        assert lines[0] == '200000 samples in 33 x 33 x 33 voxels of 0.25'
+        assert lines[-1].endswith('% of voxels reachable')
+
+    def test_region_counts_and_projections(self):
+        volume = self.calc.accessibleVolume(WAVELENGTH, .5, 20000)
+        occupied = volume.occupancy > 0
+        for lower, upper in (((-1, -1, -1), (1, 1, 1)),
+                             ((0, -4.2, 1), (3, 2, 1)),
+                             ((-10, -10, -10), (10, 10, 10)),
+                             ((5, 5, 5), (6, 6, 6))):
+            (i0, j0, k0), (i1, j1, k1) = [
+                np.clip(np.floor((np.array(corner) - volume.lower) /
+                                 volume.step).astype(int) + extra,
+                        0, volume.shape)
+                for corner, extra in ((lower, 0), (upper, 1))]
+            assert volume.count_reachable(lower, upper) == \
+                occupied[i0:i1, j0:j1, k0:k1].sum()
+        for i, axis in enumerate('hkl'):
+            assert (volume.projection(axis) == occupied.sum(i)).all()
+            assert len(volume.centres(axis)) == volume.shape[i]
+        assert 0 < volume.fraction < 1
+        assert list(volume.centres('h')).count(0) == 1
+
+    def test_too_many_voxels(self):
+        with pytest.raises(DiffcalcException):
+            self.calc.accessibleVolume(WAVELENGTH, .001, 10)
+
+    def test_axis_ranges(self):
+        hardware = settings.hardware
+        hardware.set_lower_limit('mu', -10)
+        hardware.set_upper_limit('delta', 100)
+        hardware.set_cut('eta', 0)
+        ranges = accessible._axis_ranges(hardware, hardware.get_axes_names())
+        assert ranges.tolist() == [[-10, 350], [-260, 100], [-180, 180],
+                                   [0, 360], [-180, 180], [0, 360]]
@@ -0,0 +1,250 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi
+from itertools import product
+
+import pytest
+
+try:
+    import numpy as np
+except ImportError:
+    pytest.skip('numpy not available', allow_module_level=True)
+
+from diffcalc import settings
+from diffcalc.hardware import DummyHardwareAdapter
+from diffcalc.hkl.you.batch import youAnglesToHklArray, \
+    create_you_matrix_stacks, youAnglesToVirtualAnglesArray
+from diffcalc.hkl.you.calc import YouHklCalculator, youAnglesToHkl
+from diffcalc.hkl.you.geometry import YouPosition, create_you_matrices
+from diffcalc.hkl.you.constraints import YouConstraintManager
+from diffcalc.hkl.you.geometry import SixCircle, FourCircle
+from diffcalc.settings import NUNAME
+from diffcalc.tests.hkl.you.test_calc import createMockUbcalc, \
+    createMockHardwareMonitor
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.ub.crystal import CrystalUnderTest
+from diffcalc.util import x_rotation, y_rotation, z_rotation, \
+    DiffcalcException
+
+TORAD = pi / 180
+
+MODES = (
+    {'a_eq_b': None, 'mu': 0, NUNAME: 0},
+    {'psi': 30 * TORAD, 'naz': 60 * TORAD, 'phi': 5 * TORAD},
+    {'psi': 10 * TORAD, 'qaz': 90 * TORAD, 'mu': 5 * TORAD},
+    {'alpha': 2 * TORAD, NUNAME: 5 * TORAD, 'phi': 20 * TORAD},
+    {'beta': 3 * TORAD, 'delta': 40 * TORAD, 'eta': 10 * TORAD},
+    {'betain': 2 * TORAD, 'qaz': 90 * TORAD, 'chi': 30 * TORAD},
+    {'bin_eq_bout': None, 'qaz': 0, 'mu': 10 * TORAD},
+    {'betaout': 1 * TORAD, 'delta': 0, 'eta': 0},
+)
+
+SCALAR_MODES = (
+    {'a_eq_b': None, 'chi': 90 * TORAD, 'phi': 0},
+    {'chi': 0, 'phi': 0, 'eta': 0},
+)
+
+
+def _rounded(positions):
+    return sorted(tuple(round(v, 5) + 0. for v in pos) for pos in positions)
+
+
+class TestHklArrayToAngles(object):
+
+    def setup_method(self):
+        B = CrystalUnderTest('xtal', 3.8, 4.1, 5.7, 90, 95, 120).B
+        U = z_rotation(12 * TORAD) * y_rotation(5 * TORAD) * x_rotation(-3 * TORAD)
+        self.ubcalc = createMockUbcalc(U * B)
+        self.ubcalc.surf_nphi = np.matrix([[0], [0.6], [0.8]])
+        settings.geometry = SixCircle()
+        settings.hardware = createMockHardwareMonitor()
+        self.constraints = YouConstraintManager()
+        self.calc = YouHklCalculator(self.ubcalc, self.constraints)
+        hkl = list(product(range(-2, 3), repeat=3))
+        rand = np.random.RandomState(0)
+        self.hkl = np.vstack((hkl, rand.uniform(-2, 2, (40, 3))))
+        self.wavelength = 1.2
+
+    def _scalar_solutions(self, hkl, wavelength, filter_out_of_limits):
+        solutions = []
+        for h, k, l in hkl:
+            try:
+                pairs = self.calc._hklToAngles(h, k, l, wavelength,
+                                               not filter_out_of_limits)
+            except DiffcalcException:
+                solutions.append([])
+                continue
+            positions = []
+            for pos, _ in pairs:
+                pos.changeToDegrees()
+                positions.append(pos.totuple())
+            solutions.append(positions)
+        return solutions
+
+    def _check_against_scalar(self, constraints, filter_out_of_limits=True):
+        self.constraints._constrained = constraints
+        index, positions, virtual_angles = self.calc.hklArrayToAngles(
+            self.hkl, self.wavelength, filter_out_of_limits)
+        expected = self._scalar_solutions(self.hkl, self.wavelength,
+                                          filter_out_of_limits)
+        assert sum(len(s) for s in expected) > 0
+        assert list(index) == sorted(index)
+        for row, expected_positions in enumerate(expected):
+            batch_positions = positions[index == row]
+            assert _rounded(batch_positions) == _rounded(expected_positions), \
+                'hkl %s in mode %s' % (self.hkl[row], constraints)
+        for name in ('theta', 'ttheta', 'qaz', 'betain', 'betaout'):
+            assert len(virtual_angles[name]) == len(index)
+
+    def test_vectorised_modes(self):
+        for constraints in MODES:
+            self._check_against_scalar(constraints)
+
+    def test_vectorised_modes_without_limits(self):
+        for constraints in MODES:
+            self._check_against_scalar(constraints, False)
+
+    def test_scalar_modes(self):
+        for constraints in SCALAR_MODES:
+            self._check_against_scalar(constraints)
+
+    def test_virtual_angles(self):
+        self.constraints._constrained = MODES[1]
+        index, positions, virtual_angles = self.calc.hklArrayToAngles(
+            self.hkl, self.wavelength)
+        for i in (0, len(index) // 2, len(index) - 1):
+            h, k, l = self.hkl[index[i]]
+            pos = settings.geometry.create_position(*positions[i])
+            (hkl, expected) = self.calc.anglesToHkl(pos, self.wavelength)
+            assert_array_almost_equal(hkl, (h, k, l), 6)
+            for name, value in expected.items():
+                assert_array_almost_equal([virtual_angles[name][i]], [value], 6)
+            assert abs(virtual_angles['psi'][i] - 30) < 1e-6
+
+    def test_wavelength_array(self):
+        self.constraints._constrained = MODES[0]
+        wavelength = np.linspace(1., 1.5, len(self.hkl))
+        index, positions, _ = self.calc.hklArrayToAngles(self.hkl, wavelength)
+        for i in (0, len(index) - 1):
+            row = index[i]
+            pos = settings.geometry.create_position(*positions[i])
+            hkl, _ = self.calc.anglesToHkl(pos, wavelength[row])
+            assert_array_almost_equal(hkl, self.hkl[row], 6)
+
+    def test_four_circle_geometry(self):
+        settings.geometry = FourCircle()
+        settings.hardware = DummyHardwareAdapter(('delta', 'eta', 'chi', 'phi'))
+        settings.hardware.set_lower_limit('delta', 0)
+        settings.hardware.set_upper_limit('chi', 90)
+        self._check_against_scalar(MODES[0])
+
+    def test_empty_array(self):
+        self.constraints._constrained = MODES[0]
+        index, positions, _ = self.calc.hklArrayToAngles(np.zeros((0, 3)), 1.)
+        assert index.shape == (0,)
+        assert positions.shape == (0, 6)
+
+    def test_not_fully_constrained(self):
+        self.constraints._constrained = {'mu': 0}
+        with pytest.raises(DiffcalcException):
+            self.calc.hklArrayToAngles(self.hkl, self.wavelength)
+
+
+class TestYouAnglesToHklArray(object):
+
+    def setup_method(self):
+        B = CrystalUnderTest('xtal', 3.8, 4.1, 5.7, 90, 95, 120).B
+        self.UB = z_rotation(12 * TORAD) * y_rotation(5 * TORAD) * B
+        rand = np.random.RandomState(0)
+        self.positions = rand.uniform(-pi, pi, (20, 6))
+        self.wavelength = rand.uniform(0.5, 1.5, 20)
+
+    def test_matrix_stacks(self):
+        stacks = create_you_matrix_stacks(self.positions)
+        for pos, matrices in zip(self.positions, zip(*stacks)):
+            for expected, result in zip(create_you_matrices(*pos), matrices):
+                assert_array_almost_equal(result.ravel(),
+                                          np.asarray(expected).ravel(), 12)
+
+    def test_against_scalar(self):
+        hkl = youAnglesToHklArray(self.positions, self.wavelength, self.UB)
+        assert hkl.shape == (20, 3)
+        for pos, wl, result in zip(self.positions, self.wavelength, hkl):
+            expected = youAnglesToHkl(YouPosition(*pos, unit='RAD'), wl,
+                                      self.UB)
+            assert_array_almost_equal(result, expected, 10)
+
+    def test_single_wavelength(self):
+        hkl = youAnglesToHklArray(self.positions, 1., self.UB)
+        expected = youAnglesToHkl(YouPosition(*self.positions[3], unit='RAD'),
+                                  1., self.UB)
+        assert_array_almost_equal(hkl[3], expected, 10)
+
+    def test_calculator_in_degrees(self):
+        calc = YouHklCalculator(createMockUbcalc(self.UB),
+                                YouConstraintManager())
+        hkl = calc.anglesArrayToHkl(self.positions / TORAD, self.wavelength)
+        assert_array_almost_equal(
+            hkl[5], youAnglesToHklArray(self.positions[5:6],
+                                        self.wavelength[5], self.UB)[0], 10)
+
+
+class TestYouAnglesToVirtualAnglesArray(object):
+
+    def setup_method(self):
+        B = CrystalUnderTest('xtal', 3.8, 4.1, 5.7, 90, 95, 120).B
+        self.ubcalc = createMockUbcalc(z_rotation(12 * TORAD) * B)
+        self.ubcalc.surf_nphi = np.matrix([[0], [0.6], [0.8]])
+        self.calc = YouHklCalculator(self.ubcalc, YouConstraintManager())
+        rand = np.random.RandomState(0)
+        self.positions = rand.uniform(-pi, pi, (20, 6))
+        self.positions[0] = (0, 60 * TORAD, 0, 30 * TORAD, 0, 0)
+        self.include_reference = settings.include_reference
+
+    def teardown_method(self):
+        settings.include_reference = self.include_reference
+
+    def _check_against_scalar(self):
+        virtual_angles = youAnglesToVirtualAnglesArray(
+            self.positions, self.ubcalc.n_phi, self.ubcalc.surf_nphi)
+        assert len(virtual_angles) == 20
+        for pos, result in zip(self.positions, virtual_angles):
+            expected = self.calc._anglesToVirtualAngles(
+                YouPosition(*pos, unit='RAD'), 1.)
+            assert set(expected.keys()) == set(virtual_angles.dtype.names)
+            for name, value in expected.items():
+                assert_array_almost_equal([result[name]], [value], 10)
+
+    def test_against_scalar(self):
+        settings.include_reference = True
+        self._check_against_scalar()
+
+    def test_against_scalar_without_reference(self):
+        settings.include_reference = False
+        self._check_against_scalar()
+
+    def test_calculator_in_degrees(self):
+        settings.include_reference = True
+        virtual_angles = self.calc.anglesArrayToVirtualAngles(
+            self.positions[:2] / TORAD, 1.)
+        expected = self.calc.anglesToVirtualAngles(
+            YouPosition(*self.positions[1], unit='RAD'), 1.)
+        for name, value in expected.items():
+            assert_array_almost_equal([virtual_angles[name][1]], [value], 10)
+        assert_array_almost_equal([virtual_angles['ttheta'][0]], [60], 10)
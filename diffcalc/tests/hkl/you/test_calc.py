@@ -27,7 +27,8 @@ except ImportError:
     from numjy import matrix
 
 from diffcalc.hardware import DummyHardwareAdapter
-from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.calc import YouHklCalculator, REFERENCE_DETECTOR_SAMPLE, \
+    DETECTOR_TWO_SAMPLE, REFERENCE_TWO_SAMPLE, THREE_SAMPLE
 from diffcalc.hkl.you.constraints import YouConstraintManager
 from diffcalc.tests.tools import assert_array_almost_equal, \
     assert_second_dict_almost_in_first, arrayeq_
@@ -56,6 +57,7 @@ def createMockUbcalc(UB):
     ubcalc.tau = 0
     ubcalc.sigma = 0
     ubcalc.UB = UB
+    ubcalc.UB_inv = None  # the calculators invert UB
     ubcalc.n_phi = matrix([[0], [0], [1]])
     ubcalc.surf_nphi = matrix([[0], [0], [1]])
     return ubcalc
@@ -1969,3 +1971,139 @@ class Test_FixedAlphaMuChiSurfaceNormalHorizontal(_BaseTest):
         self.makes_cases(None, None)  # xrot, yrot unused
         for case_tuple in self.case_generator():
             yield case_tuple
+
+
+class TestConstraintPlan(object):
+
+    def setup_method(self):
+        B = CrystalUnderTest('xtal', 3.8, 4.1, 5.7, 90, 95, 120).B
+        self.UB = z_rotation(12 * TORAD) * y_rotation(5 * TORAD) * B
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        self.constraints = YouConstraintManager()
+        self.calc = YouHklCalculator(createMockUbcalc(self.UB),
+                                     self.constraints)
+
+    def test_plan_is_rebuilt_only_when_constraints_change(self):
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        plan = self.calc._get_constraint_plan()
+        assert self.calc._get_constraint_plan() is plan
+        assert plan.branch == REFERENCE_DETECTOR_SAMPLE
+        self.constraints.unconstrain('a_eq_b')
+        self.constraints.constrain('phi')
+        self.constraints.set_constraint('phi', 10)
+        plan = self.calc._get_constraint_plan()
+        assert plan.branch == DETECTOR_TWO_SAMPLE
+        assert_array_almost_equal(plan.trig['phi'],
+                                  (sin(10 * TORAD), cos(10 * TORAD)))
+
+    def test_branches(self):
+        for constraints, branch in (
+                ({'psi': 0, 'eta': 0, 'phi': 0}, REFERENCE_TWO_SAMPLE),
+                ({'chi': 0, 'phi': 0, 'eta': 0}, THREE_SAMPLE)):
+            self.constraints._constrained = constraints
+            assert self.calc._get_constraint_plan().branch == branch
+
+    @raises(DiffcalcException)
+    def test_not_fully_constrained(self):
+        self.constraints._constrained = {'mu': 0, NUNAME: 0}
+        self.calc._get_constraint_plan()
+
+    def test_three_sample_constraints(self):
+        fixed = {'mu': 10 * TORAD, 'eta': 20 * TORAD, 'chi': 30 * TORAD,
+                 'phi': 40 * TORAD}
+        for free in ('mu', 'eta', 'chi', 'phi'):
+            self.constraints._constrained = dict(
+                (name, value) for name, value in fixed.items() if name != free)
+            assert self.calc._get_constraint_plan().free_sample_angle == free
+            for pos, _ in self.calc.hklToAngles(1, .5, .2, 1., True):
+                hkl, _ = self.calc.anglesToHkl(pos, 1.)
+                assert_array_almost_equal(hkl, (1, .5, .2))
+                for name, value in fixed.items():
+                    if name != free:
+                        assert_array_almost_equal(
+                            [getattr(pos, name)], [value * TODEG])
+
+
+class TestReferencePosition(object):
+
+    def setup_method(self):
+        B = CrystalUnderTest('xtal', 4, 4, 4, 90, 90, 90).B
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        constraints = YouConstraintManager()
+        constraints._constrained = {'chi': 0, 'phi': 0, 'eta': 0}
+        self.calc = YouHklCalculator(createMockUbcalc(B), constraints)
+        self.all_solutions = self.calc.hklToAngles(0, 0, 1, 1., True)
+        assert len(self.all_solutions) > 1
+
+    def test_solution_closest_to_reference_is_chosen(self):
+        settings.hardware.get_position = Mock(side_effect=AssertionError(
+            'hardware should not be read'))
+        for expected, _ in self.all_solutions:
+            reference = Pos(*[v + .5 for v in expected.totuple()], unit='DEG')
+            pos, _ = self.calc.hklToAngles(0, 0, 1, 1.,
+                                           reference_position=reference)
+            assert_array_almost_equal(pos.totuple(), expected.totuple())
+            pos, _ = self.calc.hklToAngles(
+                0, 0, 1, 1., reference_position=expected.totuple())
+            assert_array_almost_equal(pos.totuple(), expected.totuple())
+            pos, _ = self.calc.hklListToAngles(
+                [(0, 0, 1)], 1., reference_position=reference)
+            assert_array_almost_equal(pos.totuple(), expected.totuple())
+
+    def test_hardware_position_is_default(self):
+        for expected, _ in self.all_solutions:
+            settings.hardware.position = expected.totuple()
+            pos, _ = self.calc.hklToAngles(0, 0, 1, 1.)
+            assert_array_almost_equal(pos.totuple(), expected.totuple())
+
+
+class TestIterHklListToAngles(object):
+
+    def setup_method(self):
+        B = CrystalUnderTest('xtal', 4, 4, 4, 90, 90, 90).B
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        constraints = YouConstraintManager()
+        constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        self.calc = YouHklCalculator(createMockUbcalc(B), constraints)
+
+    def test_yields_solutions_per_hkl_in_order(self):
+        hkl_list = [(1, 0, 1), (20, 0, 0), (0, 1, 1)]
+        items = list(self.calc.iterHklListToAngles(hkl_list, 1., True))
+        assert [hkl for hkl, _ in items] == hkl_list
+        assert items[1][1] == []
+        for hkl, solutions in (items[0], items[2]):
+            expected = self.calc.hklToAngles(*(hkl + (1., True)))
+            assert len(solutions) == len(expected)
+            for (pos, _), (pos_e, _) in zip(solutions, expected):
+                assert_array_almost_equal(pos.totuple(), pos_e.totuple())
+
+    def test_reads_hkl_lazily_and_stops_early(self):
+        read = []
+
+        def hkl_generator():
+            for hkl in [(20, 0, 0), (1, 0, 1), (0, 1, 1)]:
+                read.append(hkl)
+                yield hkl
+        for hkl, solutions in self.calc.iterHklListToAngles(hkl_generator(),
+                                                            1.):
+            if solutions:
+                break
+        assert hkl == (1, 0, 1)
+        assert read == [(20, 0, 0), (1, 0, 1)]
+
+    def test_chunks(self):
+        hkl_list = [(1, 0, 1), (0, 1, 1), (1, 1, 1), (1, 0, 2), (0, 0, 1)]
+        chunks = list(self.calc.iterHklListToAngles(hkl_list, 1.,
+                                                    chunk_size=2))
+        assert [[hkl for hkl, _ in chunk] for chunk in chunks] == \
+            [hkl_list[:2], hkl_list[2:4], hkl_list[4:]]
+
+    @raises(ValueError)
+    def test_chunk_size_must_be_positive(self):
+        self.calc.iterHklListToAngles([(1, 0, 1)], 1., chunk_size=0)
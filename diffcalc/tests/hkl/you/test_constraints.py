@@ -92,6 +92,16 @@ class TestConstraintManager:
         self.cm.clear_constraints()
         eq_(self.cm.all, {})
 
+    def test_changes_bump_version(self):
+        version = self.cm.notifier.version
+        self.cm.constrain('delta')
+        self.cm.set_constraint('delta', 10)
+        self.cm.unconstrain('delta')
+        self.cm.clear_constraints()
+        eq_(self.cm.notifier.version, version + 4)
+        self.cm.unconstrain('delta')
+        eq_(self.cm.notifier.version, version + 4)
+
     def test_unconstrain_bad(self):
         eq_(self.cm.all, {})
         eq_(self.cm.unconstrain('delta'), "Delta was not already constrained.")
@@ -0,0 +1,149 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi, cos, sin
+
+import pytest
+
+try:
+    import numpy as np
+except ImportError:
+    pytest.skip('numpy not available', allow_module_level=True)
+
+from diffcalc import settings
+from diffcalc.hardware import DummyHardwareAdapter
+from diffcalc.hkl.you import flyscan
+from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.constraints import YouConstraintManager
+from diffcalc.hkl.you.geometry import SixCircle
+from diffcalc.settings import NUNAME
+from diffcalc.tests.hkl.you.test_calc import createMockUbcalc
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.ub.crystal import CrystalUnderTest
+from diffcalc.util import DiffcalcException
+
+TORAD = pi / 180
+
+# a full turn of the in-plane component: phi goes once around
+PATH = [(cos(t * TORAD), sin(t * TORAD), 1) for t in range(0, 361, 10)]
+
+
+def _interpolate(trajectory, t):
+    """Evaluate the cubic segments a motion controller would follow"""
+    i = min(np.searchsorted(trajectory.times, t, 'right') - 1,
+            len(trajectory) - 2)
+    T = trajectory.times[i + 1] - trajectory.times[i]
+    s = (t - trajectory.times[i]) / T
+    p0, p1 = trajectory.positions[i], trajectory.positions[i + 1]
+    v0, v1 = trajectory.velocities[i], trajectory.velocities[i + 1]
+    return ((2 * s ** 3 - 3 * s ** 2 + 1) * p0 + (s ** 3 - 2 * s ** 2 + s) * T * v0 +
+            (-2 * s ** 3 + 3 * s ** 2) * p1 + (s ** 3 - s ** 2) * T * v1)
+
+
+class TestHklPathToPVT(object):
+
+    def setup_method(self):
+        B = CrystalUnderTest('xtal', 4, 4, 4, 90, 90, 90).B
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        self.constraints = YouConstraintManager()
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        self.calc = YouHklCalculator(createMockUbcalc(B), self.constraints)
+
+    def test_points_follow_the_path_in_the_total_time(self):
+        trajectory = self.calc.hklPathToPVT(PATH, 1., total_time=36.)
+        assert trajectory.names == ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi')
+        assert trajectory.slowdown == 1.
+        assert trajectory.path_rows == slice(1, len(PATH) + 1)
+        times = trajectory.times[trajectory.path_rows]
+        # the path has constant speed through hkl
+        assert_array_almost_equal(times - times[0], range(len(PATH)))
+        positions = trajectory.positions[trajectory.path_rows]
+        assert_array_almost_equal(
+            self.calc.anglesArrayToHkl(positions, 1.).ravel(),
+            np.array(PATH).ravel())
+        # phi goes once around without jumping at the cut
+        phi, _, _ = trajectory.axis('phi')
+        assert_array_almost_equal([phi[-2] - phi[1]], [360])
+
+    def test_velocities_follow_the_path(self):
+        trajectory = self.calc.hklPathToPVT(PATH, 1., hkl_speed=.5)
+        rows = trajectory.path_rows
+        for i in range(rows.start, rows.stop):
+            t = trajectory.times[i]
+            velocity = (_interpolate(trajectory, t + 1e-6) -
+                        _interpolate(trajectory, t - 1e-6)) / 2e-6
+            assert_array_almost_equal(velocity, trajectory.velocities[i], 4)
+        # midway between points the cubics stay close to the path
+        for i in range(rows.start, rows.stop - 1):
+            t = (trajectory.times[i] + trajectory.times[i + 1]) / 2
+            hkl = self.calc.anglesArrayToHkl([_interpolate(trajectory, t)], 1.)
+            assert abs(hkl[0, 2] - 1) < 1e-3
+
+    def test_starts_and_ends_at_rest(self):
+        trajectory = self.calc.hklPathToPVT(PATH, 1., total_time=36.,
+                                            max_acceleration=2.)
+        assert_array_almost_equal(trajectory.velocities[0], [0] * 6)
+        assert_array_almost_equal(trajectory.velocities[-1], [0] * 6)
+        run_up = trajectory.times[1] - trajectory.times[0]
+        assert_array_almost_equal(
+            [abs(trajectory.velocities[1]).max() / run_up], [2.])
+        trajectory = self.calc.hklPathToPVT(PATH, 1., total_time=36.,
+                                            ramp=False)
+        assert len(trajectory) == len(PATH)
+
+    def test_slows_down_for_velocity_limits(self):
+        fast = self.calc.hklPathToPVT(PATH, 1., total_time=36., ramp=False)
+        phi_speed = abs(fast.axis('phi')[1]).max()
+        slow = self.calc.hklPathToPVT(PATH, 1., total_time=36., ramp=False,
+                                      max_velocity={'phi': phi_speed / 2})
+        assert slow.slowdown > 2 - 1e-6
+        assert_array_almost_equal(slow.times, fast.times * slow.slowdown)
+        assert abs(slow.axis('phi')[1]).max() <= phi_speed / 2 + 1e-9
+        limits = flyscan._peak_velocities_and_accelerations(
+            slow.positions, slow.velocities, np.diff(slow.times))
+        assert limits[0][-1] <= phi_speed / 2 + 1e-9
+
+    def test_checks_limits_between_points(self):
+        trajectory = self.calc.hklPathToPVT(PATH, 1., total_time=36.)
+        phi = trajectory.axis('phi')[0]
+        settings.hardware.set_upper_limit('phi', phi.max() - 1e-3)
+        settings.hardware.set_cut('phi', -180)
+        with pytest.raises(DiffcalcException):
+            self.calc.hklPathToPVT(PATH, 1., total_time=36.)
+
+    def test_position_extremes_include_overshoot(self):
+        # a move from rest and back again peaks between the points
+        positions = np.array([[0.], [0.]])
+        velocities = np.array([[3.], [-3.]])
+        low, _, high, t_high = flyscan._position_extremes(
+            positions, velocities, np.array([2.]))
+        assert_array_almost_equal(low, [0.])
+        assert_array_almost_equal(high, [1.5])
+        assert_array_almost_equal(t_high, [1.])
+
+    def test_invalid_timing(self):
+        for kwargs in ({}, {'total_time': 1, 'hkl_speed': 1},
+                       {'total_time': -1}, {'hkl_speed': 0}):
+            with pytest.raises(DiffcalcException):
+                self.calc.hklPathToPVT(PATH, 1., **kwargs)
+        with pytest.raises(DiffcalcException):
+            self.calc.hklPathToPVT(PATH[:1], 1., total_time=1)
+        with pytest.raises(DiffcalcException):
+            self.calc.hklPathToPVT(PATH[:1] * 2, 1., total_time=1)
@@ -17,6 +17,7 @@
 ###
 
 
+import pytest
 from mock import Mock, call
 from diffcalc import settings
 
@@ -95,3 +96,23 @@ def test_con_message_display_whenn_selecting_an_unimplmented_mode():
     hkl.hklcalc.constraints.is_fully_constrained.return_value = True
     hkl.hklcalc.constraints.is_current_mode_implemented.return_value = False
     hkl.con('phi', 'chi', 'eta')
+
+
+def test_hklcache():
+    hkl.hklcache()
+    hkl.hklcache('clear')
+    hkl.hklcalc.solution_cache.clear.assert_called()
+    hkl.hklcache(10)
+    hkl.hklcalc.solution_cache.resize.assert_called_with(10)
+    with pytest.raises(TypeError):
+        hkl.hklcache('not a command')
+
+
+def test_hklprocesses():
+    hkl.hklprocesses()
+    hkl.hklprocesses(4)
+    assert hkl.hklcalc.processes == 4
+    hkl.hklprocesses(0)
+    assert hkl.hklcalc.processes == 0
+    with pytest.raises(TypeError):
+        hkl.hklprocesses(-1)
@@ -0,0 +1,257 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi, sin
+
+import pytest
+from mock import Mock, patch
+
+try:
+    import numpy as np
+except ImportError:
+    pytest.skip('numpy not available', allow_module_level=True)
+
+from diffcalc import settings
+from diffcalc.hardware import DummyHardwareAdapter
+from diffcalc.hkl.you import numerical
+from diffcalc.hkl.you.calc import YouHklCalculator, NUMERICAL
+from diffcalc.hkl.you.constraints import YouConstraintManager
+from diffcalc.hkl.you.geometry import SixCircle, YouPosition
+from diffcalc.settings import NUNAME
+from diffcalc.tests.hkl.you.test_calc import createMockUbcalc
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.ub.crystal import CrystalUnderTest
+
+TORAD = pi / 180
+
+VIRTUAL_ANGLE_RESIDUALS = {'alpha': sin, 'beta': sin, 'betain': sin,
+                           'betaout': sin, 'psi': float, 'qaz': float,
+                           'naz': float}
+
+
+def _normalised(v):
+    v = np.matrix(v).T
+    return v / np.linalg.norm(v)
+
+
+class TestNumericalSolver(object):
+
+    def setup_method(self):
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        B = CrystalUnderTest('xtal', 3.8, 4.1, 5.7, 90, 95, 120).B
+        self.ubcalc = createMockUbcalc(B)
+        self.ubcalc.n_phi = _normalised((.3, .2, .9))
+        self.ubcalc.surf_nphi = _normalised((-.1, .5, .7))
+        self.constraints = YouConstraintManager()
+        self.calc = YouHklCalculator(self.ubcalc, self.constraints)
+        self.calc.solution_cache.resize(0)
+        self.positions = np.random.RandomState(1).uniform(-1.5, 1.5, (5, 6))
+
+    def _residuals(self, name, positions):
+        return numerical.RESIDUALS[name](
+            numerical.RotationChain(positions),
+            np.asarray(self.ubcalc.n_phi).ravel(),
+            np.asarray(self.ubcalc.surf_nphi).ravel(), 0.)
+
+    def test_jacobians_match_finite_differences(self):
+        eps = 1e-6
+        for name in numerical.RESIDUALS:
+            _, J = self._residuals(name, self.positions)
+            for i in range(6):
+                step = np.zeros(6)
+                step[i] = eps
+                r_plus, _ = self._residuals(name, self.positions + step)
+                r_minus, _ = self._residuals(name, self.positions - step)
+                assert_array_almost_equal(
+                    J[:, i], numerical._wrap(r_plus - r_minus) / (2 * eps), 6)
+
+    def test_residuals_match_virtual_angles(self):
+        for name, function in VIRTUAL_ANGLE_RESIDUALS.items():
+            r, _ = self._residuals(name, self.positions)
+            expected = [function(self.calc._anglesToVirtualAngles(
+                YouPosition(*p, unit='RAD'), 1.)[name])
+                for p in self.positions]
+            assert_array_almost_equal(r, expected, 12)
+
+    def _solutions(self, hkl, wavelength=1.2):
+        return sorted(tuple(np.round(pos.totuple(), 6))
+                      for pos, _ in self.calc._hklToAngles(
+                          hkl[0], hkl[1], hkl[2], wavelength, True))
+
+    def _force_numerical(self):
+        plan = self.calc._get_constraint_plan()
+        plan.branch = NUMERICAL
+
+    def check_matches_analytic_solutions(self, constraints, hkl):
+        self.constraints._constrained = constraints
+        expected = self._solutions(hkl)
+        self._force_numerical()
+        actual = self._solutions(hkl)
+        assert len(actual) == len(expected)
+        for pos, pos_e in zip(actual, expected):
+            assert_array_almost_equal(pos, pos_e, 5)
+
+    def test_matches_analytic_solutions(self):
+        for constraints in ({'a_eq_b': None, 'mu': 0, NUNAME: 0},
+                            {'psi': 10 * TORAD, 'mu': 0, 'phi': 20 * TORAD},
+                            {'chi': 10 * TORAD, 'eta': 20 * TORAD,
+                             NUNAME: 10 * TORAD},
+                            {'chi': 10 * TORAD, 'phi': 20 * TORAD,
+                             'mu': 5 * TORAD}):
+            for hkl in ((1, .5, 1.2), (0, 1, 1)):
+                yield self.check_matches_analytic_solutions, constraints, hkl
+
+    def test_unimplemented_mode_is_solved(self):
+        self.constraints._constrained = {'delta': 30 * TORAD,
+                                         'omega': 5 * TORAD,
+                                         'chi': 10 * TORAD}
+        assert not self.constraints.is_current_mode_implemented()
+        solutions = self.calc._hklToAngles(1, .5, 1.2, 1.2, True)
+        assert solutions
+        for pos, _ in solutions:
+            assert_array_almost_equal(
+                self.calc._anglesToHkl(pos, 1.2), (1, .5, 1.2), 8)
+            r, _ = self._residuals('omega', np.array([pos.totuple()]))
+            assert abs(r[0] - 5 * TORAD) < 1e-8
+            pos.changeToDegrees()
+            assert abs(pos.delta - 30) < 1e-6
+            assert abs(pos.chi - 10) < 1e-6
+
+    def test_unreachable_hkl_has_no_solutions(self):
+        solver = numerical.LeastSquaresSolver()
+        # 2theta is 32.5 degrees, delta cannot be larger
+        solutions = solver.solve(
+            {'delta': 60 * TORAD, 'omega': 5 * TORAD, 'chi': 10 * TORAD},
+            self.ubcalc.UB * np.matrix([[1], [.5], [1.2]]), 1.2,
+            self.ubcalc.n_phi, self.ubcalc.surf_nphi)
+        assert solutions == []
+        assert solver.converged == 0
+
+    def test_iteration_budget(self):
+        constraints = {'delta': 30 * TORAD, 'omega': 5 * TORAD,
+                       'chi': 10 * TORAD}
+        h_phi = self.ubcalc.UB * np.matrix([[1], [.5], [1.2]])
+        solver = numerical.LeastSquaresSolver(max_iterations=2)
+        solver.solve(constraints, h_phi, 1.2, self.ubcalc.n_phi,
+                     self.ubcalc.surf_nphi)
+        assert solver.iterations <= 2
+        solver = numerical.LeastSquaresSolver(max_iterations=0)
+        assert solver.solve(constraints, h_phi, 1.2, self.ubcalc.n_phi,
+                            self.ubcalc.surf_nphi) == []
+        assert solver.iterations == 0
+
+    def test_solutions_do_not_depend_on_time_taken(self):
+        constraints = {'delta': 30 * TORAD, 'omega': 5 * TORAD,
+                       'chi': 10 * TORAD}
+        h_phi = self.ubcalc.UB * np.matrix([[1], [.5], [1.2]])
+        solver = numerical.LeastSquaresSolver()
+        solutions = solver.solve(constraints, h_phi, 1.2, self.ubcalc.n_phi,
+                                 self.ubcalc.surf_nphi)
+        assert solutions
+        clock = iter(range(0, 1000000, 10))
+        with patch.object(numerical, '_timer', lambda: next(clock)):
+            assert solver.solve(constraints, h_phi, 1.2, self.ubcalc.n_phi,
+                                self.ubcalc.surf_nphi) == solutions
+        assert solver.elapsed > 0
+
+    def test_start_position_is_a_seed(self):
+        seeds = numerical.LeastSquaresSolver().seeds(
+            {'chi': .1, NUNAME: None}, .2, (.1, .2, .3, .4, .5, .6))
+        assert tuple(seeds[0]) == (.1, .2, .3, .4, .1, .6)
+        assert (seeds[:, 4] == .1).all()
+
+
+class TestJacobians(object):
+
+    def setup_method(self):
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        B = CrystalUnderTest('xtal', 3.8, 4.1, 5.7, 90, 95, 120).B
+        ubcalc = createMockUbcalc(B)
+        ubcalc.n_phi = _normalised((.3, .2, .9))
+        self.constraints = YouConstraintManager()
+        self.constraints._constrained = {'alpha': 2 * TORAD, 'delta': 30 * TORAD,
+                                         'chi': 10 * TORAD}
+        self.calc = YouHklCalculator(ubcalc, self.constraints)
+        self.hkl = np.array([(1, .5, 1.2), (0, 1, 1), (.3, .2, 1.5)])
+        index, self.positions, _ = self.calc.hklArrayToAngles(self.hkl, 1.2)
+        self.hkl = self.hkl[index]
+
+    def test_hkl_jacobians_match_finite_differences(self):
+        eps = 1e-5
+        J = self.calc.anglesArrayToHklJacobians(self.positions, 1.2)
+        assert J.shape == (len(self.positions), 3, 6)
+        for i in range(6):
+            step = np.zeros(6)
+            step[i] = eps
+            expected = (self.calc.anglesArrayToHkl(self.positions + step, 1.2) -
+                        self.calc.anglesArrayToHkl(self.positions - step, 1.2)
+                        ) / (2 * eps)
+            assert_array_almost_equal(J[:, :, i].ravel(), expected.ravel(), 6)
+
+    def test_angle_jacobians_match_finite_differences(self):
+        eps = 1e-6
+        J = self.calc.hklToAnglesJacobians(self.positions, 1.2)
+        assert J.shape == (len(self.positions), 6, 3)
+        for hkl, pos, J_pos in zip(self.hkl, self.positions, J):
+            for i in range(3):
+                step = np.zeros(3)
+                step[i] = eps
+                _, solutions, _ = self.calc.hklArrayToAngles(
+                    [hkl + step, hkl - step], 1.2)
+                plus, minus = [min(solutions, key=lambda s: np.abs(
+                    s - sign * J_pos[:, i] * eps - pos).max())
+                    for sign in (1, -1)]
+                assert_array_almost_equal(J_pos[:, i],
+                                          (plus - minus) / (2 * eps), 5)
+
+    def test_angle_jacobians_invert_hkl_jacobians(self):
+        J_hkl = self.calc.anglesArrayToHklJacobians(self.positions, 1.2)
+        J_angles = self.calc.hklToAnglesJacobians(self.positions, 1.2)
+        for product in np.einsum('sij,sjk->sik', J_hkl, J_angles):
+            assert_array_almost_equal(product.ravel(), np.eye(3).ravel(), 10)
+
+    def test_angle_jacobians_are_nan_where_singular(self):
+        self.constraints._constrained = {'mu': 0, 'eta': 0, 'chi': 0}
+        J = self.calc.hklToAnglesJacobians([(0, 0, 0, 0, 0, 0)], 1.)
+        assert np.isnan(J).all()
+
+    def test_reference_position_seeds_the_solver(self):
+        self.constraints._constrained = {'delta': 30 * TORAD,
+                                         'omega': 5 * TORAD,
+                                         'chi': 10 * TORAD}
+        self.calc.solution_cache.resize(100)
+        settings.hardware.get_position = Mock(side_effect=AssertionError(
+            'hardware should not be read'))
+        self.calc.numerical_solver = numerical.LeastSquaresSolver()
+        solve = self.calc.numerical_solver.solve
+        self.calc.numerical_solver.solve = Mock(side_effect=solve)
+        reference = YouPosition(1, 30, 0, 15, 10, 5, unit='DEG')
+        for _ in range(3):
+            self.calc.hklToAngles(1, .5, 1.2, 1.2,
+                                  reference_position=reference)
+        self.calc.hklToAngles(1, .5, 1.2, 1.2,
+                              reference_position=reference.totuple())
+        assert self.calc.numerical_solver.solve.call_count == 4
+        for call in self.calc.numerical_solver.solve.call_args_list:
+            assert_array_almost_equal(call[0][5],
+                                      reference.inRadians().totuple())
+        assert len(self.calc.solution_cache) == 0
@@ -0,0 +1,135 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi
+
+from mock import patch
+
+from diffcalc import settings
+from diffcalc.hardware import DummyHardwareAdapter
+from diffcalc.hkl.you import parallel
+from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.constraints import YouConstraintManager
+from diffcalc.hkl.you.geometry import SixCircle
+from diffcalc.settings import NUNAME
+from diffcalc.tests.hkl.you.test_calc import createMockUbcalc
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.ub.crystal import CrystalUnderTest
+
+TORAD = pi / 180
+
+HKL_LIST = [(h * .25, k * .25, l * .25)
+            for h in range(-2, 4) for k in range(-2, 3) for l in range(1, 5)]
+
+
+class TestParallelHklList(object):
+
+    def setup_method(self):
+        B = CrystalUnderTest('xtal', 4, 4, 4, 90, 90, 90).B
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        settings.hardware.set_lower_limit('delta', 0)
+        settings.hardware.set_upper_limit('eta', 60)
+        settings.hardware.set_cut('phi', -180)
+        constraints = YouConstraintManager()
+        constraints._constrained = {'alpha': 2 * TORAD, NUNAME: 0, 'mu': 0}
+        self.calc = YouHklCalculator(createMockUbcalc(B), constraints)
+
+    def _assert_same_solutions(self, actual, expected):
+        assert len(actual) == len(expected)
+        for (pos, virtual), (pos_e, virtual_e) in zip(actual, expected):
+            assert_array_almost_equal(pos.totuple(), pos_e.totuple())
+            assert sorted(virtual) == sorted(virtual_e)
+
+    def test_matches_serial_in_input_order(self):
+        for return_all_solutions in (False, True):
+            expected = self.calc._hkl_list_solutions(
+                HKL_LIST, 1., return_all_solutions)
+            assert 0 < len(expected) != len(HKL_LIST)
+            actual = parallel.hkl_list_solutions(
+                self.calc, HKL_LIST, 1., return_all_solutions, 2)
+            self._assert_same_solutions(actual, expected)
+
+    def test_hkl_list_to_angles_chooses_as_serial(self):
+        reference = (0, 60, 0, 30, 0, 0)
+        expected = self.calc.hklListToAngles(
+            HKL_LIST, 1., reference_position=reference)
+        self.calc.processes = 2
+        actual = self.calc.hklListToAngles(
+            HKL_LIST, 1., reference_position=reference)
+        self._assert_same_solutions([actual], [expected])
+
+    def test_numerical_matches_serial(self):
+        self.calc.constraints._constrained = {
+            'alpha': 2 * TORAD, 'omega': 5 * TORAD, 'chi': 10 * TORAD}
+        settings.hardware.position = [0, 40, 10, 20, 10, 30]
+        self.calc.solution_cache.resize(0)
+        expected = self.calc._hkl_list_solutions(HKL_LIST, 1., True)
+        assert expected
+        actual = parallel.hkl_list_solutions(self.calc, HKL_LIST, 1., True, 2)
+        self._assert_same_solutions(actual, expected)
+
+    def test_workers_are_given_the_reference_position(self):
+        settings.hardware.position = [0, 40, 10, 20, 10, 30]
+        with patch('multiprocessing.Pool') as pool:
+            pool.return_value.imap.return_value = []
+            parallel.hkl_list_solutions(self.calc, HKL_LIST, 1., False, 2)
+            tasks = pool.return_value.imap.call_args[0][1]
+            assert all(task[3] == (0, 40, 10, 20, 10, 30) for task in tasks)
+            reference = (0, 60, 0, 30, 0, 0)
+            parallel.hkl_list_solutions(self.calc, HKL_LIST, 1., False, 2,
+                                        reference)
+            tasks = pool.return_value.imap.call_args[0][1]
+            assert all(task[3] == reference for task in tasks)
+
+    def test_iter_hkl_list_to_angles_gives_each_hkl(self):
+        expected = list(self.calc.iterHklListToAngles(HKL_LIST, 1.))
+        actual = list(self.calc.iterHklListToAngles(HKL_LIST, 1.,
+                                                    processes=2))
+        assert [hkl for hkl, _ in actual] == HKL_LIST
+        for (_, pairs), (_, pairs_e) in zip(actual, expected):
+            self._assert_same_solutions(pairs, pairs_e)
+        self.calc.processes = 2
+        chunks = list(self.calc.iterHklListToAngles(HKL_LIST, 1.,
+                                                    chunk_size=50))
+        assert [len(chunk) for chunk in chunks] == [50, 50, 20]
+        assert [hkl for chunk in chunks for hkl, _ in chunk] == HKL_LIST
+
+    def test_workers_use_a_snapshot(self):
+        snapshot = parallel._Snapshot(self.calc)
+        settings.hardware.set_lower_limit('delta', None)
+        self.calc.constraints._constrained = {'chi': 0, 'phi': 0, 'eta': 0}
+        hardware = snapshot.create_hardware()
+        assert hardware.get_lower_limit('delta') == 0
+        assert hardware.get_upper_limit('eta') == 60
+        assert hardware.get_cuts()['phi'] == -180
+        constraints = snapshot.create_calculator().constraints
+        assert sorted(constraints.all) == sorted(['alpha', 'mu', NUNAME])
+
+    def test_short_lists_are_solved_in_process(self):
+        with patch('multiprocessing.Pool') as pool:
+            solutions = parallel.hkl_list_solutions(
+                self.calc, HKL_LIST[:40], 1., False, 4)
+        assert not pool.called
+        self._assert_same_solutions(
+            solutions, self.calc._hkl_list_solutions(HKL_LIST[:40], 1., False))
+
+    def test_chunks(self):
+        chunks = list(parallel._chunks(range(10), 4))
+        assert chunks == [[0, 1, 2], [3, 4, 5], [6, 7], [8, 9]]
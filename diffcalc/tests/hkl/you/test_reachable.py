@@ -0,0 +1,133 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from itertools import product
+from math import pi
+
+import pytest
+from mock import Mock, patch
+
+try:
+    import numpy as np
+except ImportError:
+    pytest.skip('numpy not available', allow_module_level=True)
+
+from diffcalc import settings
+from diffcalc.hardware import DummyHardwareAdapter
+from diffcalc.hkl.you import reachable
+from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.constraints import YouConstraintManager
+from diffcalc.hkl.you.geometry import SixCircle
+from diffcalc.settings import NUNAME
+from diffcalc.tests.hkl.you.test_calc import createMockUbcalc
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.ub.crystal import CrystalUnderTest
+from diffcalc.util import DiffcalcException
+
+TORAD = pi / 180
+WAVELENGTH = 1.5
+
+
+class TestReachableReflections(object):
+
+    def setup_method(self):
+        self.crystal = CrystalUnderTest('xtal', 3, 3.2, 3.5, 90, 95, 110)
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        self.constraints = YouConstraintManager()
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        self.calc = YouHklCalculator(createMockUbcalc(self.crystal.B),
+                                     self.constraints)
+        self.calc.solution_cache.resize(0)
+
+    def test_hkl_within_sphere(self):
+        UB = np.asarray(self.crystal.B)
+        chunks = list(reachable.hkl_within_sphere(UB, WAVELENGTH, 100))
+        assert all(len(chunk) >= 100 for chunk in chunks[:-1])
+        hkl = np.vstack(chunks)
+        expected = [v for v in product(range(-6, 7), repeat=3)
+                    if any(v) and np.linalg.norm(UB.dot(v)) <= 4 * pi / WAVELENGTH]
+        assert sorted(map(tuple, hkl)) == sorted(expected)
+        assert len(expected) < 13 ** 3
+
+    def check_matches_single_reflections(self, limits):
+        for name, (lower, upper) in limits.items():
+            settings.hardware.set_lower_limit(name, lower)
+            settings.hardware.set_upper_limit(name, upper)
+        hkl, positions, ttheta = self.calc.reachableReflections(WAVELENGTH)
+        assert len(hkl) == len(positions) == len(ttheta)
+        assert (np.diff(ttheta) > -1e-8).all()
+        assert_array_almost_equal(
+            self.calc.anglesArrayToHkl(positions, WAVELENGTH).ravel(),
+            hkl.ravel())
+        assert_array_almost_equal(ttheta, np.abs(positions[:, 1]))
+
+        expected = []
+        for chunk in reachable.hkl_within_sphere(self.crystal.B, WAVELENGTH):
+            for h, k, l in chunk:
+                try:
+                    self.calc.hklToAngles(h, k, l, WAVELENGTH)
+                except DiffcalcException:
+                    continue
+                expected.append((h, k, l))
+        assert sorted(map(tuple, hkl)) == sorted(expected)
+        return hkl
+
+    def test_matches_single_reflections(self):
+        everything = self.check_matches_single_reflections({})
+        limited = self.check_matches_single_reflections({'delta': (0, 60)})
+        assert 0 < len(limited) < len(everything)
+
+    def test_closest_to_reference_position(self):
+        self.constraints._constrained = {'delta': 40, 'mu': 0, 'chi': 30}
+        hkl, positions, _ = self.calc.reachableReflections(WAVELENGTH)
+        reference = positions[0] + (0, 0, 0, 0, 0, 170)
+        _, closest, _ = self.calc.reachableReflections(WAVELENGTH, reference)
+        index, solutions, _ = self.calc.hklArrayToAngles(hkl[:1], WAVELENGTH)
+        distance = np.abs((solutions - reference + 180) % 360 - 180).max(1)
+        assert_array_almost_equal(closest[0], solutions[np.argmin(distance)])
+
+
+class TestReachableCommand(object):
+
+    def setup_method(self):
+        settings.geometry = SixCircle()
+        settings.hardware = Mock()
+        settings.hardware.get_axes_names.return_value = (
+            'mu', 'delta', NUNAME, 'eta', 'chi', 'phi')
+        settings.hardware.get_position.return_value = (0, 60, 0, 30, 0, 0)
+        settings.hardware.get_wavelength.return_value = 1.
+
+    def teardown_method(self):
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+
+    def test_reachable(self, capsys):
+        from diffcalc.hkl.you import hkl
+        with patch.object(hkl, 'hklcalc') as hklcalc:
+            hklcalc.reachableReflections.return_value = (
+                np.array([[0., 0, 1], [0, 1, 1]]),
+                np.array([[0., 40, 0, 20, 90, 0], [0, 60, 0, 30, 90, 45]]),
+                np.array([40., 60]))
+            hkl.reachable()
+        hklcalc.reachableReflections.assert_called_with(1., (0, 60, 0, 30, 0, 0))
+        lines = capsys.readouterr()[0].splitlines()
+        assert lines[1].split() == ['0', '0', '1', '40.0000', '0.0000', '40.0000',
+                                    '0.0000', '20.0000', '90.0000', '0.0000']
+        assert lines[-1] == '2 reachable reflections'
@@ -0,0 +1,108 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi, cos, sin
+
+import pytest
+from mock import patch
+
+from diffcalc import settings
+from diffcalc.hardware import DummyHardwareAdapter
+from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.constraints import YouConstraintManager
+from diffcalc.hkl.you.geometry import SixCircle, YouPosition
+from diffcalc.hkl.you import trajectory
+from diffcalc.hkl.you.trajectory import LIMITS
+from diffcalc.settings import NUNAME
+from diffcalc.tests.hkl.you.test_calc import createMockUbcalc
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.ub.crystal import CrystalUnderTest
+from diffcalc.util import DiffcalcException
+
+TORAD = pi / 180
+
+# a full turn of the in-plane component: phi goes once around
+PATH = [(cos(t * TORAD), sin(t * TORAD), 1) for t in range(0, 361, 10)]
+
+
+class TestHklPathToAngles(object):
+
+    def setup_method(self):
+        B = CrystalUnderTest('xtal', 4, 4, 4, 90, 90, 90).B
+        settings.geometry = SixCircle()
+        settings.hardware = DummyHardwareAdapter(
+            ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'))
+        self.constraints = YouConstraintManager()
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        self.calc = YouHklCalculator(createMockUbcalc(B), self.constraints)
+
+    def _steps(self, positions):
+        return [max(abs(a - b) for a, b in zip(p.totuple(), q.totuple()))
+                for p, q in zip(positions, positions[1:])]
+
+    def test_continuous_through_angle_cut(self):
+        positions, virtual_angles, flips = self.calc.hklPathToAngles(PATH, 1.)
+        assert flips == []
+        assert len(positions) == len(virtual_angles) == len(PATH)
+        assert max(self._steps(positions)) < 10 + 1e-6
+        assert_array_almost_equal([positions[-1].phi], [360])
+        for (h, k, l), pos in zip(PATH, positions):
+            hkl, _ = self.calc.anglesToHkl(pos, 1.)
+            assert_array_almost_equal(hkl, (h, k, l))
+
+    def test_branches_only_enumerated_at_flips(self):
+        with patch.object(trajectory, '_all_solutions',
+                          wraps=trajectory._all_solutions) as enumerate_all:
+            positions, virtual_angles, _ = self.calc.hklPathToAngles(PATH, 1.)
+            assert enumerate_all.call_count == 0
+        with patch.object(trajectory, '_continuation', return_value=None):
+            enumerated, enumerated_angles, _ = self.calc.hklPathToAngles(
+                PATH, 1.)
+        for pos, expected in zip(positions, enumerated):
+            assert_array_almost_equal(pos.totuple(), expected.totuple(), 8)
+        for angles, expected in zip(virtual_angles, enumerated_angles):
+            assert_array_almost_equal([angles['alpha'], angles['psi']],
+                                      [expected['alpha'], expected['psi']], 8)
+
+        with patch.object(trajectory, '_all_solutions',
+                          wraps=trajectory._all_solutions) as enumerate_all:
+            settings.hardware.set_lower_limit('phi', -180)
+            settings.hardware.set_upper_limit('phi', 180)
+            _, _, flips = self.calc.hklPathToAngles(PATH, 1.)
+            assert len(flips) == 1
+            assert enumerate_all.call_count == 1
+
+    def test_continues_from_start_position(self):
+        start = YouPosition(0, 20, 0, 10, 45, 350, unit='DEG')
+        positions, _, flips = self.calc.hklPathToAngles(PATH[:3], 1., start)
+        assert flips == []
+        assert_array_almost_equal([p.phi for p in positions], [360, 370, 380])
+
+    def test_flip_reported_at_limit(self):
+        settings.hardware.set_lower_limit('phi', -180)
+        settings.hardware.set_upper_limit('phi', 180)
+        positions, _, flips = self.calc.hklPathToAngles(PATH, 1.)
+        assert len(flips) == 1
+        assert flips[0].index == 19
+        assert flips[0].reason == LIMITS
+        assert max(abs(p.phi) for p in positions) <= 180
+        assert 'leaves the hardware limits' in str(flips[0])
+
+    def test_unreachable_point(self):
+        with pytest.raises(DiffcalcException):
+            self.calc.hklPathToAngles(PATH[:2] + [(10, 0, 0)], 1.)
@@ -158,6 +158,13 @@ class TestDummyHardwareAdapter(object):
         with pytest.raises(ValueError):
             self.hardware.get_position_by_name('not an angle name')
 
+    def test_limit_and_cut_changes_bump_version(self):
+        version = self.hardware.notifier.version
+        self.hardware.set_lower_limit('delta', 0)
+        self.hardware.set_upper_limit('delta', 90)
+        self.hardware.set_cut('phi', -180)
+        assert self.hardware.notifier.version == version + 3
+
     def testLowerLimitSetAndGet(self):
         self.hardware.set_lower_limit('alpha', -1)
         self.hardware.set_lower_limit('delta', -2)
@@ -269,3 +276,11 @@ class TestGdaHardwareMonitor(object):
         self.hardware.set_upper_limit('d', None)
         assert self.hardware.get_upper_limit('a') == 1
         assert self.hardware.get_upper_limit('c') == 3
+
+    def test_limits_key_follows_limits_set_on_scannables(self):
+        key = self.hardware.limits_key()
+        version = self.hardware.notifier.version
+        self.grp.getGroupMember('b').setLowerDummyLimit(-2)
+        assert self.hardware.notifier.version == version
+        assert self.hardware.limits_key() != key
+        assert self.hardware.limits_key()[1] == (-2, None)
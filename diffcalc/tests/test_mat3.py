@@ -0,0 +1,80 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi
+
+from diffcalc import mat3
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.util import x_rotation, y_rotation, z_rotation, cross3, \
+    angle_between_vectors
+
+try:
+    from numpy import matrix
+except ImportError:
+    from numjy import matrix
+
+
+def _flat(m):
+    return [v for row in mat3.from_matrix(m) for v in row]
+
+
+class TestMat3(object):
+
+    def setup_method(self):
+        self.R = z_rotation(.3) * y_rotation(-.2) * x_rotation(1.1)
+        self.S = matrix('1 2 3; -4 5 6; 7 -8 9')
+        self.a = matrix('1; 2; 3')
+        self.b = matrix('-1; .5; 2')
+
+    def test_from_and_to_matrix(self):
+        assert mat3.from_matrix(self.a) == (1, 2, 3)
+        assert mat3.from_matrix(self.a.T) == (1, 2, 3)
+        assert mat3.from_matrix((1, 2, 3)) == (1, 2, 3)
+        assert mat3.from_matrix(self.S) == ((1, 2, 3), (-4, 5, 6), (7, -8, 9))
+        assert (mat3.to_column((1, 2, 3)) == self.a).all()
+
+    def test_rotations(self):
+        for th in (-2., -.1, 0, .4, pi):
+            for rotation, expected in ((mat3.x_rotation, x_rotation),
+                                       (mat3.y_rotation, y_rotation),
+                                       (mat3.z_rotation, z_rotation)):
+                assert_array_almost_equal(_flat(rotation(th)),
+                                          _flat(expected(th)), 15)
+
+    def test_products(self):
+        R, S = mat3.from_matrix(self.R), mat3.from_matrix(self.S)
+        a = mat3.from_matrix(self.a)
+        assert_array_almost_equal(_flat(mat3.mul(R, S)),
+                                  _flat(self.R * self.S), 14)
+        assert_array_almost_equal(mat3.mul_vec(S, a),
+                                  mat3.from_matrix(self.S * self.a), 14)
+        assert_array_almost_equal(mat3.tmul_vec(R, a),
+                                  mat3.from_matrix(self.R.I * self.a), 14)
+        assert_array_almost_equal(_flat(mat3.transpose(S)),
+                                  _flat(self.S.T), 15)
+        assert_array_almost_equal([mat3.det(S)], [240], 12)
+        assert_array_almost_equal(_flat(mat3.inverse(S)), _flat(self.S.I), 14)
+
+    def test_vectors(self):
+        a, b = mat3.from_matrix(self.a), mat3.from_matrix(self.b)
+        assert mat3.dot(a, b) == 6
+        assert_array_almost_equal(mat3.cross(a, b),
+                                  mat3.from_matrix(cross3(self.a, self.b)), 15)
+        assert_array_almost_equal([mat3.norm(mat3.normalised(a))], [1], 15)
+        assert_array_almost_equal([angle_between_vectors(a, b)],
+                                  [angle_between_vectors(self.a, self.b)], 15)
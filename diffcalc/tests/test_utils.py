@@ -22,8 +22,9 @@ from nose.tools import eq_  # @UnresolvedImport
 from diffcalc.hkl.vlieg.geometry import VliegPosition
 from diffcalc.util import MockRawInput, \
     getInputWithDefault, differ, nearlyEqual, degreesEquivilant,\
-    CoordinateConverter
+    CoordinateConverter, ChangeNotifier, LRUCache, version_key
 import diffcalc.util  # @UnusedImport
+import pickle
 import pytest
 
 try:
@@ -219,3 +220,93 @@ class TestCoordinateConverter(object):
             self.conv.transform(failvec)
         with pytest.raises(TypeError):
             self.conv.transform(failmarix)
+
+
+class TestChangeNotifier(object):
+
+    def test_notify_bumps_version_and_calls_listeners(self):
+        notifier = ChangeNotifier()
+        calls = []
+        notifier.add_listener(lambda: calls.append(notifier.version))
+        notifier.notify()
+        notifier.notify()
+        assert notifier.version == 2
+        assert calls == [1, 2]
+
+    def test_remove_listener(self):
+        notifier = ChangeNotifier()
+        calls = []
+        listener = lambda: calls.append(1)
+        notifier.add_listener(listener)
+        notifier.add_listener(listener)
+        notifier.notify()
+        notifier.remove_listener(listener)
+        notifier.notify()
+        assert calls == [1]
+
+    def test_forward_to(self):
+        notifier, owner = ChangeNotifier(), ChangeNotifier()
+        calls = []
+        owner.add_listener(lambda: calls.append(owner.version))
+        notifier.forward_to(owner)
+        notifier.notify()
+        owner.notify()
+        assert calls == [1, 2]
+        assert owner.version == 2
+
+    def test_listeners_are_not_pickled(self):
+        notifier = ChangeNotifier()
+        calls = []
+        notifier.add_listener(lambda: calls.append(1))
+        notifier.notify()
+        copy = pickle.loads(pickle.dumps(notifier))
+        assert copy.version == 1
+        copy.notify()
+        assert calls == [1]
+
+    def test_version_key(self):
+
+        class Owner(object):
+            notifier = ChangeNotifier()
+
+        owner = Owner()
+        key = version_key(owner, owner)
+        assert version_key(owner, owner) == key
+        owner.notifier.notify()
+        assert version_key(owner, owner) != key
+        assert version_key(owner, object()) is None
+
+
+class TestLRUCache(object):
+
+    def test_get_and_put(self):
+        cache = LRUCache(2)
+        assert cache.get('a') is None
+        cache.put('a', 1)
+        assert cache.get('a') == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_least_recently_used_entry_discarded(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert len(cache) == 2
+
+    def test_resize_and_clear(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache.put(key, key)
+        cache.resize(1)
+        assert 'c' in cache and len(cache) == 1
+        cache.clear()
+        assert len(cache) == 0
+        assert (cache.hits, cache.misses) == (0, 0)
+
+    def test_size_zero_disables(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        assert len(cache) == 0
@@ -19,12 +19,14 @@
 from diffcalc.hkl.you.calc import YouUbCalcStrategy
 from diffcalc.hkl.you.geometry import SixCircle, YouPosition
 from diffcalc.ub.calc import UBCalculation
-from diffcalc.ub.persistence import UBCalculationJSONPersister
+from diffcalc.ub.persistence import UBCalculationJSONPersister, \
+    UBCalculationSQLitePersister
 from diffcalc.ub.calcstate import UBCalcStateEncoder
 from math import pi, sqrt, atan2
 from mock import Mock
 from nose.tools import eq_
 from diffcalc.tests.tools import matrixeq_
+import os
 import tempfile
 import datetime
 from diffcalc.util import TORAD, x_rotation
@@ -199,3 +201,68 @@ class TestUBCalculationWithYouStrategy():
             matrixeq_(matrix([[pol_ref, az_ref, sc_ref]]),
                       matrix([[pol, az, sc]]))
 
+
+    def test_derived_matrices_follow_ub(self):
+        self.ubcalc.start_new('test_derived_matrices')
+        self.ubcalc.set_lattice('latt', 2, 3, 4, 90, 90, 90)
+        self.ubcalc.set_U_manually(x_rotation(10 * TORAD))
+        UB_inv = self.ubcalc.UB_inv
+        matrixeq_(UB_inv, self.ubcalc.UB.I)
+        assert self.ubcalc.UB_inv is UB_inv
+        matrixeq_(self.ubcalc.B_inv, self.ubcalc._state.crystal.B.I)
+        matrixeq_(self.ubcalc.metric_tensor,
+                  matrix([[.25, 0, 0], [0, 1. / 9, 0], [0, 0, 1. / 16]]))
+        eq_(round(self.ubcalc.get_hkl_plane_distance([1, 1, 0]), 10),
+            round(6 / sqrt(13), 10))
+
+        self.ubcalc.set_U_manually(x_rotation(20 * TORAD))
+        assert self.ubcalc.UB_inv is not UB_inv
+        matrixeq_(self.ubcalc.UB_inv, self.ubcalc.UB.I)
+
+    def test_changes_are_notified_where_made(self):
+        self.ubcalc.start_new('test_changes_notified')
+        self.ubcalc.set_lattice('latt', 1, 1, 1, 90, 90, 90)
+        self.ubcalc.set_U_manually(x_rotation(0))
+        self.ubcalc.UB_inv  # calculated and kept until the state changes
+        version = self.ubcalc.notifier.version
+        self.ubcalc._persister.save = Mock(side_effect=IOError('disk full'))
+        try:
+            self.ubcalc.set_U_manually(x_rotation(10 * TORAD))
+        except IOError:
+            pass
+        assert self.ubcalc.notifier.version == version + 1
+        matrixeq_(self.ubcalc.UB_inv, self.ubcalc.UB.I)
+        self.ubcalc._persister.save = Mock()
+        version = self.ubcalc.notifier.version
+        self.ubcalc.save()
+        assert self.ubcalc.notifier.version == version
+
+    def test_reference_changes_are_notified(self):
+        self.ubcalc.start_new('test_reference_changes')
+        self.ubcalc.set_lattice('latt', 1, 1, 1, 90, 90, 90)
+        self.ubcalc.set_U_manually(x_rotation(0))
+        self.ubcalc.n_phi  # calculated and kept until the state changes
+        version = self.ubcalc.notifier.version
+        self.ubcalc._state.reference.n_hkl_configured = matrix('0; 1; 0')
+        assert self.ubcalc.notifier.version == version + 1
+        matrixeq_(self.ubcalc.n_phi, matrix('0; 1; 0'))
+        self.ubcalc._state.surface.n_phi_configured = matrix('0; 1; 0')
+        matrixeq_(self.ubcalc.surf_nphi, matrix('0; 1; 0'))
+
+    def test_reference_vectors_are_normalised(self):
+        self.ubcalc.start_new('test_normalised_reference')
+        self.ubcalc.set_lattice('latt', 1, 1, 1, 90, 90, 90)
+        self.ubcalc.set_U_manually(x_rotation(0))
+        self.ubcalc.set_n_phi_configured(matrix('0; 0; 2'))
+        matrixeq_(self.ubcalc.n_phi, matrix('0; 0; 1'))
+        self.ubcalc.set_surf_nhkl_configured(matrix('3; 0; 0'))
+        matrixeq_(self.ubcalc.surf_nphi, matrix('1; 0; 0'))
+
+
+class TestUBCalculationWithSQLitePersister(TestUBCalculationWithYouStrategy):
+
+    def setup_method(self):
+        TestUBCalculationWithYouStrategy.setup_method(self)
+        persister = UBCalculationSQLitePersister(
+            os.path.join(self.tmpdir, 'ubcalc.db'), UBCalcStateEncoder)
+        self.ubcalc = UBCalculation(persister, YouUbCalcStrategy())
@@ -82,3 +82,29 @@ class TestUBCalculationWithYouStrategy():
         self.ubcalc.add_reflection(0, 0, 1, REF1b, EN1, '001', None)
         self.ubcalc.calculate_UB()
         matrixeq_(self.ubcalc.UB, UB1)
+
+    def testRefinedUB(self):
+        from diffcalc.tests.ub.test_fitting import _reflections
+        from diffcalc.util import xyz_rotation
+        self.ubcalc.start_new('refined')
+        self.ubcalc.set_lattice('latt', 3.8, 4.1, 5.7, 80, 95, 120)
+        U = xyz_rotation([.2, .8, .1], .3)
+        UB = U * self.ubcalc._state.crystal.B
+        for i, (hkl, pos, energy) in enumerate(
+                _reflections(self.ubcalc._state.crystal, U, 6)):
+            assert self.ubcalc.refined_UB is None or i >= 3
+            pos.changeToDegrees()
+            self.ubcalc.add_reflection(hkl[0], hkl[1], hkl[2], pos, energy,
+                                       None, None)
+        matrixeq_(self.ubcalc.refined_UB, UB)
+        assert abs(self.ubcalc.refined_UB_covariance).max() < 1e-12
+
+        hkl, pos, energy, _, _ = self.ubcalc.get_reflection(3)
+        self.ubcalc.edit_reflection(3, 1, 1, 1, pos, energy, None, None)
+        assert abs(self.ubcalc.refined_UB - UB).max() > 1e-3
+        assert self.ubcalc.refined_UB_covariance[0, 0] > 1e-6
+        self.ubcalc.del_reflection(3)
+        matrixeq_(self.ubcalc.refined_UB, UB)
+        # reflections added with unknown hkl are ignored
+        self.ubcalc.add_reflection(0, 0, 0, pos, energy, None, None)
+        matrixeq_(self.ubcalc.refined_UB, UB)
@@ -0,0 +1,127 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi
+
+import pytest
+
+try:
+    import numpy as np
+except ImportError:
+    pytest.skip('numpy not available', allow_module_level=True)
+
+from diffcalc.hkl.you.geometry import YouPosition
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.ub import fitting
+from diffcalc.ub.crystal import CrystalUnderTest
+from diffcalc.util import xyz_rotation
+
+ENERGY = 12.3984
+
+
+def _reflections(crystal, U, count, seed=0):
+    """Reflections at random positions, with hkl exactly matching them"""
+    rng = np.random.RandomState(seed)
+    UBinv = np.linalg.inv(np.asarray(U * crystal.B))
+    refl_list = []
+    for angles in rng.uniform([-.2, .3, -.2, -1, -1, -3],
+                              [.2, 1.5, .5, 1, 1, 3], (count, 6)):
+        pos = YouPosition(*angles, unit='RAD')
+        hkl, q_phi = fitting._q_phi_array([(np.zeros(3), pos, ENERGY)])
+        refl_list.append((list(UBinv.dot(q_phi[0])), pos, ENERGY))
+    return refl_list
+
+
+class TestVectorisedTargets(object):
+
+    def setup_method(self):
+        self.crystal = CrystalUnderTest('xtal', 3.8, 4.1, 5.7, 80, 95, 120)
+        self.U = xyz_rotation([.2, .8, .1], .3)
+        self.refl_list = _reflections(self.crystal, self.U, 20)
+
+    def _check_gradient(self, target, vals, eps=1e-6, places=5):
+        _, gradient = target.value_and_gradient(vals)
+        for i in range(len(vals)):
+            step = np.zeros(len(vals))
+            step[i] = eps
+            expected = (target.value(vals + step) -
+                        target.value(vals - step)) / (2 * eps)
+            assert_array_almost_equal([gradient[i]], [expected], places)
+
+    def test_crystal_target_matches_func_crystal(self):
+        ref_data = fitting._get_refl_hkl(self.refl_list)
+        for system, vals in (('Triclinic', (3.9, 4., 5.6, 81, 94, 119)),
+                             ('Monoclinic', (3.9, 4., 5.6, 94)),
+                             ('Hexagonal', (3.9, 5.6)),
+                             ('Rhombohedral', (3.9, 85)),
+                             ('Cubic', (4.2,))):
+            target = fitting.VectorisedCrystalTarget(self.refl_list, system)
+            vals = np.array(vals, dtype=float)
+            assert_array_almost_equal(
+                [target.value(vals)],
+                [fitting._func_crystal(vals, system, ref_data)], 8)
+            self._check_gradient(target, vals)
+
+    def test_crystal_target_rejects_impossible_cells(self):
+        target = fitting.VectorisedCrystalTarget(self.refl_list, 'Rhombohedral')
+        assert target.value_and_gradient([4., 150.])[0] == 1e6
+
+    def test_orient_target_matches_func_orient(self):
+        ref_data = fitting._get_refl_hkl(self.refl_list)
+        target = fitting.VectorisedOrientTarget(self.refl_list, self.crystal)
+        u123 = (.3, .2, .7)
+        quat = np.array(fitting._get_quat_from_u123(*u123)) * 1.5
+        assert_array_almost_equal(
+            [target.value(quat)],
+            [fitting._func_orient(u123, self.crystal, ref_data)], 8)
+        self._check_gradient(target, quat)
+
+    def test_init_quat(self):
+        for U in (xyz_rotation([.2, .8, .1], .3), np.diag([1., -1., -1.]),
+                  np.diag([-1., 1., -1.]), np.diag([-1., -1., 1.]),
+                  xyz_rotation([1, 1, 0], pi), np.eye(3)):
+            U = np.matrix(U)
+            quat = fitting._get_init_quat(U)
+            assert_array_almost_equal([np.linalg.norm(quat)], [1.], 12)
+            assert_array_almost_equal(
+                np.asarray(fitting._get_rot_matrix(*quat)).ravel(),
+                np.asarray(U).ravel(), 12)
+
+    def test_fit_half_turn_initial_u(self):
+        U = np.matrix(np.diag([1., -1., -1.]))
+        refl_list = _reflections(self.crystal, U, 10)
+        fitted = fitting.fit_u_matrix(U, self.crystal, refl_list)
+        assert_array_almost_equal(np.asarray(fitted).ravel(),
+                                  np.asarray(U).ravel(), 8)
+
+    def test_fit_many_reflections(self):
+        refl_list = _reflections(self.crystal, self.U, 300, seed=1)
+        start = CrystalUnderTest('xtal', 3.9, 4., 5.6, 81, 94, 119)
+        crystal = fitting.fit_crystal(start, refl_list)
+        assert_array_almost_equal(crystal.getLattice()[1:],
+                                  self.crystal.getLattice()[1:], 5)
+        statistics = fitting.last_fit_statistics['crystal']
+        assert 0 < statistics.iterations <= statistics.evaluations
+        assert statistics.seconds > 0
+
+        U = fitting.fit_u_matrix(xyz_rotation([0, 1, 0], .1), crystal,
+                                 refl_list)
+        assert_array_almost_equal(np.asarray(U).ravel(),
+                                  np.asarray(self.U).ravel(), 5)
+        assert fitting.last_fit_statistics['orientation'].iterations > 0
+        assert 'iterations' in str(statistics)
@@ -0,0 +1,85 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from random import Random
+
+from diffcalc import mat3
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.ub.incremental import IncrementalUBEstimator
+
+
+def ravel(m):
+    return [v for row in m for v in row]
+
+
+def batch_fit(hkls, qs):
+    """UB and the covariance of its rows fitted to all reflections at once"""
+    A = [[sum(hkl[i] * hkl[j] for hkl in hkls) for j in range(3)]
+         for i in range(3)]
+    C = [[sum(hkl[i] * q[j] for hkl, q in zip(hkls, qs)) for j in range(3)]
+         for i in range(3)]
+    A_inv = mat3.inverse(A)
+    UB = mat3.transpose(mat3.mul(A_inv, C))
+    rss = sum(sum((a - b) ** 2 for a, b in zip(q, mat3.mul_vec(UB, hkl)))
+              for hkl, q in zip(hkls, qs))
+    variance = rss / (3 * len(hkls) - 9)
+    return UB, [mat3.scale(row, variance) for row in A_inv]
+
+
+class TestIncrementalUBEstimator(object):
+
+    def setup_method(self):
+        rng = Random(0)
+        self.UB = [[rng.gauss(0, 1) for _ in range(3)] for _ in range(3)]
+        self.hkl = [tuple(float(rng.randint(-4, 4)) for _ in range(3))
+                    for _ in range(50)]
+        self.q = [tuple(v + rng.gauss(0, 1e-3)
+                        for v in mat3.mul_vec(self.UB, hkl))
+                  for hkl in self.hkl]
+        self.estimator = IncrementalUBEstimator()
+
+    def check_matches_batch_fit(self, rows):
+        UB, covariance = batch_fit([self.hkl[i] for i in rows],
+                                   [self.q[i] for i in rows])
+        assert_array_almost_equal(ravel(self.estimator.UB), ravel(UB), 10)
+        assert_array_almost_equal(ravel(self.estimator.covariance),
+                                  ravel(covariance), 14)
+
+    def test_matches_batch_fit_as_reflections_come_and_go(self):
+        for i in range(50):
+            self.estimator.add(self.hkl[i], self.q[i])
+            if i >= 3:
+                self.check_matches_batch_fit(range(i + 1))
+        assert_array_almost_equal(ravel(self.estimator.UB), ravel(self.UB), 3)
+        for i in range(0, 40, 2):
+            self.estimator.remove(self.hkl[i], self.q[i])
+        self.check_matches_batch_fit(range(1, 40, 2) + range(40, 50))
+        assert self.estimator.count == 30
+
+    def test_needs_three_independent_reflections(self):
+        assert self.estimator.UB is None
+        for hkl in ((1, 0, 0), (2, 0, 0), (0, 1, 0), (1, 1, 0)):
+            self.estimator.add(hkl, mat3.mul_vec(self.UB, hkl))
+            assert self.estimator.UB is None
+        self.estimator.add((0, 0, 1), mat3.mul_vec(self.UB, (0, 0, 1)))
+        assert_array_almost_equal(ravel(self.estimator.UB), ravel(self.UB), 12)
+        assert self.estimator.residual_variance < 1e-12
+        self.estimator.clear()
+        assert self.estimator.count == 0
+        assert self.estimator.UB is None
+        assert self.estimator.covariance is None
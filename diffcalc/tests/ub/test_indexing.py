@@ -0,0 +1,102 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import pytest
+
+try:
+    import numpy as np
+except ImportError:
+    pytest.skip('numpy not available', allow_module_level=True)
+
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.ub import indexing
+from diffcalc.ub.crystal import CrystalUnderTest
+from diffcalc.util import DiffcalcException, xyz_rotation
+
+LATTICES = ((3.8, 4.1, 5.7, 80, 95, 120),
+            (4, 4, 4, 90, 90, 90),
+            (5.4, 5.4, 13, 90, 90, 120))
+
+
+def _peaks(crystal, count, strays, seed=0):
+    rng = np.random.RandomState(seed)
+    UB = np.asarray(xyz_rotation([.2, .8, .1], .3) * crystal.B)
+    hkl = rng.randint(-4, 5, (count, 3)).astype(float)
+    hkl = hkl[np.abs(hkl).sum(1) > 0]
+    q = hkl.dot(UB.T) + rng.normal(0, 1e-3, hkl.shape)
+    return UB, hkl, np.vstack((q, rng.normal(0, 2, (strays, 3))))
+
+
+def _check_indexing(result, UB, hkl):
+    """The hkl found must give the same scattering vectors"""
+    count = len(hkl)
+    assert result.indexed[:count].all()
+    assert not result.indexed[count:].any()
+    assert_array_almost_equal(result.hkl[:count].dot(np.asarray(result.UB).T).ravel(),
+                              hkl.dot(UB.T).ravel(), 2)
+
+
+class TestIndexPeaks(object):
+
+    def check_known_lattice(self, lattice):
+        crystal = CrystalUnderTest('xtal', *lattice)
+        UB, hkl, q = _peaks(crystal, 30, 3)
+        result = indexing.index_peaks(q, crystal)
+        assert result.lattice_known
+        assert result.lattice == tuple(crystal.getLattice()[1:])
+        _check_indexing(result, UB, hkl)
+        U = np.asarray(result.U)
+        assert_array_almost_equal(U.dot(U.T).ravel(), np.eye(3).ravel(), 10)
+        assert_array_almost_equal([np.linalg.det(U)], [1], 10)
+
+    def check_unknown_lattice(self, lattice, count, strays):
+        crystal = CrystalUnderTest('xtal', *lattice)
+        UB, hkl, q = _peaks(crystal, count, strays)
+        result = indexing.index_peaks(q)
+        assert not result.lattice_known
+        _check_indexing(result, UB, hkl)
+        # the same lattice, in a basis at least as short
+        assert_array_almost_equal([abs(np.linalg.det(result.UB))],
+                                  [abs(np.linalg.det(UB))], 3)
+        assert sum(result.lattice[:3]) <= sum(lattice[:3]) + 1e-2
+
+    def test_known_lattice(self):
+        for lattice in LATTICES:
+            yield self.check_known_lattice, lattice
+
+    def test_unknown_lattice(self):
+        for lattice in LATTICES:
+            for count, strays in ((30, 3), (200, 20)):
+                yield self.check_unknown_lattice, lattice, count, strays
+
+    def test_reduce_finds_short_basis(self):
+        A = np.array([[4., 0, 0], [0, 5, 0], [0, 0, 6]])
+        M = np.array([[1., 2, -1], [0, 1, 3], [0, 0, 1]])
+        reduced = indexing._reduce(A.dot(M))
+        assert_array_almost_equal(np.abs(reduced).ravel(), A.ravel())
+        assert np.linalg.det(reduced) > 0
+
+    def test_too_few_peaks(self):
+        crystal = CrystalUnderTest('xtal', *LATTICES[0])
+        _, _, q = _peaks(crystal, 5, 0)
+        with pytest.raises(DiffcalcException):
+            indexing.index_peaks(q[:1], crystal)
+        with pytest.raises(DiffcalcException):
+            indexing.index_peaks(q[:2])
+        with pytest.raises(DiffcalcException):
+            indexing.index_peaks([q[0], 2 * q[0]], crystal)
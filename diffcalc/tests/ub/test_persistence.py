@@ -21,6 +21,8 @@ import shutil
 import unittest
 import tempfile
 import time
+import pytest
+from mock import patch
 from nose.tools import eq_  # @UnresolvedImport
 
 try:
@@ -28,7 +30,9 @@ try:
 except ImportError:
     print "Could not import LocalProperties to configure database locations."
 
-from diffcalc.ub.persistence import UbCalculationNonPersister, UBCalculationJSONPersister
+from diffcalc.ub import persistence
+from diffcalc.ub.persistence import UbCalculationNonPersister, UBCalculationJSONPersister, \
+    UBCalculationSQLitePersister
 from diffcalc.ub.calcstate import UBCalcStateEncoder
 
 
@@ -99,6 +103,138 @@ class TestUBCalculationJSONPersister(object):
         self.persister.save(d, 'first')
         self.persister.remove('first')
         eq_(self.persister.list(), [])
-        
-    
 
+    def age_directory(self):
+        """Change the directory modification time, as any change made
+        elsewhere would"""
+        t = time.time() - 10
+        os.utime(self.tmpdir, (t, t))
+
+    def test_list_metadata(self):
+        crystal = repr(['xtal', 'Cubic', 1, 1, 1, 90, 90, 90])
+        self.persister.save({'crystal': crystal, 'reflist': {'1': {}, '2': {}}},
+                            'with_crystal')
+        self.persister.save({'a': 1}, 'without_crystal')
+        os.utime(self.persister.filepath('with_crystal'), (0, 0))
+        self.age_directory()
+        metadata = self.persister.list_metadata()
+        eq_(self.persister.list(), ['without_crystal', 'with_crystal'])
+        assert 'xtal' not in metadata[0]
+        assert metadata[1].startswith('01 Jan 1970')
+        assert metadata[1].split()[-3:] == ['xtal', '2', 'reflections']
+
+    def test_index_is_read_without_listing_directory(self):
+        d = {'a': 1}
+        eq_(self.persister.list(), [])
+        with patch.object(UBCalculationJSONPersister, '_rebuild_index') as rebuild:
+            self.persister.save(d, 'first')
+            self.persister.save(d, 'second')
+            eq_(self.persister.list(), ['second', 'first'])
+            self.persister.list_metadata()
+            self.persister.remove('first')
+            eq_(self.persister.list(), ['second'])
+            rebuild.assert_not_called()
+        assert sorted(os.listdir(self.tmpdir)) == ['.diffcalc', 'second.json',
+                                                   'unexpected_file']
+
+    def test_index_names_are_str(self):
+        self.persister.save({'a': 1}, u'first')
+        self.persister.save({'a': 1}, 'second')
+        assert all(type(name) is str for name in self.persister.list())
+
+    def test_metadata_is_not_evaluated(self):
+        self.persister.save({'crystal': "__import__('os').getcwd()",
+                             'reflist': {'1': {}}}, 'first')
+        assert self.persister.list_metadata()[0].split()[-3:] != ['reflections']
+        assert persistence._state_metadata(
+            {'crystal': "__import__('os').getcwd()", 'reflist': {'1': {}}}
+            ) == (None, 1)
+
+    def test_index_follows_changes_made_elsewhere(self):
+        d = {'a': 1}
+        self.persister.save(d, 'first')
+        self.age_directory()
+        eq_(self.persister.list(), ['first'])
+        other = UBCalculationJSONPersister(self.tmpdir, UBCalcStateEncoder)
+        shutil.copy(self.persister.filepath('first'), other.filepath('second'))
+        os.remove(self.persister.filepath('first'))
+        eq_(self.persister.list(), ['second'])
+        with open(self.persister._index_path(), 'w') as f:
+            f.write('{"corrupt')
+        eq_(self.persister.list(), ['second'])
+
+
+class TestUBCalculationSQLitePersister(object):
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'ubcalc.db')
+        self.persister = UBCalculationSQLitePersister(self.path, UBCalcStateEncoder)
+
+    def test_list_with_empty_database(self):
+        eq_(self.persister.list(), [])
+        eq_(self.persister.list_metadata(), [])
+
+    def test_save_load_and_overwrite(self):
+        d1 = {'a': 1, 'b': 2}
+        self.persister.save(d1, 'first')
+        eq_(self.persister.load('first'), d1)
+        d2 = {'a': 3, 'b': 4, 'c': 5}
+        self.persister.save(d2, 'first')
+        eq_(self.persister.load('first'), d2)
+        eq_(UBCalculationSQLitePersister(self.path, None).load('first'), d2)
+        with pytest.raises(IOError):
+            self.persister.load('second')
+
+    def test_list_newest_first(self):
+        for name in ('first', 'second', 'third'):
+            self.persister.save({'name': name}, name)
+        eq_(self.persister.list(), ['third', 'second', 'first'])
+        self.persister.save({'name': 'first', 'a': 1}, 'first')
+        eq_(self.persister.list(), ['first', 'third', 'second'])
+
+    def test_list_metadata(self):
+        crystal = repr(['xtal', 'Cubic', 1, 1, 1, 90, 90, 90])
+        self.persister.save({'crystal': crystal, 'reflist': {'1': {}}}, 'first')
+        self.persister.save({'a': 1}, 'second')
+        metadata = self.persister.list_metadata()
+        assert 'xtal' not in metadata[0]
+        assert metadata[1].split()[-3:] == ['xtal', '1', 'reflections']
+
+    def test_history(self):
+        for i in range(3):
+            self.persister.save({'a': i}, 'first')
+        self.persister.save({'a': 2}, 'first')  # unchanged
+        self.persister.save({'b': 0}, 'second')
+        versions = [version for version, _ in self.persister.history('first')]
+        eq_(len(versions), 2)
+        eq_(self.persister.load('first', versions[0]), {'a': 1})
+        eq_(self.persister.load('first', versions[1]), {'a': 0})
+        with pytest.raises(IOError):
+            self.persister.load('second', versions[0])
+        eq_(self.persister.history('second'), [])
+
+    def test_history_length_is_limited(self):
+        with patch.object(persistence, 'HISTORY_LENGTH', 3):
+            for i in range(6):
+                self.persister.save({'a': i}, 'first')
+        eq_([self.persister.load('first', version) for version, _
+             in self.persister.history('first')], [{'a': 4}, {'a': 3}, {'a': 2}])
+
+    def test_remove_keeps_history(self):
+        self.persister.save({'a': 1}, 'first')
+        self.persister.remove('first')
+        eq_(self.persister.list(), [])
+        version, _ = self.persister.history('first')[0]
+        eq_(self.persister.load('first', version), {'a': 1})
+        with pytest.raises(IOError):
+            self.persister.remove('first')
+
+    def test_failed_save_changes_nothing(self):
+        self.persister.save({'a': 1}, 'first')
+        with patch.object(UBCalculationSQLitePersister, '_keep_previous',
+                          side_effect=RuntimeError('killed')):
+            with pytest.raises(RuntimeError):
+                self.persister.save({'a': 2}, 'first')
+        eq_(self.persister.load('first'), {'a': 1})
+        eq_(self.persister.history('first'), [])
@@ -0,0 +1,125 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import pytest
+
+try:
+    import numpy as np
+except ImportError:
+    pytest.skip('numpy not available', allow_module_level=True)
+
+from diffcalc.tests.tools import assert_array_almost_equal
+from diffcalc.ub import refinement
+from diffcalc.ub.crystal import CrystalUnderTest
+from diffcalc.util import DiffcalcException, xyz_rotation
+
+LATTICE = (3.8, 4.1, 5.7, 80, 95, 120)
+
+
+class TestRefineUB(object):
+
+    def setup_method(self):
+        self.crystal = CrystalUnderTest('xtal', *LATTICE)
+        self.U = np.asarray(xyz_rotation([.2, .8, .1], .3))
+        self.UB = self.U.dot(np.asarray(self.crystal.B))
+        rng = np.random.RandomState(0)
+        self.hkl = rng.randint(-5, 6, (500, 3)).astype(float)
+        self.q = self.hkl.dot(self.UB.T) + rng.normal(0, 1e-4, (500, 3))
+        # misindexed reflections
+        self.q_outliers = self.q.copy()
+        self.q_outliers[:40] = (self.hkl[:40] + rng.randint(1, 3, (40, 3))
+                                ).dot(self.UB.T)
+
+    def check(self, result, places=4):
+        assert_array_almost_equal(np.asarray(result.U).ravel(),
+                                  self.U.ravel(), places)
+        assert_array_almost_equal(result.lattice, LATTICE, places - 1)
+
+    def test_u_and_lattice_from_ub(self):
+        U, lattice = refinement.u_and_lattice_from_ub(self.UB)
+        assert_array_almost_equal(U.ravel(), self.U.ravel(), 10)
+        assert_array_almost_equal(lattice, LATTICE, 10)
+
+    def test_exact_reflections(self):
+        for method in refinement.METHODS:
+            result = refinement.refine_ub(self.hkl, self.hkl.dot(self.UB.T),
+                                          method)
+            self.check(result, 8)
+            assert result.rms < 1e-10
+            assert len(result.outliers) == 0
+
+    def test_least_squares_is_spoilt_by_outliers(self):
+        result = refinement.refine_ub(self.hkl, self.q_outliers,
+                                      refinement.LSTSQ)
+        assert abs(result.lattice[0] - LATTICE[0]) > 1e-3
+
+    def test_outliers_are_rejected(self):
+        for method in (refinement.IRLS, refinement.RANSAC):
+            result = refinement.refine_ub(self.hkl, self.q_outliers, method)
+            self.check(result)
+            assert set(result.outliers) == set(range(40))
+            assert (result.residuals[:40] > 100 * result.rms).all()
+            assert result.iterations > 0
+            assert 'rejected' in str(result)
+
+    def test_moderate_outliers_are_rejected(self):
+        # 8 standard deviations in one component
+        q = self.q.copy()
+        q[:10, 0] += 8e-4
+        result = refinement.refine_ub(self.hkl, q, refinement.IRLS)
+        assert set(range(10)) <= set(result.outliers)
+        assert len(result.outliers) < 15
+
+    def test_ransac_samples(self):
+        result = refinement.refine_ub(self.hkl, self.q_outliers,
+                                      refinement.RANSAC, max_iterations=50)
+        assert result.iterations == 50
+        result = refinement.refine_ub(self.hkl, self.q_outliers,
+                                      refinement.RANSAC)
+        assert result.iterations == refinement.RANSAC_ITERATIONS
+
+    def test_covariance_matches_scatter(self):
+        result = refinement.refine_ub(self.hkl, self.q, refinement.LSTSQ)
+        assert_array_almost_equal([result.rms], [1e-4 * np.sqrt(3)], 5)
+        # repeat the experiment with fresh noise
+        rng = np.random.RandomState(1)
+        lattices, rotations = [], []
+        for _ in range(100):
+            q = self.hkl.dot(self.UB.T) + rng.normal(0, 1e-4, self.q.shape)
+            trial = refinement.refine_ub(self.hkl, q, refinement.LSTSQ)
+            lattices.append(trial.lattice)
+            R = np.asarray(trial.U).dot(np.asarray(result.U).T)
+            rotations.append(np.array((R[2, 1], R[0, 2], R[1, 0])) * 180 / np.pi)
+        for measured, predicted in ((np.std(lattices, 0), result.lattice_sigma),
+                                    (np.std(rotations, 0), result.u_sigma)):
+            ratio = measured / np.array(predicted)
+            assert (abs(ratio - 1) < .25).all()
+        assert result.covariance_ub.shape == (9, 9)
+        assert result.covariance_lattice.shape == (6, 6)
+        assert result.covariance_u.shape == (3, 3)
+
+    def test_invalid_input(self):
+        with pytest.raises(DiffcalcException):
+            refinement.refine_ub(self.hkl[:2], self.q[:2])
+        with pytest.raises(DiffcalcException):
+            refinement.refine_ub(self.hkl, self.q[:10])
+        with pytest.raises(DiffcalcException):
+            refinement.refine_ub(self.hkl, self.q, 'simplex')
+        with pytest.raises(DiffcalcException):
+            refinement.refine_ub([(1, 0, 0), (2, 0, 0), (0, 1, 0)],
+                                 self.q[:3], refinement.LSTSQ)
@@ -619,6 +619,61 @@ class _UBCommandsBase():
             mneq_(self.ub.ubcalc.U, matrix(s.umatrix),
                   3, note="wrong U matrix after fitting UB")
 
+    def testFitubrobust(self):
+        self.ub.newub('testfitubrobust')
+        s = scenarios.sessions(settings.Pos)[-1]
+        for r in s.reflist:
+            self.ub.addref([r.h, r.k, r.l], r.pos.totuple(), r.energy, r.tag)
+        # misindex a copy of the first reflection
+        r = s.reflist[0]
+        self.ub.addref([r.h + 1, r.k, r.l], r.pos.totuple(), r.energy, 'bad')
+        self.ub.setlat(s.name, s.system, *s.lattice)
+        self.ub.setu([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+
+        prepareRawInput(['y', 'y'])
+        self.ub.fitubrobust('ransac')
+        mneq_(matrix((self.ub.ubcalc._state.crystal.getLattice()[1:])), matrix(s.lattice),
+              2, note="wrong lattice after fitting UB")
+        mneq_(self.ub.ubcalc.U, matrix(s.umatrix),
+              3, note="wrong U matrix after fitting UB")
+
+    def testAutoindex(self):
+        self.ub.newub('testautoindex')
+        s = scenarios.sessions(settings.Pos)[-1]
+        self.ub.setlat(s.name, s.system, *s.lattice)
+        # unindexed reflections do not trigger a UB calculation
+        for r in s.reflist:
+            self.ub.addref([0, 0, 0], r.pos.totuple(), r.energy, r.tag)
+        assert not self.ub.ubcalc.is_ub_calculated()
+
+        prepareRawInput(['y', 'y'])
+        self.ub.autoindex()
+        UB = matrix(s.umatrix) * self.ub.ubcalc._state.crystal.B
+        for i, r in enumerate(s.reflist):
+            hkl = self.ub.ubcalc.get_reflection(i + 1)[0]
+            mneq_(self.ub.ubcalc.UB * matrix([hkl]).T,
+                  UB * matrix([[r.h, r.k, r.l]]).T,
+                  3, note="wrong reflection indices")
+
+    def testAutoindexFindingLattice(self):
+        self.ub.newub('testautoindexlattice')
+        s = scenarios.sessions(settings.Pos)[-1]
+        for r in s.reflist:
+            self.ub.addref([0, 0, 0], r.pos.totuple(), r.energy, r.tag)
+
+        # without the new lattice nothing else is offered or changed
+        prepareRawInput(['n'])
+        self.ub.autoindex()
+        assert self.ub.ubcalc._state.crystal is None
+        assert self.ub.ubcalc._U is None
+        for i in range(len(s.reflist)):
+            eq_(self.ub.ubcalc.get_reflection(i + 1)[0], [0, 0, 0])
+
+        prepareRawInput(['y', 'found', 'y', 'y'])
+        self.ub.autoindex()
+        eq_(self.ub.ubcalc._state.crystal.getLattice()[0], 'found')
+        assert self.ub.ubcalc.is_ub_calculated()
+
     def testC2th(self):
         self.ub.newub('testc2th')
         self.ub.setlat('cube', 1, 1, 1, 90, 90, 90)
@@ -26,28 +26,38 @@ crystal miscut information.
 from diffcalc.ub.calcstate import UBCalcState
 from diffcalc.ub.crystal import CrystalUnderTest
 from diffcalc.ub.reflections import ReflectionList
-from diffcalc.ub.persistence import UBCalculationJSONPersister, UBCalculationPersister
+from diffcalc.ub.persistence import UBCalculationJSONPersister, \
+    UBCalculationSQLitePersister, UBCalculationPersister
 from diffcalc.util import DiffcalcException, cross3, dot3, bold, xyz_rotation,\
-    bound, angle_between_vectors, norm3, CoordinateConverter, allnum, TODEG
-from math import acos, cos, sin, pi, atan2
+    bound, angle_between_vectors, norm3, CoordinateConverter, allnum, TODEG,\
+    ChangeNotifier
+from math import acos, cos, sin, pi, atan2, sqrt
 from diffcalc.ub.reference import YouReference
 from diffcalc.ub.orientations import OrientationList
 from diffcalc import settings
 from itertools import product
-from diffcalc.ub.fitting import fit_crystal, fit_u_matrix
+from diffcalc.ub.incremental import IncrementalUBEstimator
+from diffcalc.ub.fitting import fit_crystal, fit_u_matrix, last_fit_statistics
 from diffcalc.hkl.you.geometry import create_you_matrices
 
 try:
     from numpy import matrix, hstack
-    from numpy.linalg import norm
+    from numpy.linalg import norm, lstsq
+    NUMPY = True
 except ImportError:
     from numjy import matrix, hstack
     from numjy.linalg import norm
+    NUMPY = False
 
 SMALL = 1e-7
 
 WIDTH = 13
 
+
+def _normalised(vector):
+    return vector * (1 / norm(vector))
+
+
 def z(num):
     """Round to zero if small.
     
@@ -123,6 +133,11 @@ class UBCalculation:
             self._tobj = CoordinateConverter(transform=settings.geometry.beamline_axes_transform)
         except AttributeError:
             self._tobj = CoordinateConverter(transform=None)
+        self.notifier = ChangeNotifier()
+        self._derived = {}
+        self._derived_version = None
+        self._derived_UB = None
+        self._refined = IncrementalUBEstimator()
         self._clear()
         
     def _get_diffractometer_axes_names(self):
@@ -146,7 +161,21 @@ class UBCalculation:
                                   surface=surface)
         self._U = None
         self._UB = None
+        self._refined.clear()
         self._state.configure_calc_type()
+        self._follow_references()
+        self.notifier.notify()
+
+    def _follow_references(self):
+        """Pass on changes made directly to the reference and surface vectors
+        """
+        for reference in (self._state.reference, self._state.surface):
+            if reference is None:
+                continue
+            if getattr(reference, 'notifier', None) is None:
+                # saved to the GDA database before references had notifiers
+                reference.notifier = ChangeNotifier()
+            reference.notifier.forward_to(self.notifier)
 
 ### State ###
     def start_new(self, name):
@@ -165,7 +194,8 @@ class UBCalculation:
 
     def load(self, name):
         state = self._persister.load(name)
-        if isinstance(self._persister, UBCalculationJSONPersister):
+        if isinstance(self._persister, (UBCalculationJSONPersister,
+                                        UBCalculationSQLitePersister)):
             self._state = self._persister.encoder.decode_ubcalcstate(state,
                                                                      settings.geometry,
                                                                      self._get_diffractometer_axes_names(),
@@ -176,6 +206,7 @@ class UBCalculation:
             self._state = state
         else:
             raise DiffcalcException('Unexpected persister type: ' + str(self._persister))
+        self._follow_references()
         if self._state.manual_U is not None:
             self._U = self._state.manual_U
             self._UB = self._U * self._state.crystal.B
@@ -190,6 +221,10 @@ class UBCalculation:
                 print e
         else:
             print "Warning: No UB calculation loaded."
+        self._refined.clear()
+        for idx in range(1, self.get_number_reflections() + 1):
+            self._update_refined_ub(idx, 1.)
+        self.notifier.notify()
 
     def save(self):
         """Save current UB matrix calculation."""
@@ -380,6 +415,7 @@ class UBCalculation:
                 "Cannot set lattice until a UBCalcaluation has been started "
                 "with newubcalc")
         self._state.crystal = CrystalUnderTest(name, *fullform)
+        self.notifier.notify()
         # Clear U and UB if these exist
         if self._U is not None:  # (UB will also exist)
             print ("Warning: Setting new unit cell parameters.\n"
@@ -398,6 +434,7 @@ class UBCalculation:
 
     def _settau(self, tau):
         self._state.tau = tau
+        self.notifier.notify()
         self.save()
 
     tau = property(_gettau, _settau)
@@ -412,6 +449,7 @@ class UBCalculation:
 
     def _setsigma(self, sigma):
         self.state._sigma = sigma
+        self.notifier.notify()
         self.save()
 
     sigma = property(_getsigma, _setsigma)
@@ -420,10 +458,11 @@ class UBCalculation:
 ### Reference vector ###
 
     def _get_n_hkl(self):
-        return self._state.reference.n_hkl
+        return self._get_derived('n_hkl', lambda: self._state.reference.n_hkl)
     
     def _get_n_phi(self):
-        return self._state.reference.n_phi
+        return self._get_derived(
+            'n_phi', lambda: _normalised(self._state.reference.n_phi))
     
     n_hkl = property(_get_n_hkl)
     n_phi = property(_get_n_phi)
@@ -443,10 +482,11 @@ class UBCalculation:
 ### Surface vector ###
 
     def _get_surf_nhkl(self):
-        return self._state.surface.n_hkl
+        return self._get_derived('surf_nhkl', lambda: self._state.surface.n_hkl)
     
     def _get_surf_nphi(self):
-        return self._state.surface.n_phi
+        return self._get_derived(
+            'surf_nphi', lambda: _normalised(self._state.surface.n_phi))
     
     surf_nhkl = property(_get_surf_nhkl)
     surf_nphi = property(_get_surf_nphi)
@@ -490,6 +530,8 @@ class UBCalculation:
         if self._state.reflist is None:
             raise DiffcalcException("No UBCalculation loaded")
         self._state.reflist.add_reflection(h, k, l, position, energy, tag, time)
+        self._update_refined_ub(len(self._state.reflist), 1.)
+        self.notifier.notify()
         self.save()  # incase autocalculateUbAndReport fails
 
         # If second reflection has just been added then calculateUB
@@ -525,7 +567,10 @@ class UBCalculation:
         if self._state.reflist is None:
             raise DiffcalcException("No UBCalculation loaded")
         num = self.get_tag_refl_num(idx)
+        self._update_refined_ub(num, -1.)
         self._state.reflist.edit_reflection(num, h, k, l, position, energy, tag, time)
+        self._update_refined_ub(num, 1.)
+        self.notifier.notify()
 
         # If first or second reflection has been changed and there are at least
         # two reflections then recalculate  UB
@@ -601,7 +646,9 @@ class UBCalculation:
             index or tag of the deleted reflection
         """
         num = self.get_tag_refl_num(idx)
+        self._update_refined_ub(num, -1.)
         self._state.reflist.removeReflection(num)
+        self.notifier.notify()
         or12 = self.get_ub_references()
         if ((idx in or12 or num in or12) and
             (self._U is not None)):
@@ -621,6 +668,7 @@ class UBCalculation:
         num1 = self.get_tag_refl_num(idx1)
         num2 = self.get_tag_refl_num(idx2)
         self._state.reflist.swap_reflections(num1, num2)
+        self.notifier.notify()
         or12 = self.get_ub_references()
         if ((idx1 in or12 or idx2 in or12 or 
              num1 in or12 or num2 in or12) and
@@ -628,6 +676,28 @@ class UBCalculation:
             self._autocalculateUbAndReport()
         self.save()
 
+    def _update_refined_ub(self, num, weight):
+        """Add (weight 1) or remove (weight -1) reflection num in the refined
+        UB, unless it is unindexed"""
+        hkl, q = self._reflections_hkl_and_q_phi(num)
+        if any(hkl[0]):
+            self._refined.add(hkl[0], q[0], weight)
+
+    @property
+    def refined_UB(self):
+        """matrix: Least squares UB of all indexed reference reflections,
+        updated as each is added, edited or deleted, or None with fewer than
+        three of them. It is not used for calculations until set with
+        setub."""
+        UB = self._refined.UB
+        return None if UB is None else matrix(UB)
+
+    @property
+    def refined_UB_covariance(self):
+        """matrix: Covariance of each row of refined_UB, or None"""
+        covariance = self._refined.covariance
+        return None if covariance is None else matrix(covariance)
+
     def _autocalculateUbAndReport(self):
         if self.get_reference_count() < 2:
             pass
@@ -637,6 +707,9 @@ class UBCalculation:
         elif not self._state.is_okay_to_autocalculate_ub:
             print ("Not calculating UB matrix as it has been manually set. "
                    "Use 'calcub' to explicitly recalculate it.")
+        elif self._unindexed_ub_references():
+            print ("Not calculating UB matrix as its reference reflections "
+                   "have not been indexed. Use 'autoindex' to index them.")
         else:  # okay to autocalculate
             if self._UB is None:
                 print "Calculating UB matrix."
@@ -645,6 +718,18 @@ class UBCalculation:
             or12 = self.get_ub_references()
             self.calculate_UB(*or12)
 
+    def _unindexed_ub_references(self):
+        """True if a reflection used for UB has hkl 0 0 0, i.e. was added
+        with its hkl unknown"""
+        for idx, default in zip(self.get_ub_references(), (1, 2)):
+            try:
+                hkl = self.get_reflection(default if idx is None else idx)[0]
+            except Exception:
+                continue
+            if not any(hkl):
+                return True
+        return False
+
 ### Orientations ###
 
     def add_orientation(self, h, k, l, x, y, z, position, tag, time):
@@ -679,6 +764,7 @@ class UBCalculation:
         xyz_tr = self._tobj.transform(matrix([[x],[y],[z]]))
         xr, yr, zr = xyz_tr.T.tolist()[0]
         self._state.orientlist.add_orientation(h, k, l, xr, yr, zr, position, tag, time)
+        self.notifier.notify()
         self.save()  # in case autocalculateUbAndReport fails
 
         # If second reflection has just been added then calculateUB
@@ -721,6 +807,7 @@ class UBCalculation:
         xyz_tr = self._tobj.transform(matrix([[x],[y],[z]]))
         xr, yr, zr = xyz_tr.T.tolist()[0]
         self._state.orientlist.edit_orientation(num, h, k, l, xr, yr, zr, position, tag, time)
+        self.notifier.notify()
 
         # If first or second orientation has been changed and there are
         # two orientations then recalculate  UB
@@ -805,6 +892,7 @@ class UBCalculation:
         """
         orientationNumber = self.get_tag_orient_num(idx)
         self._state.orientlist.removeOrientation(orientationNumber)
+        self.notifier.notify()
         if ((orientationNumber == 2) and (self._U is not None)):
             self._autocalculateUbAndReport()
         self.save()
@@ -822,6 +910,7 @@ class UBCalculation:
         num1 = self.get_tag_orient_num(idx1)
         num2 = self.get_tag_orient_num(idx2)
         self._state.orientlist.swap_orientations(num1, num2)
+        self.notifier.notify()
         if ((num1 == 1 or num1 == 2 or num2 == 1 or num2 == 2) and
             (self._U is not None)):
             self._autocalculateUbAndReport()
@@ -863,6 +952,7 @@ class UBCalculation:
             raise DiffcalcException(
                 "A crystal must be specified before manually setting U")
         self._UB = self._U * self._state.crystal.B
+        self.notifier.notify()
         self.save()
 
     def set_UB_manually(self, m):
@@ -880,6 +970,7 @@ class UBCalculation:
         else:
             self._UB = m
         self._state.configure_calc_type(manual_UB=self._UB)
+        self.notifier.notify()
         self.save()
 
     @property
@@ -905,6 +996,46 @@ class UBCalculation:
         else:
             return self._UB
 
+### Derived quantities ###
+
+    def _get_derived(self, name, calculate):
+        """Return a quantity derived from the current state.
+
+        Each quantity is calculated on first use and kept until the UB matrix
+        or any other part of the calculation state changes.
+        """
+        if (self._derived_version != self.notifier.version or
+                self._derived_UB is not self._UB):
+            self._derived = {}
+            self._derived_version = self.notifier.version
+            self._derived_UB = self._UB
+        try:
+            return self._derived[name]
+        except KeyError:
+            value = self._derived[name] = calculate()
+            return value
+
+    @property
+    def UB_inv(self):
+        """matrix: Returns inverse of UB matrix."""
+        return self._get_derived('UB_inv', lambda: self._get_UB().I)
+
+    @property
+    def B_inv(self):
+        """matrix: Returns inverse of the crystal B matrix."""
+        return self._get_derived('B_inv', lambda: self._state.crystal.B.I)
+
+    @property
+    def metric_tensor(self):
+        """matrix: Returns reciprocal lattice metric tensor in 1/Angstrom^2.
+
+        The spacing of (hkl) planes is 1 / sqrt(hkl * metric_tensor * hkl.T).
+        """
+        def calculate():
+            B = self._state.crystal.B / (2 * pi)
+            return B.T * B
+        return self._get_derived('metric_tensor', calculate)
+
     def _calc_UB(self, h1, h2, u1p, u2p):
         B = self._state.crystal.B
         h1c = B * h1
@@ -941,6 +1072,7 @@ class UBCalculation:
         Tp = hstack([t1p, t2p, t3p])
         self._U = Tp * Tc.I
         self._UB = self._U * B
+        self.notifier.notify()
 
     def calculate_UB(self, idx1=None, idx2=None):
         """Calculate UB matrix.
@@ -1097,6 +1229,7 @@ class UBCalculation:
 
         self._U = matrix(m)
         self._UB = self._U * B
+        self.notifier.notify()
 
         self._state.configure_calc_type(manual_U=self._U, or0=idx)
         self.save()
@@ -1120,17 +1253,16 @@ class UBCalculation:
                     raise DiffcalcException("Cannot read reflection data for index %s" % str(idx))
             print "Fitting crystal lattice parameters..."
             new_lattice = fit_crystal(self._state.crystal, refl_list)
+            print "    %s" % last_fit_statistics['crystal']
             print "Fitting orientation matrix..."
             new_u = fit_u_matrix(self._U, new_lattice, refl_list)
+            print "    %s" % last_fit_statistics['orientation']
             uc_params = (self._state.crystal.getLattice()[0],) + new_lattice.getLattice()[1:]
         return new_u, uc_params
 
-    def _fit_ub_matrix_uncon(self, *args):
-        if args is None:
-            raise DiffcalcException("Please specify list of reference reflection indices.")
-        if len(args) < 3:
-            raise DiffcalcException("Need at least 3 reference reflections to fit UB matrix.")
-
+    def _reflections_hkl_and_q_phi(self, *args):
+        """Return the hkl and the scattering vectors in the phi frame,
+        including the factor 2 pi, of the listed reference reflections"""
         x = []
         y = []
         for idx in args:
@@ -1140,13 +1272,31 @@ class UBCalculation:
                 raise DiffcalcException("Cannot read reflection data for index %s" % str(idx))
             pos.changeToRadians()
             x.append(hkl_vals)
-            wl = 12.3984 / en
-            y_tmp = self._strategy.calculate_q_phi(pos) * 2.* pi / wl
-            y.append(y_tmp.T.tolist()[0])
+            y.append(self._q_phi(pos, en))
+        return x, y
+
+    def _q_phi(self, pos, en):
+        """Return the scattering vector in the phi frame, including the
+        factor 2 pi, of a position in radians measured at energy en"""
+        wl = 12.3984 / en
+        y_tmp = self._strategy.calculate_q_phi(pos) * 2.* pi / wl
+        return y_tmp.T.tolist()[0]
+
+    def _fit_ub_matrix_uncon(self, *args):
+        if args is None:
+            raise DiffcalcException("Please specify list of reference reflection indices.")
+        if len(args) < 3:
+            raise DiffcalcException("Need at least 3 reference reflections to fit UB matrix.")
 
+        x, y = self._reflections_hkl_and_q_phi(*args)
         xm = matrix(x)
         ym = matrix(y)
-        b = (xm.T * xm).I * xm.T * ym
+        if NUMPY:
+            # solve by SVD rather than squaring the condition number
+            # with the normal equations
+            b = matrix(lstsq(xm, ym, rcond=None)[0])
+        else:
+            b = (xm.T * xm).I * xm.T * ym
 
         b1, b2, b3 = matrix(b.tolist()[0]), matrix(b.tolist()[1]), matrix(b.tolist()[2])
         e1 = b1 / norm(b1)
@@ -1171,6 +1321,37 @@ class UBCalculation:
         lattice_name = self._state.crystal.getLattice()[0]
         return new_umatrix, (lattice_name, ax, bx, cx, alpha, beta, gamma)
 
+    def refine_ub_matrix(self, method, *args):
+        """Refine UB to the listed reference reflections, or to all of them,
+        rejecting outliers with method 'irls' or 'ransac' ('lstsq' keeps
+        every reflection). Returns a diffcalc.ub.refinement.UBRefinement."""
+        from diffcalc.ub.refinement import refine_ub
+        if not args:
+            args = range(1, self.get_number_reflections() + 1)
+        x, y = self._reflections_hkl_and_q_phi(*args)
+        return refine_ub(x, y, method)
+
+    def autoindex(self, *args):
+        """Index the listed reference reflections, or all of them, ignoring
+        the hkl they were entered with. Uses the lattice if one has been set
+        and otherwise finds one too. Returns a
+        diffcalc.ub.indexing.IndexingResult."""
+        if not args:
+            args = range(1, self.get_number_reflections() + 1)
+        _, q = self._reflections_hkl_and_q_phi(*args)
+        from diffcalc.ub.indexing import index_peaks
+        return index_peaks(q, self._state.crystal)
+
+    def autoindex_positions(self, positions, energy):
+        """Index peaks at a list of internal positions in degrees, measured at
+        one energy or at a list of energies. Returns an IndexingResult."""
+        if not isinstance(energy, (list, tuple)):
+            energy = [energy] * len(positions)
+        q = [self._q_phi(pos.inRadians(), en)
+             for pos, en in zip(positions, energy)]
+        from diffcalc.ub.indexing import index_peaks
+        return index_peaks(q, self._state.crystal)
+
     def set_miscut(self, xyz, angle, add_miscut=False):
         """Calculate U matrix using a miscut axis and an angle"""
         if xyz is None:
@@ -1187,7 +1368,8 @@ class UBCalculation:
 
     def get_hkl_plane_distance(self, hkl):
         """Calculates and returns the distance between planes"""
-        return self._state.crystal.get_hkl_plane_distance(hkl)
+        hkl = matrix([hkl])
+        return 1.0 / sqrt((hkl * self.metric_tensor * hkl.T)[0, 0])
 
     def get_hkl_plane_angle(self, hkl1, hkl2):
         """Calculates and returns the angle between planes"""
@@ -1254,7 +1436,7 @@ class UBCalculation:
         rot_polar = xyz_rotation(y_axis.T.tolist()[0], pol)
         rot_azimuthal = xyz_rotation(hkl_nphi.T.tolist()[0], az)
         hklrot_nphi = rot_azimuthal * rot_polar * hkl_nphi
-        hklrot = self._UB.I * hklrot_nphi
+        hklrot = self.UB_inv * hklrot_nphi
         hkl_list = hklrot.T.tolist()[0]
         return hkl_list
 
@@ -15,17 +15,39 @@
 # You should have received a copy of the GNU General Public License
 # along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
 ###
-from diffcalc.util import DiffcalcException, SMALL, angle_between_vectors, TODEG
+from diffcalc.util import DiffcalcException, SMALL, angle_between_vectors, TODEG,\
+    TORAD
 from math import pi, sqrt, sin, cos, atan2
+from timeit import default_timer as _timer
 from diffcalc.ub.crystal import CrystalUnderTest
 from diffcalc.hkl.you.geometry import create_you_matrices
 
 try:
     from numpy import matrix
     from numpy.linalg import norm
+    import numpy as np
 except ImportError:
     from numjy import matrix
     from numjy.linalg import norm
+    np = None  # only the scipy fitting path uses the vectorised targets
+
+
+class FitStatistics(object):
+    """The work done by the last fit of one kind"""
+
+    def __init__(self, iterations=0, evaluations=0, seconds=0.):
+        self.iterations = iterations
+        self.evaluations = evaluations
+        self.seconds = seconds
+
+    def __str__(self):
+        return '%d iterations, %d evaluations, %.3f s' % (
+            self.iterations, self.evaluations, self.seconds)
+
+
+# statistics of the last fit_crystal and fit_u_matrix calls
+last_fit_statistics = {'crystal': FitStatistics(),
+                       'orientation': FitStatistics()}
 
 
 def is_small(x):
@@ -105,6 +127,156 @@ class UbTargetOrient(object):
         return _func_orient(vals, self.crystal, self.ref_data)
 
 
+### Vectorised targets with analytic gradients for scipy
+
+# the cell (a, b, c, alpha, beta, gamma) for each system as the indices of
+# the fitted values (or None) and the fixed angles in degrees
+_SYSTEM_CELLS = {
+    'Triclinic': ((0, 1, 2, 3, 4, 5), ()),
+    'Monoclinic': ((0, 1, 2, None, 3, None), (90, 90)),
+    'Orthorhombic': ((0, 1, 2, None, None, None), (90, 90, 90)),
+    'Tetragonal': ((0, 0, 1, None, None, None), (90, 90, 90)),
+    'Hexagonal': ((0, 0, 1, None, None, None), (90, 90, 120)),
+    'Rhombohedral': ((0, 0, 0, 1, 1, 1), ()),
+    'Cubic': ((0, 0, 0, None, None, None), (90, 90, 90))}
+
+
+def _cell_mapping(uc_system, nvals):
+    """Return M and c with the cell (lengths, angles in radians) = M vals + c
+    """
+    if nvals == 6:
+        uc_system = 'Triclinic'
+    try:
+        indices, fixed = _SYSTEM_CELLS[uc_system]
+    except KeyError:
+        raise TypeError("Invalid crystal system parameter: %s" % str(uc_system))
+    M = np.zeros((6, nvals))
+    c = np.zeros(6)
+    fixed = list(fixed)
+    for p, i in enumerate(indices):
+        scale = 1. if p < 3 else TORAD
+        if i is None:
+            c[p] = fixed.pop(0) * TORAD
+        else:
+            M[p, i] = scale
+    return M, c
+
+
+def _metric_and_derivatives(cell):
+    """Return the direct metric tensor G of the cell and dG by each cell
+    parameter"""
+    a, b, c, alpha, beta, gamma = cell
+    ca, cb, cg = np.cos([alpha, beta, gamma])
+    sa, sb, sg = np.sin([alpha, beta, gamma])
+    G = np.array([[a * a, a * b * cg, a * c * cb],
+                  [a * b * cg, b * b, b * c * ca],
+                  [a * c * cb, b * c * ca, c * c]])
+    dG = np.zeros((6, 3, 3))
+    dG[0] = [[2 * a, b * cg, c * cb], [b * cg, 0, 0], [c * cb, 0, 0]]
+    dG[1] = [[0, a * cg, 0], [a * cg, 2 * b, c * ca], [0, c * ca, 0]]
+    dG[2] = [[0, 0, a * cb], [0, 0, b * ca], [a * cb, b * ca, 2 * c]]
+    dG[3, 1, 2] = dG[3, 2, 1] = -b * c * sa
+    dG[4, 0, 2] = dG[4, 2, 0] = -a * c * sb
+    dG[5, 0, 1] = dG[5, 1, 0] = -a * b * sg
+    return G, dG
+
+
+def _q_phi_array(ref_data):
+    """Return the (N, 3) hkl and scattering vectors in the phi frame"""
+    from diffcalc.hkl.you.batch import create_you_matrix_stacks
+    hkl = np.array([np.asarray(hkl_vals).ravel()
+                    for hkl_vals, _, _ in ref_data], dtype=float)
+    positions = np.array([pos.totuple() for _, pos, _ in ref_data],
+                         dtype=float)
+    k = 2 * pi / (12.3984 / np.array([en for _, _, en in ref_data],
+                                      dtype=float))
+    MU, DELTA, NU, ETA, CHI, PHI = create_you_matrix_stacks(positions)
+    q_lab = (np.einsum('sij,sjk->sik', NU, DELTA)[:, :, 1] -
+             np.array([0., 1, 0])) * k[:, None]
+    Z = np.einsum('sij,sjk,skl,slm->sim', MU, ETA, CHI, PHI)
+    return hkl, np.einsum('sji,sj->si', Z, q_lab)
+
+
+class VectorisedCrystalTarget(object):
+    """_func_crystal for all reflections at once, with its gradient.
+
+    The scattering vector lengths measured at the reflections do not depend
+    on the lattice and are calculated once. The lengths predicted from hkl
+    are 2 pi sqrt(hkl G^-1 hkl) for the direct metric tensor G.
+    """
+
+    def __init__(self, refl_list, uc_system):
+        self.uc_system = uc_system
+        self.hkl, q_phi = _q_phi_array(_get_refl_hkl(refl_list))
+        self.q_pos = np.sqrt((q_phi ** 2).sum(1))
+
+    def value_and_gradient(self, vals):
+        vals = np.asarray(vals, dtype=float)
+        M, c = _cell_mapping(self.uc_system, len(vals))
+        cell = M.dot(vals) + c
+        G, dG = _metric_and_derivatives(cell)
+        if (cell[:3] <= 0).any() or np.linalg.det(G) <= SMALL ** 3:
+            return 1e6, np.zeros(len(vals))
+        u = np.linalg.solve(G, self.hkl.T).T
+        s = (u * self.hkl).sum(1)
+        root = np.sqrt(s)
+        r = self.q_pos - 2 * pi * root
+        W = np.einsum('s,si,sj->ij', 2 * pi * r / root, u, u)
+        gradient = np.einsum('pij,ij->p', dG, W).dot(M)
+        return (r ** 2).sum(), gradient
+
+    def value(self, vals):
+        return self.value_and_gradient(vals)[0]
+
+
+def _quat_matrix_derivatives(q0, q1, q2, q3):
+    """Return the derivatives of _get_rot_matrix by each quaternion element
+    """
+    return 2 * np.array([[[q0, -q3, q2], [q3, q0, -q1], [-q2, q1, q0]],
+                         [[q1, q2, q3], [q2, -q1, -q0], [q3, q0, -q1]],
+                         [[-q2, q1, q0], [q1, q2, q3], [-q0, q3, -q2]],
+                         [[-q3, -q0, q1], [q0, -q3, q2], [q1, q2, q3]]])
+
+
+class VectorisedOrientTarget(object):
+    """_func_orient for all reflections at once, with its gradient.
+
+    The orientation is given by an unnormalised quaternion rather than by
+    u1, u2 and u3, whose derivatives are infinite at the identity.
+    """
+
+    def __init__(self, refl_list, crystal):
+        self.crystal = crystal
+        hkl, q_phi = _q_phi_array(_get_refl_hkl(refl_list))
+        B = np.asarray(crystal.B, dtype=float)
+        self.b_hkl = hkl.dot(B.T)
+        self.q_dir = q_phi / np.sqrt((q_phi ** 2).sum(1))[:, None]
+
+    def value_and_gradient(self, quat):
+        quat = np.asarray(quat, dtype=float)
+        size = np.sqrt((quat ** 2).sum())
+        q = quat / size
+        U = np.asarray(_get_rot_matrix(*q), dtype=float)
+        x = self.b_hkl.dot(U.T)
+        x_len = np.sqrt((x ** 2).sum(1))
+        x_dir = x / x_len[:, None]
+        cos_angle = (x_dir * self.q_dir).sum(1)
+        e = self.q_dir - cos_angle[:, None] * x_dir
+        sin_angle = np.sqrt((e ** 2).sum(1))
+        angles = np.arctan2(sin_angle, cos_angle)
+        # d(angle)/dx is -e / (|e| |x|); it is undefined for a perfect match
+        ok = sin_angle > SMALL ** 2
+        g = np.zeros_like(x)
+        g[ok] = -e[ok] / (sin_angle[ok] * x_len[ok])[:, None]
+        W = np.einsum('si,sj->ij', g, self.b_hkl)
+        gradient_q = np.einsum('kij,ij->k', _quat_matrix_derivatives(*q), W)
+        gradient = (gradient_q - q * q.dot(gradient_q)) / size
+        return angles.sum(), gradient
+
+    def value(self, quat):
+        return self.value_and_gradient(quat)[0]
+
+
 def get_crystal_target(refl_list, system):
 
     try:
@@ -148,16 +320,47 @@ def _get_rot_matrix(q0, q1, q2, q3):
     return rot
 
 
+def _get_init_quat(um):
+    """Return the quaternion of rotation matrix um.
+
+    Uses Shepperd's method: the largest of q0, q1, q2 and q3 is found from
+    the diagonal, and the others from the off-diagonal sums and differences
+    divided by it. This stays accurate for rotations by 180 degrees, where
+    the off-diagonal differences all vanish.
+    """
+    u00, u11, u22 = um[0,0], um[1,1], um[2,2]
+    tr = u00 + u11 + u22
+    largest = max(tr, u00, u11, u22)
+    if largest == tr:
+        q0 = sqrt(max(1. + tr, 0.)) / 2.
+        f = 4. * q0
+        q1 = (um[2,1] - um[1,2]) / f
+        q2 = (um[0,2] - um[2,0]) / f
+        q3 = (um[1,0] - um[0,1]) / f
+    elif largest == u00:
+        q1 = sqrt(max(1. + u00 - u11 - u22, 0.)) / 2.
+        f = 4. * q1
+        q0 = (um[2,1] - um[1,2]) / f
+        q2 = (um[0,1] + um[1,0]) / f
+        q3 = (um[0,2] + um[2,0]) / f
+    elif largest == u11:
+        q2 = sqrt(max(1. - u00 + u11 - u22, 0.)) / 2.
+        f = 4. * q2
+        q0 = (um[0,2] - um[2,0]) / f
+        q1 = (um[0,1] + um[1,0]) / f
+        q3 = (um[1,2] + um[2,1]) / f
+    else:
+        q3 = sqrt(max(1. - u00 - u11 + u22, 0.)) / 2.
+        f = 4. * q3
+        q0 = (um[1,0] - um[0,1]) / f
+        q1 = (um[0,2] + um[2,0]) / f
+        q2 = (um[1,2] + um[2,1]) / f
+    return q0, q1, q2, q3
+
+
 def _get_init_u123(um):
 
-    tr = um[0,0] + um[1,1] + um[2,2]
-    sgn_q1 = sign(um[2,1] - um[1,2])
-    sgn_q2 = sign(um[0,2] - um[2,0])
-    sgn_q3 = sign(um[1,0] - um[0,1])
-    q0 = sqrt(1. + tr) / 2.
-    q1 = sgn_q1 * sqrt(1. + um[0,0] - um[1,1] - um[2,2]) / 2.0
-    q2 = sgn_q2 * sqrt(1. - um[0,0] + um[1,1] - um[2,2]) / 2.0
-    q3 = sgn_q3 * sqrt(1. - um[0,0] - um[1,1] + um[2,2]) / 2.0
+    q0, q1, q2, q3 = _get_init_quat(um)
     u1 = (1. - um[0,0]) / 2.
     u2 = atan2(q0, q1) / (2. * pi)
     u3 = atan2(q2, q3) / (2. * pi)
@@ -201,6 +404,7 @@ def _get_uc_upper_limits(system):
 
 
 def fit_crystal(uc, refl_list):
+    start_time = _timer()
     try:
         uc_system, uc_params = uc.get_lattice_params()
         start = uc_params
@@ -231,27 +435,32 @@ def fit_crystal(uc, refl_list):
                                    SimpleBounds(lower, upper)))
         vals = opt.getPoint()
         #res = opt.getValue()
+        last_fit_statistics['crystal'] = FitStatistics(
+            optimizer.getIterations(), optimizer.getEvaluations(),
+            _timer() - start_time)
     except ImportError:
         from scipy.optimize import minimize
 
-        ref_data = _get_refl_hkl(refl_list)
+        target = VectorisedCrystalTarget(refl_list, uc_system)
         bounds = zip(lower, upper)
-        res = minimize(_func_crystal,
+        res = minimize(target.value_and_gradient,
                        start,
-                       args=(uc_system, ref_data),
+                       jac=True,
                        method='SLSQP',
                        tol=1e-10,
                        options={'disp' : False,
                                 'maxiter': 10000,
-                                'eps': 1e-6,
                                 'ftol': 1e-10},
                        bounds=bounds)
         vals = res.x
+        last_fit_statistics['crystal'] = FitStatistics(
+            res.nit, res.nfev, _timer() - start_time)
     res_cr = CrystalUnderTest('trial', uc_system, 1, 1, 1, 90, 90, 90)
     res_cr._set_cell_for_system(uc_system, *vals)
     return res_cr
 
 def fit_u_matrix(init_u, uc, refl_list):
+    start_time = _timer()
     try:
         start = list(_get_init_u123(init_u))
         lower = [ 0, 0, 0]
@@ -282,23 +491,25 @@ def fit_u_matrix(init_u, uc, refl_list):
                                    SimpleBounds(lower, upper)))
         vals = opt.getPoint()
         res = opt.getValue()
+        q0, q1, q2, q3 = _get_quat_from_u123(*vals)
+        last_fit_statistics['orientation'] = FitStatistics(
+            optimizer.getIterations(), optimizer.getEvaluations(),
+            _timer() - start_time)
     except ImportError:
         from scipy.optimize import minimize
 
-        ref_data = _get_refl_hkl(refl_list)
-        bounds = zip(lower, upper)
-        res = minimize(_func_orient,
-                       start,
-                       args=(uc, ref_data),
+        target = VectorisedOrientTarget(refl_list, uc)
+        res = minimize(target.value_and_gradient,
+                       _get_init_quat(init_u),
+                       jac=True,
                        method='SLSQP',
                        tol=1e-10,
                        options={'disp' : False,
                                 'maxiter': 10000,
-                                'eps': 1e-6,
-                                'ftol': 1e-10},
-                       bounds=bounds)
-        vals = res.x
-    q0, q1, q2, q3 = _get_quat_from_u123(*vals)
+                                'ftol': 1e-10})
+        q0, q1, q2, q3 = res.x / norm(res.x)
+        last_fit_statistics['orientation'] = FitStatistics(
+            res.nit, res.nfev, _timer() - start_time)
     res_u = _get_rot_matrix(q0, q1, q2, q3)
     #angle = 2. * acos(q0)
     #xr = q1 / sqrt(1. - q0 * q0)
@@ -0,0 +1,111 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Recursive least squares estimate of UB from reflections that are added and
+removed one at a time.
+
+The UB minimising sum w |q - UB hkl|^2 is (A^-1 C)^T with A = sum w hkl hkl^T
+and C = sum w hkl q^T. Keeping these sums, together with sum w |q|^2 for the
+residual, makes adding or removing a reflection O(1) and recovering UB and
+its covariance a handful of 3x3 operations, however many reflections have
+been seen. Everything is pure float (diffcalc.mat3) so that it runs under
+Jython too.
+"""
+
+from diffcalc import mat3
+
+ZERO = ((0., 0., 0.), (0., 0., 0.), (0., 0., 0.))
+SMALL = 1e-12
+
+
+def _vector(v):
+    """(x, y, z) from a sequence, a 1d array or a 3x1 or 1x3 matrix"""
+    if not isinstance(v, (tuple, list)):
+        values = v.tolist()
+        if not isinstance(values[0], list):
+            return tuple(values)
+    return mat3.from_matrix(v)
+
+
+def _add_outer(m, u, v, weight):
+    """Return m + weight * u v^T"""
+    return tuple(tuple(m[i][j] + weight * u[i] * v[j] for j in range(3))
+                 for i in range(3))
+
+
+class IncrementalUBEstimator(object):
+    """Least squares UB from the hkl and phi frame scattering vectors q (with
+    the factor 2 pi) of the reflections added so far."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._hh = ZERO
+        self._hq = ZERO
+        self._qq = 0.
+        self.count = 0
+        self._solution = None
+
+    def add(self, hkl, q, weight=1.):
+        hkl, q = _vector(hkl), _vector(q)
+        self._hh = _add_outer(self._hh, hkl, hkl, weight)
+        self._hq = _add_outer(self._hq, hkl, q, weight)
+        self._qq += weight * mat3.dot(q, q)
+        self.count += 1 if weight > 0 else -1
+        self._solution = None
+
+    def remove(self, hkl, q, weight=1.):
+        """Remove a reflection previously added with the same values"""
+        self.add(hkl, q, -weight)
+
+    def _solve(self):
+        if self._solution is None:
+            scale = (self._hh[0][0] + self._hh[1][1] + self._hh[2][2]) / 3
+            if self.count < 3 or abs(mat3.det(self._hh)) <= SMALL * scale ** 3:
+                self._solution = ()
+            else:
+                hh_inv = mat3.inverse(self._hh)
+                self._solution = (hh_inv, mat3.mul(hh_inv, self._hq))
+        return self._solution
+
+    @property
+    def UB(self):
+        """The UB matrix as a mat3 tuple, or None until three reflections with
+        independent hkl have been added"""
+        solution = self._solve()
+        return mat3.transpose(solution[1]) if solution else None
+
+    @property
+    def residual_variance(self):
+        """The variance of each component of q - UB hkl, or None"""
+        solution = self._solve()
+        if not solution or self.count < 4:
+            return None
+        # sum |q|^2 - trace(C^T A^-1 C)
+        hq, UBt = self._hq, solution[1]
+        rss = self._qq - sum(hq[i][j] * UBt[i][j]
+                             for i in range(3) for j in range(3))
+        return max(rss, 0.) / (3 * self.count - 9)
+
+    @property
+    def covariance(self):
+        """The covariance of each row of UB as a mat3 tuple, or None"""
+        variance = self.residual_variance
+        if variance is None:
+            return None
+        return tuple(mat3.scale(row, variance) for row in self._solve()[0])
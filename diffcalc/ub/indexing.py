@@ -0,0 +1,263 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Find a UB matrix that indexes measured peaks whose hkl are unknown.
+
+The peaks are given as scattering vectors q in the phi frame (including the
+factor 2 pi), as returned by calculate_q_phi.
+
+With a known lattice, every peak is matched to the hkl whose |B hkl| equals
+its |q|. For the anchor pair of peaks with the fewest such candidates, each
+pair of candidates whose angle matches the measured one gives a U from the
+two vectors (as calcub does); all of these U are scored together against
+every peak, and the best is refined by fitting a rotation to all the peaks
+it indexes.
+
+With an unknown lattice, the differences between all pairs of peaks are lattice
+vectors of the reciprocal lattice. They are clustered, and each triple of
+the most frequent short clusters is scored as a basis against every peak. The
+best basis is refined by least squares and reduced to a cell with short,
+near-orthogonal axes.
+
+This module requires numpy and is therefore not available under Jython.
+"""
+
+from itertools import combinations
+from math import pi
+
+import numpy as np
+
+from diffcalc.ub.refinement import refine_ub, u_and_lattice_from_ub, LSTSQ
+from diffcalc.util import DiffcalcException, TORAD
+
+TOLERANCE = .1  # largest distance of an indexed peak from integer hkl
+LENGTH_TOLERANCE = .01  # relative
+ANGLE_TOLERANCE = 1.  # degrees
+ANCHOR_PAIRS = 5
+CANDIDATE_VECTORS = 25
+MIN_SKEW = .05  # smallest acceptable |det| / (|b1| |b2| |b3|) of a basis
+
+
+class IndexingResult(object):
+    """The result of index_peaks.
+
+      UB, U    -- the matrices found (numpy.matrix)
+      lattice  -- (a, b, c, alpha, beta, gamma) in Angstroms and degrees
+      hkl      -- (N, 3) array of the integer hkl nearest to each peak
+      indexed  -- boolean array, True where a peak is within the tolerance
+                  of its hkl
+      lattice_known -- True if the given lattice was used
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __str__(self):
+        lines = ['%d of %d peaks indexed with %s lattice' % (
+            self.indexed.sum(), len(self.indexed),
+            'the given' if self.lattice_known else 'a new')]
+        lines.append('   a, b, c: %9.5f %9.5f %9.5f' % self.lattice[:3])
+        lines.append('            %9.5f %9.5f %9.5f' % self.lattice[3:])
+        return '\n'.join(lines)
+
+
+def _fractional_error(UB, q):
+    """The hkl of q given one or many UB, and their largest distance from
+    integers"""
+    hkl = np.einsum('...ij,nj->...ni', np.linalg.inv(UB), q)
+    return hkl, np.abs(hkl - np.round(hkl)).max(-1)
+
+
+def _triads(v1, v2):
+    """Orthonormal frames, as matrix columns, from stacks of vector pairs"""
+    t1 = v1 / np.linalg.norm(v1, axis=-1)[..., None]
+    t3 = np.cross(v1, v2)
+    t3 /= np.linalg.norm(t3, axis=-1)[..., None]
+    return np.stack((t1, np.cross(t3, t1), t3), -1)
+
+
+def _fit_rotation(p, q):
+    """The rotation U minimising |q - U p| over all rows"""
+    Us, _, Vt = np.linalg.svd(q.T.dot(p))
+    d = np.sign(np.linalg.det(Us.dot(Vt)))
+    return Us.dot(np.diag((1, 1, d))).dot(Vt)
+
+
+def _hkl_candidates(crystal, q_max, length_tolerance):
+    a, b, c = crystal.getLattice()[1:4]
+    limits = [int(q_max * (1 + length_tolerance) * x / (2 * pi)) + 1
+              for x in (a, b, c)]
+    grid = np.mgrid[-limits[0]:limits[0] + 1, -limits[1]:limits[1] + 1,
+                    -limits[2]:limits[2] + 1].reshape(3, -1).T
+    grid = grid[np.abs(grid).sum(1) > 0].astype(float)
+    B = np.asarray(crystal.B)
+    return grid, grid.dot(B.T)
+
+
+def _index_known_lattice(q, crystal, tolerance, length_tolerance,
+                         angle_tolerance):
+    B = np.asarray(crystal.B)
+    lengths = np.linalg.norm(q, axis=1)
+    _, vectors = _hkl_candidates(crystal, lengths.max(), length_tolerance)
+    vector_lengths = np.linalg.norm(vectors, axis=1)
+    matches = (np.abs(vector_lengths[None, :] - lengths[:, None]) <
+               length_tolerance * lengths[:, None])
+    counts = matches.sum(1)
+    if (counts == 0).all():
+        raise DiffcalcException(
+            'No peak matches the length of a reciprocal lattice vector')
+
+    # anchor pairs: peaks with few candidates, far from parallel
+    order = [i for i in np.argsort(counts) if counts[i]]
+    unit = q / lengths[:, None]
+    pairs = [(i, j) for i, j in combinations(order, 2)
+             if abs(unit[i].dot(unit[j])) < np.cos(10 * TORAD)]
+    if not pairs:
+        raise DiffcalcException('Need two peaks that are not parallel')
+
+    best_U, best_score = None, (-1, 0)
+    angle_tolerance *= TORAD
+    for i, j in pairs[:ANCHOR_PAIRS]:
+        ci, cj = vectors[matches[i]], vectors[matches[j]]
+        cos = (ci / np.linalg.norm(ci, axis=1)[:, None]).dot(
+            (cj / np.linalg.norm(cj, axis=1)[:, None]).T)
+        angles = np.arccos(np.clip(cos, -1, 1))
+        measured = np.arccos(np.clip(unit[i].dot(unit[j]), -1, 1))
+        ii, jj = np.nonzero(np.abs(angles - measured) < angle_tolerance)
+        if not len(ii):
+            continue
+        Tc = _triads(ci[ii], cj[jj])
+        Tp = _triads(q[i], q[j])
+        U = np.einsum('ij,skj->sik', Tp, Tc)
+        _, error = _fractional_error(np.einsum('sij,jk->sik', U, B), q)
+        indexed = error < tolerance
+        scores = indexed.sum(1)
+        # ties go to the candidate with the smallest total error
+        k = np.lexsort((np.where(indexed, error, tolerance).sum(1),
+                        -scores))[0]
+        score = (scores[k], -np.where(indexed[k], error[k], tolerance).sum())
+        if score > best_score:
+            best_U, best_score = U[k], score
+    if best_U is None:
+        raise DiffcalcException(
+            'No pair of lattice vectors matches the angle between two peaks')
+
+    hkl, error = _fractional_error(best_U.dot(B), q)
+    indexed = error < tolerance
+    U = _fit_rotation(np.round(hkl[indexed]).dot(B.T), q[indexed])
+    return U.dot(B), U, tuple(crystal.getLattice()[1:])
+
+
+def _difference_vectors(q, radius):
+    """Cluster the peaks and their pairwise differences, returning the
+    cluster centres and their sizes"""
+    i, j = np.triu_indices(len(q), 1)
+    vectors = np.vstack((q, q[i] - q[j]))
+    vectors = vectors[np.linalg.norm(vectors, axis=1) > 2 * radius]
+    # a direction unlikely to lie in a lattice plane, to pick one of +-v
+    direction = np.array([.5773, .4082, .7071])
+    vectors *= np.sign(vectors.dot(direction))[:, None]
+    _, inverse, counts = np.unique(np.round(vectors / radius), axis=0,
+                                   return_inverse=True, return_counts=True)
+    centres = np.column_stack([np.bincount(inverse, vectors[:, k]) / counts
+                               for k in range(3)])
+    return centres, counts
+
+
+def _reduce(A):
+    """Shorten the columns of a real space basis by adding or subtracting
+    the other two until none gets shorter"""
+    A = A.copy()
+    steps = [(m, n) for m in (-1, 0, 1) for n in (-1, 0, 1) if m or n]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(3):
+            j, k = [x for x in range(3) if x != i]
+            shortened = [A[:, i] + m * A[:, j] + n * A[:, k]
+                         for m, n in steps]
+            lengths = np.linalg.norm(shortened, axis=1)
+            if lengths.min() < np.linalg.norm(A[:, i]) * (1 - 1e-9):
+                A[:, i] = shortened[np.argmin(lengths)]
+                changed = True
+    A = A[:, np.argsort(np.linalg.norm(A, axis=0))]
+    if np.linalg.det(A) < 0:
+        A = -A
+    return A
+
+
+def _index_unknown_lattice(q, tolerance, length_tolerance):
+    lengths = np.linalg.norm(q, axis=1)
+    radius = length_tolerance * np.median(lengths)
+    centres, counts = _difference_vectors(q, radius)
+    # short vectors seen often, as differences between true peaks repeat
+    order = np.argsort(np.linalg.norm(centres, axis=1) / counts)
+    candidates = centres[order[:CANDIDATE_VECTORS]]
+    triples = np.array(list(combinations(range(len(candidates)), 3)))
+    if not len(triples):
+        raise DiffcalcException('Too few peaks to find a lattice')
+    bases = np.stack([candidates[triples[:, k]] for k in range(3)], -1)
+    norms = np.linalg.norm(bases, axis=1).prod(-1)
+    volumes = np.abs(np.linalg.det(bases))
+    bases = bases[volumes > MIN_SKEW * norms]
+    volumes = volumes[volumes > MIN_SKEW * norms]
+    if not len(bases):
+        raise DiffcalcException('The peaks do not span three dimensions')
+    _, error = _fractional_error(bases, q)
+    scores = (error < tolerance).sum(1)
+    # of the bases indexing the most peaks, prefer the largest, as smaller
+    # ones that index as many peaks can only come from stray vectors
+    k = np.lexsort((-volumes, -scores))[0]
+
+    hkl, error = _fractional_error(bases[k], q)
+    indexed = error < tolerance
+    UB = np.asarray(refine_ub(np.round(hkl[indexed]), q[indexed], LSTSQ).UB)
+    A = _reduce(2 * pi * np.linalg.inv(UB).T)
+    UB = 2 * pi * np.linalg.inv(A).T
+    hkl, error = _fractional_error(UB, q)
+    indexed = error < tolerance
+    UB = np.asarray(refine_ub(np.round(hkl[indexed]), q[indexed], LSTSQ).UB)
+    U, lattice = u_and_lattice_from_ub(UB)
+    return UB, U, lattice
+
+
+def index_peaks(q, crystal=None, tolerance=TOLERANCE,
+                length_tolerance=LENGTH_TOLERANCE,
+                angle_tolerance=ANGLE_TOLERANCE):
+    """Find a UB matrix indexing the peaks with scattering vectors q.
+
+    q is an (N, 3) array in the phi frame, including the factor 2 pi.
+    crystal is a CrystalUnderTest with the known lattice, or None to find
+    the lattice too. tolerance is the largest distance from integer hkl of
+    an indexed peak, length_tolerance the relative error allowed in |q| and
+    angle_tolerance that in degrees between two peaks. Returns an
+    IndexingResult.
+    """
+    q = np.asarray(q, dtype=float).reshape(-1, 3)
+    if len(q) < (2 if crystal is not None else 3):
+        raise DiffcalcException('Too few peaks to index')
+    if crystal is not None:
+        UB, U, lattice = _index_known_lattice(
+            q, crystal, tolerance, length_tolerance, angle_tolerance)
+    else:
+        UB, U, lattice = _index_unknown_lattice(q, tolerance,
+                                                length_tolerance)
+    hkl, error = _fractional_error(UB, q)
+    return IndexingResult(UB=np.matrix(UB), U=np.matrix(U),
+                          lattice=tuple(lattice), hkl=np.round(hkl) + 0.,
+                          indexed=error < tolerance,
+                          lattice_known=crystal is not None)
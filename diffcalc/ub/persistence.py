@@ -20,6 +20,9 @@ from __future__ import with_statement
 
 import os, glob
 import datetime
+import time
+from ast import literal_eval
+from contextlib import contextmanager
 
 try:
     import json
@@ -51,7 +54,59 @@ def check_directory_appropriate(directory):
         raise IOError("'%s' is not writable")
 
 
+INDEX_DIRECTORY = '.diffcalc'
+INDEX_VERSION = 2
+
+
+def _atomic_write(path, text):
+    """Replace the file at path with text so that readers see either the old
+    or the new contents, never a partial write"""
+    tmp = path + '.tmp%d' % os.getpid()
+    with open(tmp, 'w') as f:
+        f.write(text)
+    try:
+        os.rename(tmp, path)
+    except OSError:  # Windows will not rename over an existing file
+        os.remove(path)
+        os.rename(tmp, path)
+
+
+def _state_metadata(state):
+    """Return the crystal name and number of reflections of an encoded UB
+    calculation"""
+    try:
+        crystal = state.get('crystal')
+        crystal = crystal and str(literal_eval(crystal)[0])
+    except Exception:
+        crystal = None
+    try:
+        reflections = len(state.get('reflist') or {})
+    except Exception:
+        reflections = 0
+    return crystal, reflections
+
+
+def _metadata_line(mtime, crystal, reflections):
+    line = datetime.datetime.fromtimestamp(mtime).strftime('%d %b %Y (%H:%M)')
+    if crystal:
+        line += '  %-12s %3i reflections' % (crystal, reflections)
+    return line
+
+
 class UBCalculationJSONPersister(object):
+    """Saves each UB calculation to a json file in one directory.
+
+    The names, modification times, crystals and reflection counts of the
+    saved calculations are kept in an index (in a .diffcalc subdirectory so
+    that writing it does not touch the directory itself). The index is
+    updated on every save and remove, along with the directory modification
+    time that follows, and trusted while that is unchanged, so listing costs
+    one stat and one read. Calculations added or removed by other means
+    change the directory modification time and the index is then rebuilt,
+    reading only new or changed files. (A change made elsewhere within the
+    filesystem's timestamp resolution of a save is only noticed once the
+    directory next changes.)
+    """
 
     def __init__(self, directory, encoder):
         check_directory_appropriate(directory)
@@ -61,38 +116,245 @@ class UBCalculationJSONPersister(object):
         
     def filepath(self, name):
         return os.path.join(self.directory, name + '.json')
+
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_DIRECTORY, 'index.json')
         
     def save(self, state, name):
-        # FORMAT = '%Y-%m-%d %H:%M:%S'
-        # time_string = datetime.datetime.strftime(datetime.datetime.now(), FORMAT)
-        with open(self.filepath(name), 'w') as f:
-            json.dump(state, f, indent=4, cls=self.encoder)
+        text = json.dumps(state, indent=4, cls=self.encoder)
+        current, entries = self._read_index()
+        _atomic_write(self.filepath(name), text)
+        if current:
+            crystal, reflections = _state_metadata(json.loads(text))
+            entries[name] = {'mtime': os.path.getmtime(self.filepath(name)),
+                             'crystal': crystal,
+                             'reflections': reflections}
+        else:
+            entries = self._rebuild_index(entries)
+        self._write_index(entries)
 
     def load(self, name):
         with open(self.filepath(name), 'r') as f:
             return json.load(f)
 
     def list(self):  # @ReservedAssignment
-        files = self._get_save_files()
-        return [os.path.basename(f + '.json').split('.json')[0] for f in files]
-
-    def list_metadata(self):       
-        metadata = []
-        for f in self._get_save_files():            
-            dt = datetime.datetime.fromtimestamp(os.path.getmtime(f))
-            metadata.append(dt.strftime('%d %b %Y (%H:%M)'))
-        return metadata
-    
-    def _get_save_files(self):
-        files = filter(os.path.isfile, glob.glob(os.path.join(self.directory, '*.json')))
-        files.sort(key=lambda x: os.path.getmtime(x))
-        files.reverse()
-        return files
+        return [name for name, _ in self._sorted_entries()]
+
+    def list_metadata(self):
+        return [_metadata_line(entry['mtime'], entry['crystal'],
+                               entry['reflections'])
+                for _, entry in self._sorted_entries()]
+
+    def _sorted_entries(self):
+        entries = self._index().items()
+        entries.sort(key=lambda item: item[1]['mtime'], reverse=True)
+        return entries
+
+    def _index(self):
+        """Return the index entries, rebuilding them if the directory may have
+        changed since the index was written"""
+        current, entries = self._read_index()
+        if not current:
+            entries = self._rebuild_index(entries)
+            self._write_index(entries)
+        return entries
+
+    def _read_index(self):
+        """Return whether the directory is unchanged since the index was
+        written, and its entries"""
+        try:
+            with open(self._index_path(), 'r') as f:
+                index = json.load(f)
+            if index['version'] != INDEX_VERSION:
+                return False, {}
+            # json returns unicode names; list the str names saved
+            entries = dict((str(name), entry)
+                           for name, entry in index['entries'].items())
+            current = (index['directory_mtime'] ==
+                       os.path.getmtime(self.directory))
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                AttributeError):
+            return False, {}
+        return current, entries
+
+    def _rebuild_index(self, entries):
+        rebuilt = {}
+        for f in glob.glob(os.path.join(self.directory, '*.json')):
+            if not os.path.isfile(f):
+                continue
+            name = os.path.basename(f)[:-len('.json')]
+            mtime = os.path.getmtime(f)
+            entry = entries.get(name)
+            if entry is None or entry['mtime'] != mtime:
+                try:
+                    with open(f, 'r') as fp:
+                        crystal, reflections = _state_metadata(json.load(fp))
+                except (IOError, ValueError):
+                    crystal, reflections = None, 0
+                entry = {'mtime': mtime, 'crystal': crystal,
+                         'reflections': reflections}
+            rebuilt[name] = entry
+        return rebuilt
+
+    def _write_index(self, entries):
+        """Write the index along with the current directory modification
+        time"""
+        index_directory = os.path.dirname(self._index_path())
+        if not os.path.isdir(index_directory):
+            os.mkdir(index_directory)
+        index = {'version': INDEX_VERSION,
+                 'directory_mtime': os.path.getmtime(self.directory),
+                 'entries': entries}
+        _atomic_write(self._index_path(), json.dumps(index))
 
     def remove(self, name):
+        current, entries = self._read_index()
         os.remove(self.filepath(name))
+        if current:
+            entries.pop(name, None)
+        else:
+            entries = self._rebuild_index(entries)
+        self._write_index(entries)
 
 
+HISTORY_LENGTH = 100  # previous versions kept of each calculation
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS ubcalc (
+           name TEXT PRIMARY KEY,
+           mtime REAL NOT NULL,
+           crystal TEXT,
+           reflections INTEGER NOT NULL,
+           state TEXT NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS ubcalc_mtime ON ubcalc (mtime)",
+    """CREATE TABLE IF NOT EXISTS ubcalc_history (
+           version INTEGER PRIMARY KEY AUTOINCREMENT,
+           name TEXT NOT NULL,
+           mtime REAL NOT NULL,
+           crystal TEXT,
+           reflections INTEGER NOT NULL,
+           state TEXT NOT NULL)""",
+    """CREATE INDEX IF NOT EXISTS ubcalc_history_name
+           ON ubcalc_history (name, version)""")
+
+
+class UBCalculationSQLitePersister(object):
+    """Saves UB calculations in a single SQLite database file.
+
+    Each save or remove is one transaction, so a session killed part way
+    through leaves the previous state intact. The version replaced by each
+    save or remove is kept in a history table, up to HISTORY_LENGTH versions
+    for each name. The sqlite3 module is not available under Jython.
+    """
+
+    def __init__(self, path, encoder):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        check_directory_appropriate(os.path.dirname(os.path.abspath(path)))
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.description = path
+        self.encoder = encoder
+        with self._transaction() as connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+
+    def _connect(self):
+        # transactions are begun and ended explicitly
+        return self._sqlite3.connect(self.path, timeout=30,
+                                     isolation_level=None)
+
+    @contextmanager
+    def _transaction(self):
+        """Yield a connection in a transaction which is committed if the
+        block completes and rolled back otherwise"""
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def _execute(self, statement, parameters=()):
+        connection = self._connect()
+        try:
+            return connection.execute(statement, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def _keep_previous(self, connection, name):
+        connection.execute(
+            """INSERT INTO ubcalc_history
+                   (name, mtime, crystal, reflections, state)
+               SELECT name, mtime, crystal, reflections, state
+               FROM ubcalc WHERE name = ?""", (name,))
+        connection.execute(
+            """DELETE FROM ubcalc_history WHERE name = ? AND version NOT IN
+                   (SELECT version FROM ubcalc_history WHERE name = ?
+                    ORDER BY version DESC LIMIT ?)""",
+            (name, name, HISTORY_LENGTH))
+
+    def save(self, state, name):
+        text = json.dumps(state, indent=4, cls=self.encoder)
+        crystal, reflections = _state_metadata(json.loads(text))
+        with self._transaction() as connection:
+            previous = connection.execute(
+                "SELECT state FROM ubcalc WHERE name = ?", (name,)).fetchone()
+            if previous is not None and previous[0] != text:
+                self._keep_previous(connection, name)
+            connection.execute(
+                """INSERT OR REPLACE INTO ubcalc
+                       (name, mtime, crystal, reflections, state)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (name, time.time(), crystal, reflections, text))
+
+    def load(self, name, version=None):
+        """Load the current state of a calculation, or a previous version
+        from its history"""
+        if version is None:
+            rows = self._execute("SELECT state FROM ubcalc WHERE name = ?",
+                                 (name,))
+        else:
+            rows = self._execute(
+                """SELECT state FROM ubcalc_history
+                   WHERE name = ? AND version = ?""", (name, version))
+        if not rows:
+            raise IOError("No UB calculation '%s'%s in %s" % (
+                name, '' if version is None else ' version %s' % version,
+                self.path))
+        return json.loads(rows[0][0])
+
+    def list(self):  # @ReservedAssignment
+        return [str(name) for (name,) in self._execute(
+            "SELECT name FROM ubcalc ORDER BY mtime DESC, rowid DESC")]
+
+    def list_metadata(self):
+        return [_metadata_line(*row) for row in self._execute(
+            """SELECT mtime, crystal, reflections FROM ubcalc
+               ORDER BY mtime DESC, rowid DESC""")]
+
+    def history(self, name):
+        """Return the (version, metadata) of the previous versions of a
+        calculation, newest first"""
+        return [(version, _metadata_line(mtime, crystal, reflections))
+                for version, mtime, crystal, reflections in self._execute(
+                    """SELECT version, mtime, crystal, reflections
+                       FROM ubcalc_history WHERE name = ?
+                       ORDER BY version DESC""", (name,))]
+
+    def remove(self, name):
+        with self._transaction() as connection:
+            self._keep_previous(connection, name)
+            deleted = connection.execute(
+                "DELETE FROM ubcalc WHERE name = ?", (name,)).rowcount
+        if not deleted:
+            raise IOError("No UB calculation '%s' in %s" % (name, self.path))
+
 
 class UBCalculationPersister(object):
     """Attempts to the use the gda's database to store ub calculation state
@@ -21,6 +21,8 @@ try:
 except ImportError:
     from numjy.linalg import norm
 
+from diffcalc.util import ChangeNotifier
+
 
 class YouReference(object):
     
@@ -28,10 +30,12 @@ class YouReference(object):
         self.get_UB = get_UB  # callable
         self._n_phi_configured = None
         self._n_hkl_configured = None
+        self.notifier = ChangeNotifier()
     
     def _set_n_phi_configured(self, n_phi):
         self._n_phi_configured = n_phi
         self._n_hkl_configured = None
+        self.notifier.notify()
     
     def _get_n_phi_configured(self):
         return self._n_phi_configured
@@ -41,6 +45,7 @@ class YouReference(object):
     def _set_n_hkl_configured(self, n_hkl):
         self._n_phi_configured = None
         self._n_hkl_configured = n_hkl
+        self.notifier.notify()
         
     def _get_n_hkl_configured(self):
         return self._n_hkl_configured
@@ -0,0 +1,259 @@
+###
+# Copyright 2008-2019 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+"""Unconstrained UB refinement for large, possibly contaminated, sets of
+reflections.
+
+The scattering vector q of each reflection in the phi frame should equal UB
+times its hkl, which is linear in the nine elements of UB. The weighted
+least squares problem is solved by SVD (numpy.linalg.lstsq) rather than
+through the normal equations, and outlying reflections are rejected either by
+iteratively reweighted least squares with Tukey's biweight (IRLS) or by
+RANSAC. Every step is linear in the number of reflections.
+
+Alongside the refined UB, U and lattice the result holds each reflection's
+residual and the covariances of UB, of the lattice parameters and of small
+rotations of U, propagated from the scatter of the accepted reflections.
+
+This module requires numpy and is therefore not available under Jython.
+"""
+
+from math import pi
+from timeit import default_timer as _timer
+
+import numpy as np
+
+from diffcalc.util import DiffcalcException, TODEG
+
+LSTSQ = 'lstsq'
+IRLS = 'irls'
+RANSAC = 'ransac'
+METHODS = (LSTSQ, IRLS, RANSAC)
+
+TUKEY_C = 4.685  # in robust standard deviations
+MAX_IRLS_ITERATIONS = 50
+RANSAC_ITERATIONS = 200
+RANSAC_THRESHOLD = .01  # fraction of the median |q|
+CHI3_MEDIAN = 1.5382  # median length of a 3-D standard normal vector
+
+
+class UBRefinement(object):
+    """The result of refine_ub.
+
+      UB, U       -- the refined matrices (numpy.matrix)
+      lattice     -- (a, b, c, alpha, beta, gamma) in Angstroms and degrees
+      lattice_sigma -- their standard deviations
+      u_sigma     -- standard deviations in degrees of rotations of U about
+                     the phi frame x, y and z axes
+      covariance_ub, covariance_lattice, covariance_u -- the (9, 9), (6, 6)
+                     and (3, 3) covariance matrices; UB is flattened by rows
+      residuals   -- |q - UB hkl| for each reflection, in 1/Angstroms
+      weights     -- the final weight of each reflection, 0 for outliers
+      outliers    -- indices of the reflections with zero weight
+      rms         -- weighted rms residual of the accepted reflections
+      method, iterations, seconds -- how the result was obtained
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __str__(self):
+        lines = ['%s refinement of %d reflections, %d rejected as outliers '
+                 '(%d iterations, %.3f s)' % (
+                     self.method, len(self.residuals), len(self.outliers),
+                     self.iterations, self.seconds),
+                 '   rms residual: %.3g 1/A' % self.rms]
+        names = ('a', 'b', 'c', 'alpha', 'beta', 'gamma')
+        for name, value, sigma in zip(names, self.lattice, self.lattice_sigma):
+            lines.append('   %5s: %10.5f +/- %.5f' % (name, value, sigma))
+        lines.append('   U rotation sigma (x, y, z): %.4f %.4f %.4f deg' %
+                     tuple(self.u_sigma))
+        return '\n'.join(lines)
+
+
+def u_and_lattice_from_ub(UB):
+    """Return U, by Gram-Schmidt on the columns of UB, and the lattice
+    (a, b, c, alpha, beta, gamma) in Angstroms and degrees"""
+    UB = np.asarray(UB, dtype=float)
+    b1, b2, b3 = UB.T
+    e1 = b1 / np.linalg.norm(b1)
+    e2 = b2 - e1 * e1.dot(b2)
+    e2 /= np.linalg.norm(e2)
+    e3 = b3 - e1 * e1.dot(b3) - e2 * e2.dot(b3)
+    e3 /= np.linalg.norm(e3)
+    U = np.column_stack((e1, e2, e3))
+
+    volume = b1.dot(np.cross(b2, b3))
+    a1 = np.cross(b2, b3) * 2 * pi / volume
+    a2 = np.cross(b3, b1) * 2 * pi / volume
+    a3 = np.cross(b1, b2) * 2 * pi / volume
+    lengths = [np.linalg.norm(a) for a in (a1, a2, a3)]
+
+    def angle(u, v, lu, lv):
+        return np.arccos(np.clip(u.dot(v) / (lu * lv), -1, 1)) * TODEG
+
+    return U, (lengths[0], lengths[1], lengths[2],
+               angle(a2, a3, lengths[1], lengths[2]),
+               angle(a1, a3, lengths[0], lengths[2]),
+               angle(a1, a2, lengths[0], lengths[1]))
+
+
+def _weighted_lstsq(hkl, q, weights):
+    """Return UB and the inverse of hkl^T W hkl"""
+    root = np.sqrt(weights)[:, None]
+    A = hkl * root
+    solution, _, rank, _ = np.linalg.lstsq(A, q * root, rcond=None)
+    if rank < 3:
+        raise DiffcalcException(
+            'The hkl of the reflections used do not span three dimensions')
+    _, s, Vt = np.linalg.svd(A, full_matrices=False)
+    return solution.T, np.einsum('ji,j,jk->ik', Vt, 1. / s ** 2, Vt)
+
+
+def _residual_norms(hkl, q, UB):
+    return np.sqrt(((q - hkl.dot(UB.T)) ** 2).sum(1))
+
+
+def _robust_scale(residuals):
+    """Return the robust standard deviation of each component of the
+    residuals, from the median of their 3-D lengths"""
+    return np.median(residuals) / CHI3_MEDIAN
+
+
+def _irls(hkl, q, max_iterations):
+    weights = np.ones(len(hkl))
+    UB, _ = _weighted_lstsq(hkl, q, weights)
+    for iteration in range(1, max_iterations + 1):
+        residuals = _residual_norms(hkl, q, UB)
+        scale = _robust_scale(residuals[weights > 0])
+        if scale <= 0:
+            break
+        u = residuals / (TUKEY_C * scale)
+        new_weights = np.where(u < 1, (1 - u ** 2) ** 2, 0.)
+        UB, _ = _weighted_lstsq(hkl, q, new_weights)
+        converged = np.abs(new_weights - weights).max() < 1e-6
+        weights = new_weights
+        if converged:
+            break
+    else:
+        iteration = max_iterations
+    return weights, iteration
+
+
+def _ransac(hkl, q, iterations, threshold, seed):
+    rng = np.random.RandomState(seed)
+    size = len(hkl)
+    if threshold is None:
+        threshold = RANSAC_THRESHOLD * np.median(
+            np.sqrt((q ** 2).sum(1)))
+    best = None
+    for _ in range(iterations):
+        sample = rng.choice(size, 3, replace=False)
+        X = hkl[sample]
+        if abs(np.linalg.det(X)) < 1e-6 * np.abs(X).max() ** 3:
+            continue
+        UB = np.linalg.solve(X, q[sample]).T
+        inliers = _residual_norms(hkl, q, UB) < threshold
+        if best is None or inliers.sum() > best.sum():
+            best = inliers
+    if best is None or best.sum() < 3:
+        raise DiffcalcException(
+            'RANSAC found no consistent set of three reflections')
+    # refit to the consensus set and collect its inliers once more
+    UB, _ = _weighted_lstsq(hkl, q, best.astype(float))
+    inliers = _residual_norms(hkl, q, UB) < threshold
+    return inliers.astype(float), iterations
+
+
+def _numerical_jacobian(function, UB, step=1e-7):
+    UB = np.asarray(UB, dtype=float)
+    h = step * np.abs(UB).max()
+    columns = []
+    for i in range(9):
+        delta = np.zeros(9)
+        delta[i] = h
+        delta = delta.reshape(3, 3)
+        columns.append((np.asarray(function(UB + delta)) -
+                        np.asarray(function(UB - delta))) / (2 * h))
+    return np.column_stack(columns)
+
+
+def refine_ub(hkl, q, method=IRLS, threshold=None, max_iterations=None,
+              seed=0):
+    """Refine UB so that UB * hkl matches q for many reflections.
+
+    hkl is an (N, 3) array of Miller indices and q an (N, 3) array of the
+    measured scattering vectors in the phi frame, in 1/Angstroms (including
+    the factor 2 pi). method is LSTSQ (plain least squares), IRLS or RANSAC.
+    threshold is the residual above which RANSAC rejects a reflection
+    (default: 1% of the median |q|); max_iterations bounds the IRLS
+    iterations (default: MAX_IRLS_ITERATIONS) and is the number of RANSAC
+    samples (default: RANSAC_ITERATIONS). Returns a UBRefinement.
+    """
+    start = _timer()
+    hkl = np.asarray(hkl, dtype=float).reshape(-1, 3)
+    q = np.asarray(q, dtype=float).reshape(-1, 3)
+    if len(hkl) != len(q):
+        raise DiffcalcException('Need one scattering vector per reflection')
+    if len(hkl) < 3:
+        raise DiffcalcException(
+            'Need at least 3 reference reflections to fit UB matrix.')
+
+    if method == LSTSQ:
+        weights, iterations = np.ones(len(hkl)), 1
+    elif method == IRLS:
+        if max_iterations is None:
+            max_iterations = MAX_IRLS_ITERATIONS
+        weights, iterations = _irls(hkl, q, max_iterations)
+    elif method == RANSAC:
+        if max_iterations is None:
+            max_iterations = RANSAC_ITERATIONS
+        weights, iterations = _ransac(hkl, q, max_iterations, threshold, seed)
+    else:
+        raise DiffcalcException('The refinement method must be one of %s' %
+                                ', '.join(METHODS))
+
+    UB, inverse = _weighted_lstsq(hkl, q, weights)
+    residual_vectors = q - hkl.dot(UB.T)
+    residuals = np.sqrt((residual_vectors ** 2).sum(1))
+    accepted = weights > 0
+    dof = 3 * accepted.sum() - 9
+    chi2 = (weights * residuals ** 2).sum()
+    variance = chi2 / dof if dof > 0 else 0.
+    covariance_ub = np.kron(np.eye(3), variance * inverse)
+
+    U, lattice = u_and_lattice_from_ub(UB)
+    J = _numerical_jacobian(lambda m: u_and_lattice_from_ub(m)[1], UB)
+    covariance_lattice = J.dot(covariance_ub).dot(J.T)
+
+    def rotation(m):
+        # small rotation from U to the U of m, as (x, y, z) angles in degrees
+        R = u_and_lattice_from_ub(m)[0].dot(U.T)
+        return np.array((R[2, 1] - R[1, 2], R[0, 2] - R[2, 0],
+                         R[1, 0] - R[0, 1])) / 2 * TODEG
+    J = _numerical_jacobian(rotation, UB)
+    covariance_u = J.dot(covariance_ub).dot(J.T)
+
+    return UBRefinement(
+        UB=np.matrix(UB), U=np.matrix(U), lattice=lattice,
+        lattice_sigma=tuple(np.sqrt(np.diag(covariance_lattice))),
+        u_sigma=tuple(np.sqrt(np.diag(covariance_u))),
+        covariance_ub=covariance_ub, covariance_lattice=covariance_lattice,
+        covariance_u=covariance_u, residuals=residuals, weights=weights,
+        outliers=np.nonzero(~accepted)[0],
+        rms=np.sqrt(chi2 / weights.sum()), method=method,
+        iterations=iterations, seconds=_timer() - start)
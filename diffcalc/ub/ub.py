@@ -42,7 +42,7 @@ TODEG = 180 / pi
 __all__ = ['addorient', 'addref', 'c2th', 'hklangle', 'calcub', 'delorient', 'delref', 'editorient',
            'editref', 'listub', 'loadub', 'newub', 'orientub', 'saveubas', 'setlat',
            'addmiscut', 'setmiscut', 'setu', 'setub', 'showorient', 'showref', 'swaporient',
-           'swapref', 'trialub', 'fitub', 'checkub', 'ub', 'ubcalc', 'rmub', 'clearorient',
+           'swapref', 'trialub', 'fitub', 'fitubrobust', 'autoindex', 'checkub', 'ub', 'ubcalc', 'rmub', 'clearorient',
            'clearref', 'lastub', 'refineub', 'surfnphi', 'surfnhkl']
 
 if settings.include_sigtau:
@@ -810,6 +810,66 @@ def fitub(*args):
     if reply in ('y', 'Y', 'yes'):
         ubcalc.set_U_manually(new_umatrix, False)
 
+@command
+def fitubrobust(*args):
+    """fitubrobust {'irls'|'ransac'|'lstsq'} {ref1, ref2, ref3...} -- fit UB matrix to many reference reflections (default all), rejecting outliers (default irls)"""
+    args = list(args)
+    method = 'irls'
+    if args and args[0] in ('irls', 'ransac', 'lstsq'):
+        method = args.pop(0)
+    result = ubcalc.refine_ub_matrix(method, *args)
+    print str(result)
+    if len(result.outliers):
+        print "   outliers: " + ' '.join(
+            str(args[i] if args else i + 1) for i in result.outliers)
+    print
+    _system = ubcalc._state.crystal._system
+    new_lattice = (ubcalc._state.crystal.getLattice()[0],) + tuple(result.lattice)
+    reply = promptForInput('Update crystal settings?', 'y')
+    if reply in ('y', 'Y', 'yes'):
+        ubcalc.set_lattice(new_lattice[0], _system, *new_lattice[1:])
+
+    lines = ubcalc.str_lines_u(result.U) + ubcalc.str_lines_ub_angle_and_axis(result.UB)
+    print '\n' + '\n'.join(lines)
+    reply = promptForInput('Update U matrix?', 'y')
+    if reply in ('y', 'Y', 'yes'):
+        ubcalc.set_U_manually(result.U, False)
+
+@command
+def autoindex(*args):
+    """autoindex {ref1, ref2, ref3...} -- find UB matrix indexing reference reflections (default all) ignoring their hkl, and the lattice too if none is set"""
+    refs = list(args) or range(1, ubcalc.get_number_reflections() + 1)
+    result = ubcalc.autoindex(*refs)
+    print str(result)
+    lines = ['', '        OLD HKL             NEW HKL']
+    for idx, hkl, indexed in zip(refs, result.hkl, result.indexed):
+        old_hkl = ubcalc.get_reflection(idx)[0]
+        lines.append('%4s  %5.2f %5.2f %5.2f   ' % ((idx,) + tuple(old_hkl)) +
+                     ('%5d %5d %5d' % tuple(hkl) if indexed else '  not indexed'))
+    print '\n'.join(lines)
+    print
+
+    if not result.lattice_known:
+        reply = promptForInput('Update crystal settings?', 'y')
+        if reply not in ('y', 'Y', 'yes'):
+            print 'The reflections cannot be indexed without the new lattice.'
+            return
+        name = promptForInput('crystal name', 'xtal')
+        ubcalc.set_lattice(str(name), *result.lattice)
+    reply = promptForInput('Update reflection hkl?', 'y')
+    if reply in ('y', 'Y', 'yes'):
+        for idx, hkl, indexed in zip(refs, result.hkl, result.indexed):
+            if indexed:
+                _, pos, energy, tag, t = ubcalc.get_reflection(idx)
+                h, k, l = [int(x) for x in hkl]
+                ubcalc.edit_reflection(idx, h, k, l, pos, energy, tag, t)
+
+    lines = ubcalc.str_lines_u(result.U) + ubcalc.str_lines_ub_angle_and_axis(result.UB)
+    print '\n' + '\n'.join(lines)
+    reply = promptForInput('Update U matrix?', 'y')
+    if reply in ('y', 'Y', 'yes'):
+        ubcalc.set_U_manually(result.U, False)
+
 @command
 def addmiscut(*args):
     """addmiscut angle {[x y z]} -- apply miscut to U matrix using a specified miscut angle in degrees and a rotation axis"""
@@ -889,6 +949,8 @@ commands_for_help.extend([
                      swaporient,
                      'UB matrix',
                      fitub,
+                     fitubrobust,
+                     autoindex,
                      checkub,
                      setu,
                      setub,
@@ -19,8 +19,11 @@
 import os
 from math import pi, acos, cos, sin, sqrt
 from functools import wraps
+from collections import OrderedDict
 import textwrap
 
+from diffcalc import mat3
+
 GDA = os.name == 'java'
 
 try:
@@ -159,29 +162,131 @@ class AbstractPosition(object):
         raise NotImplementedError()
 
 
+class ChangeNotifier(object):
+    """Version counter and listener list for an object with mutable state.
+
+    The owner calls notify() whenever its state changes. Consumers may either
+    compare the version number with one recorded earlier or register a
+    listener to be called after every change.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._listeners = []
+
+    def add_listener(self, listener):
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def forward_to(self, other):
+        """Notify other's listeners too whenever this changes"""
+        self.add_listener(other.notify)
+
+    def notify(self):
+        self.version += 1
+        for listener in list(self._listeners):
+            listener()
+
+    # Listeners belong to the running session, so are not persisted with
+    # their owner
+
+    def __getstate__(self):
+        return {'version': self.version}
+
+    def __setstate__(self, state):
+        self.version = state['version']
+        self._listeners = []
+
+
+def version_key(*objects):
+    """Return a key that changes whenever any of objects notifies a change,
+    or None if any of them does not publish a ChangeNotifier as notifier"""
+    versions = []
+    for obj in objects:
+        notifier = getattr(obj, 'notifier', None)
+        if not isinstance(notifier, ChangeNotifier):
+            return None
+        versions.append((notifier, notifier.version))
+    return tuple(versions)
+
+
+class LRUCache(object):
+    """Bounded mapping which discards the least recently used entry first.
+
+    A maxsize of 0 disables the cache.
+    """
+
+    def __init__(self, maxsize=128):
+        self._entries = OrderedDict()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self._entries) > max(maxsize, 0):
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        rate = (100. * self.hits / lookups) if lookups else 0.
+        return ('%d/%d entries, %d hits, %d misses (%.1f%% hit rate)' %
+                (len(self._entries), self.maxsize, self.hits, self.misses,
+                 rate))
+
+
 ### Matrices
 
 def cross3(x, y):
     """z = cross3(x ,y) -- where x, y & z are 3*1 Jama matrices"""
-    [[x1], [x2], [x3]] = x.tolist()
-    [[y1], [y2], [y3]] = y.tolist()
-    return matrix([[x2 * y3 - x3 * y2],
-                   [x3 * y1 - x1 * y3],
-                   [x1 * y2 - x2 * y1]])
+    return mat3.to_column(mat3.cross(mat3.from_matrix(x), mat3.from_matrix(y)))
 
 
 def dot3(x, y):
     """z = dot3(x ,y) -- where x, y are 3*1 Jama matrices"""
-    return x[0, 0] * y[0, 0] + x[1, 0] * y[1, 0] + x[2, 0] * y[2, 0]
+    return mat3.dot(mat3.from_matrix(x), mat3.from_matrix(y))
 
 
 def norm3(x):
     """z = norm3(x) -- where x is 3*1 Jama matrix"""
-    return norm(x)
+    return mat3.norm(mat3.from_matrix(x))
 
 
 def angle_between_vectors(a, b):
-    costheta = dot3(a * (1 / norm(a)), b * (1 / norm(b)))
+    a, b = mat3.from_matrix(a), mat3.from_matrix(b)
+    costheta = mat3.dot(mat3.normalised(a), mat3.normalised(b))
     return acos(bound(costheta))
 
 
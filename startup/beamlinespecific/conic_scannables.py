@@ -47,7 +47,7 @@ def __polar_to_hkl(params):
     nphi = _dc._ub.ubcalc.n_phi
     inplane_vec = cross3(ref_nphi, nphi)
     inplane_vec *= sqrt(1 - sc ** 2) * norm3(hkl_nphi) / norm3(inplane_vec)
-    ref_nhkl = _dc._ub.ubcalc._UB.I * ref_nphi
+    ref_nhkl = _dc._ub.ubcalc.UB_inv * ref_nphi
     h_ref, k_ref, l_ref = ref_nhkl.T.tolist()[0]  
     h_res, k_res, l_res = _dc._ub.ubcalc.calc_hkl_offset(h_ref, k_ref, l_ref, acos(sc), az)
     return h_res, k_res, l_res